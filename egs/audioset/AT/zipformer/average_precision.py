@@ -0,0 +1,304 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Average precision (AP) of audio tagging, computed from the outputs of
+several evaluation processes.
+
+There are two ways to compute it:
+
+  - Exact: each process writes the probabilities and the labels of its
+    shard of the cuts to memory-mapped files with :class:`ScoreWriter`.
+    :func:`compute_average_precision_from_shards` then computes the AP of
+    a block of classes at a time from all shards, so only the scores of
+    the classes of one block are in memory. The result is the same as
+    `sklearn.metrics.average_precision_score`.
+  - Approximate: each process accumulates histograms of the probabilities
+    of the positive and negative examples of each class with
+    :class:`HistogramAveragePrecision`. The histograms of all processes are
+    summed, and the AP is computed as if all probabilities in a bin were
+    equal. The memory usage does not depend on the number of cuts.
+"""
+
+import json
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+import torch
+
+
+def average_precision(scores: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """Compute the AP of each class, in the same way as
+    `sklearn.metrics.average_precision_score`, i.e.,
+
+        AP = sum_n (R_n - R_{n-1}) P_n
+
+    where P_n and R_n are the precision and the recall at the n-th
+    threshold, and the thresholds are the distinct scores.
+
+    Args:
+      scores:
+        A 2-D array of shape (num_cuts, num_classes).
+      labels:
+        A 2-D array of shape (num_cuts, num_classes). Non-zero entries are
+        positive examples.
+    Returns:
+      Return a 1-D float64 array of shape (num_classes,). As with sklearn,
+      the AP of a class without positive examples is 0.
+    """
+    assert scores.shape == labels.shape, (scores.shape, labels.shape)
+    num_cuts, num_classes = scores.shape
+    if num_cuts == 0:
+        return np.zeros(num_classes)
+
+    # Sort the scores of each class in descending order
+    order = np.argsort(-scores, axis=0, kind="stable")
+    sorted_scores = np.take_along_axis(scores, order, axis=0)
+    sorted_labels = np.take_along_axis(labels != 0, order, axis=0)
+
+    tp = np.cumsum(sorted_labels, axis=0)
+
+    # Examples with equal scores share a threshold, i.e., the index
+    # of the last example with the same score
+    rows = np.arange(num_cuts)
+    is_last = np.ones((num_cuts, num_classes), dtype=bool)
+    is_last[:-1] = sorted_scores[:-1] != sorted_scores[1:]
+    last = np.where(is_last, rows[:, None], num_cuts)
+    last = np.minimum.accumulate(last[::-1], axis=0)[::-1]
+
+    # The precision at the threshold of each example
+    precision = np.take_along_axis(tp, last, axis=0) / (last + 1)
+
+    # Each positive example increases the recall by 1 / num_positives
+    num_positives = tp[-1]
+    ans = (precision * sorted_labels).sum(axis=0)
+    return np.divide(
+        ans, num_positives, out=np.zeros(num_classes), where=num_positives > 0
+    )
+
+
+class ScoreWriter(object):
+    """Write the scores and the labels of the cuts of one evaluation process
+    to a directory, which is read by
+    :func:`compute_average_precision_from_shards`.
+
+    The scores are saved as float16 and the labels as uint8 in flat binary
+    files, which are appended to batch by batch.
+    """
+
+    def __init__(
+        self,
+        out_dir: Union[str, Path],
+        shard: int,
+        num_classes: int,
+    ):
+        """
+        Args:
+          out_dir:
+            The directory to save the files of all shards.
+          shard:
+            The index of this shard, e.g., the rank of the process.
+          num_classes:
+            Number of classes.
+        """
+        self.out_dir = Path(out_dir)
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.shard = shard
+        self.num_classes = num_classes
+        self.num_cuts = 0
+
+        self.scores = open(self.out_dir / f"scores.{shard}.f16", "wb")
+        self.labels = open(self.out_dir / f"labels.{shard}.u8", "wb")
+        self.cut_ids = open(self.out_dir / f"cut_ids.{shard}.txt", "w")
+
+    def write(
+        self, cut_ids: List[str], scores: torch.Tensor, labels: torch.Tensor
+    ) -> None:
+        """
+        Args:
+          cut_ids:
+            The IDs of the cuts of a batch.
+          scores:
+            The probabilities of the batch, of shape (N, num_classes).
+          labels:
+            The multi-hot labels of the batch, of shape (N, num_classes).
+        """
+        assert scores.shape == (len(cut_ids), self.num_classes), scores.shape
+        assert labels.shape == scores.shape, (labels.shape, scores.shape)
+        self.scores.write(scores.cpu().numpy().astype(np.float16).tobytes())
+        self.labels.write(labels.cpu().numpy().astype(np.uint8).tobytes())
+        for cut_id in cut_ids:
+            self.cut_ids.write(f"{cut_id}\n")
+        self.num_cuts += len(cut_ids)
+
+    def close(self) -> None:
+        self.scores.close()
+        self.labels.close()
+        self.cut_ids.close()
+        # Written last, so that the reducer can check that all shards
+        # are complete
+        with open(self.out_dir / f"shard.{self.shard}.json", "w") as f:
+            json.dump({"num_cuts": self.num_cuts, "num_classes": self.num_classes}, f)
+
+    def __enter__(self) -> "ScoreWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def compute_average_precision_from_shards(
+    out_dir: Union[str, Path],
+    num_shards: int,
+    block_size: int = 64,
+) -> np.ndarray:
+    """Compute the exact AP of each class from the files written by
+    :class:`ScoreWriter`.
+
+    Args:
+      out_dir:
+        The directory containing the files of all shards.
+      num_shards:
+        Number of shards.
+      block_size:
+        Number of classes processed at a time. The memory usage is
+        proportional to it.
+    Returns:
+      Return a 1-D float64 array of shape (num_classes,).
+    """
+    out_dir = Path(out_dir)
+    scores = []
+    labels = []
+    num_classes = None
+    for shard in range(num_shards):
+        with open(out_dir / f"shard.{shard}.json") as f:
+            info = json.load(f)
+        if num_classes is None:
+            num_classes = info["num_classes"]
+        assert info["num_classes"] == num_classes, (info, num_classes)
+
+        if info["num_cuts"] == 0:
+            continue
+        shape = (info["num_cuts"], num_classes)
+        scores.append(
+            np.memmap(
+                out_dir / f"scores.{shard}.f16", dtype=np.float16, mode="r", shape=shape
+            )
+        )
+        labels.append(
+            np.memmap(
+                out_dir / f"labels.{shard}.u8", dtype=np.uint8, mode="r", shape=shape
+            )
+        )
+
+    ans = np.zeros(num_classes)
+    if not scores:
+        return ans
+
+    for start in range(0, num_classes, block_size):
+        end = min(start + block_size, num_classes)
+        block_scores = np.concatenate([s[:, start:end] for s in scores])
+        block_labels = np.concatenate([s[:, start:end] for s in labels])
+        ans[start:end] = average_precision(block_scores, block_labels)
+    return ans
+
+
+class HistogramAveragePrecision(object):
+    """Approximate AP computed from histograms of the scores, which are
+    assumed to be probabilities in [0, 1].
+
+    Usage::
+
+        ap = HistogramAveragePrecision(num_classes=527)
+        for batch in ...:
+            ap.update(scores, labels)
+        # In DDP, sum ap.positives and ap.negatives over all processes
+        mAP = ap.compute().mean()
+    """
+
+    def __init__(self, num_classes: int, num_bins: int = 10000):
+        """
+        Args:
+          num_classes:
+            Number of classes.
+          num_bins:
+            Number of bins of [0, 1]. The error of the AP is smaller with
+            more bins.
+        """
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.positives = np.zeros((num_classes, num_bins), dtype=np.int64)
+        self.negatives = np.zeros((num_classes, num_bins), dtype=np.int64)
+
+    def update(self, scores: torch.Tensor, labels: torch.Tensor) -> None:
+        """
+        Args:
+          scores:
+            The probabilities of a batch, of shape (N, num_classes).
+          labels:
+            The multi-hot labels of the batch, of shape (N, num_classes).
+        """
+        scores = scores.detach().cpu().float().numpy()
+        labels = labels.detach().cpu().numpy() != 0
+        assert scores.shape == labels.shape, (scores.shape, labels.shape)
+        assert scores.shape[1] == self.num_classes, scores.shape
+
+        bins = np.clip((scores * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+        # Index of each (class, bin) in the flattened histograms
+        bins += np.arange(self.num_classes) * self.num_bins
+        size = self.num_classes * self.num_bins
+        self.positives += np.bincount(bins[labels], minlength=size).reshape(
+            self.num_classes, self.num_bins
+        )
+        self.negatives += np.bincount(bins[~labels], minlength=size).reshape(
+            self.num_classes, self.num_bins
+        )
+
+    def merge(self, other: "HistogramAveragePrecision") -> None:
+        """Add the histograms of another instance, e.g., of another process."""
+        assert self.positives.shape == other.positives.shape
+        self.positives += other.positives
+        self.negatives += other.negatives
+
+    def compute(self) -> np.ndarray:
+        """Return the approximate AP of each class, as a 1-D float64 array of
+        shape (num_classes,). The AP of a class without positive examples
+        is 0."""
+        # From the highest bin to the lowest one
+        tp = np.cumsum(self.positives[:, ::-1], axis=1)
+        fp = np.cumsum(self.negatives[:, ::-1], axis=1)
+        precision = np.divide(tp, tp + fp, out=np.zeros(tp.shape), where=(tp + fp) > 0)
+        num_positives = tp[:, -1]
+        ans = (precision * self.positives[:, ::-1]).sum(axis=1)
+        return np.divide(
+            ans,
+            num_positives,
+            out=np.zeros(self.num_classes),
+            where=num_positives > 0,
+        )
+
+    def save(self, filename: Union[str, Path]) -> None:
+        np.savez(filename, positives=self.positives, negatives=self.negatives)
+
+    @staticmethod
+    def load(filename: Union[str, Path]) -> "HistogramAveragePrecision":
+        data = np.load(filename)
+        num_classes, num_bins = data["positives"].shape
+        ans = HistogramAveragePrecision(num_classes, num_bins)
+        ans.positives += data["positives"]
+        ans.negatives += data["negatives"]
+        return ans
@@ -25,22 +25,37 @@ export CUDA_VISIBLE_DEVICES="0"
   --exp-dir zipformer/exp \
   --max-duration 1000
 
+To evaluate the shards of the eval set in 4 processes, each using one GPU:
 
+export CUDA_VISIBLE_DEVICES="0,1,2,3"
+
+./zipformer/evaluate.py \
+  --epoch 50 \
+  --avg 10 \
+  --exp-dir zipformer/exp \
+  --max-duration 1000 \
+  --world-size 4
+
+With --ap-mode histogram, the mAP is approximated from histograms of the
+probabilities, so that the memory usage does not grow with the size of the
+eval set. See ./zipformer/average_precision.py for details.
 """
 
 import argparse
 import logging
 from pathlib import Path
-from typing import Dict
+from typing import Optional
 
+import numpy as np
 import torch
+import torch.multiprocessing as mp
 import torch.nn as nn
 from at_datamodule import AudioSetATDatamodule
-
-try:
-    from sklearn.metrics import average_precision_score
-except:
-    raise ImportError(f"Please run\n" "pip3 install -U scikit-learn")
+from average_precision import (
+    HistogramAveragePrecision,
+    ScoreWriter,
+    compute_average_precision_from_shards,
+)
 from train import add_model_arguments, get_model, get_params, str2multihot
 
 from icefall.checkpoint import (
@@ -103,6 +118,32 @@ def get_parser():
         help="The experiment dir",
     )
 
+    parser.add_argument(
+        "--world-size",
+        type=int,
+        default=1,
+        help="""Number of processes. Each process evaluates a shard of the
+        eval set, using one GPU if available.""",
+    )
+
+    parser.add_argument(
+        "--ap-mode",
+        type=str,
+        default="exact",
+        choices=["exact", "histogram"],
+        help="""exact: save the probabilities of each shard to
+        memory-mapped files and compute the exact AP from them.
+        histogram: approximate the AP from histograms of the probabilities
+        accumulated in each process.""",
+    )
+
+    parser.add_argument(
+        "--num-histogram-bins",
+        type=int,
+        default=10000,
+        help="Number of histogram bins of [0, 1] for --ap-mode histogram.",
+    )
+
     add_model_arguments(parser)
 
     return parser
@@ -123,7 +164,7 @@ def inference_one_batch(
     supervisions = batch["supervisions"]
     audio_event = supervisions["audio_event"]
 
-    label, _ = str2multihot(audio_event)
+    label, _ = str2multihot(audio_event, n_classes=params.num_events)
     label = label.detach().cpu()
 
     feature_lens = supervisions["num_frames"].to(device)
@@ -141,7 +182,15 @@ def decode_dataset(
     dl: torch.utils.data.DataLoader,
     params: AttributeDict,
     model: nn.Module,
-) -> Dict:
+    score_writer: Optional[ScoreWriter] = None,
+    histogram: Optional[HistogramAveragePrecision] = None,
+) -> int:
+    """Compute the probabilities of the cuts in the dataloader and pass them
+    to `score_writer` and/or `histogram`.
+
+    Returns:
+      Return the number of cuts.
+    """
     num_cuts = 0
 
     try:
@@ -149,9 +198,6 @@ def decode_dataset(
     except TypeError:
         num_batches = "?"
 
-    all_logits = []
-    all_labels = []
-
     for batch_idx, batch in enumerate(dl):
         cut_ids = [cut.id for cut in batch["supervisions"]["cut"]]
         num_cuts += len(cut_ids)
@@ -162,47 +208,21 @@ def decode_dataset(
             batch=batch,
         )
 
-        all_logits.append(audio_logits)
-        all_labels.append(labels)
+        if score_writer is not None:
+            score_writer.write(cut_ids, audio_logits, labels)
+        if histogram is not None:
+            histogram.update(audio_logits, labels)
 
         if batch_idx % 20 == 1:
-            logging.info(f"Processed {num_cuts} cuts already.")
+            logging.info(
+                f"batch {batch_idx}/{num_batches}, processed {num_cuts} cuts already."
+            )
     logging.info("Finish collecting audio logits")
 
-    return all_logits, all_labels
-
-
-@torch.no_grad()
-def main():
-    parser = get_parser()
-    AudioSetATDatamodule.add_arguments(parser)
-    args = parser.parse_args()
-    args.exp_dir = Path(args.exp_dir)
-
-    params = get_params()
-    params.update(vars(args))
-
-    params.res_dir = params.exp_dir / "inference_audio_tagging"
-
-    if params.iter > 0:
-        params.suffix = f"iter-{params.iter}-avg-{params.avg}"
-    else:
-        params.suffix = f"epoch-{params.epoch}-avg-{params.avg}"
-
-    if params.use_averaged_model:
-        params.suffix += "-use-averaged-model"
-
-    setup_logger(f"{params.res_dir}/log-decode-{params.suffix}")
-    logging.info("Evaluation started")
-
-    logging.info(params)
-
-    device = torch.device("cpu")
-    if torch.cuda.is_available():
-        device = torch.device("cuda", 0)
+    return num_cuts
 
-    logging.info("About to create model")
 
+def load_model(params: AttributeDict, device: torch.device) -> nn.Module:
     model = get_model(params)
 
     if not params.use_averaged_model:
@@ -291,6 +311,59 @@ def main():
     model.to(device)
     model.eval()
 
+    return model
+
+
+def get_eval_params(args: argparse.Namespace) -> AttributeDict:
+    params = get_params()
+    params.update(vars(args))
+
+    params.res_dir = params.exp_dir / "inference_audio_tagging"
+
+    if params.iter > 0:
+        params.suffix = f"iter-{params.iter}-avg-{params.avg}"
+    else:
+        params.suffix = f"epoch-{params.epoch}-avg-{params.avg}"
+
+    if params.use_averaged_model:
+        params.suffix += "-use-averaged-model"
+
+    # The outputs of all processes, which are reduced by main()
+    params.scores_dir = params.res_dir / f"scores-{params.suffix}"
+
+    return params
+
+
+@torch.no_grad()
+def run(rank: int, world_size: int, args: argparse.Namespace):
+    """Evaluate the rank-th shard of the eval set.
+
+    Args:
+      rank:
+        It is a value between 0 and `world_size-1`, which is
+        passed automatically by `mp.spawn()` in :func:`main`.
+      world_size:
+        Number of processes.
+      args:
+        The return value of get_parser().parse_args()
+    """
+    params = get_eval_params(args)
+
+    log_filename = f"{params.res_dir}/log-decode-{params.suffix}"
+    if world_size > 1:
+        log_filename += f"-{rank}"
+    setup_logger(log_filename)
+    logging.info(f"Evaluation started, shard {rank}/{world_size}")
+
+    logging.info(params)
+
+    device = torch.device("cpu")
+    if torch.cuda.is_available():
+        device = torch.device("cuda", rank)
+
+    logging.info("About to create model")
+    model = load_model(params, device)
+
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
 
@@ -298,26 +371,72 @@ def main():
     audioset = AudioSetATDatamodule(args)
 
     audioset_cuts = audioset.audioset_eval_cuts()
+    if world_size > 1:
+        audioset_cuts = audioset_cuts.to_eager().split(world_size)[rank]
 
     audioset_dl = audioset.valid_dataloaders(audioset_cuts)
 
-    test_sets = ["audioset_eval"]
+    if params.ap_mode == "exact":
+        with ScoreWriter(params.scores_dir, rank, params.num_events) as writer:
+            num_cuts = decode_dataset(
+                dl=audioset_dl,
+                params=params,
+                model=model,
+                score_writer=writer,
+            )
+    else:
+        histogram = HistogramAveragePrecision(
+            params.num_events, params.num_histogram_bins
+        )
+        num_cuts = decode_dataset(
+            dl=audioset_dl,
+            params=params,
+            model=model,
+            histogram=histogram,
+        )
+        params.scores_dir.mkdir(parents=True, exist_ok=True)
+        histogram.save(params.scores_dir / f"histogram.{rank}.npz")
 
-    logits, labels = decode_dataset(
-        dl=audioset_dl,
-        params=params,
-        model=model,
-    )
+    logging.info(f"Shard {rank}: {num_cuts} cuts")
 
-    logits = torch.cat(logits, dim=0).squeeze(dim=1).detach().numpy()
-    labels = torch.cat(labels, dim=0).long().detach().numpy()
 
-    # compute the metric
-    mAP = average_precision_score(
-        y_true=labels,
-        y_score=logits,
-    )
+def main():
+    parser = get_parser()
+    AudioSetATDatamodule.add_arguments(parser)
+    args = parser.parse_args()
+    args.exp_dir = Path(args.exp_dir)
+
+    world_size = args.world_size
+    assert world_size >= 1
+    if world_size > 1:
+        mp.spawn(run, args=(world_size, args), nprocs=world_size, join=True)
+    else:
+        run(rank=0, world_size=1, args=args)
+
+    # Reduce the outputs of all processes
+    params = get_eval_params(args)
+    if world_size > 1:
+        setup_logger(f"{params.res_dir}/log-decode-{params.suffix}")
+
+    if params.ap_mode == "exact":
+        ap = compute_average_precision_from_shards(params.scores_dir, world_size)
+    else:
+        histogram = HistogramAveragePrecision.load(
+            params.scores_dir / "histogram.0.npz"
+        )
+        for rank in range(1, world_size):
+            histogram.merge(
+                HistogramAveragePrecision.load(
+                    params.scores_dir / f"histogram.{rank}.npz"
+                )
+            )
+        ap = histogram.compute()
+
+    ap_filename = params.res_dir / f"ap-{params.suffix}.txt"
+    np.savetxt(ap_filename, ap, fmt="%.6f")
+    logging.info(f"The AP of each class is saved to {ap_filename}")
 
+    mAP = ap.mean()
     logging.info(f"mAP for audioset eval is: {mAP}")
 
     logging.info("Done")
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+To run this file, do:
+
+    cd icefall/egs/audioset/AT
+    python ./zipformer/test_average_precision.py
+"""
+
+import tempfile
+
+import numpy as np
+import torch
+from average_precision import (
+    HistogramAveragePrecision,
+    ScoreWriter,
+    average_precision,
+    compute_average_precision_from_shards,
+)
+
+
+def reference_average_precision(scores: np.ndarray, labels: np.ndarray) -> float:
+    # The definition used by sklearn.metrics.average_precision_score
+    num_positives = labels.sum()
+    if num_positives == 0:
+        return 0.0
+    ans = 0.0
+    prev_recall = 0.0
+    for threshold in np.unique(scores)[::-1]:
+        predicted = scores >= threshold
+        tp = (predicted & labels).sum()
+        recall = tp / num_positives
+        ans += (recall - prev_recall) * tp / predicted.sum()
+        prev_recall = recall
+    return ans
+
+
+def get_data(num_cuts: int = 500, num_classes: int = 20):
+    rng = np.random.default_rng(0)
+    # Round the scores to have ties
+    scores = np.round(rng.random((num_cuts, num_classes)), 2).astype(np.float16)
+    labels = (rng.random((num_cuts, num_classes)) < 0.1).astype(np.uint8)
+    # A class without positive examples
+    labels[:, 3] = 0
+    return scores, labels
+
+
+def test_average_precision():
+    scores, labels = get_data()
+    expected = [
+        reference_average_precision(scores[:, c], labels[:, c] != 0)
+        for c in range(scores.shape[1])
+    ]
+    assert np.allclose(average_precision(scores, labels), expected)
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        for shard, (start, end) in enumerate([(0, 200), (200, 200), (200, 500)]):
+            with ScoreWriter(out_dir, shard, num_classes=scores.shape[1]) as w:
+                w.write(
+                    [f"cut-{i}" for i in range(start, end)],
+                    torch.from_numpy(scores[start:end]),
+                    torch.from_numpy(labels[start:end]),
+                )
+        ap = compute_average_precision_from_shards(out_dir, 3, block_size=7)
+        assert np.allclose(ap, expected)
+
+
+def test_histogram_average_precision():
+    scores, labels = get_data()
+    expected = average_precision(scores, labels)
+
+    ap = HistogramAveragePrecision(num_classes=scores.shape[1], num_bins=1000)
+    ap.update(torch.from_numpy(scores[:300]), torch.from_numpy(labels[:300]))
+    other = HistogramAveragePrecision(num_classes=scores.shape[1], num_bins=1000)
+    other.update(torch.from_numpy(scores[300:]), torch.from_numpy(labels[300:]))
+    ap.merge(other)
+
+    # The scores are multiples of 0.01, so each distinct score
+    # falls into a different bin
+    assert np.allclose(ap.compute(), expected, atol=1e-3)
+
+
+def main():
+    test_average_precision()
+    test_histogram_average_precision()
+
+
+if __name__ == "__main__":
+    main()
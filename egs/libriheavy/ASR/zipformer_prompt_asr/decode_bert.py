@@ -93,6 +93,14 @@ biasing_list=100 # could also be 0
     --style-text-transform mixed-punc \
     --pre-text-transform mixed-punc
 
+(5) Cache the outputs of the text encoder for the prompts
+
+Add the following options to any of the above commands. The cache in
+the given directory is shared with the training and with later runs.
+
+    --use-text-embedding-cache True \
+    --text-embedding-cache-dir data/text_embedding_cache
+
 
 """
 
@@ -113,6 +121,11 @@ from asr_datamodule import LibriHeavyAsrDataModule
 from beam_search import greedy_search, greedy_search_batch, modified_beam_search
 from dataset import naive_triplet_text_sampling, random_shuffle_subset
 from ls_text_normalization import word_normalization
+from text_embedding_cache import (
+    TextEmbeddingCache,
+    add_text_embedding_cache_arguments,
+    get_text_embedding_cache,
+)
 from text_normalization import (
     _apply_style_transform,
     lower_all_char,
@@ -125,6 +138,7 @@ from text_normalization import (
 )
 from train_bert_encoder import (
     _encode_texts_as_bytes_with_tokenizer,
+    _encode_texts_with_cache,
     add_model_arguments,
     get_params,
     get_tokenizer,
@@ -384,6 +398,7 @@ def get_parser():
     )
 
     add_model_arguments(parser)
+    add_text_embedding_cache_arguments(parser)
 
     return parser
 
@@ -397,6 +412,7 @@ def decode_one_batch(
     biasing_dict: dict = None,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
+    text_embedding_cache: Optional[TextEmbeddingCache] = None,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
     following format:
@@ -430,6 +446,8 @@ def decode_one_batch(
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding_method is fast_beam_search, fast_beam_search_nbest,
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      text_embedding_cache:
+        If not None, the outputs of the text encoder are taken from this cache.
       LM:
         A neural net LM for shallow fusion. Only used when `--use-shallow-fusion`
         set to true.
@@ -493,21 +511,35 @@ def decode_one_batch(
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
 
-            # Use tokenizer to prepare input for text encoder
-            encoded_inputs, style_lens = _encode_texts_as_bytes_with_tokenizer(
-                pre_texts=pre_texts,
-                style_texts=style_texts,
-                tokenizer=tokenizer,
-                device=device,
-                no_limit=True,
-            )
-            logging.info(
-                f"Shape of the encoded prompts: {encoded_inputs['input_ids'].shape}"
-            )
+            if text_embedding_cache is not None:
+                encoded_inputs = None
+                text_embeddings, style_lens = _encode_texts_with_cache(
+                    model=model,
+                    pre_texts=pre_texts,
+                    style_texts=style_texts,
+                    tokenizer=tokenizer,
+                    text_embedding_cache=text_embedding_cache,
+                    device=device,
+                    no_limit=True,
+                )
+            else:
+                text_embeddings = None
+                # Use tokenizer to prepare input for text encoder
+                encoded_inputs, style_lens = _encode_texts_as_bytes_with_tokenizer(
+                    pre_texts=pre_texts,
+                    style_texts=style_texts,
+                    tokenizer=tokenizer,
+                    device=device,
+                    no_limit=True,
+                )
+                logging.info(
+                    f"Shape of the encoded prompts: {encoded_inputs['input_ids'].shape}"
+                )
 
             memory, memory_key_padding_mask = model.encode_text(
                 encoded_inputs=encoded_inputs,
                 style_lens=style_lens,
+                text_embeddings=text_embeddings,
             )  # (T,B,C)
     else:
         memory = None
@@ -583,6 +615,7 @@ def decode_dataset(
     biasing_dict: Dict = None,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
+    text_embedding_cache: Optional[TextEmbeddingCache] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -606,6 +639,8 @@ def decode_dataset(
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding_method is fast_beam_search, fast_beam_search_nbest,
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      text_embedding_cache:
+        If not None, the outputs of the text encoder are taken from this cache.
       LM:
         A neural network LM, used during shallow fusion
     Returns:
@@ -660,6 +695,7 @@ def decode_dataset(
             decoding_graph=decoding_graph,
             word_table=word_table,
             batch=batch,
+            text_embedding_cache=text_embedding_cache,
         )
 
         for name, hyps in hyps_dict.items():
@@ -681,6 +717,9 @@ def decode_dataset(
             batch_str = f"{batch_idx}/{num_batches}"
 
             logging.info(f"batch {batch_str}, cuts processed until now is {num_cuts}")
+
+    if text_embedding_cache is not None:
+        logging.info(f"Text embedding cache: {text_embedding_cache}")
     return results
 
 
@@ -920,6 +959,7 @@ def main():
 
     model.to(device)
     model.eval()
+    text_embedding_cache = get_text_embedding_cache(params, model.text_encoder)
 
     LM = None
 
@@ -977,6 +1017,7 @@ def main():
             biasing_dict=biasing_dict,
             word_table=word_table,
             decoding_graph=decoding_graph,
+            text_embedding_cache=text_embedding_cache,
         )
 
         save_results(
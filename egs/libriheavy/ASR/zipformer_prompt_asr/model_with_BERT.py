@@ -138,6 +138,7 @@ class PromptedTransducer(nn.Module):
         am_scale: float = 0.0,
         lm_scale: float = 0.0,
         use_pre_text: bool = True,
+        text_embeddings: Optional[Tuple[Tensor, Tensor]] = None,
     ) -> torch.Tensor:
         """
         Args:
@@ -173,6 +174,10 @@ class PromptedTransducer(nn.Module):
           lm_scale:
             The scale to smooth the loss with lm (output of predictor network)
             part
+          text_embeddings:
+            If not None, it is the output of the text encoder for the prompts,
+            e.g., from a cache, and `encoded_inputs` is not used. See
+            :func:`encode_text`.
         Returns:
           Return the transducer loss.
 
@@ -199,7 +204,7 @@ class PromptedTransducer(nn.Module):
 
         if use_pre_text:
             memory, memory_key_padding_mask = self.encode_text(
-                encoded_inputs, style_lens=style_lens
+                encoded_inputs, style_lens=style_lens, text_embeddings=text_embeddings
             )
         else:
             memory = None
@@ -324,26 +329,49 @@ class PromptedTransducer(nn.Module):
 
         return memory + extra_term
 
+    def run_text_encoder(self, encoded_inputs: Dict) -> Tuple[Tensor, Tensor]:
+        """Run the frozen text encoder.
+
+        Args:
+            encoded_inputs: The encoded inputs generated by a tokenizer (Dict)
+
+        Returns:
+            Tuple[Tensor, Tensor]: Returns the output of the text encoder
+            (B,T,C) and the number of tokens of each text (B,)
+        """
+        if self.freeze_text_encoder:
+            self.text_encoder.eval()
+        text_lens = encoded_inputs.pop("length")  # need to use pop to remove this item
+
+        # Freeze the pre-trained text encoder
+        with torch.no_grad():
+            memory = self.text_encoder(**encoded_inputs)["last_hidden_state"]  # (B,T,C)
+
+        return memory, text_lens
+
     def encode_text(
         self,
-        encoded_inputs: Dict,
+        encoded_inputs: Optional[Dict],
         style_lens: Tensor,
+        text_embeddings: Optional[Tuple[Tensor, Tensor]] = None,
     ) -> Tuple[Tensor, Tensor]:
         """Get the embeddings of text
 
         Args:
             encoded_inputs: The encoded inputs generated by a tokenizer (Dict)
+            style_lens: The number of tokens of the style prompts (B,)
+            text_embeddings: If not None, it is the return value of
+              :func:`run_text_encoder`, e.g., from a cache, and
+              `encoded_inputs` is not used.
 
         Returns:
             Tuple[Tensor, Tensor]: Returns the text embeddings encoded by the
             text_encoder and the attention mask
         """
-        text_lens = encoded_inputs.pop("length")  # need to use pop to remove this item
-
-        # Freeze the pre-trained text encoder
-        with torch.no_grad():
-            memory = self.text_encoder(**encoded_inputs)["last_hidden_state"]  # (B,T,C)
-            memory = memory.permute(1, 0, 2)
+        if text_embeddings is None:
+            text_embeddings = self.run_text_encoder(encoded_inputs)
+        memory, text_lens = text_embeddings
+        memory = memory.permute(1, 0, 2)
 
         # Text encoder adapter
         if self.text_encoder_adapter is not None:
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/libriheavy/ASR
+    python ./zipformer_prompt_asr/test_text_embedding_cache.py
+"""
+
+import tempfile
+
+import torch
+from text_embedding_cache import TextEmbeddingCache, get_text_encoder_namespace
+
+
+def test_memory_cache():
+    # Room for 2 entries of 64 KB
+    cache = TextEmbeddingCache(namespace="BERT", max_size=1)
+    cache.max_size = 2 * 64 * 1024
+    keys = [cache.get_key("Mixed-case", f"Mixed-case [SEP] text {i}") for i in range(3)]
+    assert len(set(keys)) == 3
+    assert cache.get_key("a", "b") != TextEmbeddingCache("BERT-large").get_key("a", "b")
+
+    embeddings = [torch.full((16, 1024), float(i)) for i in range(3)]
+    for k, e in zip(keys[:2], embeddings[:2]):
+        assert cache.get(k) is None
+        cache.put(k, e, style_len=3)
+
+    assert torch.equal(cache.get(keys[0])[0], embeddings[0])
+    # keys[1] is evicted since keys[0] was used more recently
+    cache.put(keys[2], embeddings[2], style_len=3)
+    assert cache.get(keys[1]) is None
+    assert torch.equal(cache.get(keys[2])[0], embeddings[2])
+
+    assert cache.num_memory_hits == 2
+    assert cache.num_misses == 3
+
+
+def test_disk_cache():
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = TextEmbeddingCache(namespace="BERT", cache_dir=cache_dir)
+        key = cache.get_key("Mixed-case", "Mixed-case [SEP] some text")
+        embedding = torch.rand(10, 768)
+        cache.put(key, embedding, style_len=4)
+
+        # A new cache, e.g., in another rank, reads it from the disk
+        cache = TextEmbeddingCache(namespace="BERT", cache_dir=cache_dir)
+        cached_embedding, style_len = cache.get(key)
+        assert torch.equal(cached_embedding, embedding)
+        assert style_len == 4
+        assert cache.num_disk_hits == 1
+
+        cache.get(key)
+        assert cache.num_memory_hits == 1
+
+
+def test_text_encoder_namespace():
+    torch.manual_seed(20240101)
+    text_encoder = torch.nn.Linear(4, 3)
+    namespace = get_text_encoder_namespace("BERT", text_encoder)
+    assert namespace.startswith("BERT-")
+    assert namespace == get_text_encoder_namespace("BERT", text_encoder)
+
+    # Another checkpoint of the same type of text encoder
+    other = torch.nn.Linear(4, 3)
+    assert namespace != get_text_encoder_namespace("BERT", other)
+
+    other.load_state_dict(text_encoder.state_dict())
+    assert namespace == get_text_encoder_namespace("BERT", other)
+
+
+def main():
+    test_memory_cache()
+    test_disk_cache()
+    test_text_encoder_namespace()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A cache of the outputs of the frozen text encoder (e.g., BERT) for the
+prompts, i.e., the style text and the pre-text, of Prompt-ASR.
+
+The prompts of Libriheavy repeat a lot, both within a book and across epochs,
+so most of the time spent on tokenizing the prompts and running the text
+encoder can be saved when the text encoder is frozen.
+
+The cache has two tiers:
+
+  - An in-memory LRU cache, limited by the total size of the embeddings.
+  - An optional on-disk cache, with one file per prompt, which is shared by
+    all the processes using the same directory, e.g., all ranks of a DDP
+    training, and the training and the decoding. The files are memory-mapped
+    when they are read.
+"""
+
+import argparse
+import hashlib
+import logging
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+import torch
+from torch import Tensor, nn
+
+from icefall.utils import atomic_save, str2bool
+
+
+def add_text_embedding_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--use-text-embedding-cache",
+        type=str2bool,
+        default=False,
+        help="""If True, cache the outputs of the text encoder for the prompts,
+        so that the text encoder is run only once for each distinct prompt.
+        It requires --freeze-text-encoder True for training.
+        """,
+    )
+
+    parser.add_argument(
+        "--text-embedding-cache-size",
+        type=int,
+        default=4096,
+        help="Size in MB of the in-memory text embedding cache.",
+    )
+
+    parser.add_argument(
+        "--text-embedding-cache-dir",
+        type=str,
+        default="",
+        help="""If not empty, the text embeddings are also saved to this
+        directory, e.g., data/text_embedding_cache, and are reused by all
+        ranks and by later runs.
+        """,
+    )
+
+
+class TextEmbeddingCache(object):
+    def __init__(
+        self,
+        namespace: str,
+        max_size: int = 4096,
+        cache_dir: Optional[Path] = None,
+    ):
+        """
+        Args:
+          namespace:
+            It identifies the text encoder and its weights, e.g., the value
+            returned by :func:`get_text_encoder_namespace`. It is part of the
+            key of each entry, so that caches of different text encoders can
+            share the same directory.
+          max_size:
+            Size in MB of the in-memory cache.
+          cache_dir:
+            If not None, the entries are also saved to files in this directory.
+        """
+        self.namespace = namespace
+        self.max_size = max_size * 2**20
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # key -> (embedding, style_len)
+        self.entries: OrderedDict = OrderedDict()
+        self.size = 0
+
+        self.num_memory_hits = 0
+        self.num_disk_hits = 0
+        self.num_misses = 0
+        # Time in seconds spent on tokenizing and encoding the missed prompts
+        self.encode_time = 0.0
+
+    def get_key(self, style_text: str, prompt_text: str) -> str:
+        """
+        Args:
+          style_text:
+            The style text after normalization and the style transform.
+          prompt_text:
+            The text given to the tokenizer, i.e., the style text and
+            the truncated pre-text.
+        """
+        h = hashlib.sha1()
+        for s in (self.namespace, style_text, prompt_text):
+            h.update(s.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Tensor, int]]:
+        """Return (embedding, style_len) of the given key, or None if it is not
+        cached. `embedding` is of shape (text_len, text_encoder_dim) and is on
+        CPU."""
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.num_memory_hits += 1
+            return self.entries[key]
+
+        if self.cache_dir is not None:
+            filename = self._filename(key)
+            if filename.is_file():
+                try:
+                    entry = torch.load(str(filename), map_location="cpu", mmap=True)
+                except (TypeError, RuntimeError):
+                    # mmap requires torch >= 2.1
+                    entry = torch.load(filename, map_location="cpu")
+                self.num_disk_hits += 1
+                value = (entry["embedding"], entry["style_len"])
+                self._put_in_memory(key, value)
+                return value
+
+        self.num_misses += 1
+        return None
+
+    def put(self, key: str, embedding: Tensor, style_len: int) -> None:
+        # Copy it, so that it does not keep the memory of the whole batch
+        value = (embedding.detach().to(device="cpu", copy=True), style_len)
+        self._put_in_memory(key, value)
+
+        if self.cache_dir is not None:
+            filename = self._filename(key)
+            filename.parent.mkdir(exist_ok=True)
+            atomic_save({"embedding": value[0], "style_len": style_len}, filename)
+
+    def _put_in_memory(self, key: str, value: Tuple[Tensor, int]) -> None:
+        if key in self.entries:
+            return
+        self.entries[key] = value
+        self.size += value[0].numel() * value[0].element_size()
+        while self.size > self.max_size and len(self.entries) > 1:
+            _, (embedding, _) = self.entries.popitem(last=False)
+            self.size -= embedding.numel() * embedding.element_size()
+
+    def _filename(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.pt"
+
+    @property
+    def hit_rate(self) -> float:
+        num_hits = self.num_memory_hits + self.num_disk_hits
+        num_lookups = num_hits + self.num_misses
+        return num_hits / num_lookups if num_lookups > 0 else 0.0
+
+    @property
+    def saved_time(self) -> float:
+        """Estimated time in seconds saved by the cache, assuming each hit
+        would take the average time of encoding a missed prompt."""
+        if self.num_misses == 0:
+            return 0.0
+        num_hits = self.num_memory_hits + self.num_disk_hits
+        return num_hits * self.encode_time / self.num_misses
+
+    def __str__(self) -> str:
+        return (
+            f"hit rate: {self.hit_rate:.2%} "
+            f"(memory hits: {self.num_memory_hits}, "
+            f"disk hits: {self.num_disk_hits}, misses: {self.num_misses}), "
+            f"entries in memory: {len(self.entries)} ({self.size / 2**20:.1f} MB), "
+            f"text encoder time: {self.encode_time:.1f} s, "
+            f"estimated time saved: {self.saved_time:.1f} s"
+        )
+
+
+def get_text_encoder_namespace(text_encoder_type: str, text_encoder: nn.Module) -> str:
+    """Return the namespace of the cache of the given text encoder, which
+    contains a hash of its weights, so that the embeddings of another
+    checkpoint of the same type of text encoder are never reused."""
+    h = hashlib.sha1()
+    for name, tensor in sorted(text_encoder.state_dict().items()):
+        h.update(name.encode("utf-8"))
+        h.update(str(tensor.dtype).encode("utf-8"))
+        h.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy())
+    return f"{text_encoder_type}-{h.hexdigest()[:16]}"
+
+
+def get_text_embedding_cache(
+    params, text_encoder: nn.Module
+) -> Optional[TextEmbeddingCache]:
+    """Return a TextEmbeddingCache if --use-text-embedding-cache is True,
+    or None otherwise.
+
+    It has to be called after the weights of `text_encoder` are loaded.
+    """
+    if not params.use_text_embedding_cache:
+        return None
+
+    namespace = get_text_encoder_namespace(params.text_encoder_type, text_encoder)
+    logging.info(f"Using the text embedding cache, namespace: {namespace}")
+    return TextEmbeddingCache(
+        namespace=namespace,
+        max_size=params.text_embedding_cache_size,
+        cache_dir=params.text_embedding_cache_dir or None,
+    )
@@ -67,6 +67,7 @@ import copy
 import logging
 import os
 import random
+import time
 import warnings
 from pathlib import Path
 from shutil import copyfile
@@ -95,6 +96,11 @@ from model_with_BERT import PromptedTransducer
 from optim import Eden, ScaledAdam
 from scaling import Balancer, BiasNorm, Dropout3, ScaleGrad, ScheduledFloat, SwooshR
 from subsampling import Conv2dSubsampling
+from text_embedding_cache import (
+    TextEmbeddingCache,
+    add_text_embedding_cache_arguments,
+    get_text_embedding_cache,
+)
 from text_normalization import (
     lower_all_char,
     lower_only_alpha,
@@ -595,6 +601,7 @@ def get_parser():
     )
 
     add_model_arguments(parser)
+    add_text_embedding_cache_arguments(parser)
 
     return parser
 
@@ -1013,6 +1020,22 @@ def save_checkpoint(
         copyfile(src=filename, dst=best_valid_filename)
 
 
+def _get_combined_texts(
+    pre_texts: List[str], style_texts: List[str], no_limit: bool = False
+) -> List[str]:
+    """Return the texts given to the text encoder, i.e., the style texts
+    followed by the truncated pre-texts."""
+    batch_size = len(pre_texts)
+    if no_limit:
+        allowed_lens = [5000 - len(s) for s in style_texts]
+    else:
+        allowed_lens = [1000 - len(s) for s in style_texts]
+    truncated_pre_texts = [pre_texts[i][-allowed_lens[i] :] for i in range(batch_size)]
+    return [
+        style_texts[i] + " [SEP] " + truncated_pre_texts[i] for i in range(batch_size)
+    ]
+
+
 def _encode_texts_as_bytes_with_tokenizer(
     pre_texts: List[str],
     style_texts: List[str],
@@ -1025,17 +1048,8 @@ def _encode_texts_as_bytes_with_tokenizer(
     Encode texts as bytes and then integer tensors.
     Note that the style text will be added to the beginning of texts.
     """
-    batch_size = len(pre_texts)
     max_len = min(max_len, 500)
-
-    if no_limit:
-        allowed_lens = [5000 - len(s) for s in style_texts]
-    else:
-        allowed_lens = [1000 - len(s) for s in style_texts]
-    truncated_pre_texts = [pre_texts[i][-allowed_lens[i] :] for i in range(batch_size)]
-    combined_text = [
-        style_texts[i] + " [SEP] " + truncated_pre_texts[i] for i in range(batch_size)
-    ]
+    combined_text = _get_combined_texts(pre_texts, style_texts, no_limit)
 
     encoded_style_texts = tokenizer(
         style_texts,
@@ -1060,6 +1074,74 @@ def _encode_texts_as_bytes_with_tokenizer(
     return encoded_inputs, style_lens
 
 
+def _encode_texts_with_cache(
+    model: nn.Module,
+    pre_texts: List[str],
+    style_texts: List[str],
+    tokenizer,
+    text_embedding_cache: TextEmbeddingCache,
+    device: torch.device,
+    max_len: int = 500,
+    no_limit: bool = False,
+) -> Tuple[Tuple[Tensor, Tensor], Tensor]:
+    """
+    Get the output of the frozen text encoder for the prompts from
+    `text_embedding_cache`. Only the prompts that are not in the cache are
+    tokenized and encoded, in the same way as
+    :func:`_encode_texts_as_bytes_with_tokenizer`, and are added to the cache.
+
+    Returns:
+      Return a tuple containing:
+        - The text embeddings, which can be passed to `model.encode_text()`.
+          They are a tuple of the text encoder output (B,T,C) and the number
+          of tokens of each prompt (B,).
+        - The number of tokens of the style prompts (B,)
+    """
+    combined_texts = _get_combined_texts(pre_texts, style_texts, no_limit)
+    keys = [
+        text_embedding_cache.get_key(s, c) for s, c in zip(style_texts, combined_texts)
+    ]
+    entries = [text_embedding_cache.get(k) for k in keys]
+
+    # A prompt may appear more than once in a batch
+    missing = list({keys[i]: i for i, e in enumerate(entries) if e is None}.values())
+    if missing:
+        start = time.time()
+        encoded_inputs, style_lens = _encode_texts_as_bytes_with_tokenizer(
+            pre_texts=[pre_texts[i] for i in missing],
+            style_texts=[style_texts[i] for i in missing],
+            tokenizer=tokenizer,
+            device=device,
+            max_len=max_len,
+            no_limit=no_limit,
+        )
+        memory, text_lens = model.run_text_encoder(encoded_inputs)
+        # It waits for the text encoder, so the measured time is correct
+        memory = memory.cpu()
+        text_lens = text_lens.tolist()
+        style_lens = style_lens.tolist()
+
+        new_entries = dict()
+        for j, i in enumerate(missing):
+            new_entries[keys[i]] = (memory[j, : text_lens[j]], style_lens[j])
+            text_embedding_cache.put(keys[i], *new_entries[keys[i]])
+        text_embedding_cache.encode_time += time.time() - start
+
+        entries = [new_entries[k] if e is None else e for k, e in zip(keys, entries)]
+
+    text_lens = [e[0].size(0) for e in entries]
+    dtype = entries[missing[0] if missing else 0][0].dtype
+    memory = torch.zeros(
+        len(entries), max(text_lens), entries[0][0].size(1), dtype=dtype, device=device
+    )
+    for i, (embedding, _) in enumerate(entries):
+        memory[i, : text_lens[i]] = embedding.to(device=device, dtype=dtype)
+
+    text_lens = torch.tensor(text_lens, device=device)
+    style_lens = torch.tensor([e[1] for e in entries], device=device)
+    return (memory, text_lens), style_lens
+
+
 def compute_loss(
     params: AttributeDict,
     model: Union[nn.Module, DDP],
@@ -1067,6 +1149,7 @@ def compute_loss(
     tokenizer,
     batch: dict,
     is_training: bool,
+    text_embedding_cache: Optional[TextEmbeddingCache] = None,
 ) -> Tuple[Tensor, MetricsTracker]:
     """
     Compute CTC loss given the model and its inputs.
@@ -1083,6 +1166,9 @@ def compute_loss(
         True for training. False for validation. When it is True, this
         function enables autograd during computation; when it is False, it
         disables autograd.
+      text_embedding_cache:
+        If not None, the outputs of the frozen text encoder are taken from
+        this cache.
      warmup: a floating point value which increases throughout training;
         values >= 1.0 are fully warmed up and have all modules present.
     """
@@ -1154,15 +1240,29 @@ def compute_loss(
         logging.info(f"Ref texts: {texts[0]}")
         logging.info(f"Style texts: {style_texts[0]}")
 
-    encoded_inputs, style_lens = _encode_texts_as_bytes_with_tokenizer(
-        pre_texts=pre_texts,
-        style_texts=style_texts,
-        tokenizer=tokenizer,
-        device=device,
-    )
+    if text_embedding_cache is not None:
+        encoded_inputs = None
+        text_embeddings, style_lens = _encode_texts_with_cache(
+            model=model.module if isinstance(model, DDP) else model,
+            pre_texts=pre_texts,
+            style_texts=style_texts,
+            tokenizer=tokenizer,
+            text_embedding_cache=text_embedding_cache,
+            device=device,
+        )
+    else:
+        text_embeddings = None
+        encoded_inputs, style_lens = _encode_texts_as_bytes_with_tokenizer(
+            pre_texts=pre_texts,
+            style_texts=style_texts,
+            tokenizer=tokenizer,
+            device=device,
+        )
 
-    if random.random() < 0.02:
-        logging.info(f"Shape of encoded texts: {encoded_inputs['input_ids'].shape} ")
+        if random.random() < 0.02:
+            logging.info(
+                f"Shape of encoded texts: {encoded_inputs['input_ids'].shape} "
+            )
 
     with torch.set_grad_enabled(is_training):
         simple_loss, pruned_loss = model(
@@ -1174,6 +1274,7 @@ def compute_loss(
             prune_range=params.prune_range,
             am_scale=params.am_scale,
             lm_scale=params.lm_scale,
+            text_embeddings=text_embeddings,
         )
 
         s = params.simple_loss_scale
@@ -1214,6 +1315,7 @@ def compute_validation_loss(
     tokenizer,
     valid_dl: torch.utils.data.DataLoader,
     world_size: int = 1,
+    text_embedding_cache: Optional[TextEmbeddingCache] = None,
 ) -> MetricsTracker:
     """Run the validation process."""
     model.eval()
@@ -1228,6 +1330,7 @@ def compute_validation_loss(
             tokenizer=tokenizer,
             batch=batch,
             is_training=False,
+            text_embedding_cache=text_embedding_cache,
         )
         assert loss.requires_grad is False
         tot_loss = tot_loss + loss_info
@@ -1257,6 +1360,7 @@ def train_one_epoch(
     tb_writer: Optional[SummaryWriter] = None,
     world_size: int = 1,
     rank: int = 0,
+    text_embedding_cache: Optional[TextEmbeddingCache] = None,
 ) -> None:
     """Train the model for one epoch.
 
@@ -1288,6 +1392,9 @@ def train_one_epoch(
       rank:
         The rank of the node in DDP training. If no DDP is used, it should
         be set to 0.
+      text_embedding_cache:
+        If not None, the outputs of the frozen text encoder are taken from
+        this cache.
     """
     model.train()
 
@@ -1329,6 +1436,7 @@ def train_one_epoch(
                     tokenizer=tokenizer,
                     batch=batch,
                     is_training=True,
+                    text_embedding_cache=text_embedding_cache,
                 )
             # summary stats
             tot_loss = (tot_loss * (1 - 1 / params.reset_interval)) + loss_info
@@ -1412,6 +1520,8 @@ def train_one_epoch(
                 f"lr: {cur_lr:.2e}, "
                 + (f"grad_scale: {scaler._scale.item()}" if params.use_fp16 else "")
             )
+            if text_embedding_cache is not None:
+                logging.info(f"Text embedding cache: {text_embedding_cache}")
 
             if tb_writer is not None:
                 tb_writer.add_scalar(
@@ -1438,6 +1548,7 @@ def train_one_epoch(
                 tokenizer=tokenizer,
                 valid_dl=valid_dl,
                 world_size=world_size,
+                text_embedding_cache=text_embedding_cache,
             )
             model.train()
             logging.info(f"Epoch {params.cur_epoch}, validation: {valid_info}")
@@ -1512,6 +1623,11 @@ def run(rank, world_size, args):
     model = get_transducer_model(params)
     tokenizer = get_tokenizer(params)
 
+    if params.use_text_embedding_cache:
+        # The cached embeddings are valid only if the text encoder does not
+        # change and runs without dropout
+        assert params.freeze_text_encoder, "Please use --freeze-text-encoder True"
+
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
 
@@ -1525,6 +1641,7 @@ def run(rank, world_size, args):
     checkpoints = load_checkpoint_if_available(
         params=params, model=model, model_avg=model_avg
     )
+    text_embedding_cache = get_text_embedding_cache(params, model.text_encoder)
 
     model.to(device)
     if world_size > 1:
@@ -1676,6 +1793,7 @@ def run(rank, world_size, args):
             tb_writer=tb_writer,
             world_size=world_size,
             rank=rank,
+            text_embedding_cache=text_embedding_cache,
         )
 
         if params.print_diagnostics:
@@ -0,0 +1 @@
+../../../librispeech/SSL/zipformer/prepare_kmeans_labels.py
\ No newline at end of file
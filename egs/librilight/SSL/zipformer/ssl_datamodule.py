@@ -128,6 +128,14 @@ class LibriLightDataModule:
             default=True,
             help="audio sample rate",
         )
+        group.add_argument(
+            "--kmeans-dir",
+            type=Path,
+            default=None,
+            help="If given, read the k-means labels from this directory, "
+            "written by prepare_kmeans_labels.py, instead of parsing them "
+            "from the cuts.",
+        )
 
     def train_dataloaders(
         self,
@@ -155,6 +163,7 @@ class LibriLightDataModule:
             pad_audio=pad_audio,
             num_classes=num_classes,
             do_normalize=do_normalize,
+            kmeans_dir=self.args.kmeans_dir,
         )
 
         if self.args.bucketing_sampler:
@@ -213,6 +222,7 @@ class LibriLightDataModule:
             pad_audio=pad_audio,
             num_classes=num_classes,
             do_normalize=do_normalize,
+            kmeans_dir=self.args.kmeans_dir,
         )
         valid_sampler = DynamicBucketingSampler(
             cuts_valid,
@@ -248,6 +258,7 @@ class LibriLightDataModule:
             pad_audio=pad_audio,
             num_classes=num_classes,
             do_normalize=do_normalize,
+            kmeans_dir=self.args.kmeans_dir,
         )
         sampler = DynamicBucketingSampler(
             cuts,
@@ -30,6 +30,7 @@ Usage:
 import argparse
 import logging
 from pathlib import Path
+from typing import Optional
 
 import k2
 import numpy as np
@@ -39,6 +40,7 @@ from conformer import Conformer
 from lhotse import CutSet
 from lhotse.features.io import FeaturesWriter, NumpyHdf5Writer
 
+from icefall.ali import AlignmentWriter
 from icefall.bpe_graph_compiler import BpeCtcTrainingGraphCompiler
 from icefall.checkpoint import average_checkpoints, load_checkpoint
 from icefall.decode import one_best_decoding
@@ -92,21 +94,27 @@ def get_parser():
         type=str,
         required=True,
         help="""Output directory.
-        It contains 3 generated files:
+        It contains 4 generated files and directories:
 
         - labels_xxx.h5
         - aux_labels_xxx.h5
         - librispeech_cuts_xxx.jsonl.gz
+        - labels_xxx/
 
         where xxx is the value of `--dataset`. For instance, if
-        `--dataset` is `train-clean-100`, it will contain 3 files:
+        `--dataset` is `train-clean-100`, it will contain:
 
         - `labels_train-clean-100.h5`
         - `aux_labels_train-clean-100.h5`
         - `librispeech_cuts_train-clean-100.jsonl.gz`
+        - `labels_train-clean-100/`
 
         Note: Both labels_xxx.h5 and aux_labels_xxx.h5 contain framewise
         alignment. The difference is that labels_xxx.h5 contains repeats.
+        labels_xxx/ contains the same alignments as labels_xxx.h5 in the
+        memory-mapped format of icefall.ali.AlignmentStore, which is used
+        by conformer_mmi/train.py. Use ./local/merge_alignments.py to merge
+        the ones of train-clean-100, train-clean-360 and train-other-500.
         """,
     )
 
@@ -156,6 +164,7 @@ def compute_alignments(
     aux_labels_writer: FeaturesWriter,
     params: AttributeDict,
     graph_compiler: BpeCtcTrainingGraphCompiler,
+    ali_writer: Optional[AlignmentWriter] = None,
 ) -> CutSet:
     """Compute the framewise alignments of a dataset.
 
@@ -168,6 +177,8 @@ def compute_alignments(
         Parameters for computing alignments.
       graph_compiler:
         It converts token IDs to decoding graphs.
+      ali_writer:
+        If not None, the alignments with repeats are also written to it.
     Returns:
       Return a CutSet. Each cut has two custom fields: labels_alignment
       and aux_labels_alignment, containing framewise alignments information.
@@ -248,6 +259,8 @@ def compute_alignments(
                 temporal_dim=0,
                 start=0,
             )
+            if ali_writer is not None:
+                ali_writer.write(cut.id, labels)
 
         cuts += cut_list
 
@@ -286,11 +299,13 @@ def main():
     out_labels_ali_filename = out_dir / f"labels_{params.dataset}.h5"
     out_aux_labels_ali_filename = out_dir / f"aux_labels_{params.dataset}.h5"
     out_manifest_filename = out_dir / f"librispeech_cuts_{params.dataset}.jsonl.gz"
+    out_ali_dir = out_dir / f"labels_{params.dataset}"
 
     for f in (
         out_labels_ali_filename,
         out_aux_labels_ali_filename,
         out_manifest_filename,
+        out_ali_dir,
     ):
         if f.exists():
             logging.info(f"{f} exists - skipping")
@@ -367,6 +382,9 @@ def main():
         dl = librispeech.valid_dataloaders(dev_other_cuts)
 
     logging.info(f"Processing {params.dataset}")
+    ali_writer = AlignmentWriter(
+        out_ali_dir, subsampling_factor=params.subsampling_factor
+    )
     with NumpyHdf5Writer(out_labels_ali_filename) as labels_writer:
         with NumpyHdf5Writer(out_aux_labels_ali_filename) as aux_labels_writer:
             cut_set = compute_alignments(
@@ -376,15 +394,17 @@ def main():
                 aux_labels_writer=aux_labels_writer,
                 params=params,
                 graph_compiler=graph_compiler,
+                ali_writer=ali_writer,
             )
+    ali_writer.close()
 
     cut_set.to_file(out_manifest_filename)
 
     logging.info(
         f"For dataset {params.dataset}, its alignments with repeats are "
-        f"saved to {out_labels_ali_filename}, the alignments without repeats "
-        f"are saved to {out_aux_labels_ali_filename}, and the cut manifest "
-        f"file is {out_manifest_filename}. Number of cuts: {len(cut_set)}"
+        f"saved to {out_labels_ali_filename} and {out_ali_dir}, the alignments "
+        f"without repeats are saved to {out_aux_labels_ali_filename}, and the "
+        f"cut manifest file is {out_manifest_filename}. Number of cuts: {len(cut_set)}"
     )
 
 
@@ -32,7 +32,7 @@ import argparse
 import logging
 from pathlib import Path
 from shutil import copyfile
-from typing import Optional, Tuple
+from typing import Optional, Tuple, Union
 
 import k2
 import torch
@@ -62,6 +62,7 @@ from icefall.utils import (
     setup_logger,
     str2bool,
 )
+from icefall.worker_graph_compiler import get_compiled_graphs
 
 
 def get_parser():
@@ -159,6 +160,16 @@ def get_parser():
         help="The seed for random generators intended for reproducibility",
     )
 
+    parser.add_argument(
+        "--compile-graphs-in-workers",
+        type=str2bool,
+        default=False,
+        help="""If True, compile the training graphs in the dataloader
+        workers instead of the training process. Use --graph-cache-dir
+        to also save them to disk for later epochs.
+        """,
+    )
+
     return parser
 
 
@@ -340,6 +351,47 @@ def save_checkpoint(
         copyfile(src=filename, dst=best_valid_filename)
 
 
+def get_graph_compiler(
+    params: AttributeDict,
+    lexicon: Lexicon,
+    device: torch.device,
+) -> Union[BpeCtcTrainingGraphCompiler, CtcTrainingGraphCompiler]:
+    if "lang_bpe" in str(params.lang_dir):
+        graph_compiler = BpeCtcTrainingGraphCompiler(
+            params.lang_dir,
+            device=device,
+            sos_token="<sos/eos>",
+            eos_token="<sos/eos>",
+        )
+    elif "lang_phone" in str(params.lang_dir):
+        assert params.att_rate == 0, (
+            "Attention decoder training does not support phone lang dirs "
+            "at this time due to a missing <sos/eos> symbol. Set --att-rate=0 "
+            "for pure CTC training when using a phone-based lang dir."
+        )
+        assert params.num_decoder_layers == 0, (
+            "Attention decoder training does not support phone lang dirs "
+            "at this time due to a missing <sos/eos> symbol. "
+            "Set --num-decoder-layers=0 for pure CTC training when using "
+            "a phone-based lang dir."
+        )
+        graph_compiler = CtcTrainingGraphCompiler(
+            lexicon,
+            device=device,
+        )
+        # Manually add the sos/eos ID with their default values
+        # from the BPE recipe which we're adapting here.
+        graph_compiler.sos_id = 1
+        graph_compiler.eos_id = 1
+    else:
+        raise ValueError(
+            f"Unsupported type of lang dir (we expected it to have "
+            f"'lang_bpe' or 'lang_phone' in its name): {params.lang_dir}"
+        )
+
+    return graph_compiler
+
+
 def compute_loss(
     params: AttributeDict,
     model: nn.Module,
@@ -385,7 +437,10 @@ def compute_loss(
         supervisions, subsampling_factor=params.subsampling_factor
     )
 
-    if isinstance(graph_compiler, BpeCtcTrainingGraphCompiler):
+    if "graphs" in batch:
+        # Compiled in the dataloader workers, see GraphCompilingDataset
+        decoding_graph = get_compiled_graphs(batch, texts, device)
+    elif isinstance(graph_compiler, BpeCtcTrainingGraphCompiler):
         # Works with a BPE model
         token_ids = graph_compiler.texts_to_ids(texts)
         decoding_graph = graph_compiler.compile(token_ids)
@@ -622,38 +677,12 @@ def run(rank, world_size, args):
     if torch.cuda.is_available():
         device = torch.device("cuda", rank)
 
-    if "lang_bpe" in str(params.lang_dir):
-        graph_compiler = BpeCtcTrainingGraphCompiler(
-            params.lang_dir,
-            device=device,
-            sos_token="<sos/eos>",
-            eos_token="<sos/eos>",
-        )
-    elif "lang_phone" in str(params.lang_dir):
-        assert params.att_rate == 0, (
-            "Attention decoder training does not support phone lang dirs "
-            "at this time due to a missing <sos/eos> symbol. Set --att-rate=0 "
-            "for pure CTC training when using a phone-based lang dir."
-        )
-        assert params.num_decoder_layers == 0, (
-            "Attention decoder training does not support phone lang dirs "
-            "at this time due to a missing <sos/eos> symbol. "
-            "Set --num-decoder-layers=0 for pure CTC training when using "
-            "a phone-based lang dir."
-        )
-        graph_compiler = CtcTrainingGraphCompiler(
-            lexicon,
-            device=device,
-        )
-        # Manually add the sos/eos ID with their default values
-        # from the BPE recipe which we're adapting here.
-        graph_compiler.sos_id = 1
-        graph_compiler.eos_id = 1
-    else:
-        raise ValueError(
-            f"Unsupported type of lang dir (we expected it to have "
-            f"'lang_bpe' or 'lang_phone' in its name): {params.lang_dir}"
-        )
+    graph_compiler = get_graph_compiler(params, lexicon, device)
+
+    worker_graph_compiler = None
+    if params.compile_graphs_in_workers:
+        # The graphs are compiled on CPU in the dataloader workers
+        worker_graph_compiler = get_graph_compiler(params, lexicon, torch.device("cpu"))
 
     logging.info("About to create model")
     model = Conformer(
@@ -704,11 +733,15 @@ def run(rank, world_size, args):
 
     train_cuts = train_cuts.filter(remove_short_and_long_utt)
 
-    train_dl = librispeech.train_dataloaders(train_cuts)
+    train_dl = librispeech.train_dataloaders(
+        train_cuts, graph_compiler=worker_graph_compiler
+    )
 
     valid_cuts = librispeech.dev_clean_cuts()
     valid_cuts += librispeech.dev_other_cuts()
-    valid_dl = librispeech.valid_dataloaders(valid_cuts)
+    valid_dl = librispeech.valid_dataloaders(
+        valid_cuts, graph_compiler=worker_graph_compiler
+    )
 
     scan_pessimistic_batches_for_oom(
         model=model,
@@ -99,6 +99,9 @@ def get_parser():
         two files, train-960.pt and valid.pt, which
         contain framewise alignment information for
         the training set and validation set.
+        If it contains the directories train-960 and valid
+        generated by local/merge_alignments.py, they are
+        used instead and are memory-mapped.
         """,
     )
 
@@ -379,6 +382,7 @@ def compute_loss(
                 cut_ids=cut_ids,
                 alignments=ali,
                 num_classes=nnet_output.shape[2],
+                device=nnet_output.device,
             ).to(nnet_output)
 
             min_len = min(nnet_output.shape[1], mask.shape[1])
@@ -749,17 +753,22 @@ def run(rank, world_size, args):
     if checkpoints:
         optimizer.load_state_dict(checkpoints["optimizer"])
 
-    train_960_ali_filename = Path(params.ali_dir) / "train-960.pt"
+    ali_dir = Path(params.ali_dir)
+    train_960_ali_filename = ali_dir / "train-960"
+    valid_ali_filename = ali_dir / "valid"
+    if not (train_960_ali_filename / "meta.json").is_file():
+        train_960_ali_filename = ali_dir / "train-960.pt"
+        valid_ali_filename = ali_dir / "valid.pt"
+
     if (
         params.batch_idx_train < params.use_ali_until
-        and train_960_ali_filename.is_file()
+        and train_960_ali_filename.exists()
     ):
         logging.info("Use pre-computed alignments")
         subsampling_factor, train_ali = load_alignments(train_960_ali_filename)
         assert subsampling_factor == params.subsampling_factor
         assert len(train_ali) == 843723, f"{len(train_ali)} vs 843723"
 
-        valid_ali_filename = Path(params.ali_dir) / "valid.pt"
         subsampling_factor, valid_ali = load_alignments(valid_ali_filename)
         assert subsampling_factor == params.subsampling_factor
 
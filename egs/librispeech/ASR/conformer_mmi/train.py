@@ -46,6 +46,7 @@ from icefall.lexicon import Lexicon
 from icefall.mmi import LFMMILoss
 from icefall.mmi_graph_compiler import MmiTrainingGraphCompiler
 from icefall.utils import AttributeDict, encode_supervisions, setup_logger, str2bool
+from icefall.worker_graph_compiler import get_compiled_graphs
 
 
 def get_parser():
@@ -99,6 +100,9 @@ def get_parser():
         two files, train-960.pt and valid.pt, which
         contain framewise alignment information for
         the training set and validation set.
+        If it contains the directories train-960 and valid
+        generated by local/merge_alignments.py, they are
+        used instead and are memory-mapped.
         """,
     )
 
@@ -137,6 +141,16 @@ def get_parser():
         lattice.""",
     )
 
+    parser.add_argument(
+        "--compile-graphs-in-workers",
+        type=str2bool,
+        default=False,
+        help="""If True, compile the numerator graphs in the dataloader
+        workers instead of the training process. Use --graph-cache-dir
+        to also save them to disk for later epochs.
+        """,
+    )
+
     return parser
 
 
@@ -379,6 +393,7 @@ def compute_loss(
                 cut_ids=cut_ids,
                 alignments=ali,
                 num_classes=nnet_output.shape[2],
+                device=nnet_output.device,
             ).to(nnet_output)
 
             min_len = min(nnet_output.shape[1], mask.shape[1])
@@ -405,7 +420,12 @@ def compute_loss(
             supervision_segments,
             allow_truncate=params.subsampling_factor - 1,
         )
-        mmi_loss = loss_fn(dense_fsa_vec=dense_fsa_vec, texts=texts)
+        # Compiled in the dataloader workers, see GraphCompilingDataset.
+        # It is None if --compile-graphs-in-workers is False.
+        num_graphs = get_compiled_graphs(batch, texts, device)
+        mmi_loss = loss_fn(
+            dense_fsa_vec=dense_fsa_vec, texts=texts, num_graphs=num_graphs
+        )
 
     if params.att_rate != 0.0:
         token_ids = graph_compiler.texts_to_ids(supervisions["text"])
@@ -717,6 +737,18 @@ def run(rank, world_size, args):
         eos_id=1,
     )
 
+    worker_graph_compiler = None
+    if params.compile_graphs_in_workers:
+        # The numerator graphs are compiled on CPU in the dataloader workers
+        worker_graph_compiler = MmiTrainingGraphCompiler(
+            params.lang_dir,
+            uniq_filename="lexicon.txt",
+            device="cpu",
+            oov="<UNK>",
+            sos_id=1,
+            eos_id=1,
+        )
+
     logging.info("About to create model")
     if params.att_rate == 0:
         assert params.num_decoder_layers == 0, f"{params.num_decoder_layers}"
@@ -749,17 +781,22 @@ def run(rank, world_size, args):
     if checkpoints:
         optimizer.load_state_dict(checkpoints["optimizer"])
 
-    train_960_ali_filename = Path(params.ali_dir) / "train-960.pt"
+    ali_dir = Path(params.ali_dir)
+    train_960_ali_filename = ali_dir / "train-960"
+    valid_ali_filename = ali_dir / "valid"
+    if not (train_960_ali_filename / "meta.json").is_file():
+        train_960_ali_filename = ali_dir / "train-960.pt"
+        valid_ali_filename = ali_dir / "valid.pt"
+
     if (
         params.batch_idx_train < params.use_ali_until
-        and train_960_ali_filename.is_file()
+        and train_960_ali_filename.exists()
     ):
         logging.info("Use pre-computed alignments")
         subsampling_factor, train_ali = load_alignments(train_960_ali_filename)
         assert subsampling_factor == params.subsampling_factor
         assert len(train_ali) == 843723, f"{len(train_ali)} vs 843723"
 
-        valid_ali_filename = Path(params.ali_dir) / "valid.pt"
         subsampling_factor, valid_ali = load_alignments(valid_ali_filename)
         assert subsampling_factor == params.subsampling_factor
 
@@ -799,11 +836,15 @@ def run(rank, world_size, args):
 
     train_cuts = train_cuts.filter(remove_short_and_long_utt)
 
-    train_dl = librispeech.train_dataloaders(train_cuts)
+    train_dl = librispeech.train_dataloaders(
+        train_cuts, graph_compiler=worker_graph_compiler
+    )
 
     valid_cuts = librispeech.dev_clean_cuts()
     valid_cuts += librispeech.dev_other_cuts()
-    valid_dl = librispeech.valid_dataloaders(valid_cuts)
+    valid_dl = librispeech.valid_dataloaders(
+        valid_cuts, graph_compiler=worker_graph_compiler
+    )
 
     for epoch in range(params.start_epoch, params.num_epochs):
         fix_random_seed(params.seed + epoch)
@@ -26,15 +26,24 @@ This script takes as input lang_dir and generates LG from
     - G, the LM, built from data/lm/G_3_gram.fst.txt
 
 The generated LG is saved in $lang_dir/LG.pt
+
+The intermediate results, e.g., the arc-sorted L and G and the composed LG,
+are saved to --cache-dir, with names containing a hash of their inputs. So
+compiling LG for another LM or after changing the lexicon only rebuilds
+the parts that depend on the changed files. See icefall/decoding_graph.py.
 """
 import argparse
 import logging
 from pathlib import Path
 
 import k2
-import torch
 
-from icefall.lexicon import Lexicon
+from icefall.decoding_graph import (
+    DEFAULT_GRAPH_CACHE_DIR,
+    GraphCache,
+    compile_LG,
+    save_fsa,
+)
 
 
 def get_args():
@@ -52,76 +61,25 @@ def get_args():
         help="""Stem name for LM used in HLG compiling.
         """,
     )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=DEFAULT_GRAPH_CACHE_DIR,
+        help="""Directory for the intermediate results. An empty string
+        disables the cache.
+        """,
+    )
 
     return parser.parse_args()
 
 
-def compile_LG(lang_dir: str, lm: str = "G_3_gram") -> k2.Fsa:
-    """
-    Args:
-      lang_dir:
-        The language directory, e.g., data/lang_phone or data/lang_bpe_5000.
-
-    Return:
-      An FSA representing LG.
-    """
-    lexicon = Lexicon(lang_dir)
-    L = k2.Fsa.from_dict(torch.load(f"{lang_dir}/L_disambig.pt"))
-
-    if Path(f"data/lm/{lm}.pt").is_file():
-        logging.info(f"Loading pre-compiled {lm}")
-        d = torch.load(f"data/lm/{lm}.pt")
-        G = k2.Fsa.from_dict(d)
-    else:
-        logging.info(f"Loading {lm}.fst.txt")
-        with open(f"data/lm/{lm}.fst.txt") as f:
-            G = k2.Fsa.from_openfst(f.read(), acceptor=False)
-            torch.save(G.as_dict(), f"data/lm/{lm}.pt")
-
-    first_token_disambig_id = lexicon.token_table["#0"]
-    first_word_disambig_id = lexicon.word_table["#0"]
-
-    L = k2.arc_sort(L)
-    G = k2.arc_sort(G)
-
-    logging.info("Intersecting L and G")
-    LG = k2.compose(L, G)
-    logging.info(f"LG shape: {LG.shape}")
-
-    logging.info("Connecting LG")
-    LG = k2.connect(LG)
-    logging.info(f"LG shape after k2.connect: {LG.shape}")
-
-    logging.info(type(LG.aux_labels))
-    logging.info("Determinizing LG")
-
-    LG = k2.determinize(LG, k2.DeterminizeWeightPushingType.kLogWeightPushing)
-    logging.info(type(LG.aux_labels))
-
-    logging.info("Connecting LG after k2.determinize")
-    LG = k2.connect(LG)
-
-    logging.info("Removing disambiguation symbols on LG")
-
-    # LG.labels[LG.labels >= first_token_disambig_id] = 0
-    # see https://github.com/k2-fsa/k2/pull/1140
-    labels = LG.labels
-    labels[labels >= first_token_disambig_id] = 0
-    LG.labels = labels
-
-    assert isinstance(LG.aux_labels, k2.RaggedTensor)
-    LG.aux_labels.values[LG.aux_labels.values >= first_word_disambig_id] = 0
-
-    LG = k2.remove_epsilon(LG)
-    logging.info(f"LG shape after k2.remove_epsilon: {LG.shape}")
-
-    LG = k2.connect(LG)
-    LG.aux_labels = LG.aux_labels.remove_values_eq(0)
-
-    logging.info("Arc sorting LG")
-    LG = k2.arc_sort(LG)
-
-    return LG
+def get_lm_file(lm: str) -> Path:
+    """Return data/lm/{lm}.fst.txt, or the data/lm/{lm}.pt saved by older
+    versions of this script if the former does not exist."""
+    lm_file = Path(f"data/lm/{lm}.fst.txt")
+    if not lm_file.is_file() and Path(f"data/lm/{lm}.pt").is_file():
+        lm_file = Path(f"data/lm/{lm}.pt")
+    return lm_file
 
 
 def main():
@@ -134,9 +92,15 @@ def main():
 
     logging.info(f"Processing {lang_dir}")
 
-    LG = compile_LG(lang_dir, args.lm)
+    cache = GraphCache(args.cache_dir) if args.cache_dir else None
+    LG = compile_LG(
+        lang_dir,
+        get_lm_file(args.lm),
+        cache=cache,
+        weight_pushing=k2.DeterminizeWeightPushingType.kLogWeightPushing,
+    )
     logging.info(f"Saving LG.pt to {lang_dir}")
-    torch.save(LG.as_dict(), f"{lang_dir}/LG.pt")
+    save_fsa(LG, lang_dir / "LG.pt")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Merge framewise alignments into one memory-mapped alignment directory
+(see icefall.ali.AlignmentStore), which is read by conformer_mmi/train.py
+with --ali-dir.
+
+Each input is either a directory written by conformer_ctc/ali.py, e.g.,
+data/ali/labels_train-clean-100, or a file saved by
+icefall.ali.save_alignments(), e.g., data/ali_500/train-960.pt.
+
+Usage:
+
+    ./local/merge_alignments.py \
+      --out-dir data/ali_500/train-960 \
+      data/ali/labels_train-clean-100 \
+      data/ali/labels_train-clean-360 \
+      data/ali/labels_train-other-500
+
+    ./local/merge_alignments.py \
+      --out-dir data/ali_500/valid \
+      data/ali/labels_dev-clean \
+      data/ali/labels_dev-other
+"""
+
+import argparse
+import logging
+from pathlib import Path
+
+from icefall.ali import AlignmentWriter, load_alignments
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--out-dir",
+        type=Path,
+        required=True,
+        help="The directory to save the merged alignments.",
+    )
+
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default="uint16",
+        choices=["uint16", "int32"],
+        help="dtype of the saved alignments. Use int32 for more than 65536 classes.",
+    )
+
+    parser.add_argument(
+        "inputs",
+        type=Path,
+        nargs="+",
+        help="Alignment directories or files to merge.",
+    )
+
+    return parser
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.info(vars(args))
+
+    if (args.out_dir / "meta.json").exists():
+        logging.info(f"{args.out_dir} exists - skipping")
+        return
+
+    writer = None
+    for p in args.inputs:
+        logging.info(f"Processing {p}")
+        subsampling_factor, alignments = load_alignments(p)
+        if writer is None:
+            writer = AlignmentWriter(args.out_dir, subsampling_factor, args.dtype)
+        assert writer.subsampling_factor == subsampling_factor, (
+            p,
+            writer.subsampling_factor,
+            subsampling_factor,
+        )
+
+        # An AlignmentStore is copied one cut at a time
+        for cut_id in alignments.keys():
+            writer.write(cut_id, alignments[cut_id])
+
+    writer.close()
+    logging.info(f"Saved {len(writer.cut_ids)} alignments to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
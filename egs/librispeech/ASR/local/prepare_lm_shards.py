@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+#
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script takes a `bpe.model` and a text file such as
+./download/lm/librispeech-lm-norm.txt
+and saves the LM training data in memory-mapped shards to a directory such
+as data/lm_training_bpe_500/lm_shards. See `LmShards` in
+icefall/rnn_lm/dataset.py for the format.
+
+Unlike ./local/prepare_lm_training_data.py and ./local/sort_lm_training_data.py,
+the text is read in chunks of --sentences-per-shard lines, which are encoded
+and saved by a pool of processes, so the memory usage does not grow with the
+size of the corpus. The sentences are sorted by length within each shard.
+
+The directory can be passed to `--lm-data` of rnn_lm/train.py and
+transformer_lm/train.py in place of sorted_lm_data.pt.
+
+Usage:
+
+    ./local/prepare_lm_shards.py \
+      --bpe-model data/lang_bpe_500/bpe.model \
+      --lm-data download/lm/librispeech-lm-norm.txt \
+      --lm-dir data/lm_training_bpe_500/lm_shards \
+      --num-workers 16
+"""
+
+import argparse
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import Dict, List, Union
+
+import sentencepiece as spm
+
+from icefall.rnn_lm.dataset import LmShards
+
+# The sentencepiece model of each worker process
+_sp = None
+# word -> BPE tokens, per worker process
+_word2bpe: Dict[str, List[int]] = {}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        "--bpe-model",
+        type=str,
+        required=True,
+        help="Input BPE model, e.g. data/lang_bpe_500/bpe.model",
+    )
+    parser.add_argument(
+        "--lm-data",
+        type=str,
+        required=True,
+        help="""Input LM training data as text, e.g.
+        download/lm/librispeech-lm-norm.txt""",
+    )
+    parser.add_argument(
+        "--lm-dir",
+        type=Path,
+        required=True,
+        help="""Output directory for the shards, e.g.
+        data/lm_training_bpe_500/lm_shards""",
+    )
+    parser.add_argument(
+        "--sentences-per-shard",
+        type=int,
+        default=1000000,
+        help="Number of sentences in each shard.",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=8,
+        help="Number of processes for encoding the sentences.",
+    )
+
+    return parser.parse_args()
+
+
+def _init_worker(bpe_model: str) -> None:
+    global _sp
+    _sp = spm.SentencePieceProcessor()
+    _sp.load(bpe_model)
+
+
+def _encode_shard(
+    lm_dir: Path, index: int, lines: List[str]
+) -> Dict[str, Union[str, int]]:
+    sentences = []
+    for line in lines:
+        tokens = []
+        for w in line.split():
+            # Encode each word only once, as in prepare_lm_training_data.py
+            if w not in _word2bpe:
+                _word2bpe[w] = _sp.encode(w)
+            tokens.extend(_word2bpe[w])
+        sentences.append(tokens)
+    return LmShards.write_shard(lm_dir, index, sentences)
+
+
+def main():
+    args = get_args()
+    logging.info(vars(args))
+
+    if (args.lm_dir / "index.json").exists():
+        logging.warning(f"{args.lm_dir} exists - skipping")
+        return
+
+    args.lm_dir.mkdir(parents=True, exist_ok=True)
+
+    shards = []
+    # Limit the number of chunks kept in memory
+    max_pending = 2 * args.num_workers
+    pending = deque()
+    with ProcessPoolExecutor(
+        args.num_workers, initializer=_init_worker, initargs=(args.bpe_model,)
+    ) as pool, open(args.lm_data) as f:
+        index = 0
+        while True:
+            lines = list(islice(f, args.sentences_per_shard))
+            if not lines:
+                break
+            if len(pending) >= max_pending:
+                shards.append(pending.popleft().result())
+                logging.info(f"Saved {shards[-1]}")
+            pending.append(pool.submit(_encode_shard, args.lm_dir, index, lines))
+            index += 1
+
+        while pending:
+            shards.append(pending.popleft().result())
+            logging.info(f"Saved {shards[-1]}")
+
+    LmShards.write_index(args.lm_dir, shards)
+
+    num_sentences = sum(s["num_sentences"] for s in shards)
+    num_tokens = sum(s["num_tokens"] for s in shards)
+    logging.info(
+        f"Saved {len(shards)} shards to {args.lm_dir}, "
+        f"num_sentences: {num_sentences}, num_tokens: {num_tokens}"
+    )
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    main()
@@ -11,6 +11,10 @@ set -eou pipefail
 # 1) Split long audios into chunks with overlaps.
 # 2) Perform speech recognition on chunks, getting tokens and timestamps.
 # 3) Merge the overlapped chunks into utterances acording to the timestamps.
+#
+# Stage 5 does the same as stages 2-4 in a single pass, without saving the chunk
+# manifests. It writes the results in shards and can resume after an interruption.
+# Use it instead of stages 2-4 for large datasets by setting stage=5 and stop_stage=5.
 
 # Each chunk (except the first and the last) is padded with extra left side and right side.
 # The chunk length is: left_side + chunk_size + right_side.
@@ -91,4 +95,21 @@ if [ $stage -le 4 ] && [ $stop_stage -ge 4 ]; then
     --extra $extra
 fi
 
-
+if [ $stage -le 5 ] && [ $stop_stage -ge 5 ]; then
+  # Results are saved in $output_dir/manifests_recog/librilight_cuts_{subset}_job_{rank}.{shard}.jsonl
+  log "Stage 5: Split, recognize and merge in a single pass"
+  for subset in small medium large; do
+    ./long_file_recog/recognize_single_pass.py \
+      --world-size $world_size \
+      --num-workers 8 \
+      --subset $subset \
+      --manifest-in-dir $output_dir/manifests \
+      --manifest-out-dir $output_dir/manifests_recog \
+      --nn-model-filename long_file_recog/exp/jit_model.pt \
+      --bpe-model data/lang_bpe_500/bpe.model \
+      --max-duration 2400 \
+      --chunk $chunk \
+      --extra $extra \
+      --decoding-method greedy_search
+  done
+fi
@@ -0,0 +1,636 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script recognizes long audios in a single pass. It does the work of
+split_into_chunks.py, recognize.py and merge_chunks.py without writing or
+reading the intermediate chunk manifests:
+
+  1) The recordings are read lazily and each one is sliced into overlapped
+     windows. Windows of consecutive recordings are put into the same batch,
+     and the features are computed in the dataloader workers.
+  2) The windows are decoded, getting tokens and timestamps.
+  3) The tokens of a recording are merged as its windows are decoded. Once
+     its last window is decoded, the recording is written out and dropped
+     from memory.
+
+The recordings whose audio fails to load are skipped with a warning.
+
+So the memory used depends on the number of recordings in flight, i.e., in
+the batches being prepared and decoded, not on the size of the manifest.
+
+The results are written to shards of --shard-size recordings,
+{manifest-out-dir}/librilight_cuts_{subset}[_job_{rank}].{shard}.jsonl, in the
+same format as merge_chunks.py. Each cut is flushed to its shard as soon as
+it is written. A file {shard}.jsonl.done is created when a shard is
+complete. If the script is restarted, complete shards are skipped.
+
+Usage:
+
+./long_file_recog/recognize_single_pass.py \
+  --world-size 4 \
+  --num-workers 8 \
+  --subset small \
+  --manifest-in-dir data/librilight/manifests \
+  --manifest-out-dir data/librilight/manifests_recog \
+  --nn-model-filename long_file_recog/exp/jit_model.pt \
+  --bpe-model data/lang_bpe_500/bpe.model \
+  --max-duration 2400 \
+  --chunk 30.0 \
+  --extra 2.0 \
+  --decoding-method greedy_search
+
+See recognize.py for how to get the torchscript model.
+"""
+
+import argparse
+import logging
+import math
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set
+
+import k2
+import sentencepiece as spm
+import torch
+import torch.multiprocessing as mp
+from asr_datamodule import SpeechRecognitionDataset
+from lhotse import (
+    CutSet,
+    Fbank,
+    FbankConfig,
+    MonoCut,
+    SupervisionSegment,
+    load_manifest_lazy,
+)
+from lhotse.cut import Cut
+from lhotse.dataset.input_strategies import OnTheFlyFeatures
+from lhotse.serialization import SequentialJsonlWriter
+from lhotse.supervision import AlignmentItem
+from recognize import decode_one_batch, get_params
+
+from icefall.utils import setup_logger, str2bool
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--world-size",
+        type=int,
+        default=1,
+        help="Number of GPUs to use.",
+    )
+
+    parser.add_argument(
+        "--subset",
+        type=str,
+        default="small",
+        help="Subset to process. Possible values are 'small', 'medium', 'large'",
+    )
+
+    parser.add_argument(
+        "--manifest-in-dir",
+        type=Path,
+        default=Path("data/librilight/manifests"),
+        help="""Path to directory with librilight_recordings_{subset}.jsonl.gz
+        and librilight_supervisions_{subset}.jsonl.gz""",
+    )
+
+    parser.add_argument(
+        "--manifest-out-dir",
+        type=Path,
+        default=Path("data/librilight/manifests_recog"),
+        help="Path to directory to save the shards of recognition results.",
+    )
+
+    parser.add_argument(
+        "--log-dir",
+        type=Path,
+        default=Path("long_file_recog/log"),
+        help="Path to directory to save logs.",
+    )
+
+    parser.add_argument(
+        "--nn-model-filename",
+        type=str,
+        required=True,
+        help="Path to the torchscript model cpu_jit.pt",
+    )
+
+    parser.add_argument(
+        "--bpe-model",
+        type=str,
+        default="data/lang_bpe_500/bpe.model",
+        help="Path to the BPE model",
+    )
+
+    parser.add_argument(
+        "--decoding-method",
+        type=str,
+        default="greedy_search",
+        help="""Possible values are:
+          - greedy_search
+          - modified_beam_search
+          - fast_beam_search
+        """,
+    )
+
+    parser.add_argument(
+        "--chunk",
+        type=float,
+        default=30.0,
+        help="""Duration (in seconds) of each window.""",
+    )
+
+    parser.add_argument(
+        "--extra",
+        type=float,
+        default=2.0,
+        help="""Extra duration (in seconds) at both sides of each window.
+        The tokens in them are dropped when merging.""",
+    )
+
+    parser.add_argument(
+        "--max-duration",
+        type=float,
+        default=600.0,
+        help="Maximum duration (in seconds) of the windows in a batch.",
+    )
+
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=8,
+        help="The number of dataloader workers computing features.",
+    )
+
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=1000,
+        help="Number of recordings in each output shard.",
+    )
+
+    parser.add_argument(
+        "--use-supervisions",
+        type=str2bool,
+        default=True,
+        help="""If True, read librilight_supervisions_{subset}.jsonl.gz, which
+        must be in the same order as the recordings, to copy the language,
+        speaker and book of each recording to the results.""",
+    )
+
+    return parser
+
+
+class Window(NamedTuple):
+    # The window, with one supervision covering it
+    cut: Cut
+    # Index of the recording among the recordings processed by this job
+    rec_index: int
+    # Index of the window in the recording
+    index: int
+    num_windows: int
+    # The original supervision of the recording, if any
+    supervision: Optional[SupervisionSegment]
+
+
+def iter_windows(
+    recordings_filename: Path,
+    supervisions_filename: Optional[Path],
+    chunk: float,
+    extra: float,
+    rank: int = 0,
+    world_size: int = 1,
+    skip_rec_index=None,
+) -> Iterator[Window]:
+    """Read the recordings lazily and yield their overlapped windows in order.
+    The windows are the same as the ones of split_into_chunks.py.
+
+    Args:
+      recordings_filename:
+        The recording manifest.
+      supervisions_filename:
+        The supervision manifest, with one supervision per recording in the
+        same order as the recordings. May be None.
+      chunk:
+        Duration (in seconds) of each window.
+      extra:
+        Extra duration (in seconds) at both sides of each window.
+      rank:
+        Only the recordings whose index modulo world_size equals rank are used.
+      world_size:
+        Number of jobs.
+      skip_rec_index:
+        If not None, a function called with the index of a recording among
+        the recordings of this job. It returns True to skip the recording.
+    """
+    recordings = load_manifest_lazy(recordings_filename)
+    if supervisions_filename is not None:
+        supervisions = iter(load_manifest_lazy(supervisions_filename))
+
+    rec_index = 0
+    for i, rec in enumerate(recordings):
+        sup = None
+        if supervisions_filename is not None:
+            sup = next(supervisions)
+            assert sup.recording_id == rec.id, (sup.recording_id, rec.id)
+
+        if i % world_size != rank:
+            continue
+        rec_index += 1
+        if skip_rec_index is not None and skip_rec_index(rec_index - 1):
+            continue
+
+        cut = MonoCut(
+            id=rec.id,
+            start=0,
+            duration=rec.duration,
+            channel=0,
+            recording=rec,
+        )
+        windows = cut.cut_into_windows(duration=chunk, hop=chunk - extra * 2)
+        windows = list(windows)
+        for index, window in enumerate(windows):
+            yield Window(
+                cut=window.fill_supervision(),
+                rec_index=rec_index - 1,
+                index=index,
+                num_windows=len(windows),
+                supervision=sup,
+            )
+
+
+class WindowDataset(torch.utils.data.IterableDataset):
+    """Batch the windows of iter_windows() by duration and compute their
+    features. The batches are split among the dataloader workers in a round
+    robin way, so that the dataloader returns them in order.
+
+    batch["windows"] contains the windows of the batch in order. The windows
+    whose audio fails to load are not in batch["supervisions"]["cut"]."""
+
+    def __init__(self, max_duration: float, **kwargs):
+        """
+        Args:
+          max_duration:
+            Maximum duration (in seconds) of the windows in a batch.
+          kwargs:
+            The arguments of :func:`iter_windows`.
+        """
+        self.max_duration = max_duration
+        self.kwargs = kwargs
+        self.dataset = SpeechRecognitionDataset(
+            return_cuts=True,
+            input_strategy=OnTheFlyFeatures(
+                Fbank(FbankConfig(num_mel_bins=80)), fault_tolerant=True
+            ),
+        )
+
+    def _iter_batches(self) -> Iterator[List[Window]]:
+        batch = []
+        duration = 0.0
+        for window in iter_windows(**self.kwargs):
+            if batch and duration + window.cut.duration > self.max_duration:
+                yield batch
+                batch = []
+                duration = 0.0
+            batch.append(window)
+            duration += window.cut.duration
+        if batch:
+            yield batch
+
+    def __iter__(self) -> Iterator[dict]:
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        for batch_idx, windows in enumerate(self._iter_batches()):
+            if batch_idx % num_workers != worker_id:
+                continue
+            try:
+                batch = self.dataset[CutSet.from_cuts(w.cut for w in windows)]
+            except Exception as e:
+                # lhotse fails on a batch without any audio loaded
+                logging.warning(f"Failed to compute the features of a batch: {e}")
+                batch = {"supervisions": {"cut": []}}
+            batch["windows"] = windows
+            yield batch
+
+
+class WindowMerger(object):
+    """Merge the decoding results of the windows of each recording, which
+    must be added in order. Only the recordings with windows not decoded yet
+    are kept. A recording with a dropped window is discarded."""
+
+    def __init__(self, extra: float):
+        """
+        Args:
+          extra:
+            Extra duration (in seconds) to drop at both sides of each window.
+        """
+        self.extra = extra
+        # recording id -> (alignments, end of the merged part)
+        self.pending: Dict[str, tuple] = {}
+        # Ids of the recordings discarded, whose last window is not seen yet
+        self.dropped: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def add(
+        self,
+        window: Window,
+        symbols: List[str],
+        timestamps: List[float],
+        scores: List[float],
+    ) -> Optional[MonoCut]:
+        """Add the results of a window. Return the cut of the recording with
+        the merged results if it is the last window of the recording, or None
+        otherwise. See merge_chunks.py for the format of the returned cut."""
+        cut = window.cut
+        rec = cut.recording
+        if rec.id in self.dropped:
+            if window.index == window.num_windows - 1:
+                self.dropped.remove(rec.id)
+            return None
+
+        if window.index == 0:
+            assert rec.id not in self.pending, rec.id
+            self.pending[rec.id] = ([], 0.0)
+        alignments, cur_end = self.pending[rec.id]
+
+        # Get left and right borders
+        extra = self.extra
+        left = cut.start + extra if cut.start > 0 else 0
+        chunk_end = cut.start + cut.duration
+        right = chunk_end - extra if chunk_end < rec.duration else rec.duration
+
+        # Assert the windows are continuous
+        assert math.isclose(left, cur_end, abs_tol=1e-6), (left, cur_end)
+
+        for symbol, start, score in zip(symbols, timestamps, scores):
+            t = start + cut.start
+            if left <= t < right:
+                ali = AlignmentItem(
+                    symbol=symbol, start=start, duration=None, score=score
+                )
+                alignments.append(ali.with_offset(cut.start))
+
+        if window.index < window.num_windows - 1:
+            self.pending[rec.id] = (alignments, right)
+            return None
+
+        del self.pending[rec.id]
+
+        sup = window.supervision
+        new_sup = SupervisionSegment(
+            id=rec.id,
+            recording_id=rec.id,
+            start=0,
+            duration=rec.duration,
+            alignment={"symbol": alignments},
+            language=sup.language if sup is not None else None,
+            speaker=sup.speaker if sup is not None else None,
+        )
+
+        utt_cut = MonoCut(
+            id=rec.id,
+            start=0,
+            duration=rec.duration,
+            channel=0,
+            recording=rec,
+            supervisions=[new_sup],
+        )
+        if sup is not None:
+            # Set a custom attribute to the cut
+            utt_cut.text_path = sup.book
+
+        return utt_cut
+
+    def drop(self, window: Window) -> None:
+        """Discard the recording of a window that could not be decoded, e.g.,
+        because its audio failed to load. The other windows of the recording
+        are ignored."""
+        rec_id = window.cut.recording.id
+        self.pending.pop(rec_id, None)
+        if window.index < window.num_windows - 1:
+            self.dropped.add(rec_id)
+        else:
+            self.dropped.discard(rec_id)
+
+
+class ShardedCutWriter(object):
+    """Write cuts, in the order of their recording indexes, to shards of
+    shard_size recordings. The cuts are flushed as soon as they are written,
+    and a marker file is created for each complete shard."""
+
+    def __init__(self, out_dir: Path, prefix: str, shard_size: int):
+        self.out_dir = out_dir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard = None
+        self.writer: Optional[SequentialJsonlWriter] = None
+
+    def _shard_filename(self, shard: int) -> Path:
+        return self.out_dir / f"{self.prefix}.{shard:06d}.jsonl"
+
+    def _done_filename(self, shard: int) -> Path:
+        return self.out_dir / f"{self.prefix}.{shard:06d}.jsonl.done"
+
+    def is_done(self, rec_index: int) -> bool:
+        """Return True if the shard of the given recording is complete."""
+        return self._done_filename(rec_index // self.shard_size).is_file()
+
+    def write(self, cut: Cut, rec_index: int) -> None:
+        shard = rec_index // self.shard_size
+        if shard != self.shard:
+            self._close_shard()
+            self.shard = shard
+            # A shard not marked as complete is written again from scratch
+            self.writer = SequentialJsonlWriter(
+                self._shard_filename(shard), overwrite=True
+            )
+        self.writer.write(cut, flush=True)
+
+    def _close_shard(self) -> None:
+        if self.writer is None:
+            return
+        self.writer.close()
+        self._done_filename(self.shard).touch()
+        logging.info(f"Shard saved to {self._shard_filename(self.shard)}")
+        self.writer = None
+
+    def close(self) -> None:
+        """Close the last shard. Call it only after all cuts are written."""
+        self._close_shard()
+
+
+@torch.no_grad()
+def run(rank, world_size, args):
+    """
+    Args:
+      rank:
+        It is a value between 0 and `world_size-1`.
+      world_size:
+        Number of GPUs to use.
+      args:
+        The return value of get_parser().parse_args()
+    """
+    params = get_params()
+    params.update(vars(args))
+
+    setup_logger(f"{params.log_dir}/log-decode-single-pass-{rank}")
+    logging.info("Decoding started")
+
+    assert params.decoding_method in (
+        "greedy_search",
+        "fast_beam_search",
+        "modified_beam_search",
+    ), params.decoding_method
+
+    sp = spm.SentencePieceProcessor()
+    sp.load(params.bpe_model)
+
+    # <blk> is defined in local/train_bpe_model.py
+    params.blank_id = sp.piece_to_id("<blk>")
+    params.unk_id = sp.piece_to_id("<unk>")
+    params.vocab_size = sp.get_piece_size()
+
+    logging.info(f"{params}")
+
+    device = torch.device("cpu")
+    if torch.cuda.is_available():
+        device = torch.device("cuda", rank)
+    logging.info(f"device: {device}")
+
+    logging.info("Loading jit model")
+    model = torch.jit.load(params.nn_model_filename)
+    model.to(device)
+    model.eval()
+
+    if params.decoding_method == "fast_beam_search":
+        decoding_graph = k2.trivial_graph(params.vocab_size - 1, device=device)
+    else:
+        decoding_graph = None
+
+    prefix = f"librilight_cuts_{params.subset}"
+    if world_size > 1:
+        prefix += f"_job_{rank}"
+    cuts_writer = ShardedCutWriter(
+        params.manifest_out_dir, prefix=prefix, shard_size=params.shard_size
+    )
+
+    supervisions_filename = None
+    if params.use_supervisions:
+        supervisions_filename = (
+            params.manifest_in_dir / f"librilight_supervisions_{params.subset}.jsonl.gz"
+        )
+    dataset = WindowDataset(
+        max_duration=params.max_duration,
+        recordings_filename=params.manifest_in_dir
+        / f"librilight_recordings_{params.subset}.jsonl.gz",
+        supervisions_filename=supervisions_filename,
+        chunk=params.chunk,
+        extra=params.extra,
+        rank=rank,
+        world_size=world_size,
+        skip_rec_index=cuts_writer.is_done,
+    )
+    dl = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=params.num_workers,
+        persistent_workers=False,
+    )
+
+    merger = WindowMerger(extra=params.extra)
+
+    num_recordings = 0
+    num_dropped = 0
+    log_interval = 10
+    for batch_idx, batch in enumerate(dl):
+        hyps, timestamps, scores = [], [], []
+        if len(batch["supervisions"]["cut"]) > 0:
+            hyps, timestamps, scores = decode_one_batch(
+                params=params,
+                model=model,
+                decoding_graph=decoding_graph,
+                batch=batch,
+            )
+
+        # The cuts whose audio failed to load are not in the batch, so the
+        # results are matched with the windows by cut id
+        results = {
+            cut.id: result
+            for cut, *result in zip(
+                batch["supervisions"]["cut"], hyps, timestamps, scores
+            )
+        }
+        for window in batch["windows"]:
+            if window.cut.id not in results:
+                logging.warning(
+                    f"Failed to load the audio of {window.cut.id}, "
+                    f"dropping recording {window.cut.recording.id}"
+                )
+                if window.cut.recording.id not in merger.dropped:
+                    num_dropped += 1
+                merger.drop(window)
+                continue
+
+            hyp, time_list, score_list = results[window.cut.id]
+            cut = merger.add(window, sp.id_to_piece(hyp), time_list, score_list)
+            if cut is not None:
+                cuts_writer.write(cut, window.rec_index)
+                num_recordings += 1
+
+        if batch_idx % log_interval == 0:
+            logging.info(
+                f"recordings processed until now is {num_recordings}, "
+                f"recordings in flight: {len(merger)}"
+            )
+
+    assert len(merger) == 0, len(merger)
+    cuts_writer.close()
+    logging.info(f"{num_recordings} recordings saved to {params.manifest_out_dir}")
+    if num_dropped > 0:
+        logging.warning(f"{num_dropped} recordings dropped")
+
+    logging.info("Done!")
+
+
+def main():
+    args = get_parser().parse_args()
+
+    subset = args.subset
+    assert subset in ["small", "medium", "large"], subset
+
+    args.manifest_out_dir.mkdir(parents=True, exist_ok=True)
+
+    world_size = args.world_size
+    assert world_size >= 1
+    if world_size > 1:
+        mp.spawn(run, args=(world_size, args), nprocs=world_size, join=True)
+    else:
+        run(rank=0, world_size=world_size, args=args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./long_file_recog/test_recognize_single_pass.py
+"""
+
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import soundfile as sf
+import torch
+from lhotse import (
+    CutSet,
+    Recording,
+    RecordingSet,
+    SupervisionSegment,
+    SupervisionSet,
+    load_manifest,
+)
+from lhotse.supervision import AlignmentItem
+from merge_chunks import merge_chunks
+from recognize_single_pass import (
+    ShardedCutWriter,
+    WindowDataset,
+    WindowMerger,
+    iter_windows,
+)
+
+CHUNK = 4.0
+EXTRA = 1.0
+DURATIONS = [10.0, 7.0, 3.0]
+
+
+def write_manifests(out_dir: Path):
+    recordings = []
+    supervisions = []
+    for i, duration in enumerate(DURATIONS):
+        filename = out_dir / f"rec-{i}.wav"
+        samples = np.random.uniform(-0.5, 0.5, int(duration * 16000))
+        sf.write(filename, samples, 16000)
+        rec = Recording.from_file(filename, recording_id=f"rec-{i}")
+        recordings.append(rec)
+        supervisions.append(
+            SupervisionSegment(
+                id=rec.id,
+                recording_id=rec.id,
+                start=0,
+                duration=rec.duration,
+                language="English",
+                speaker=f"spk-{i}",
+                custom={"book": f"book-{i}.txt"},
+            )
+        )
+    RecordingSet.from_recordings(recordings).to_file(out_dir / "recordings.jsonl.gz")
+    SupervisionSet.from_segments(supervisions).to_file(
+        out_dir / "supervisions.jsonl.gz"
+    )
+
+
+def window_kwargs(out_dir: Path, **kwargs):
+    return dict(
+        recordings_filename=out_dir / "recordings.jsonl.gz",
+        supervisions_filename=out_dir / "supervisions.jsonl.gz",
+        chunk=CHUNK,
+        extra=EXTRA,
+        **kwargs,
+    )
+
+
+def fake_results(window):
+    """Tokens every 0.25 seconds of a window, as if they were decoded."""
+    timestamps = np.arange(0, window.cut.duration, 0.25).tolist()
+    symbols = [f"{window.cut.id}-{i}" for i in range(len(timestamps))]
+    scores = [0.5] * len(timestamps)
+    return symbols, timestamps, scores
+
+
+def test_window_dataset():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        write_manifests(tmp_dir)
+        windows = list(iter_windows(**window_kwargs(tmp_dir)))
+        assert [w.rec_index for w in windows] == [0] * 4 + [1] * 3 + [2]
+        assert len(set(w.cut.id for w in windows)) == len(windows)
+
+        # Skip the second recording
+        windows = list(
+            iter_windows(**window_kwargs(tmp_dir, skip_rec_index={1}.__contains__))
+        )
+        assert [w.rec_index for w in windows] == [0] * 4 + [2]
+
+        # The second job of two gets the second recording
+        windows = list(iter_windows(**window_kwargs(tmp_dir, rank=1, world_size=2)))
+        assert [w.cut.recording.id for w in windows] == ["rec-1"] * 3
+
+        for num_workers in [0, 2]:
+            dataset = WindowDataset(max_duration=10.0, **window_kwargs(tmp_dir))
+            dl = torch.utils.data.DataLoader(
+                dataset, batch_size=None, num_workers=num_workers
+            )
+            batched = []
+            for batch in dl:
+                assert sum(w.cut.duration for w in batch["windows"]) <= 10.0
+                assert batch["inputs"].shape[0] == len(batch["windows"])
+                cut_ids = [c.id for c in batch["supervisions"]["cut"]]
+                assert cut_ids == [w.cut.id for w in batch["windows"]]
+                batched.extend(batch["windows"])
+            # In the same order as the windows
+            expected = list(iter_windows(**window_kwargs(tmp_dir)))
+            assert [w.cut.id for w in batched] == [w.cut.id for w in expected]
+
+        # The cuts whose audio fails to load are dropped from the batch
+        (tmp_dir / "rec-1.wav").unlink()
+        dataset = WindowDataset(max_duration=10.0, **window_kwargs(tmp_dir))
+        for batch in dataset:
+            cut_ids = [c.id for c in batch["supervisions"]["cut"]]
+            expected = [w.cut.id for w in batch["windows"] if w.rec_index != 1]
+            assert cut_ids == expected
+            if cut_ids:
+                assert batch["inputs"].shape[0] == len(cut_ids)
+
+
+def test_window_merger():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        write_manifests(tmp_dir)
+        windows = list(iter_windows(**window_kwargs(tmp_dir)))
+
+        # The chunk cuts with recognition results read by merge_chunks.py
+        cuts_chunk = []
+        for window in windows:
+            symbols, timestamps, scores = fake_results(window)
+            cut = window.cut
+            cut.supervisions[0].alignment = {
+                "symbol": [
+                    AlignmentItem(symbol=s, start=t, duration=None, score=p)
+                    for s, t, p in zip(symbols, timestamps, scores)
+                ]
+            }
+            cuts_chunk.append(cut)
+
+        class ListWriter:
+            def __init__(self):
+                self.cuts = []
+
+            def write(self, cut, flush=False):
+                self.cuts.append(cut)
+
+        writer = ListWriter()
+        supervisions = load_manifest(tmp_dir / "supervisions.jsonl.gz")
+        merge_chunks(
+            CutSet.from_cuts(cuts_chunk), supervisions, writer, sp=None, extra=EXTRA
+        )
+        expected = writer.cuts
+        assert len(expected) == len(DURATIONS)
+
+        merger = WindowMerger(extra=EXTRA)
+        merged = []
+        for window in iter_windows(**window_kwargs(tmp_dir)):
+            cut = merger.add(window, *fake_results(window))
+            assert (cut is None) == (window.index < window.num_windows - 1)
+            if cut is not None:
+                merged.append(cut)
+        assert len(merger) == 0
+
+        assert [c.to_dict() for c in merged] == [c.to_dict() for c in expected]
+        # The windows overlap, so some tokens are dropped
+        num_tokens = sum(len(fake_results(w)[0]) for w in windows)
+        num_merged = sum(len(c.supervisions[0].alignment["symbol"]) for c in merged)
+        assert num_merged < num_tokens
+
+        # A recording with a dropped window is discarded
+        merger = WindowMerger(extra=EXTRA)
+        merged = []
+        for window in iter_windows(**window_kwargs(tmp_dir)):
+            if window.rec_index == 0 and window.index == 1:
+                merger.drop(window)
+                continue
+            cut = merger.add(window, *fake_results(window))
+            if cut is not None:
+                merged.append(cut)
+        assert len(merger) == 0 and len(merger.dropped) == 0
+        assert [c.id for c in merged] == ["rec-1", "rec-2"]
+
+
+def test_sharded_cut_writer():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        write_manifests(tmp_dir)
+        cuts = CutSet.from_manifests(
+            recordings=load_manifest(tmp_dir / "recordings.jsonl.gz")
+        )
+        ids = [c.id for c in cuts]
+
+        writer = ShardedCutWriter(tmp_dir, prefix="cuts", shard_size=2)
+        for i, cut in enumerate(cuts):
+            assert not writer.is_done(i)
+            writer.write(cut, i)
+        # The first shard is complete as soon as a cut of the second one is
+        # written
+        assert writer.is_done(0) and writer.is_done(1)
+        assert not writer.is_done(2)
+        writer.close()
+        assert writer.is_done(2)
+
+        shard_0 = CutSet.from_file(tmp_dir / "cuts.000000.jsonl")
+        shard_1 = CutSet.from_file(tmp_dir / "cuts.000001.jsonl")
+        assert list(shard_0.ids) == ids[:2]
+        assert list(shard_1.ids) == ids[2:]
+
+        # A shard not marked as complete is written again from scratch
+        (tmp_dir / "cuts.000001.jsonl.done").unlink()
+        writer = ShardedCutWriter(tmp_dir, prefix="cuts", shard_size=2)
+        assert writer.is_done(0) and not writer.is_done(2)
+        writer.write(cuts[2], 2)
+        writer.close()
+        shard_1 = CutSet.from_file(tmp_dir / "cuts.000001.jsonl")
+        assert list(shard_1.ids) == ids[2:]
+
+
+def main():
+    test_window_dataset()
+    test_window_merger()
+    test_sharded_cut_writer()
+
+
+if __name__ == "__main__":
+    main()
@@ -262,3 +262,33 @@ if [ $stage -le 8 ] && [ $stop_stage -ge 8 ]; then
       --out-statistics $out_dir/statistics-test.txt
   done
 fi
+
+if [ $stage -le 9 ] && [ $stop_stage -ge 9 ]; then
+  log "Stage 9: Generate memory-mapped shards of NNLM data"
+  # An alternative to stages 5-8 for large LM corpora. The output
+  # directories can be passed to --lm-data and --lm-data-valid
+  # of rnn_lm/train.py and transformer_lm/train.py
+
+  for vocab_size in ${vocab_sizes[@]}; do
+    log "Processing vocab_size == ${vocab_size}"
+    lang_dir=data/lang_bpe_${vocab_size}
+    out_dir=data/lm_training_bpe_${vocab_size}
+    mkdir -p $out_dir
+
+    ./local/prepare_lm_shards.py \
+      --bpe-model $lang_dir/bpe.model \
+      --lm-data $dl_dir/lm/librispeech-lm-norm.txt \
+      --lm-dir $out_dir/lm_shards \
+      --num-workers $nj
+
+    ./local/prepare_lm_shards.py \
+      --bpe-model $lang_dir/bpe.model \
+      --lm-data $out_dir/valid.txt \
+      --lm-dir $out_dir/lm_shards-valid
+
+    ./local/prepare_lm_shards.py \
+      --bpe-model $lang_dir/bpe.model \
+      --lm-data $out_dir/test.txt \
+      --lm-dir $out_dir/lm_shards-test
+  done
+fi
@@ -17,6 +17,7 @@
 
 import math
 import warnings
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Tuple, Union
 
@@ -25,7 +26,15 @@ import sentencepiece as spm
 import torch
 from torch import nn
 
-from icefall import ContextGraph, ContextState, NgramLm, NgramLmStateCost
+from icefall import (
+    CompiledContextGraph,
+    CompiledNgramLm,
+    CompiledNgramLmStateCost,
+    ContextGraph,
+    ContextState,
+    NgramLm,
+    NgramLmStateCost,
+)
 from icefall.decode import Nbest, one_best_decoding
 from icefall.lm_wrapper import LmScorer
 from icefall.rnn_lm.model import RnnLmModel
@@ -781,6 +790,180 @@ def greedy_search_batch(
         )
 
 
+def greedy_search_batch_tensorized(
+    model: nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    blank_penalty: float = 0,
+    return_timestamps: bool = False,
+    sync_free: Optional[bool] = None,
+) -> Union[List[List[int]], DecodingResults]:
+    """Greedy search in batch mode. It hardcodes --max-sym-per-frame=1.
+
+    It produces the same results as :func:`greedy_search_batch`, but keeps
+    the hypotheses, timestamps and scores in tensors on the device of the
+    model, and copies them to the host only once at the end. After each
+    frame, the decoder output of the hypotheses that emitted a token is
+    updated in one of two ways:
+
+      - If sync_free is True, the decoder is run on all hypotheses and
+        torch.where() keeps the old output of the others. There is no
+        host-device synchronization until the end of the batch.
+      - Otherwise, the decoder is run only on the hypotheses that emitted a
+        token, and its outputs are scattered back with index_copy(). Finding
+        these hypotheses needs one synchronization per frame, which is cheap
+        on CPU, where it skips most of the decoder computation.
+
+    On CPU, the second way is faster than :func:`greedy_search_batch` for
+    large batches, e.g., the ones of decode.py, but slightly slower for
+    batches of a few utterances. See benchmark_greedy_search.py.
+
+    Args:
+      model:
+        The transducer model.
+      encoder_out:
+        Output from the encoder. Its shape is (N, T, C), where N >= 1.
+      encoder_out_lens:
+        A 1-D tensor of shape (N,), containing number of valid frames in
+        encoder_out before padding.
+      return_timestamps:
+        Whether to return timestamps.
+      sync_free:
+        Whether to update the decoder output without host-device
+        synchronization, see above. If None, it is True unless the model
+        is on CPU.
+    Returns:
+      If return_timestamps is False, return the decoded result.
+      Else, return a DecodingResults object containing
+      decoded result and corresponding timestamps.
+    """
+    assert encoder_out.ndim == 3
+    assert encoder_out.size(0) >= 1, encoder_out.size(0)
+
+    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
+        input=encoder_out,
+        lengths=encoder_out_lens.cpu(),
+        batch_first=True,
+        enforce_sorted=False,
+    )
+
+    device = next(model.parameters()).device
+    if sync_free is None:
+        sync_free = device.type != "cpu"
+
+    blank_id = model.decoder.blank_id
+    unk_id = getattr(model, "unk_id", blank_id)
+    context_size = model.decoder.context_size
+
+    batch_size_list = packed_encoder_out.batch_sizes.tolist()
+    N = encoder_out.size(0)
+    assert torch.all(encoder_out_lens > 0), encoder_out_lens
+    assert N == batch_size_list[0], (N, batch_size_list)
+
+    # The last context_size tokens of each hypothesis
+    contexts = torch.tensor(
+        [-1] * (context_size - 1) + [blank_id], device=device, dtype=torch.int64
+    ).repeat(N, 1)
+    # (N, context_size)
+
+    # tokens[t] contains the argmax of the hyps on frame t, and scores[t]
+    # their logits. They are packed like packed_encoder_out.
+    tokens = []
+    scores = []
+
+    decoder_out = model.decoder(contexts, need_pad=False)
+    decoder_out = model.joiner.decoder_proj(decoder_out)
+    # decoder_out: (N, 1, decoder_out_dim)
+
+    encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+
+    offset = 0
+    for t, batch_size in enumerate(batch_size_list):
+        start = offset
+        end = offset + batch_size
+        current_encoder_out = encoder_out.data[start:end]
+        current_encoder_out = current_encoder_out.unsqueeze(1).unsqueeze(1)
+        # current_encoder_out's shape: (batch_size, 1, 1, encoder_out_dim)
+        offset = end
+
+        decoder_out = decoder_out[:batch_size]
+        contexts = contexts[:batch_size]
+
+        logits = model.joiner(
+            current_encoder_out, decoder_out.unsqueeze(1), project_input=False
+        )
+        # logits'shape (batch_size, 1, 1, vocab_size)
+
+        logits = logits.squeeze(1).squeeze(1)  # (batch_size, vocab_size)
+        assert logits.ndim == 2, logits.shape
+
+        if blank_penalty != 0:
+            logits[:, 0] -= blank_penalty
+
+        score, y = logits.max(dim=1)
+        tokens.append(y)
+        scores.append(score)
+
+        # update decoder output of the hyps that emitted a token
+        emitted = y != blank_id
+        if unk_id != blank_id:
+            emitted &= y != unk_id
+        if sync_free:
+            new_contexts = torch.cat([contexts[:, 1:], y.unsqueeze(1)], dim=1)
+            new_decoder_out = model.decoder(new_contexts, need_pad=False)
+            new_decoder_out = model.joiner.decoder_proj(new_decoder_out)
+            contexts = torch.where(emitted.unsqueeze(1), new_contexts, contexts)
+            decoder_out = torch.where(
+                emitted.reshape(-1, 1, 1), new_decoder_out, decoder_out
+            )
+            continue
+
+        rows = emitted.nonzero(as_tuple=True)[0]
+        num_rows = rows.numel()
+        if num_rows == batch_size:
+            # No need to gather and scatter
+            contexts = torch.cat([contexts[:, 1:], y.unsqueeze(1)], dim=1)
+            decoder_out = model.decoder(contexts, need_pad=False)
+            decoder_out = model.joiner.decoder_proj(decoder_out)
+        elif num_rows > 0:
+            new_contexts = torch.cat([contexts[rows, 1:], y[rows].unsqueeze(1)], dim=1)
+            new_decoder_out = model.decoder(new_contexts, need_pad=False)
+            new_decoder_out = model.joiner.decoder_proj(new_decoder_out)
+            contexts = contexts.index_copy(0, rows, new_contexts)
+            decoder_out = decoder_out.index_copy(0, rows, new_decoder_out)
+
+    # Unpack to (N, T) in the original order of the utterances, padding
+    # with blank_id
+    tokens, _ = torch.nn.utils.rnn.pad_packed_sequence(
+        packed_encoder_out._replace(data=torch.cat(tokens)),
+        batch_first=True,
+        padding_value=blank_id,
+    )
+    scores, _ = torch.nn.utils.rnn.pad_packed_sequence(
+        packed_encoder_out._replace(data=torch.cat(scores)), batch_first=True
+    )
+    tokens = tokens.tolist()
+    scores = scores.tolist()
+
+    ans = []
+    ans_timestamps = []
+    ans_scores = []
+    for n in range(N):
+        frames = [t for t, v in enumerate(tokens[n]) if v not in (blank_id, unk_id)]
+        ans.append([tokens[n][t] for t in frames])
+        ans_timestamps.append(frames)
+        ans_scores.append([scores[n][t] for t in frames])
+
+    if not return_timestamps:
+        return ans
+    else:
+        return DecodingResults(
+            hyps=ans,
+            timestamps=ans_timestamps,
+            scores=ans_scores,
+        )
+
+
 @dataclass
 class Hypothesis:
     # The predicted tokens so far.
@@ -804,7 +987,7 @@ class Hypothesis:
     state: Optional[Tuple[torch.Tensor, torch.Tensor]] = None
 
     # N-gram LM state
-    state_cost: Optional[NgramLmStateCost] = None
+    state_cost: Optional[Union[NgramLmStateCost, CompiledNgramLmStateCost]] = None
 
     # Context graph state
     context_state: Optional[ContextState] = None
@@ -934,6 +1117,160 @@ class HypothesisList(object):
         return ", ".join(s)
 
 
+class DecoderOutputCache(object):
+    def __init__(self, max_size: int = 10000) -> None:
+        """
+        A LRU cache of the projected decoder output, i.e.,
+        `model.joiner.decoder_proj(model.decoder(...))`, keyed by the last
+        `context_size` tokens of a hypothesis.
+
+        Since the stateless decoder only depends on the last `context_size`
+        tokens, hypotheses sharing the same context can reuse the decoder
+        output, which is the case for most hypotheses when they emit blanks.
+
+        Args:
+          max_size:
+            Maximum number of entries in the cache. When the cache is full,
+            the least recently used entry is evicted.
+        """
+        assert max_size > 0, max_size
+        self.max_size = max_size
+        self._data: "OrderedDict[Tuple[int, ...], torch.Tensor]" = OrderedDict()
+
+        # Number of hypotheses whose decoder output is taken from the cache
+        self.num_hits = 0
+        # Number of hypotheses whose decoder output has to be computed
+        self.num_misses = 0
+
+    def get(self, key: Tuple[int, ...]) -> Optional[torch.Tensor]:
+        """Return the cached decoder output for the given context or None
+        if it does not exist. It does not change the counters."""
+        value = self._data.get(key)
+        if value is not None:
+            self._data.move_to_end(key)
+        return value
+
+    def put(self, key: Tuple[int, ...], value: torch.Tensor) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.num_hits + self.num_misses
+        return self.num_hits / total if total > 0 else 0.0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __str__(self) -> str:
+        return (
+            f"num_hits: {self.num_hits}, num_misses: {self.num_misses}, "
+            f"hit_rate: {self.hit_rate:.2%}, size: {len(self)}/{self.max_size}"
+        )
+
+
+def get_decoder_out_with_cache(
+    model: nn.Module,
+    contexts: List[List[int]],
+    caches: List[DecoderOutputCache],
+) -> torch.Tensor:
+    """Compute the projected decoder output of the given contexts.
+    Only contexts not present in the caches are fed to the decoder, in a
+    single batch.
+
+    Args:
+      model:
+        The transducer model.
+      contexts:
+        contexts[i] contains the last `context_size` tokens of the i-th
+        hypothesis.
+      caches:
+        caches[i] is the cache used for the i-th hypothesis. Different
+        hypotheses can share the same cache, e.g., hypotheses of the same
+        stream in streaming decoding.
+    Returns:
+      Return a tensor of shape (len(contexts), 1, 1, joiner_dim), the same as
+      `model.joiner.decoder_proj(model.decoder(...).unsqueeze(1))`.
+    """
+    assert len(contexts) == len(caches), (len(contexts), len(caches))
+    device = next(model.parameters()).device
+
+    ans: List[Optional[torch.Tensor]] = []
+    # Map (id(cache), key) to indexes of hypotheses in `ans` that need it
+    missed: Dict[Tuple[int, Tuple[int, ...]], List[int]] = {}
+    missed_caches = []
+    for i, (context, cache) in enumerate(zip(contexts, caches)):
+        key = tuple(context)
+        value = cache.get(key)
+        if value is not None:
+            cache.num_hits += 1
+        elif (id(cache), key) in missed:
+            # The same context is computed only once in a batch
+            cache.num_hits += 1
+            missed[(id(cache), key)].append(i)
+        else:
+            cache.num_misses += 1
+            missed[(id(cache), key)] = [i]
+            missed_caches.append(cache)
+        ans.append(value)
+
+    if missed:
+        decoder_input = torch.tensor(
+            [key for _, key in missed.keys()],
+            device=device,
+            dtype=torch.int64,
+        )  # (num_missed, context_size)
+
+        decoder_out = model.decoder(decoder_input, need_pad=False)
+        decoder_out = model.joiner.decoder_proj(decoder_out)
+        # decoder_out is of shape (num_missed, 1, joiner_dim)
+
+        for cache, (_, key), indexes, value in zip(
+            missed_caches, missed.keys(), missed.values(), decoder_out
+        ):
+            # clone() so that the cache does not keep the whole batch alive
+            value = value.clone()
+            cache.put(key, value)
+            for i in indexes:
+                ans[i] = value
+
+    return torch.stack(ans).unsqueeze(1)
+
+
+def init_state_cost(
+    ngram_lm: Union[NgramLm, CompiledNgramLm]
+) -> Union[NgramLmStateCost, CompiledNgramLmStateCost]:
+    """Return the n-gram LM state of a hypothesis without any tokens."""
+    if isinstance(ngram_lm, CompiledNgramLm):
+        return CompiledNgramLmStateCost(ngram_lm)
+    return NgramLmStateCost(ngram_lm)
+
+
+def forward_state_costs(
+    state_costs: List[Union[NgramLmStateCost, CompiledNgramLmStateCost]],
+    labels: List[int],
+) -> List[Union[NgramLmStateCost, CompiledNgramLmStateCost]]:
+    """Advance the n-gram LM states of many hypotheses by one token each.
+    For a :class:`CompiledNgramLm`, it is a single vectorized lookup.
+
+    Args:
+      state_costs:
+        The n-gram LM states of the hypotheses.
+      labels:
+        The new token of each hypothesis.
+    Returns:
+      Return the new n-gram LM states, one per hypothesis.
+    """
+    if len(state_costs) == 0:
+        return []
+    return type(state_costs[0]).forward_one_step_batch(state_costs, labels)
+
+
 def get_hyps_shape(hyps: List[HypothesisList]) -> k2.RaggedShape:
     """Return a ragged shape with axes [utt][num_hyps].
 
@@ -1203,6 +1540,7 @@ def modified_beam_search(
     temperature: float = 1.0,
     blank_penalty: float = 0.0,
     return_timestamps: bool = False,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> Union[List[List[int]], DecodingResults]:
     """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
 
@@ -1220,6 +1558,9 @@ def modified_beam_search(
         Softmax temperature.
       return_timestamps:
         Whether to return timestamps.
+      decoder_cache:
+        If not None, decoder outputs are looked up in it and only
+        the missed contexts are computed.
     Returns:
       If return_timestamps is False, return the decoded result.
       Else, return a DecodingResults object containing
@@ -1281,14 +1622,20 @@ def modified_beam_search(
             [hyp.log_prob.reshape(1, 1) for hyps in A for hyp in hyps]
         )  # (num_hyps, 1)
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
+        if decoder_cache is None:
+            decoder_input = torch.tensor(
+                [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+                device=device,
+                dtype=torch.int64,
+            )  # (num_hyps, context_size)
 
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+            decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
+            decoder_out = model.joiner.decoder_proj(decoder_out)
+        else:
+            contexts = [hyp.ys[-context_size:] for hyps in A for hyp in hyps]
+            decoder_out = get_decoder_out_with_cache(
+                model, contexts, [decoder_cache] * len(contexts)
+            )
         # decoder_out is of shape (num_hyps, 1, 1, joiner_dim)
 
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
@@ -1347,6 +1694,7 @@ def modified_beam_search(
                         (
                             context_score,
                             new_context_state,
+                            _,
                         ) = context_graph.forward_one_step(hyp.context_state, new_token)
 
                 new_log_prob = topk_log_probs[k] + context_score
@@ -1400,6 +1748,281 @@ def modified_beam_search(
         )
 
 
+# Parameters of the two polynomial rolling hashes used by
+# modified_beam_search_tensorized() to identify the token sequence of a
+# hypothesis. _HASH_MOD is 2**31 - 1, so that hash * base never overflows int64.
+_HASH_MOD = 2147483647
+_HASH_BASES = (1000003, 999331)
+
+
+def modified_beam_search_tensorized(
+    model: nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    context_graph: Optional[CompiledContextGraph] = None,
+    beam: int = 4,
+    temperature: float = 1.0,
+    blank_penalty: float = 0.0,
+    return_timestamps: bool = False,
+) -> Union[List[List[int]], DecodingResults]:
+    """The same as :func:`modified_beam_search`, but all hypotheses of the
+    batch are kept in preallocated tensors of shape (N, beam) instead of
+    `Hypothesis` objects.
+
+    For each hypothesis, we keep its score, the last `context_size` tokens
+    (i.e., the decoder input), the number of emitted tokens and a pair of
+    rolling hashes of its token sequence. Hypotheses with the same token
+    sequence are detected by comparing hashes and merged with `logaddexp`.
+    The top-k of all utterances is computed with a single `topk` call per frame.
+    Back-pointers and emitted tokens are saved for each frame and the
+    token sequences are recovered by backtracking only once at the end.
+
+    Args:
+      model:
+        The transducer model.
+      encoder_out:
+        Output from the encoder. Its shape is (N, T, C).
+      encoder_out_lens:
+        A 1-D tensor of shape (N,), containing number of valid frames in
+        encoder_out before padding.
+      context_graph:
+        An optional compiled context graph for contextual biasing. It has to
+        be on the same device as the model.
+      beam:
+        Number of active paths during the beam search.
+      temperature:
+        Softmax temperature.
+      blank_penalty:
+        The score used to penalize blank probability.
+      return_timestamps:
+        Whether to return timestamps.
+    Returns:
+      If return_timestamps is False, return the decoded result.
+      Else, return a DecodingResults object containing
+      decoded result and corresponding timestamps.
+    """
+    assert encoder_out.ndim == 3, encoder_out.shape
+    assert encoder_out.size(0) >= 1, encoder_out.size(0)
+
+    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
+        input=encoder_out,
+        lengths=encoder_out_lens.cpu(),
+        batch_first=True,
+        enforce_sorted=False,
+    )
+
+    blank_id = model.decoder.blank_id
+    unk_id = getattr(model, "unk_id", blank_id)
+    context_size = model.decoder.context_size
+    device = next(model.parameters()).device
+
+    batch_size_list = packed_encoder_out.batch_sizes.tolist()
+    N = encoder_out.size(0)
+    T = len(batch_size_list)
+    assert torch.all(encoder_out_lens > 0), encoder_out_lens
+    assert N == batch_size_list[0], (N, batch_size_list)
+
+    # scores[n][k] is the log_prob of the k-th hypothesis of the n-th utterance.
+    # Unused slots have a score of -inf.
+    scores = torch.full((N, beam), float("-inf"), device=device)
+    scores[:, 0] = 0
+
+    # contexts[n][k] contains the last context_size tokens of the hypothesis
+    contexts = torch.tensor(
+        [-1] * (context_size - 1) + [blank_id], device=device, dtype=torch.int64
+    ).repeat(N, beam, 1)
+
+    # num_tokens[n][k] is the number of tokens emitted by the hypothesis
+    num_tokens = torch.zeros(N, beam, device=device, dtype=torch.int64)
+
+    # hashes[n][k] contains the two rolling hashes of the emitted tokens
+    hashes = torch.zeros(N, beam, 2, device=device, dtype=torch.int64)
+    hash_bases = torch.tensor(_HASH_BASES, device=device, dtype=torch.int64)
+
+    # context_states[n][k] is the state of the hypothesis in context_graph.
+    # All hypotheses start from the root, whose id is 0.
+    context_states = torch.zeros(N, beam, device=device, dtype=torch.int64)
+
+    # back_pointers[t][n][k] is the index of the hypothesis on frame t - 1
+    # that the k-th hypothesis on frame t extends.
+    # tokens[t][n][k] is the token emitted on frame t by that hypothesis,
+    # or -1 if it emitted nothing.
+    back_pointers = torch.zeros(T, N, beam, device=device, dtype=torch.int64)
+    tokens = torch.full((T, N, beam), -1, device=device, dtype=torch.int64)
+
+    encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+
+    offset = 0
+    for t, batch_size in enumerate(batch_size_list):
+        start = offset
+        end = offset + batch_size
+        current_encoder_out = encoder_out.data[start:end]
+        # current_encoder_out's shape is (batch_size, encoder_out_dim)
+        offset = end
+
+        cur_scores = scores[:batch_size]
+        utt_indexes, hyp_indexes = torch.nonzero(
+            cur_scores != float("-inf"), as_tuple=True
+        )
+
+        decoder_input = contexts[utt_indexes, hyp_indexes]
+        # (num_hyps, context_size)
+
+        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
+        decoder_out = model.joiner.decoder_proj(decoder_out)
+        # decoder_out is of shape (num_hyps, 1, 1, joiner_dim)
+
+        current_encoder_out = current_encoder_out[utt_indexes]
+        current_encoder_out = current_encoder_out.unsqueeze(1).unsqueeze(1)
+        # (num_hyps, 1, 1, encoder_out_dim)
+
+        logits = model.joiner(
+            current_encoder_out,
+            decoder_out,
+            project_input=False,
+        )  # (num_hyps, 1, 1, vocab_size)
+
+        logits = logits.squeeze(1).squeeze(1)  # (num_hyps, vocab_size)
+
+        if blank_penalty != 0:
+            logits[:, 0] -= blank_penalty
+
+        log_probs = (logits / temperature).log_softmax(dim=-1)  # (num_hyps, vocab_size)
+
+        log_probs.add_(cur_scores[utt_indexes, hyp_indexes].unsqueeze(1))
+
+        vocab_size = log_probs.size(-1)
+
+        padded_log_probs = log_probs.new_full(
+            (batch_size, beam, vocab_size), float("-inf")
+        )
+        padded_log_probs[utt_indexes, hyp_indexes] = log_probs
+
+        # Since unused slots contain -inf, the order of the candidates
+        # is the same as that of the ragged topk in modified_beam_search()
+        topk_log_probs, topk_indexes = padded_log_probs.reshape(batch_size, -1).topk(
+            beam
+        )  # (batch_size, beam)
+
+        topk_hyp_indexes = torch.div(topk_indexes, vocab_size, rounding_mode="floor")
+        topk_token_indexes = topk_indexes % vocab_size
+
+        emitted = (topk_token_indexes != blank_id) & (topk_token_indexes != unk_id)
+
+        new_context_states = context_states[:batch_size].gather(1, topk_hyp_indexes)
+        if context_graph is not None:
+            context_scores, next_context_states, _ = context_graph.forward_one_step(
+                new_context_states.reshape(-1), topk_token_indexes.reshape(-1)
+            )
+            context_scores = context_scores.reshape(batch_size, beam)
+            next_context_states = next_context_states.reshape(batch_size, beam)
+
+            topk_log_probs = topk_log_probs + torch.where(emitted, context_scores, 0)
+            new_context_states = torch.where(
+                emitted, next_context_states, new_context_states
+            )
+
+        prev_contexts = contexts[:batch_size].gather(
+            1, topk_hyp_indexes.unsqueeze(-1).expand(-1, -1, context_size)
+        )
+        new_contexts = torch.cat(
+            [prev_contexts[:, :, 1:], topk_token_indexes.unsqueeze(-1)], dim=-1
+        )
+        new_contexts = torch.where(emitted.unsqueeze(-1), new_contexts, prev_contexts)
+
+        new_num_tokens = num_tokens[:batch_size].gather(1, topk_hyp_indexes) + emitted
+
+        prev_hashes = hashes[:batch_size].gather(
+            1, topk_hyp_indexes.unsqueeze(-1).expand(-1, -1, 2)
+        )
+        new_hashes = (
+            prev_hashes * hash_bases + topk_token_indexes.unsqueeze(-1) + 1
+        ) % _HASH_MOD
+        new_hashes = torch.where(emitted.unsqueeze(-1), new_hashes, prev_hashes)
+
+        # same[n][i][j] is True if the i-th and the j-th candidates of the
+        # n-th utterance have the same token sequence
+        same = (new_hashes.unsqueeze(2) == new_hashes.unsqueeze(1)).all(dim=-1)
+        same &= new_num_tokens.unsqueeze(2) == new_num_tokens.unsqueeze(1)
+
+        # first[n][i] is the index of the first candidate having the same
+        # token sequence as the i-th candidate. Note that argmax returns
+        # the index of the first maximal value.
+        first = same.to(torch.int32).argmax(dim=-1)
+
+        # Merge duplicates into the first one in the order in which
+        # HypothesisList.add() would merge them
+        new_scores = topk_log_probs.clone()
+        for k in range(1, beam):
+            index = first[:, k : k + 1]
+            prev = new_scores.gather(1, index)
+            merged = torch.logaddexp(prev, topk_log_probs[:, k : k + 1])
+            new_scores.scatter_(1, index, torch.where(index == k, prev, merged))
+
+        is_duplicate = first != torch.arange(beam, device=device)
+        new_scores.masked_fill_(is_duplicate, float("-inf"))
+
+        scores[:batch_size] = new_scores
+        contexts[:batch_size] = new_contexts
+        num_tokens[:batch_size] = new_num_tokens
+        hashes[:batch_size] = new_hashes
+        context_states[:batch_size] = new_context_states
+
+        back_pointers[t, :batch_size] = topk_hyp_indexes
+        tokens[t, :batch_size] = torch.where(emitted, topk_token_indexes, -1)
+
+    if context_graph is not None:
+        # Subtract the bonus of partially matched phrases, see
+        # ContextGraph.finalize()
+        context_scores, _ = context_graph.finalize(context_states)
+        scores = scores + context_scores
+
+    # len(hyp.ys) in modified_beam_search() includes the context_size
+    # leading tokens
+    best_hyp_indexes = (scores / (num_tokens + context_size)).argmax(dim=1)
+
+    back_pointers = back_pointers.cpu()
+    tokens = tokens.cpu()
+    cur_hyp_indexes = best_hyp_indexes.cpu()
+
+    # Utterances are sorted by length in descending order, so at frame t
+    # the first batch_size_list[t] utterances are active and an utterance
+    # starts backtracking from its best hypothesis on its last frame.
+    best_path_tokens = torch.full((T, N), -1, dtype=torch.int64)
+    utt_indexes = torch.arange(N)
+    for t in range(T - 1, -1, -1):
+        batch_size = batch_size_list[t]
+        indexes = cur_hyp_indexes[:batch_size]
+        best_path_tokens[t, :batch_size] = tokens[t, utt_indexes[:batch_size], indexes]
+        cur_hyp_indexes[:batch_size] = back_pointers[
+            t, utt_indexes[:batch_size], indexes
+        ]
+
+    best_path_tokens = best_path_tokens.t()  # (N, T)
+
+    sorted_ans = []
+    sorted_timestamps = []
+    for n in range(N):
+        timestamp = torch.nonzero(best_path_tokens[n] != -1, as_tuple=True)[0]
+        sorted_ans.append(best_path_tokens[n, timestamp].tolist())
+        sorted_timestamps.append(timestamp.tolist())
+
+    ans = []
+    ans_timestamps = []
+    unsorted_indices = packed_encoder_out.unsorted_indices.tolist()
+    for i in range(N):
+        ans.append(sorted_ans[unsorted_indices[i]])
+        ans_timestamps.append(sorted_timestamps[unsorted_indices[i]])
+
+    if not return_timestamps:
+        return ans
+    else:
+        return DecodingResults(
+            hyps=ans,
+            timestamps=ans_timestamps,
+        )
+
+
 def modified_beam_search_lm_rescore(
     model: nn.Module,
     encoder_out: torch.Tensor,
@@ -2462,7 +3085,7 @@ def modified_beam_search_ngram_rescoring(
     model: nn.Module,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
-    ngram_lm: NgramLm,
+    ngram_lm: Union[NgramLm, CompiledNgramLm],
     ngram_lm_scale: float,
     beam: int = 4,
     temperature: float = 1.0,
@@ -2512,7 +3135,7 @@ def modified_beam_search_ngram_rescoring(
             Hypothesis(
                 ys=[-1] * (context_size - 1) + [blank_id],
                 log_prob=torch.zeros(1, dtype=torch.float32, device=device),
-                state_cost=NgramLmStateCost(ngram_lm),
+                state_cost=init_state_cost(ngram_lm),
             )
         )
 
@@ -2582,6 +3205,11 @@ def modified_beam_search_ngram_rescoring(
         )
         ragged_log_probs = k2.RaggedTensor(shape=log_probs_shape, value=log_probs)
 
+        # Advance the n-gram LM states of all hyps with a non-blank new
+        # token at once
+        topk = []
+        state_costs = []
+        labels = []
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
 
@@ -2589,6 +3217,18 @@ def modified_beam_search_ngram_rescoring(
                 warnings.simplefilter("ignore")
                 topk_hyp_indexes = (topk_indexes // vocab_size).tolist()
                 topk_token_indexes = (topk_indexes % vocab_size).tolist()
+            topk.append((topk_log_probs, topk_hyp_indexes, topk_token_indexes))
+
+            for hyp_idx, new_token in zip(topk_hyp_indexes, topk_token_indexes):
+                if new_token not in (blank_id, unk_id):
+                    state_costs.append(A[i][hyp_idx].state_cost)
+                    labels.append(new_token)
+
+        state_costs = forward_state_costs(state_costs, labels)
+
+        count = 0  # index, used to locate state_costs
+        for i in range(batch_size):
+            topk_log_probs, topk_hyp_indexes, topk_token_indexes = topk[i]
 
             for k in range(len(topk_hyp_indexes)):
                 hyp_idx = topk_hyp_indexes[k]
@@ -2598,7 +3238,8 @@ def modified_beam_search_ngram_rescoring(
                 new_token = topk_token_indexes[k]
                 if new_token not in (blank_id, unk_id):
                     new_ys.append(new_token)
-                    state_cost = hyp.state_cost.forward_one_step(new_token)
+                    state_cost = state_costs[count]
+                    count += 1
                 else:
                     state_cost = hyp.state_cost
 
@@ -2626,11 +3267,12 @@ def modified_beam_search_LODR(
     model: nn.Module,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
-    LODR_lm: NgramLm,
+    LODR_lm: Union[NgramLm, CompiledNgramLm],
     LODR_lm_scale: float,
     LM: LmScorer,
     beam: int = 4,
     context_graph: Optional[ContextGraph] = None,
+    decoder_cache: Optional[DecoderOutputCache] = None,
 ) -> List[List[int]]:
     """This function implements LODR (https://arxiv.org/abs/2203.16776) with
     `modified_beam_search`. It uses a bi-gram language model as the estimate
@@ -2654,6 +3296,11 @@ def modified_beam_search_LODR(
             A neural net LM, e.g an RNNLM or transformer LM
         beam (int, optional):
             Beam size. Defaults to 4.
+        context_graph:
+            An optional context graph for contextual biasing.
+        decoder_cache:
+            If not None, decoder outputs are looked up in it and only
+            the missed contexts are computed.
 
     Returns:
       Return a list-of-list of token IDs. ans[i] is the decoding results
@@ -2696,9 +3343,7 @@ def modified_beam_search_LODR(
                 log_prob=torch.zeros(1, dtype=torch.float32, device=device),
                 state=init_states,  # state of the NN LM
                 lm_score=init_score.reshape(-1),
-                state_cost=NgramLmStateCost(
-                    LODR_lm
-                ),  # state of the source domain ngram
+                state_cost=init_state_cost(LODR_lm),  # state of the source domain ngram
                 context_state=None if context_graph is None else context_graph.root,
             )
         )
@@ -2727,14 +3372,20 @@ def modified_beam_search_LODR(
             [hyp.log_prob.reshape(1, 1) for hyps in A for hyp in hyps]
         )
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
+        if decoder_cache is None:
+            decoder_input = torch.tensor(
+                [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+                device=device,
+                dtype=torch.int64,
+            )  # (num_hyps, context_size)
 
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+            decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
+            decoder_out = model.joiner.decoder_proj(decoder_out)
+        else:
+            contexts = [hyp.ys[-context_size:] for hyps in A for hyp in hyps]
+            decoder_out = get_decoder_out_with_cache(
+                model, contexts, [decoder_cache] * len(contexts)
+            )
 
         current_encoder_out = torch.index_select(
             current_encoder_out,
@@ -2773,8 +3424,11 @@ def modified_beam_search_LODR(
         non-blank token.
         """
         token_list = []
-        hs = []
-        cs = []
+        # The LM states of the hyps to score, i.e., the LSTM states for the RNN
+        # LM, or the cached keys and values for the transformer LM, so that
+        # only the new token is fed to the LM.
+        states = []
+        state_costs = []
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
 
@@ -2788,39 +3442,22 @@ def modified_beam_search_LODR(
 
                 new_token = topk_token_indexes[k]
                 if new_token not in (blank_id, unk_id):
-                    if LM.lm_type == "rnn":
-                        token_list.append([new_token])
-                        # store the LSTM states
-                        hs.append(hyp.state[0])
-                        cs.append(hyp.state[1])
-                    else:
-                        # for transformer LM
-                        token_list.append(
-                            [sos_id] + hyp.ys[context_size:] + [new_token]
-                        )
+                    token_list.append([new_token])
+                    states.append(hyp.state)
+                    state_costs.append(hyp.state_cost)
+
+        # advance the n-gram LM states of the same hyps at once
+        state_costs = forward_state_costs(
+            state_costs, [tokens[0] for tokens in token_list]
+        )
 
         # forward NN LM to get new states and scores
         if len(token_list) != 0:
             x_lens = torch.tensor([len(tokens) for tokens in token_list]).to(device)
-            if LM.lm_type == "rnn":
-                tokens_to_score = (
-                    torch.tensor(token_list).to(torch.int64).to(device).reshape(-1, 1)
-                )
-                hs = torch.cat(hs, dim=1).to(device)
-                cs = torch.cat(cs, dim=1).to(device)
-                state = (hs, cs)
-            else:
-                # for transformer LM
-                tokens_list = [torch.tensor(tokens) for tokens in token_list]
-                tokens_to_score = (
-                    torch.nn.utils.rnn.pad_sequence(
-                        tokens_list, batch_first=True, padding_value=0.0
-                    )
-                    .to(device)
-                    .to(torch.int64)
-                )
-
-                state = None
+            tokens_to_score = (
+                torch.tensor(token_list).to(torch.int64).to(device).reshape(-1, 1)
+            )
+            state = LM.stack_states(states)
 
             scores, lm_states = LM.score_token(tokens_to_score, x_lens, state)
 
@@ -2853,10 +3490,11 @@ def modified_beam_search_LODR(
                         (
                             context_score,
                             new_context_state,
+                            _,
                         ) = context_graph.forward_one_step(hyp.context_state, new_token)
 
                     ys.append(new_token)
-                    state_cost = hyp.state_cost.forward_one_step(new_token)
+                    state_cost = state_costs[count]
 
                     # calculate the score of the latest token
                     current_ngram_score = state_cost.lm_score - hyp.state_cost.lm_score
@@ -2874,11 +3512,7 @@ def modified_beam_search_LODR(
                     )  # add the lm score
 
                     lm_score = scores[count]
-                    if LM.lm_type == "rnn":
-                        state = (
-                            lm_states[0][:, count, :].unsqueeze(1),
-                            lm_states[1][:, count, :].unsqueeze(1),
-                        )
+                    state = LM.get_state(lm_states, count)
                     count += 1
                 else:
                     state_cost = hyp.state_cost
@@ -3068,8 +3702,10 @@ def modified_beam_search_lm_shallow_fusion(
         non-blank token.
         """
         token_list = []  # a list of list
-        hs = []
-        cs = []
+        # The LM states of the hyps to score, i.e., the LSTM states for the RNN
+        # LM, or the cached keys and values for the transformer LM, so that
+        # only the new token is fed to the LM.
+        states = []
         for i in range(batch_size):
             topk_log_probs, topk_indexes = ragged_log_probs[i].topk(beam)
 
@@ -3083,38 +3719,15 @@ def modified_beam_search_lm_shallow_fusion(
 
                 new_token = topk_token_indexes[k]
                 if new_token not in (blank_id, unk_id):
-                    if LM.lm_type == "rnn":
-                        token_list.append([new_token])
-                        # store the LSTM states
-                        hs.append(hyp.state[0])
-                        cs.append(hyp.state[1])
-                    else:
-                        # for transformer LM
-                        token_list.append(
-                            [sos_id] + hyp.ys[context_size:] + [new_token]
-                        )
+                    token_list.append([new_token])
+                    states.append(hyp.state)
 
         if len(token_list) != 0:
             x_lens = torch.tensor([len(tokens) for tokens in token_list]).to(device)
-            if LM.lm_type == "rnn":
-                tokens_to_score = (
-                    torch.tensor(token_list).to(torch.int64).to(device).reshape(-1, 1)
-                )
-                hs = torch.cat(hs, dim=1).to(device)
-                cs = torch.cat(cs, dim=1).to(device)
-                state = (hs, cs)
-            else:
-                # for transformer LM
-                tokens_list = [torch.tensor(tokens) for tokens in token_list]
-                tokens_to_score = (
-                    torch.nn.utils.rnn.pad_sequence(
-                        tokens_list, batch_first=True, padding_value=0.0
-                    )
-                    .to(device)
-                    .to(torch.int64)
-                )
-
-                state = None
+            tokens_to_score = (
+                torch.tensor(token_list).to(torch.int64).to(device).reshape(-1, 1)
+            )
+            state = LM.stack_states(states)
 
             scores, lm_states = LM.score_token(tokens_to_score, x_lens, state)
 
@@ -3146,11 +3759,7 @@ def modified_beam_search_lm_shallow_fusion(
                     hyp_log_prob += lm_score[new_token] * lm_scale  # add the lm score
 
                     lm_score = scores[count]
-                    if LM.lm_type == "rnn":
-                        state = (
-                            lm_states[0][:, count, :].unsqueeze(1),
-                            lm_states[1][:, count, :].unsqueeze(1),
-                        )
+                    state = LM.get_state(lm_states, count)
                     count += 1
 
                 new_hyp = Hypothesis(
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the speed of greedy_search_batch() and
+greedy_search_batch_tensorized() across batch sizes. The latter is run
+both with sync_free=False, which runs the decoder only on the utterances
+that emitted a token, and with sync_free=True, which has no host-device
+synchronization per frame.
+
+It uses a randomly initialized decoder and joiner, and random encoder
+outputs, so it measures only the search itself. The encoder output lengths
+of a batch are drawn uniformly from [num_frames/2, num_frames].
+
+On CPU, the times of small batches vary a lot between runs with the default
+glibc malloc, since the scaled weights of the decoder and joiner are
+allocated again on every call. Setting MALLOC_MMAP_THRESHOLD_=33554432
+makes them stable.
+
+Usage:
+
+    cd icefall/egs/librispeech/ASR
+    ./pruned_transducer_stateless2/benchmark_greedy_search.py \
+      --batch-sizes 1,8,32,128 \
+      --num-frames 400
+"""
+
+import argparse
+import logging
+import statistics
+import time
+from functools import partial
+from typing import Callable, List
+
+import torch
+import torch.nn as nn
+from beam_search import greedy_search_batch, greedy_search_batch_tensorized
+from decoder import Decoder
+from joiner import Joiner
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--batch-sizes",
+        type=str,
+        default="1,8,32,128",
+        help="Comma separated batch sizes to test.",
+    )
+
+    parser.add_argument(
+        "--num-frames",
+        type=int,
+        default=400,
+        help="Maximum number of encoder output frames of an utterance.",
+    )
+
+    parser.add_argument(
+        "--vocab-size",
+        type=int,
+        default=500,
+    )
+
+    parser.add_argument(
+        "--context-size",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--encoder-dim",
+        type=int,
+        default=512,
+    )
+
+    parser.add_argument(
+        "--decoder-dim",
+        type=int,
+        default=512,
+    )
+
+    parser.add_argument(
+        "--joiner-dim",
+        type=int,
+        default=512,
+    )
+
+    parser.add_argument(
+        "--emit-prob",
+        type=float,
+        default=0.3,
+        help="""The blank logit is biased so that the random model emits a
+        token on about this fraction of the frames, as a real model does.""",
+    )
+
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="",
+        help="The device to run on, e.g., cpu or cuda:0. "
+        "If empty, use cuda:0 if available, otherwise cpu.",
+    )
+
+    parser.add_argument(
+        "--num-iters",
+        type=int,
+        default=5,
+        help="""Number of timed runs per batch size, after one warm-up run.
+        The median time is reported.""",
+    )
+
+    return parser
+
+
+class _Transducer(nn.Module):
+    """A transducer without encoder, which is all that greedy search needs."""
+
+    def __init__(self, args):
+        super().__init__()
+        self.decoder = Decoder(
+            vocab_size=args.vocab_size,
+            decoder_dim=args.decoder_dim,
+            blank_id=0,
+            context_size=args.context_size,
+        )
+        self.joiner = Joiner(
+            encoder_dim=args.encoder_dim,
+            decoder_dim=args.decoder_dim,
+            joiner_dim=args.joiner_dim,
+            vocab_size=args.vocab_size,
+        )
+
+
+@torch.no_grad()
+def get_blank_penalty(
+    model: nn.Module, args, device: torch.device, num_samples: int = 2000
+) -> float:
+    """Return the blank_penalty with which the model emits a token on
+    about args.emit_prob of the frames of random encoder outputs."""
+    encoder_out = model.joiner.encoder_proj(
+        torch.randn(num_samples, args.encoder_dim, device=device)
+    )
+    contexts = torch.randint(
+        1, args.vocab_size, (num_samples, args.context_size), device=device
+    )
+    decoder_out = model.joiner.decoder_proj(model.decoder(contexts, need_pad=False))
+    logits = model.joiner(encoder_out, decoder_out.squeeze(1), project_input=False)
+    margin = logits[:, 1:].max(dim=1).values - logits[:, 0]
+    # A negative penalty increases the blank logit
+    return -torch.quantile(margin, 1 - args.emit_prob).item()
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.no_grad()
+def benchmark(
+    searches: List[Callable],
+    model: nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    blank_penalty: float,
+    num_iters: int,
+) -> List[float]:
+    """Return the median time of a call to each of `searches` in seconds.
+    The calls of the different searches are interleaved, so that they are
+    affected in the same way by the load of the machine."""
+    device = encoder_out.device
+    kwargs = dict(
+        model=model,
+        encoder_out=encoder_out,
+        encoder_out_lens=encoder_out_lens,
+        blank_penalty=blank_penalty,
+    )
+    for search in searches:
+        search(**kwargs)
+    _synchronize(device)
+
+    elapsed = [[] for _ in searches]
+    for _ in range(num_iters):
+        for i, search in enumerate(searches):
+            start = time.time()
+            search(**kwargs)
+            _synchronize(device)
+            elapsed[i].append(time.time() - start)
+    return [statistics.median(e) for e in elapsed]
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.info(vars(args))
+
+    if args.device:
+        device = torch.device(args.device)
+    elif torch.cuda.is_available():
+        device = torch.device("cuda", 0)
+    else:
+        device = torch.device("cpu")
+    logging.info(f"Device: {device}")
+
+    torch.manual_seed(20240107)
+    model = _Transducer(args).to(device)
+    model.eval()
+
+    blank_penalty = get_blank_penalty(model, args, device)
+    logging.info(f"blank_penalty: {blank_penalty:.3f}")
+
+    for batch_size in map(int, args.batch_sizes.split(",")):
+        encoder_out = torch.randn(
+            batch_size, args.num_frames, args.encoder_dim, device=device
+        )
+        encoder_out_lens = torch.randint(
+            args.num_frames // 2, args.num_frames + 1, (batch_size,), device=device
+        )
+        encoder_out_lens[0] = args.num_frames
+
+        searches = [
+            greedy_search_batch,
+            partial(greedy_search_batch_tensorized, sync_free=False),
+            partial(greedy_search_batch_tensorized, sync_free=True),
+        ]
+        with torch.no_grad():
+            expected = greedy_search_batch(
+                model, encoder_out, encoder_out_lens, blank_penalty
+            )
+            for search in searches[1:]:
+                actual = search(model, encoder_out, encoder_out_lens, blank_penalty)
+                assert actual == expected
+        num_tokens = sum(len(h) for h in expected)
+        num_frames = encoder_out_lens.sum().item()
+
+        elapsed, elapsed_rows, elapsed_sync_free = benchmark(
+            searches,
+            model,
+            encoder_out,
+            encoder_out_lens,
+            blank_penalty,
+            args.num_iters,
+        )
+        logging.info(
+            f"batch size: {batch_size}, "
+            f"tokens per frame: {num_tokens / num_frames:.2f}, "
+            f"greedy_search_batch: {elapsed * 1000:.1f} ms, "
+            f"tensorized (sync_free=False): {elapsed_rows * 1000:.1f} ms, "
+            f"speedup: {elapsed / elapsed_rows:.2f}x, "
+            f"tensorized (sync_free=True): {elapsed_sync_free * 1000:.1f} ms, "
+            f"speedup: {elapsed / elapsed_sync_free:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
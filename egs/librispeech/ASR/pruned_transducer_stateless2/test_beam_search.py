@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./pruned_transducer_stateless2/test_beam_search.py
+"""
+
+import torch
+import torch.nn as nn
+from beam_search import (
+    DecoderOutputCache,
+    greedy_search_batch,
+    greedy_search_batch_tensorized,
+    modified_beam_search,
+    modified_beam_search_tensorized,
+)
+from decoder import Decoder
+from joiner import Joiner
+
+from icefall import CompiledContextGraph, ContextGraph
+
+
+class _Transducer(nn.Module):
+    """A transducer without encoder, which is all that beam search needs."""
+
+    def __init__(self, vocab_size: int, context_size: int):
+        super().__init__()
+        self.decoder = Decoder(
+            vocab_size=vocab_size,
+            decoder_dim=16,
+            blank_id=0,
+            context_size=context_size,
+        )
+        self.joiner = Joiner(
+            encoder_dim=32,
+            decoder_dim=16,
+            joiner_dim=24,
+            vocab_size=vocab_size,
+        )
+
+
+def test_modified_beam_search_tensorized():
+    torch.manual_seed(20240101)
+    for context_size in [1, 2]:
+        model = _Transducer(vocab_size=10, context_size=context_size)
+        model.eval()
+
+        encoder_out = torch.randn(5, 30, 32) * 3
+        encoder_out_lens = torch.tensor([30, 12, 25, 1, 30])
+
+        for beam in [1, 4, 8]:
+            with torch.no_grad():
+                expected = modified_beam_search(
+                    model=model,
+                    encoder_out=encoder_out,
+                    encoder_out_lens=encoder_out_lens,
+                    beam=beam,
+                    return_timestamps=True,
+                )
+                actual = modified_beam_search_tensorized(
+                    model=model,
+                    encoder_out=encoder_out,
+                    encoder_out_lens=encoder_out_lens,
+                    beam=beam,
+                    return_timestamps=True,
+                )
+            assert actual.hyps == expected.hyps, (actual.hyps, expected.hyps)
+            assert actual.timestamps == expected.timestamps
+
+
+def test_modified_beam_search_tensorized_with_context_graph():
+    torch.manual_seed(20240103)
+    model = _Transducer(vocab_size=10, context_size=2)
+    model.eval()
+
+    encoder_out = torch.randn(5, 30, 32) * 3
+    encoder_out_lens = torch.tensor([30, 12, 25, 1, 30])
+
+    context_graph = ContextGraph(context_score=2.0)
+    context_graph.build([[3, 5], [3, 5, 7], [8, 1], [2], [4, 4, 4]])
+    compiled = CompiledContextGraph.from_context_graph(context_graph)
+
+    with torch.no_grad():
+        expected = modified_beam_search(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            context_graph=context_graph,
+            beam=4,
+        )
+        actual = modified_beam_search_tensorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            context_graph=compiled,
+            beam=4,
+        )
+    assert actual == expected, (actual, expected)
+
+
+def test_decoder_output_cache():
+    cache = DecoderOutputCache(max_size=2)
+    cache.put((0, 1), torch.zeros(1))
+    cache.put((0, 2), torch.ones(1))
+    assert cache.get((0, 1)) is not None
+    # (0, 2) is the least recently used one and is evicted
+    cache.put((1, 2), torch.ones(1))
+    assert len(cache) == 2
+    assert cache.get((0, 2)) is None
+    assert cache.get((0, 1)) is not None
+
+    torch.manual_seed(20240102)
+    model = _Transducer(vocab_size=10, context_size=2)
+    model.eval()
+
+    encoder_out = torch.randn(5, 30, 32) * 3
+    encoder_out_lens = torch.tensor([30, 12, 25, 1, 30])
+
+    for max_size in [1, 3, 1000]:
+        cache = DecoderOutputCache(max_size=max_size)
+        with torch.no_grad():
+            expected = modified_beam_search(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                beam=4,
+            )
+            actual = modified_beam_search(
+                model=model,
+                encoder_out=encoder_out,
+                encoder_out_lens=encoder_out_lens,
+                beam=4,
+                decoder_cache=cache,
+            )
+        assert actual == expected, (actual, expected)
+        assert cache.num_hits > 0, cache
+        assert len(cache) <= max_size, cache
+
+
+def test_greedy_search_batch_tensorized():
+    torch.manual_seed(20240107)
+    for context_size in [1, 2]:
+        model = _Transducer(vocab_size=10, context_size=context_size)
+        model.eval()
+
+        encoder_out = torch.randn(5, 30, 32) * 3
+        encoder_out_lens = torch.tensor([30, 12, 25, 1, 30])
+
+        for blank_penalty in [0, 1.5]:
+            with torch.no_grad():
+                expected = greedy_search_batch(
+                    model=model,
+                    encoder_out=encoder_out,
+                    encoder_out_lens=encoder_out_lens,
+                    blank_penalty=blank_penalty,
+                    return_timestamps=True,
+                )
+            for sync_free in [False, True]:
+                with torch.no_grad():
+                    actual = greedy_search_batch_tensorized(
+                        model=model,
+                        encoder_out=encoder_out,
+                        encoder_out_lens=encoder_out_lens,
+                        blank_penalty=blank_penalty,
+                        return_timestamps=True,
+                        sync_free=sync_free,
+                    )
+                assert actual.hyps == expected.hyps, (actual.hyps, expected.hyps)
+                assert actual.timestamps == expected.timestamps
+                for a, b in zip(actual.scores, expected.scores):
+                    assert torch.allclose(torch.tensor(a), torch.tensor(b))
+
+
+def main():
+    test_modified_beam_search_tensorized()
+    test_modified_beam_search_tensorized_with_context_graph()
+    test_decoder_output_cache()
+    test_greedy_search_batch_tensorized()
+
+
+if __name__ == "__main__":
+    main()
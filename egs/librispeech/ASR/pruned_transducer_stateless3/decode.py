@@ -157,7 +157,7 @@ from beam_search import (
 from librispeech import LibriSpeech
 from train import add_model_arguments, get_params, get_transducer_model
 
-from icefall import LmScorer, NgramLm
+from icefall import CompiledNgramLm, LmScorer
 from icefall.checkpoint import average_checkpoints, find_checkpoints, load_checkpoint
 from icefall.lexicon import Lexicon
 from icefall.rnn_lm.model import RnnLmModel
@@ -449,7 +449,7 @@ def decode_one_batch(
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
     G: Optional[k2.Fsa] = None,
-    ngram_lm: Optional[NgramLm] = None,
+    ngram_lm: Optional[CompiledNgramLm] = None,
     ngram_lm_scale: float = 1.0,
     rnn_lm_model: Optional[RnnLmModel] = None,
     LM: Optional[LmScorer] = None,
@@ -777,7 +777,7 @@ def decode_dataset(
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
     G: Optional[k2.Fsa] = None,
-    ngram_lm: Optional[NgramLm] = None,
+    ngram_lm: Optional[CompiledNgramLm] = None,
     ngram_lm_scale: float = 1.0,
     rnn_lm_model: Optional[RnnLmModel] = None,
     LM: Optional[LmScorer] = None,
@@ -1155,12 +1155,15 @@ def main():
     if "ngram" in params.decoding_method or "LODR" in params.decoding_method:
         lm_filename = f"{params.tokens_ngram}gram.fst.txt"
         logging.info(f"lm filename: {lm_filename}")
-        ngram_lm = NgramLm(
+        # The flattened LM is cached in a .npz file next to the FST, which
+        # is memory-mapped and thus shared by all decoding processes.
+        ngram_lm = CompiledNgramLm.load_or_compile(
             str(params.lang_dir / lm_filename),
             backoff_id=params.backoff_id,
             is_binary=False,
+            cache_filename=str(params.lang_dir / f"{params.tokens_ngram}gram.npz"),
         )
-        logging.info(f"num states: {ngram_lm.lm.num_states}")
+        logging.info(f"num states: {ngram_lm.num_states}")
         ngram_lm_scale = params.ngram_lm_scale
     else:
         ngram_lm = None
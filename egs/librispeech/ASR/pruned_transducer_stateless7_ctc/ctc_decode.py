@@ -96,6 +96,7 @@ from icefall.decode import (
     rescore_with_n_best_list,
     rescore_with_whole_lattice,
 )
+from icefall.decoding_graph import GraphCache, get_rescoring_G, load_fsa
 from icefall.lexicon import Lexicon
 from icefall.utils import (
     AttributeDict,
@@ -248,6 +249,17 @@ def get_parser():
 
     add_model_arguments(parser)
 
+    parser.add_argument(
+        "--max-arcs",
+        type=int,
+        default=1000000,
+        help="""Maximum total number of arcs of the lattices rescored with
+        the n-gram LM at a time. A lattice with more arcs is pruned on its
+        own before rescoring. Reduce it if you get CUDA OOM errors during
+        rescoring. 0 means no limit.
+        """,
+    )
+
     return parser
 
 
@@ -440,6 +452,7 @@ def decode_one_batch(
             lattice=lattice,
             G_with_epsilon_loops=G,
             lm_scale_list=lm_scale_list,
+            max_arcs=params.max_arcs or None,
         )
     else:
         assert False, f"Unsupported decoding method: {params.decoding_method}"
@@ -632,9 +645,7 @@ def main():
     else:
         H = None
         bpe_model = None
-        HLG = k2.Fsa.from_dict(
-            torch.load(f"{params.lang_dir}/HLG.pt", map_location=device)
-        )
+        HLG = load_fsa(f"{params.lang_dir}/HLG.pt", device)
         assert HLG.requires_grad is False
 
         HLG.scores *= params.hlg_scale
@@ -645,46 +656,14 @@ def main():
         "nbest-rescoring",
         "whole-lattice-rescoring",
     ):
-        if not (params.lm_dir / "G_4_gram.pt").is_file():
-            logging.info("Loading G_4_gram.fst.txt")
-            logging.warning("It may take 8 minutes.")
-            with open(params.lm_dir / "G_4_gram.fst.txt") as f:
-                first_word_disambig_id = lexicon.word_table["#0"]
-
-                G = k2.Fsa.from_openfst(f.read(), acceptor=False)
-                # G.aux_labels is not needed in later computations, so
-                # remove it here.
-                del G.aux_labels
-                # CAUTION: The following line is crucial.
-                # Arcs entering the back-off state have label equal to #0.
-                # We have to change it to 0 here.
-                G.labels[G.labels >= first_word_disambig_id] = 0
-                # See https://github.com/k2-fsa/k2/issues/874
-                # for why we need to set G.properties to None
-                G.__dict__["_properties"] = None
-                G = k2.Fsa.from_fsas([G]).to(device)
-                G = k2.arc_sort(G)
-                # Save a dummy value so that it can be loaded in C++.
-                # See https://github.com/pytorch/pytorch/issues/67902
-                # for why we need to do this.
-                G.dummy = 1
-
-                torch.save(G.as_dict(), params.lm_dir / "G_4_gram.pt")
-        else:
-            logging.info("Loading pre-compiled G_4_gram.pt")
-            d = torch.load(params.lm_dir / "G_4_gram.pt", map_location=device)
-            G = k2.Fsa.from_dict(d)
-
-        if params.decoding_method == "whole-lattice-rescoring":
-            # Add epsilon self-loops to G as we will compose
-            # it with the whole lattice later
-            G = k2.add_epsilon_self_loops(G)
-            G = k2.arc_sort(G)
-            G = G.to(device)
-
-        # G.lm_scores is used to replace HLG.lm_scores during
-        # LM rescoring.
-        G.lm_scores = G.scores.clone()
+        G = get_rescoring_G(
+            params.lm_dir,
+            "G_4_gram",
+            first_word_disambig_id=lexicon.word_table["#0"],
+            device=device,
+            cache=GraphCache(),
+            add_epsilon_self_loops=params.decoding_method == "whole-lattice-rescoring",
+        )
     else:
         G = None
 
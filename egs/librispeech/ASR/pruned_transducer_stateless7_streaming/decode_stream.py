@@ -30,7 +30,7 @@ class DecodeStream(object):
         self,
         params: AttributeDict,
         cut_id: str,
-        initial_states: List[torch.Tensor],
+        initial_states: Optional[List[torch.Tensor]] = None,
         decoding_graph: Optional[k2.Fsa] = None,
         device: torch.device = torch.device("cpu"),
     ) -> None:
@@ -38,7 +38,8 @@ class DecodeStream(object):
         Args:
           initial_states:
             Initial decode states of the model, e.g. the return value of
-            `get_init_state` in conformer.py
+            `get_init_state` in conformer.py. It can be None if the states
+            are kept in a `StatePool`, see :attr:`state_slot`.
           decoding_graph:
             Decoding graph used for decoding, may be a TrivialGraph or a HLG.
             Used only when decoding_method is fast_beam_search.
@@ -55,6 +56,10 @@ class DecodeStream(object):
 
         self.states = initial_states
 
+        # The slot of this stream in a `StatePool`, if the states are not
+        # kept in self.states
+        self.state_slot: Optional[int] = None
+
         # It contains a 2-D tensors representing the feature frames.
         self.features: torch.Tensor = None
 
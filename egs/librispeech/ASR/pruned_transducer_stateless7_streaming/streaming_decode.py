@@ -48,8 +48,9 @@ from streaming_beam_search import (
 )
 from torch.nn.utils.rnn import pad_sequence
 from train import add_model_arguments, get_params, get_transducer_model
-from zipformer import stack_states, unstack_states
+from zipformer import get_state_batch_dims
 
+from icefall import StatePool
 from icefall.checkpoint import (
     average_checkpoints,
     average_checkpoints_with_averaged_model,
@@ -193,6 +194,7 @@ def decode_one_chunk(
     params: AttributeDict,
     model: nn.Module,
     decode_streams: List[DecodeStream],
+    state_pool: StatePool,
 ) -> List[int]:
     """Decode one chunk frames of features for each decode_streams and
     return the indexes of finished streams in a List.
@@ -204,6 +206,9 @@ def decode_one_chunk(
         The neural model.
       decode_streams:
         A List of DecodeStream, each belonging to a utterance.
+      state_pool:
+        The pool holding the encoder states of decode_streams, indexed by
+        `DecodeStream.state_slot`.
     Returns:
       Return a List containing which DecodeStreams are finished.
     """
@@ -211,14 +216,14 @@ def decode_one_chunk(
 
     features = []
     feature_lens = []
-    states = []
+    slots = []
     processed_lens = []
 
     for stream in decode_streams:
         feat, feat_len = stream.get_feature_frames(params.decode_chunk_len)
         features.append(feat)
         feature_lens.append(feat_len)
-        states.append(stream.states)
+        slots.append(stream.state_slot)
         processed_lens.append(stream.done_frames)
 
     feature_lens = torch.tensor(feature_lens, device=device)
@@ -238,7 +243,9 @@ def decode_one_chunk(
             value=LOG_EPS,
         )
 
-    states = stack_states(states)
+    # Unless the set of streams changed since the last chunk, this returns
+    # the states from the last chunk without any copy.
+    states = state_pool.get_batch_states(slots)
     processed_lens = torch.tensor(processed_lens, device=device)
 
     encoder_out, encoder_out_lens, new_states = model.encoder.streaming_forward(
@@ -272,11 +279,10 @@ def decode_one_chunk(
     else:
         raise ValueError(f"Unsupported decoding method: {params.decoding_method}")
 
-    states = unstack_states(new_states)
+    state_pool.set_batch_states(slots, new_states)
 
     finished_streams = []
     for i in range(len(decode_streams)):
-        decode_streams[i].states = states[i]
         decode_streams[i].done_frames += encoder_out_lens[i]
         if decode_streams[i].done:
             finished_streams.append(i)
@@ -324,19 +330,25 @@ def decode_dataset(
 
     log_interval = 50
 
+    initial_states = model.encoder.get_init_state(device=device)
+    state_pool = StatePool(
+        init_states=initial_states,
+        batch_dims=get_state_batch_dims(len(initial_states) // 7),
+        max_streams=params.num_decode_streams,
+    )
+
     decode_results = []
     # Contain decode streams currently running.
     decode_streams = []
     for num, cut in enumerate(cuts):
         # each utterance has a DecodeStream.
-        initial_states = model.encoder.get_init_state(device=device)
         decode_stream = DecodeStream(
             params=params,
             cut_id=cut.id,
-            initial_states=initial_states,
             decoding_graph=decoding_graph,
             device=device,
         )
+        decode_stream.state_slot = state_pool.allocate()
 
         audio: np.ndarray = cut.load_audio()
         # audio.shape: (1, num_samples)
@@ -363,7 +375,10 @@ def decode_dataset(
 
         while len(decode_streams) >= params.num_decode_streams:
             finished_streams = decode_one_chunk(
-                params=params, model=model, decode_streams=decode_streams
+                params=params,
+                model=model,
+                decode_streams=decode_streams,
+                state_pool=state_pool,
             )
             for i in sorted(finished_streams, reverse=True):
                 decode_results.append(
@@ -373,6 +388,7 @@ def decode_dataset(
                         sp.decode(decode_streams[i].decoding_result()).split(),
                     )
                 )
+                state_pool.free(decode_streams[i].state_slot)
                 del decode_streams[i]
 
         if num % log_interval == 0:
@@ -381,7 +397,10 @@ def decode_dataset(
     # decode final chunks of last sequences
     while len(decode_streams):
         finished_streams = decode_one_chunk(
-            params=params, model=model, decode_streams=decode_streams
+            params=params,
+            model=model,
+            decode_streams=decode_streams,
+            state_pool=state_pool,
         )
         for i in sorted(finished_streams, reverse=True):
             decode_results.append(
@@ -391,6 +410,7 @@ def decode_dataset(
                     sp.decode(decode_streams[i].decoding_result()).split(),
                 )
             )
+            state_pool.free(decode_streams[i].state_slot)
             del decode_streams[i]
 
     if params.decoding_method == "greedy_search":
@@ -47,6 +47,19 @@ from torch import Tensor, nn
 from icefall.utils import make_pad_mask, subsequent_chunk_mask
 
 
+def get_state_batch_dims(num_encoders: int) -> List[int]:
+    """Return the batch dimension of each tensor in the states returned by
+    :func:`Zipformer.get_init_state`, which is needed by `StatePool`.
+
+    Args:
+      num_encoders:
+        The number of encoder stacks, i.e., len(states) // 7.
+    """
+    # cached_len, cached_avg, cached_key, cached_val, cached_val2,
+    # cached_conv1, cached_conv2
+    return sum([[d] * num_encoders for d in [1, 1, 2, 2, 2, 1, 1]], [])
+
+
 def stack_states(state_list: List[List[Tensor]]) -> List[Tensor]:
     """Stack list of zipformer states that correspond to separate utterances
     into a single emformer state, so that it can be used as an input for
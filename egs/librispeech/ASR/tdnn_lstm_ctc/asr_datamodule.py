@@ -42,7 +42,9 @@ from lhotse.dataset.input_strategies import (  # noqa F401 For AudioSamples
 from lhotse.utils import fix_random_seed
 from torch.utils.data import DataLoader
 
+from icefall.prefetcher import TokenizedDataset
 from icefall.utils import str2bool
+from icefall.worker_graph_compiler import GraphCompilingDataset
 
 
 class _SeedWorkers:
@@ -202,10 +204,21 @@ class AsrDataModule:
             help="AudioSamples or PrecomputedFeatures",
         )
 
+        group.add_argument(
+            "--graph-cache-dir",
+            type=Path,
+            default=None,
+            help="Used only when the training graphs are compiled in the "
+            "dataloader workers. If not None, the graph of each transcript "
+            "is saved to this directory and reused in later epochs and runs.",
+        )
+
     def train_dataloaders(
         self,
         cuts_train: CutSet,
         sampler_state_dict: Optional[Dict[str, Any]] = None,
+        sp: Optional[Any] = None,
+        graph_compiler: Optional[Any] = None,
     ) -> DataLoader:
         """
         Args:
@@ -213,6 +226,14 @@ class AsrDataModule:
             CutSet for training.
           sampler_state_dict:
             The state dict for the training sampler.
+          sp:
+            If not None, a sentencepiece model to encode the texts of the
+            supervisions in the dataloader workers. The token IDs are saved
+            in `batch["supervisions"]["token_ids"]`.
+          graph_compiler:
+            If not None, a graph compiler on CPU to compile the training
+            graphs in the dataloader workers. The graphs are saved in
+            `batch["graphs"]`. See :class:`GraphCompilingDataset`.
         """
         transforms = []
         if self.args.enable_musan:
@@ -316,6 +337,14 @@ class AsrDataModule:
             logging.info("Loading sampler state dict")
             train_sampler.load_state_dict(sampler_state_dict)
 
+        if sp is not None:
+            train = TokenizedDataset(train, sp)
+
+        if graph_compiler is not None:
+            train = GraphCompilingDataset(
+                train, graph_compiler, cache_dir=self.args.graph_cache_dir
+            )
+
         # 'seed' is derived from the current random state, which will have
         # previously been set in the main process.
         seed = torch.randint(0, 100000, ()).item()
@@ -332,7 +361,19 @@ class AsrDataModule:
 
         return train_dl
 
-    def valid_dataloaders(self, cuts_valid: CutSet) -> DataLoader:
+    def valid_dataloaders(
+        self,
+        cuts_valid: CutSet,
+        graph_compiler: Optional[Any] = None,
+    ) -> DataLoader:
+        """
+        Args:
+          cuts_valid:
+            CutSet for validation.
+          graph_compiler:
+            If not None, the training graphs are compiled in the dataloader
+            workers. See :meth:`train_dataloaders`.
+        """
         transforms = []
         if self.args.concatenate_cuts:
             transforms = [
@@ -354,6 +395,12 @@ class AsrDataModule:
                 cut_transforms=transforms,
                 return_cuts=self.args.return_cuts,
             )
+
+        if graph_compiler is not None:
+            validate = GraphCompilingDataset(
+                validate, graph_compiler, cache_dir=self.args.graph_cache_dir
+            )
+
         valid_sampler = DynamicBucketingSampler(
             cuts_valid,
             max_duration=self.args.max_duration,
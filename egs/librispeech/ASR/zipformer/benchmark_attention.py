@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compare the peak memory and latency of a Zipformer2EncoderLayer in inference
+with the attention weights computed at once (block size 0) and computed block
+by block (see Zipformer2.set_attention_block_size()), for inputs of different
+durations.
+
+It uses a randomly initialized layer. The default dimensions are those of the
+first encoder stack of the default zipformer, which runs at 50 frames per
+second. Each measurement runs in a new process, so that the peak memory of a
+run is not affected by the other runs. On CPU, the peak memory is the
+increase of the peak resident set size during the forward pass.
+
+Usage:
+
+    cd icefall/egs/librispeech/ASR
+    ./zipformer/benchmark_attention.py \
+      --durations 1,5,15,30,60 \
+      --block-sizes 0,1024
+
+With block size 0, the attention weights of a 60-minute input take more than
+500 GB, so only short inputs can be run this way.
+
+Use --chunk-size and --left-context-chunks to benchmark the layer of a causal
+model decoded with chunked attention.  With block size 0 the full
+(seq_len, seq_len) chunk mask is used; otherwise the mask of each block is built
+when it is needed (see ChunkAttentionMask).
+"""
+
+import argparse
+import logging
+import multiprocessing
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--durations",
+        type=str,
+        default="1,5,15,30,60",
+        help="Comma separated durations of the input in minutes.",
+    )
+
+    parser.add_argument(
+        "--block-sizes",
+        type=str,
+        default="0,1024",
+        help="Comma separated attention block sizes to test. "
+        "0 means the attention weights are computed at once.",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=-1,
+        help="Chunk size in frames for chunked attention. -1 means no chunking.",
+    )
+
+    parser.add_argument(
+        "--left-context-chunks",
+        type=int,
+        default=4,
+        help="Number of left-context chunks for chunked attention. "
+        "Used only if --chunk-size is positive.",
+    )
+
+    parser.add_argument(
+        "--frame-rate",
+        type=int,
+        default=50,
+        help="Number of frames per second at the input of the layer.",
+    )
+
+    parser.add_argument(
+        "--embed-dim",
+        type=int,
+        default=192,
+    )
+
+    parser.add_argument(
+        "--num-heads",
+        type=int,
+        default=4,
+    )
+
+    parser.add_argument(
+        "--feedforward-dim",
+        type=int,
+        default=512,
+    )
+
+    parser.add_argument(
+        "--num-warmup-iters",
+        type=int,
+        default=1,
+        help="Number of untimed runs before the timed ones. Use 0 for long "
+        "inputs, for which a run takes minutes on CPU.",
+    )
+
+    parser.add_argument(
+        "--num-iters",
+        type=int,
+        default=1,
+        help="Number of timed runs.",
+    )
+
+    return parser
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@torch.no_grad()
+def run(args, num_frames: int, block_size: int):
+    """Return (peak memory in MB, average time in seconds) of the forward
+    pass of a layer on num_frames frames."""
+    from zipformer import (
+        ChunkAttentionMask,
+        CompactRelPositionalEncoding,
+        Zipformer2EncoderLayer,
+    )
+
+    device = torch.device("cpu")
+    if torch.cuda.is_available():
+        device = torch.device("cuda", 0)
+
+    torch.manual_seed(20240108)
+    layer = Zipformer2EncoderLayer(
+        embed_dim=args.embed_dim,
+        pos_dim=48,
+        num_heads=args.num_heads,
+        query_head_dim=32,
+        pos_head_dim=4,
+        value_head_dim=12,
+        feedforward_dim=args.feedforward_dim,
+        causal=args.chunk_size > 0,
+    )
+    layer.self_attn_weights.block_size = block_size
+    layer.to(device)
+    layer.eval()
+
+    encoder_pos = CompactRelPositionalEncoding(48, dropout_rate=0.0, length_factor=1.0)
+    src = torch.randn(num_frames, 1, args.embed_dim, device=device)
+    pos_emb = encoder_pos(src)
+
+    attn_mask = None
+    if args.chunk_size > 0:
+        attn_mask = ChunkAttentionMask(
+            num_frames, args.chunk_size, args.left_context_chunks, device=device
+        )
+
+    # The peak memory includes the warm-up runs, since the peak resident set
+    # size cannot be reset
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        start_memory = torch.cuda.memory_allocated(device)
+    else:
+        start_memory = _peak_rss_mb()
+
+    if attn_mask is not None and block_size <= 0:
+        # The full mask, as Zipformer2._get_attn_mask() returns it
+        attn_mask = attn_mask[:, :]
+
+    for _ in range(args.num_warmup_iters):
+        layer(src, pos_emb, chunk_size=args.chunk_size, attn_mask=attn_mask)
+    _synchronize(device)
+
+    start = time.time()
+    for _ in range(args.num_iters):
+        layer(src, pos_emb, chunk_size=args.chunk_size, attn_mask=attn_mask)
+    _synchronize(device)
+    elapsed = (time.time() - start) / args.num_iters
+
+    if device.type == "cuda":
+        peak_memory = (torch.cuda.max_memory_allocated(device) - start_memory) / 2**20
+    else:
+        peak_memory = _peak_rss_mb() - start_memory
+
+    return peak_memory, elapsed
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.info(vars(args))
+
+    # CUDA cannot be re-initialized in forked processes
+    context = multiprocessing.get_context("spawn")
+
+    for duration in map(float, args.durations.split(",")):
+        num_frames = int(duration * 60 * args.frame_rate)
+        for block_size in map(int, args.block_sizes.split(",")):
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                try:
+                    peak_memory, elapsed = executor.submit(
+                        run, args, num_frames, block_size
+                    ).result()
+                except (RuntimeError, MemoryError, BrokenProcessPool) as e:
+                    logging.info(
+                        f"duration: {duration} min, frames: {num_frames}, "
+                        f"chunk size: {args.chunk_size}, block size: {block_size}, "
+                        f"failed: {type(e).__name__}"
+                    )
+                    continue
+
+            logging.info(
+                f"duration: {duration} min, frames: {num_frames}, "
+                f"chunk size: {args.chunk_size}, block size: {block_size}, "
+                f"peak memory: {peak_memory:.1f} MB, time: {elapsed:.3f} s"
+            )
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
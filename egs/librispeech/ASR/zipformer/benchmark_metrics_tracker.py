@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Count the host-device synchronizations caused by the loss bookkeeping of
+./train.py, i.e., compute_loss() filling a MetricsTracker and
+train_one_epoch() accumulating it into tot_loss and logging it every
+--log-interval batches, with and without the device-resident mode of
+MetricsTracker.
+
+On CUDA, the synchronizations are counted with torch.cuda.set_sync_debug_mode().
+On CPU, the calls of Tensor.item() and Tensor.tolist(), which would be
+synchronizations on CUDA, are counted.
+
+Usage:
+
+    cd icefall/egs/librispeech/ASR
+    ./zipformer/benchmark_metrics_tracker.py --num-batches 1000
+"""
+
+import argparse
+import logging
+import time
+import warnings
+
+import torch
+
+from icefall.utils import MetricsTracker
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--num-batches",
+        type=int,
+        default=1000,
+    )
+
+    parser.add_argument(
+        "--log-interval",
+        type=int,
+        default=50,
+    )
+
+    parser.add_argument(
+        "--reset-interval",
+        type=int,
+        default=200,
+    )
+
+    return parser
+
+
+def compute_loss(device: torch.device, device_resident: bool) -> MetricsTracker:
+    """Simulate the end of compute_loss() in ./train.py."""
+    feature_lens = torch.randint(500, 1000, (32,), device=device)
+    simple_loss = torch.rand((), device=device) * 1000
+    pruned_loss = torch.rand((), device=device) * 100
+    ctc_loss = torch.rand((), device=device) * 1000
+    loss = 0.5 * simple_loss + pruned_loss + 0.2 * ctc_loss
+
+    if device_resident:
+        info = MetricsTracker(device=device)
+        info["frames"] = (feature_lens // 4).sum()
+        info["loss"] = loss.detach()
+        info["simple_loss"] = simple_loss.detach()
+        info["pruned_loss"] = pruned_loss.detach()
+        info["ctc_loss"] = ctc_loss.detach()
+    else:
+        info = MetricsTracker()
+        info["frames"] = (feature_lens // 4).sum().item()
+        info["loss"] = loss.detach().cpu().item()
+        info["simple_loss"] = simple_loss.detach().cpu().item()
+        info["pruned_loss"] = pruned_loss.detach().cpu().item()
+        info["ctc_loss"] = ctc_loss.detach().cpu().item()
+    return info
+
+
+def train_one_epoch(args, device: torch.device, device_resident: bool) -> None:
+    """Simulate the loss bookkeeping of train_one_epoch() in ./train.py."""
+    tot_loss = MetricsTracker(device=device if device_resident else None)
+    for batch_idx in range(args.num_batches):
+        loss_info = compute_loss(device, device_resident)
+        tot_loss = (tot_loss * (1 - 1 / args.reset_interval)) + loss_info
+        if batch_idx % args.log_interval == 0:
+            logging.debug(f"loss[{loss_info}], tot_loss[{tot_loss}]")
+
+
+def count_syncs(args, device: torch.device, device_resident: bool) -> int:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter("always")
+            torch.cuda.set_sync_debug_mode("warn")
+            try:
+                train_one_epoch(args, device, device_resident)
+            finally:
+                torch.cuda.set_sync_debug_mode("default")
+        return len(w)
+
+    num_calls = 0
+    item, tolist = torch.Tensor.item, torch.Tensor.tolist
+
+    def counted(f):
+        def wrapper(*args, **kwargs):
+            nonlocal num_calls
+            num_calls += 1
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    torch.Tensor.item, torch.Tensor.tolist = counted(item), counted(tolist)
+    try:
+        train_one_epoch(args, device, device_resident)
+    finally:
+        torch.Tensor.item, torch.Tensor.tolist = item, tolist
+    return num_calls
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.info(vars(args))
+
+    devices = [torch.device("cpu")]
+    if torch.cuda.is_available():
+        devices.append(torch.device("cuda", 0))
+
+    for device in devices:
+        for device_resident in [False, True]:
+            num_syncs = count_syncs(args, device, device_resident)
+
+            start = time.time()
+            train_one_epoch(args, device, device_resident)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            elapsed = time.time() - start
+
+            logging.info(
+                f"device: {device}, device-resident: {device_resident}, "
+                f"batches: {args.num_batches}, syncs: {num_syncs}, "
+                f"time per batch: {elapsed / args.num_batches * 1e6:.1f} us"
+            )
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -0,0 +1,117 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Drop the encoder frames on which the CTC head is confident that the output
+is blank, before running transducer search on the remaining frames.
+
+See also ../../pruned_transducer_stateless7_ctc_bs/frame_reducer.py, which
+does the same during training with a fixed threshold.
+"""
+
+import math
+from typing import Tuple
+
+import torch
+
+
+def skip_blank_frames(
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    ctc_output: torch.Tensor,
+    threshold: float,
+    blank_id: int = 0,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Remove the frames whose CTC blank probability is larger than
+    `threshold` and move the kept frames of each utterance to the front.
+
+    At least one frame, the last one, is kept for an utterance even if all
+    of its frames are blank, since the search methods expect non-empty
+    utterances.
+
+    Args:
+      encoder_out:
+        The encoder output, of shape (N, T, C).
+      encoder_out_lens:
+        A tensor of shape (N,) containing the number of frames in
+        `encoder_out` before padding.
+      ctc_output:
+        The CTC log-probs computed from `encoder_out`, of shape (N, T, V).
+      threshold:
+        A frame is removed if its blank probability is larger than this
+        value. It should be in (0, 1].
+      blank_id:
+        The ID of the blank symbol.
+    Returns:
+      Return a tuple containing:
+        - The kept frames, of shape (N, T', C)
+        - The number of kept frames of each utterance, of shape (N,)
+        - The indexes of the kept frames in `encoder_out`, of shape (N, T').
+          Entries for padding frames are 0.
+    """
+    assert encoder_out.ndim == 3, encoder_out.shape
+    assert 0 < threshold <= 1, threshold
+    N, T, C = encoder_out.shape
+
+    frames = torch.arange(T, device=encoder_out.device)
+    padding_mask = frames.unsqueeze(0) >= encoder_out_lens.unsqueeze(1)
+
+    keep = ctc_output[:, :, blank_id] <= math.log(threshold)
+    keep = keep & ~padding_mask
+
+    # Keep the last frame of the utterances without any kept frame
+    empty = keep.sum(dim=1) == 0
+    last = (encoder_out_lens - 1).clamp(min=0)
+    keep[torch.arange(N, device=keep.device), last] |= empty
+
+    out_lens = keep.sum(dim=1)
+    max_len = int(out_lens.max().item())
+
+    # A stable sort moves the kept frames to the front in their original order
+    frame_indexes = torch.sort((~keep).to(torch.int8), dim=1, stable=True).indices
+    frame_indexes = frame_indexes[:, :max_len]
+    frame_indexes = frame_indexes.masked_fill(
+        frames[:max_len].unsqueeze(0) >= out_lens.unsqueeze(1), 0
+    )
+
+    out = torch.gather(
+        encoder_out, dim=1, index=frame_indexes.unsqueeze(-1).expand(N, max_len, C)
+    )
+    return out, out_lens, frame_indexes
+
+
+class BlankSkipStats(object):
+    """Count the frames before and after :func:`skip_blank_frames`."""
+
+    def __init__(self):
+        self.num_frames = 0
+        self.num_kept_frames = 0
+
+    def update(self, encoder_out_lens: torch.Tensor, out_lens: torch.Tensor) -> None:
+        self.num_frames += encoder_out_lens.sum().item()
+        self.num_kept_frames += out_lens.sum().item()
+
+    @property
+    def skip_ratio(self) -> float:
+        if self.num_frames == 0:
+            return 0.0
+        return 1 - self.num_kept_frames / self.num_frames
+
+    def __str__(self) -> str:
+        return (
+            f"kept {self.num_kept_frames} of {self.num_frames} frames, "
+            f"skipped {self.skip_ratio:.2%}"
+        )
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This script runs ./zipformer/decode.py with a range of --blank-skip-threshold
+values and prints the WER, the fraction of skipped frames and the decoding
+time of each test set, relative to decoding without skipping (threshold 0).
+
+Usage:
+
+./zipformer/blank_skip_sweep.py \
+  --thresholds 0,0.9,0.95,0.99,0.999 \
+  --epoch 30 \
+  --avg 9 \
+  --exp-dir ./zipformer/exp \
+  --use-ctc 1 \
+  --max-duration 600 \
+  --decoding-method greedy_search
+
+All the arguments except --thresholds are passed to decode.py. The table is
+also saved to {exp-dir}/{decoding-method}/blank-skip-sweep.txt.
+
+decode.py saves the blank-skip-*.txt files read by this script only when
+frames are skipped. For threshold 0, the decoding time is read from the
+log of decode.py and the WER from its wer-summary-*.txt files.
+"""
+
+import argparse
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--thresholds",
+        type=str,
+        default="0,0.9,0.95,0.99,0.999",
+        help="Comma separated values of --blank-skip-threshold. "
+        "0 decodes without skipping.",
+    )
+
+    # The arguments of decode.py that are needed to find its results
+    parser.add_argument("--exp-dir", type=str, default="zipformer/exp")
+    parser.add_argument("--decoding-method", type=str, default="greedy_search")
+
+    return parser
+
+
+def run_decode(cmd: List[str]) -> Dict[str, float]:
+    """Run decode.py, echoing its log.
+
+    Returns:
+      Return a dict mapping a test set to its decoding time in seconds.
+    """
+    elapsed = {}
+    proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, text=True)
+    for line in proc.stderr:
+        sys.stderr.write(line)
+        m = re.search(r"Decoding (\S+) took ([0-9.]+) seconds", line)
+        if m is not None:
+            elapsed[m.group(1)] = float(m.group(2))
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return elapsed
+
+
+def read_wers(res_dir: Path, since: float) -> Dict[str, str]:
+    """Read the best WER of each test set from the wer-summary-*.txt files
+    written by decode.py after `since`."""
+    wers = {}
+    for filename in res_dir.glob("wer-summary-*.txt"):
+        if filename.stat().st_mtime < since:
+            continue
+        test_set = filename.name[len("wer-summary-") :].split("-epoch-")[0]
+        test_set = test_set.split("-iter-")[0]
+        lines = filename.read_text().strip().split("\n")
+        wers[test_set] = lines[1].split("\t")[1]
+    return wers
+
+
+def read_stats(
+    res_dir: Path, since: float
+) -> Dict[str, Tuple[float, float, float, str]]:
+    """Read the blank-skip-*.txt files written by decode.py after `since`.
+
+    Returns:
+      Return a dict mapping a test set to (threshold, skipped frames,
+      decoding time, WER).
+    """
+    stats = {}
+    for filename in res_dir.glob("blank-skip-*.txt"):
+        if filename.name == "blank-skip-sweep.txt":
+            continue
+        if filename.stat().st_mtime < since:
+            continue
+        test_set = filename.name[len("blank-skip-") :].split("-epoch-")[0]
+        test_set = test_set.split("-iter-")[0]
+        lines = filename.read_text().strip().split("\n")
+        threshold, skipped, elapsed, wer = lines[1].split("\t")
+        stats[test_set] = (float(threshold), float(skipped), float(elapsed), wer)
+    return stats
+
+
+def main():
+    args, decode_args = get_parser().parse_known_args()
+    thresholds = [float(t) for t in args.thresholds.split(",")]
+    res_dir = Path(args.exp_dir) / args.decoding_method
+
+    decode = Path(__file__).parent / "decode.py"
+    # test set -> list of (threshold, skipped frames, decoding time, WER)
+    results: Dict[str, List[Tuple[float, float, float, str]]] = {}
+    for threshold in thresholds:
+        start = time.time()
+        elapsed = run_decode(
+            [
+                sys.executable,
+                str(decode),
+                "--exp-dir",
+                args.exp_dir,
+                "--decoding-method",
+                args.decoding_method,
+                "--blank-skip-threshold",
+                str(threshold),
+            ]
+            + decode_args
+        )
+        if threshold > 0:
+            stats = read_stats(res_dir, since=start)
+        else:
+            wers = read_wers(res_dir, since=start)
+            stats = {
+                test_set: (threshold, 0.0, elapsed[test_set], wers.get(test_set, "-"))
+                for test_set in elapsed
+            }
+        for test_set, row in stats.items():
+            results.setdefault(test_set, []).append(row)
+
+    lines = []
+    for test_set, rows in results.items():
+        lines.append(f"{test_set}")
+        lines.append("threshold\tskipped frames\tdecoding time (s)\tspeedup\tWER")
+        # Speedups are relative to the run with the smallest threshold,
+        # normally 0, i.e., without skipping
+        base_elapsed = min(rows)[2]
+        for threshold, skipped, elapsed, wer in rows:
+            speedup = base_elapsed / elapsed if elapsed > 0 else 0.0
+            lines.append(
+                f"{threshold}\t{skipped:.4f}\t{elapsed:.2f}\t{speedup:.2f}x\t{wer}"
+            )
+        lines.append("")
+
+    s = "\n".join(lines)
+    print(s)
+    (res_dir / "blank-skip-sweep.txt").write_text(s)
+
+
+if __name__ == "__main__":
+    main()
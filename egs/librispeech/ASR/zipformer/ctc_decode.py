@@ -140,6 +140,7 @@ from icefall.decode import (
     rescore_with_n_best_list,
     rescore_with_whole_lattice,
 )
+from icefall.decoding_graph import GraphCache, get_rescoring_G, load_fsa
 from icefall.lexicon import Lexicon
 from icefall.utils import (
     AttributeDict,
@@ -197,6 +198,35 @@ def get_parser():
         "`epoch` are loaded for averaging. ",
     )
 
+    parser.add_argument(
+        "--num-avg-threads",
+        type=int,
+        default=0,
+        help="If positive, the number of threads reading the checkpoints "
+        "ahead of averaging. Each of them may keep a copy of the model in "
+        "memory. Used only when --use-averaged-model is False.",
+    )
+
+    parser.add_argument(
+        "--cache-averaged-model",
+        type=str2bool,
+        default=False,
+        help="If True, save the averaged model to exp-dir, so that later runs "
+        "with the same --epoch/--iter, --avg and --use-averaged-model, e.g., "
+        "with other decoding methods, load it instead of averaging again.",
+    )
+
+    parser.add_argument(
+        "--attention-block-size",
+        type=int,
+        default=0,
+        help="""If positive, the self-attention of the encoder is computed in
+        blocks of this many frames, so that its memory usage is linear in the
+        number of frames. It gives the same results and is useful for
+        decoding long recordings, e.g., 1024.
+        """,
+    )
+
     parser.add_argument(
         "--exp-dir",
         type=str,
@@ -306,6 +336,17 @@ def get_parser():
 
     add_model_arguments(parser)
 
+    parser.add_argument(
+        "--max-arcs",
+        type=int,
+        default=1000000,
+        help="""Maximum total number of arcs of the lattices rescored with
+        the n-gram LM at a time. A lattice with more arcs is pruned on its
+        own before rescoring. Reduce it if you get CUDA OOM errors during
+        rescoring. 0 means no limit.
+        """,
+    )
+
     return parser
 
 
@@ -545,6 +586,7 @@ def decode_one_batch(
             lattice=lattice,
             G_with_epsilon_loops=G,
             lm_scale_list=lm_scale_list,
+            max_arcs=params.max_arcs or None,
         )
     elif params.decoding_method == "attention-decoder-rescoring-with-ngram":
         # lattice uses a 3-gram Lm. We rescore it with a 4-gram LM.
@@ -552,6 +594,7 @@ def decode_one_batch(
             lattice=lattice,
             G_with_epsilon_loops=G,
             lm_scale_list=None,
+            max_arcs=params.max_arcs or None,
         )
         best_path_dict = rescore_with_attention_decoder_with_ngram(
             lattice=rescored_lattice,
@@ -799,9 +842,7 @@ def main():
     else:
         H = None
         bpe_model = None
-        HLG = k2.Fsa.from_dict(
-            torch.load(f"{params.lang_dir}/HLG.pt", map_location=device)
-        )
+        HLG = load_fsa(f"{params.lang_dir}/HLG.pt", device)
         assert HLG.requires_grad is False
 
         HLG.scores *= params.hlg_scale
@@ -813,54 +854,34 @@ def main():
         "whole-lattice-rescoring",
         "attention-decoder-rescoring-with-ngram",
     ):
-        if not (params.lm_dir / "G_4_gram.pt").is_file():
-            logging.info("Loading G_4_gram.fst.txt")
-            logging.warning("It may take 8 minutes.")
-            with open(params.lm_dir / "G_4_gram.fst.txt") as f:
-                first_word_disambig_id = lexicon.word_table["#0"]
-
-                G = k2.Fsa.from_openfst(f.read(), acceptor=False)
-                # G.aux_labels is not needed in later computations, so
-                # remove it here.
-                del G.aux_labels
-                # CAUTION: The following line is crucial.
-                # Arcs entering the back-off state have label equal to #0.
-                # We have to change it to 0 here.
-                G.labels[G.labels >= first_word_disambig_id] = 0
-                # See https://github.com/k2-fsa/k2/issues/874
-                # for why we need to set G.properties to None
-                G.__dict__["_properties"] = None
-                G = k2.Fsa.from_fsas([G]).to(device)
-                G = k2.arc_sort(G)
-                # Save a dummy value so that it can be loaded in C++.
-                # See https://github.com/pytorch/pytorch/issues/67902
-                # for why we need to do this.
-                G.dummy = 1
-
-                torch.save(G.as_dict(), params.lm_dir / "G_4_gram.pt")
-        else:
-            logging.info("Loading pre-compiled G_4_gram.pt")
-            d = torch.load(params.lm_dir / "G_4_gram.pt", map_location=device)
-            G = k2.Fsa.from_dict(d)
-
-        if params.decoding_method in [
-            "whole-lattice-rescoring", "attention-decoder-rescoring-with-ngram"
-        ]:
-            # Add epsilon self-loops to G as we will compose
-            # it with the whole lattice later
-            G = k2.add_epsilon_self_loops(G)
-            G = k2.arc_sort(G)
-            G = G.to(device)
-
-        # G.lm_scores is used to replace HLG.lm_scores during
-        # LM rescoring.
-        G.lm_scores = G.scores.clone()
+        G = get_rescoring_G(
+            params.lm_dir,
+            "G_4_gram",
+            first_word_disambig_id=lexicon.word_table["#0"],
+            device=device,
+            cache=GraphCache(),
+            add_epsilon_self_loops=params.decoding_method
+            in [
+                "whole-lattice-rescoring",
+                "attention-decoder-rescoring-with-ngram",
+            ],
+        )
     else:
         G = None
 
     logging.info("About to create model")
     model = get_model(params)
 
+    avg_cache_filename = None
+    if params.cache_averaged_model:
+        if params.iter > 0:
+            name = f"iter-{params.iter}_avg-{params.avg}"
+        else:
+            name = f"epoch-{params.epoch}_avg-{params.avg}"
+        if params.use_averaged_model:
+            name += "_use-averaged-model"
+        avg_cache_filename = params.exp_dir / f"averaged-model-{name}.pt"
+
     if not params.use_averaged_model:
         if params.iter > 0:
             filenames = find_checkpoints(params.exp_dir, iteration=-params.iter)[
@@ -878,7 +899,14 @@ def main():
                 )
             logging.info(f"averaging {filenames}")
             model.to(device)
-            model.load_state_dict(average_checkpoints(filenames, device=device))
+            model.load_state_dict(
+                average_checkpoints(
+                    filenames,
+                    device=device,
+                    num_threads=params.num_avg_threads,
+                    cache_filename=avg_cache_filename,
+                )
+            )
         elif params.avg == 1:
             load_checkpoint(f"{params.exp_dir}/epoch-{params.epoch}.pt", model)
         else:
@@ -889,7 +917,14 @@ def main():
                     filenames.append(f"{params.exp_dir}/epoch-{i}.pt")
             logging.info(f"averaging {filenames}")
             model.to(device)
-            model.load_state_dict(average_checkpoints(filenames, device=device))
+            model.load_state_dict(
+                average_checkpoints(
+                    filenames,
+                    device=device,
+                    num_threads=params.num_avg_threads,
+                    cache_filename=avg_cache_filename,
+                )
+            )
     else:
         if params.iter > 0:
             filenames = find_checkpoints(params.exp_dir, iteration=-params.iter)[
@@ -917,6 +952,7 @@ def main():
                     filename_start=filename_start,
                     filename_end=filename_end,
                     device=device,
+                    cache_filename=avg_cache_filename,
                 )
             )
         else:
@@ -935,12 +971,16 @@ def main():
                     filename_start=filename_start,
                     filename_end=filename_end,
                     device=device,
+                    cache_filename=avg_cache_filename,
                 )
             )
 
     model.to(device)
     model.eval()
 
+    if params.attention_block_size > 0:
+        model.encoder.set_attention_block_size(params.attention_block_size)
+
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
 
@@ -26,6 +26,12 @@ Usage:
     --max-duration 600 \
     --decoding-method greedy_search
 
+    You can use --decoding-method greedy_search_tensorized, which gives the
+    same results. On GPU, it synchronizes with the host only once per batch
+    instead of on every frame. On CPU, it runs the decoder only on the
+    utterances that emitted a token on a frame, which is faster for large
+    batches.
+
 (2) beam search (not recommended)
 ./zipformer/decode.py \
     --epoch 28 \
@@ -44,6 +50,10 @@ Usage:
     --decoding-method modified_beam_search \
     --beam-size 4
 
+    You can use --decoding-method modified_beam_search_tensorized to run
+    the same search with all hypotheses of a batch kept in tensors, which is
+    faster for large batches. It also supports --context-file.
+
 (4) fast beam search (one best)
 ./zipformer/decode.py \
     --epoch 28 \
@@ -91,6 +101,26 @@ Usage:
     --beam 20.0 \
     --max-contexts 8 \
     --max-states 64
+
+(8) Any of the above methods with CTC-guided blank frame skipping. It needs
+    a model trained with --use-ctc 1. Encoder frames whose CTC blank
+    probability is larger than --blank-skip-threshold are dropped before
+    the transducer search. The fraction of skipped frames and the decoding
+    time are saved in blank-skip-*.txt next to the WER summary, so that you
+    can compare the speed and WER of different thresholds, e.g.,
+
+for threshold in 0.99 0.95 0.9; do
+  ./zipformer/decode.py \
+      --epoch 28 \
+      --avg 15 \
+      --exp-dir ./zipformer/exp \
+      --max-duration 600 \
+      --use-transducer 1 \
+      --use-ctc 1 \
+      --decoding-method modified_beam_search \
+      --beam-size 4 \
+      --blank-skip-threshold $threshold
+done
 """
 
 
@@ -98,9 +128,10 @@ import argparse
 import logging
 import math
 import os
+import time
 from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
 import k2
 import sentencepiece as spm
@@ -108,6 +139,7 @@ import torch
 import torch.nn as nn
 from asr_datamodule import LibriSpeechAsrDataModule
 from beam_search import (
+    DecoderOutputCache,
     beam_search,
     fast_beam_search_nbest,
     fast_beam_search_nbest_LG,
@@ -115,16 +147,19 @@ from beam_search import (
     fast_beam_search_one_best,
     greedy_search,
     greedy_search_batch,
+    greedy_search_batch_tensorized,
     modified_beam_search,
     modified_beam_search_lm_rescore,
     modified_beam_search_lm_rescore_LODR,
     modified_beam_search_lm_shallow_fusion,
     modified_beam_search_LODR,
+    modified_beam_search_tensorized,
 )
+from blank_skip import BlankSkipStats, skip_blank_frames
 from lhotse import set_caching_enabled
 from train import add_model_arguments, get_model, get_params
 
-from icefall import ContextGraph, LmScorer, NgramLm
+from icefall import CompiledContextGraph, CompiledNgramLm, ContextGraph, LmScorer
 from icefall.checkpoint import (
     average_checkpoints,
     average_checkpoints_with_averaged_model,
@@ -187,6 +222,35 @@ def get_parser():
         "`epoch` are loaded for averaging. ",
     )
 
+    parser.add_argument(
+        "--num-avg-threads",
+        type=int,
+        default=0,
+        help="If positive, the number of threads reading the checkpoints "
+        "ahead of averaging. Each of them may keep a copy of the model in "
+        "memory. Used only when --use-averaged-model is False.",
+    )
+
+    parser.add_argument(
+        "--cache-averaged-model",
+        type=str2bool,
+        default=False,
+        help="If True, save the averaged model to exp-dir, so that later runs "
+        "with the same --epoch/--iter, --avg and --use-averaged-model, e.g., "
+        "with other decoding methods, load it instead of averaging again.",
+    )
+
+    parser.add_argument(
+        "--attention-block-size",
+        type=int,
+        default=0,
+        help="""If positive, the self-attention of the encoder is computed in
+        blocks of this many frames, so that its memory usage is linear in the
+        number of frames. It gives the same results and is useful for
+        decoding long recordings, e.g., 1024.
+        """,
+    )
+
     parser.add_argument(
         "--exp-dir",
         type=str,
@@ -214,15 +278,19 @@ def get_parser():
         default="greedy_search",
         help="""Possible values are:
           - greedy_search
+          - greedy_search_tensorized
           - beam_search
           - modified_beam_search
           - modified_beam_search_LODR
+          - modified_beam_search_tensorized
           - fast_beam_search
           - fast_beam_search_nbest
           - fast_beam_search_nbest_oracle
           - fast_beam_search_nbest_LG
         If you use fast_beam_search_nbest_LG, you have to specify
         `--lang-dir`, which should contain `LG.pt`.
+        greedy_search_tensorized gives the same results as greedy_search,
+        without a host-device synchronization per frame on GPU.
         """,
     )
 
@@ -231,8 +299,8 @@ def get_parser():
         type=int,
         default=4,
         help="""An integer indicating how many candidates we will keep for each
-        frame. Used only when --decoding-method is beam_search or
-        modified_beam_search.""",
+        frame. Used only when --decoding-method is beam_search,
+        modified_beam_search or modified_beam_search_tensorized.""",
     )
 
     parser.add_argument(
@@ -371,6 +439,41 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--context-graph-cache-dir",
+        type=str,
+        default="data/context_graph_cache",
+        help="""
+        The directory to cache the compiled context graphs of
+        modified_beam_search_tensorized, so that the graph of a context file
+        is built only once. Use an empty string to disable the cache.
+        """,
+    )
+
+    parser.add_argument(
+        "--decoder-cache-size",
+        type=int,
+        default=0,
+        help="""
+        If positive, the decoder outputs are cached by the last context_size
+        tokens in a LRU cache with this many entries, so that they are not
+        recomputed for hypotheses sharing the same context.
+        Used only when --decoding-method is modified_beam_search and
+        modified_beam_search_LODR.
+        """,
+    )
+
+    parser.add_argument(
+        "--blank-skip-threshold",
+        type=float,
+        default=0.0,
+        help="""
+        If positive, the encoder frames whose blank probability given by the
+        CTC head is larger than this value are removed before the transducer
+        search. It should be in (0, 1] and requires --use-ctc 1.
+        """,
+    )
+
     parser.add_argument(
         "--skip-scoring",
         type=str2bool,
@@ -390,10 +493,12 @@ def decode_one_batch(
     batch: dict,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, CompiledContextGraph]] = None,
     LM: Optional[LmScorer] = None,
     ngram_lm=None,
     ngram_lm_scale: float = 0.0,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    blank_skip_stats: Optional[BlankSkipStats] = None,
 ) -> Dict[str, List[List[str]]]:
     """Decode one batch and return the result in a dict. The dict has the
     following format:
@@ -428,6 +533,12 @@ def decode_one_batch(
         A ngram language model
       ngram_lm_scale:
         The scale for the ngram language model.
+      decoder_cache:
+        An optional cache of decoder outputs. Used only when
+        --decoding-method is modified_beam_search and modified_beam_search_LODR.
+      blank_skip_stats:
+        If not None, it counts the encoder frames before and after
+        --blank-skip-threshold is applied.
     Returns:
       Return the decoding result. See above description for the format of
       the returned dict.
@@ -454,6 +565,20 @@ def decode_one_batch(
 
     encoder_out, encoder_out_lens = model.forward_encoder(feature, feature_lens)
 
+    num_frames = encoder_out_lens
+    if params.blank_skip_threshold > 0:
+        # None of the search methods here return timestamps, so the indexes
+        # of the kept frames are not needed
+        encoder_out, encoder_out_lens, _ = skip_blank_frames(
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            ctc_output=model.ctc_output(encoder_out),
+            threshold=params.blank_skip_threshold,
+            blank_id=params.blank_id,
+        )
+    if blank_skip_stats is not None:
+        blank_skip_stats.update(num_frames, encoder_out_lens)
+
     hyps = []
 
     if params.decoding_method == "fast_beam_search":
@@ -519,6 +644,14 @@ def decode_one_batch(
         )
         for hyp in sp.decode(hyp_tokens):
             hyps.append(hyp.split())
+    elif params.decoding_method == "greedy_search_tensorized":
+        hyp_tokens = greedy_search_batch_tensorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+        )
+        for hyp in sp.decode(hyp_tokens):
+            hyps.append(hyp.split())
     elif params.decoding_method == "modified_beam_search":
         hyp_tokens = modified_beam_search(
             model=model,
@@ -526,6 +659,17 @@ def decode_one_batch(
             encoder_out_lens=encoder_out_lens,
             beam=params.beam_size,
             context_graph=context_graph,
+            decoder_cache=decoder_cache,
+        )
+        for hyp in sp.decode(hyp_tokens):
+            hyps.append(hyp.split())
+    elif params.decoding_method == "modified_beam_search_tensorized":
+        hyp_tokens = modified_beam_search_tensorized(
+            model=model,
+            encoder_out=encoder_out,
+            encoder_out_lens=encoder_out_lens,
+            context_graph=context_graph,
+            beam=params.beam_size,
         )
         for hyp in sp.decode(hyp_tokens):
             hyps.append(hyp.split())
@@ -549,6 +693,7 @@ def decode_one_batch(
             LODR_lm_scale=ngram_lm_scale,
             LM=LM,
             context_graph=context_graph,
+            decoder_cache=decoder_cache,
         )
         for hyp in sp.decode(hyp_tokens):
             hyps.append(hyp.split())
@@ -601,8 +746,8 @@ def decode_one_batch(
 
     # prefix = ( "greedy_search" | "fast_beam_search_nbest" | "modified_beam_search" )
     prefix = f"{params.decoding_method}"
-    if params.decoding_method == "greedy_search":
-        return {"greedy_search": hyps}
+    if params.decoding_method in ("greedy_search", "greedy_search_tensorized"):
+        return {params.decoding_method: hyps}
     elif "fast_beam_search" in params.decoding_method:
         prefix += f"_beam-{params.beam}"
         prefix += f"_max-contexts-{params.max_contexts}"
@@ -642,10 +787,12 @@ def decode_dataset(
     sp: spm.SentencePieceProcessor,
     word_table: Optional[k2.SymbolTable] = None,
     decoding_graph: Optional[k2.Fsa] = None,
-    context_graph: Optional[ContextGraph] = None,
+    context_graph: Optional[Union[ContextGraph, CompiledContextGraph]] = None,
     LM: Optional[LmScorer] = None,
     ngram_lm=None,
     ngram_lm_scale: float = 0.0,
+    decoder_cache: Optional[DecoderOutputCache] = None,
+    blank_skip_stats: Optional[BlankSkipStats] = None,
 ) -> Dict[str, List[Tuple[str, List[str], List[str]]]]:
     """Decode dataset.
 
@@ -664,6 +811,12 @@ def decode_dataset(
         The decoding graph. Can be either a `k2.trivial_graph` or HLG, Used
         only when --decoding-method is fast_beam_search, fast_beam_search_nbest,
         fast_beam_search_nbest_oracle, and fast_beam_search_nbest_LG.
+      decoder_cache:
+        An optional cache of decoder outputs. Used only when
+        --decoding-method is modified_beam_search and modified_beam_search_LODR.
+      blank_skip_stats:
+        If not None, it counts the encoder frames before and after
+        --blank-skip-threshold is applied.
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
       is used, or it may be "beam_7" if beam size of 7 is used.
@@ -678,7 +831,7 @@ def decode_dataset(
     except TypeError:
         num_batches = "?"
 
-    if params.decoding_method == "greedy_search":
+    if params.decoding_method in ("greedy_search", "greedy_search_tensorized"):
         log_interval = 50
     else:
         log_interval = 20
@@ -699,6 +852,8 @@ def decode_dataset(
             LM=LM,
             ngram_lm=ngram_lm,
             ngram_lm_scale=ngram_lm_scale,
+            decoder_cache=decoder_cache,
+            blank_skip_stats=blank_skip_stats,
         )
 
         for name, hyps in hyps_dict.items():
@@ -716,9 +871,34 @@ def decode_dataset(
             batch_str = f"{batch_idx}/{num_batches}"
 
             logging.info(f"batch {batch_str}, cuts processed until now is {num_cuts}")
+
+    if decoder_cache is not None:
+        logging.info(f"Decoder output cache: {decoder_cache}")
     return results
 
 
+def save_blank_skip_stats(
+    params: AttributeDict,
+    test_set_name: str,
+    blank_skip_stats: BlankSkipStats,
+    elapsed: float,
+    wer: Optional[float] = None,
+):
+    """Save the fraction of skipped frames, the decoding time and the best
+    WER of a test set. See blank_skip_sweep.py, which collects them over a
+    range of thresholds."""
+    stats_filename = params.res_dir / f"blank-skip-{test_set_name}-{params.suffix}.txt"
+    with open(stats_filename, "w") as f:
+        print("threshold\tskipped frames\tdecoding time (s)\tWER", file=f)
+        print(
+            f"{params.blank_skip_threshold}\t{blank_skip_stats.skip_ratio:.4f}"
+            f"\t{elapsed:.2f}\t{wer if wer is not None else '-'}",
+            file=f,
+        )
+    logging.info(f"Blank skipping on {test_set_name}: {blank_skip_stats}")
+    logging.info(f"Blank skipping stats are saved to {stats_filename}")
+
+
 def save_asr_output(
     params: AttributeDict,
     test_set_name: str,
@@ -741,9 +921,9 @@ def save_wer_results(
     params: AttributeDict,
     test_set_name: str,
     results_dict: Dict[str, List[Tuple[str, List[str], List[str], Tuple]]],
-):
+) -> float:
     """
-    Save WER and per-utterance word alignments.
+    Save WER and per-utterance word alignments. Return the best WER.
     """
     test_set_wers = dict()
     for key, results in results_dict.items():
@@ -774,6 +954,8 @@ def save_wer_results(
         note = ""
     logging.info(s)
 
+    return test_set_wers[0][1]
+
 
 @torch.no_grad()
 def main():
@@ -791,6 +973,7 @@ def main():
 
     assert params.decoding_method in (
         "greedy_search",
+        "greedy_search_tensorized",
         "beam_search",
         "fast_beam_search",
         "fast_beam_search_nbest",
@@ -798,10 +981,16 @@ def main():
         "fast_beam_search_nbest_oracle",
         "modified_beam_search",
         "modified_beam_search_LODR",
+        "modified_beam_search_tensorized",
         "modified_beam_search_lm_shallow_fusion",
         "modified_beam_search_lm_rescore",
         "modified_beam_search_lm_rescore_LODR",
     )
+    if params.decoding_method == "greedy_search_tensorized":
+        assert params.max_sym_per_frame == 1, params.max_sym_per_frame
+    if params.blank_skip_threshold > 0:
+        assert params.use_ctc, "--blank-skip-threshold requires --use-ctc 1"
+        assert params.blank_skip_threshold <= 1, params.blank_skip_threshold
     params.res_dir = params.exp_dir / params.decoding_method
 
     if os.path.exists(params.context_file):
@@ -853,6 +1042,9 @@ def main():
                 f"_LODR-{params.tokens_ngram}gram-scale-{params.ngram_lm_scale}"
             )
 
+    if params.blank_skip_threshold > 0:
+        params.suffix += f"_blank-skip-{params.blank_skip_threshold}"
+
     if params.use_averaged_model:
         params.suffix += "_use-averaged-model"
 
@@ -878,6 +1070,16 @@ def main():
     logging.info("About to create model")
     model = get_model(params)
 
+    avg_cache_filename = None
+    if params.cache_averaged_model:
+        if params.iter > 0:
+            name = f"iter-{params.iter}_avg-{params.avg}"
+        else:
+            name = f"epoch-{params.epoch}_avg-{params.avg}"
+        if params.use_averaged_model:
+            name += "_use-averaged-model"
+        avg_cache_filename = params.exp_dir / f"averaged-model-{name}.pt"
+
     if not params.use_averaged_model:
         if params.iter > 0:
             filenames = find_checkpoints(params.exp_dir, iteration=-params.iter)[
@@ -895,7 +1097,14 @@ def main():
                 )
             logging.info(f"averaging {filenames}")
             model.to(device)
-            model.load_state_dict(average_checkpoints(filenames, device=device))
+            model.load_state_dict(
+                average_checkpoints(
+                    filenames,
+                    device=device,
+                    num_threads=params.num_avg_threads,
+                    cache_filename=avg_cache_filename,
+                )
+            )
         elif params.avg == 1:
             load_checkpoint(f"{params.exp_dir}/epoch-{params.epoch}.pt", model)
         else:
@@ -906,7 +1115,14 @@ def main():
                     filenames.append(f"{params.exp_dir}/epoch-{i}.pt")
             logging.info(f"averaging {filenames}")
             model.to(device)
-            model.load_state_dict(average_checkpoints(filenames, device=device))
+            model.load_state_dict(
+                average_checkpoints(
+                    filenames,
+                    device=device,
+                    num_threads=params.num_avg_threads,
+                    cache_filename=avg_cache_filename,
+                )
+            )
     else:
         if params.iter > 0:
             filenames = find_checkpoints(params.exp_dir, iteration=-params.iter)[
@@ -934,6 +1150,7 @@ def main():
                     filename_start=filename_start,
                     filename_end=filename_end,
                     device=device,
+                    cache_filename=avg_cache_filename,
                 )
             )
         else:
@@ -952,12 +1169,16 @@ def main():
                     filename_start=filename_start,
                     filename_end=filename_end,
                     device=device,
+                    cache_filename=avg_cache_filename,
                 )
             )
 
     model.to(device)
     model.eval()
 
+    if params.attention_block_size > 0:
+        model.encoder.set_attention_block_size(params.attention_block_size)
+
     # only load the neural network LM if required
     if params.use_shallow_fusion or params.decoding_method in (
         "modified_beam_search_lm_rescore",
@@ -995,12 +1216,15 @@ def main():
     elif params.decoding_method == "modified_beam_search_LODR":
         lm_filename = f"{params.tokens_ngram}gram.fst.txt"
         logging.info(f"Loading token level lm: {lm_filename}")
-        ngram_lm = NgramLm(
+        # The flattened LM is cached in a .npz file next to the FST, which
+        # is memory-mapped and thus shared by all decoding processes.
+        ngram_lm = CompiledNgramLm.load_or_compile(
             str(params.lang_dir / lm_filename),
             backoff_id=params.backoff_id,
             is_binary=False,
+            cache_filename=str(params.lang_dir / f"{params.tokens_ngram}gram.npz"),
         )
-        logging.info(f"num states: {ngram_lm.lm.num_states}")
+        logging.info(f"num states: {ngram_lm.num_states}")
         ngram_lm_scale = params.ngram_lm_scale
     else:
         ngram_lm = None
@@ -1027,14 +1251,37 @@ def main():
         if os.path.exists(params.context_file):
             contexts = []
             for line in open(params.context_file).readlines():
-                contexts.append((sp.encode(line.strip()), 0.0))
-            context_graph = ContextGraph(params.context_score)
-            context_graph.build(contexts)
+                contexts.append(sp.encode(line.strip()))
+            if (
+                params.decoding_method == "modified_beam_search_tensorized"
+                and params.context_graph_cache_dir
+            ):
+                context_graph = CompiledContextGraph.load_or_build(
+                    params.context_graph_cache_dir,
+                    token_ids=contexts,
+                    context_score=params.context_score,
+                    device=device,
+                )
+            else:
+                context_graph = ContextGraph(params.context_score)
+                context_graph.build(contexts)
+                if params.decoding_method == "modified_beam_search_tensorized":
+                    context_graph = CompiledContextGraph.from_context_graph(
+                        context_graph
+                    ).to(device)
         else:
             context_graph = None
     else:
         context_graph = None
 
+    if params.decoder_cache_size > 0 and params.decoding_method in (
+        "modified_beam_search",
+        "modified_beam_search_LODR",
+    ):
+        decoder_cache = DecoderOutputCache(params.decoder_cache_size)
+    else:
+        decoder_cache = None
+
     num_param = sum([p.numel() for p in model.parameters()])
     logging.info(f"Number of model parameters: {num_param}")
 
@@ -1052,6 +1299,11 @@ def main():
     test_dl = [test_clean_dl, test_other_dl]
 
     for test_set, test_dl in zip(test_sets, test_dl):
+        blank_skip_stats = None
+        if params.blank_skip_threshold > 0:
+            blank_skip_stats = BlankSkipStats()
+
+        start = time.time()
         results_dict = decode_dataset(
             dl=test_dl,
             params=params,
@@ -1063,7 +1315,11 @@ def main():
             LM=LM,
             ngram_lm=ngram_lm,
             ngram_lm_scale=ngram_lm_scale,
+            decoder_cache=decoder_cache,
+            blank_skip_stats=blank_skip_stats,
         )
+        elapsed = time.time() - start
+        logging.info(f"Decoding {test_set} took {elapsed:.2f} seconds")
 
         save_asr_output(
             params=params,
@@ -1071,13 +1327,23 @@ def main():
             results_dict=results_dict,
         )
 
+        wer = None
         if not params.skip_scoring:
-            save_wer_results(
+            wer = save_wer_results(
                 params=params,
                 test_set_name=test_set,
                 results_dict=results_dict,
             )
 
+        if blank_skip_stats is not None:
+            save_blank_skip_stats(
+                params=params,
+                test_set_name=test_set,
+                blank_skip_stats=blank_skip_stats,
+                elapsed=elapsed,
+                wer=wer,
+            )
+
     logging.info("Done!")
 
 
@@ -20,7 +20,7 @@ from typing import List, Optional, Tuple
 
 import k2
 import torch
-from beam_search import Hypothesis, HypothesisList
+from beam_search import DecoderOutputCache, Hypothesis, HypothesisList
 
 from icefall.utils import AttributeDict
 
@@ -30,7 +30,7 @@ class DecodeStream(object):
         self,
         params: AttributeDict,
         cut_id: str,
-        initial_states: List[torch.Tensor],
+        initial_states: Optional[List[torch.Tensor]] = None,
         decoding_graph: Optional[k2.Fsa] = None,
         device: torch.device = torch.device("cpu"),
     ) -> None:
@@ -38,7 +38,8 @@ class DecodeStream(object):
         Args:
           initial_states:
             Initial decode states of the model, e.g. the return value of
-            `get_init_state` in conformer.py
+            `get_init_state` in conformer.py. It can be None if the states
+            are kept in a `StatePool`, see :attr:`state_slot`.
           decoding_graph:
             Decoding graph used for decoding, may be a TrivialGraph or a HLG.
             Used only when decoding_method is fast_beam_search.
@@ -55,6 +56,10 @@ class DecodeStream(object):
 
         self.states = initial_states
 
+        # The slot of this stream in a `StatePool`, if the states are not
+        # kept in self.states
+        self.state_slot: Optional[int] = None
+
         # It contains a 2-D tensors representing the feature frames.
         self.features: torch.Tensor = None
 
@@ -78,6 +83,10 @@ class DecodeStream(object):
         # The ConvNeXt module needs (7 - 1) // 2 = 3 frames of right padding after subsampling
         self.pad_length = 7 + 2 * 3
 
+        # Cache of decoder outputs of this stream, used only in
+        # modified_beam_search
+        self.decoder_cache: Optional[DecoderOutputCache] = None
+
         if params.decoding_method == "greedy_search":
             self.hyp = [-1] * (params.context_size - 1) + [params.blank_id]
         elif params.decoding_method == "modified_beam_search":
@@ -88,6 +97,8 @@ class DecodeStream(object):
                     log_prob=torch.zeros(1, dtype=torch.float32, device=device),
                 )
             )
+            if params.get("decoder_cache_size", 0) > 0:
+                self.decoder_cache = DecoderOutputCache(params.decoder_cache_size)
         elif params.decoding_method == "fast_beam_search":
             # The rnnt_decoding_stream for fast_beam_search.
             self.rnnt_decoding_stream: k2.RnntDecodingStream = k2.RnntDecodingStream(
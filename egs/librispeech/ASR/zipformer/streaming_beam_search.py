@@ -20,7 +20,12 @@ from typing import List
 import k2
 import torch
 import torch.nn as nn
-from beam_search import Hypothesis, HypothesisList, get_hyps_shape
+from beam_search import (
+    Hypothesis,
+    HypothesisList,
+    get_decoder_out_with_cache,
+    get_hyps_shape,
+)
 from decode_stream import DecodeStream
 
 from icefall.decode import one_best_decoding
@@ -115,6 +120,10 @@ def modified_beam_search(
         A list of stream objects.
       num_active_paths:
         Number of active paths during the beam search.
+
+    If `streams[i].decoder_cache` is not None, decoder outputs of the
+    hypotheses of the i-th stream are looked up in it, and only the missed
+    contexts of all streams are computed in a single batch.
     """
     assert encoder_out.ndim == 3, encoder_out.shape
     assert len(streams) == encoder_out.size(0)
@@ -140,14 +149,21 @@ def modified_beam_search(
             [hyp.log_prob.reshape(1) for hyps in A for hyp in hyps], dim=0
         )  # (num_hyps, 1)
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
+        if streams[0].decoder_cache is None:
+            decoder_input = torch.tensor(
+                [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+                device=device,
+                dtype=torch.int64,
+            )  # (num_hyps, context_size)
 
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
+            decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
+            decoder_out = model.joiner.decoder_proj(decoder_out)
+        else:
+            decoder_out = get_decoder_out_with_cache(
+                model,
+                [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
+                [streams[i].decoder_cache for i in range(batch_size) for _ in A[i]],
+            )
         # decoder_out is of shape (num_hyps, 1, 1, decoder_output_dim)
 
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
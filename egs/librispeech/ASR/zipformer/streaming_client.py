@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A load generator for ./zipformer/streaming_server.py.
+
+For each number of concurrent clients given by --num-clients, it starts that
+many clients at the same time. Each client sends --num-utterances sound
+files to the server, one after another, with --packet-ms of audio per
+message, at --speed times real time. It reports the percentiles of the chunk
+latency, i.e., the time from sending the audio that completes a chunk to
+receiving the result of that chunk, and the real-time factor.
+
+Usage:
+
+./zipformer/streaming_client.py \
+  --server-port 6006 \
+  --num-clients 1,4,16,64 \
+  /path/to/foo.wav \
+  /path/to/bar.wav
+"""
+
+import argparse
+import asyncio
+import bisect
+import json
+import logging
+import time
+from typing import Dict, List
+
+import numpy as np
+import torchaudio
+from streaming_server import read_message, write_message
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--server-addr",
+        type=str,
+        default="127.0.0.1",
+        help="Address of the server",
+    )
+
+    parser.add_argument(
+        "--server-port",
+        type=int,
+        default=6006,
+        help="Port of the server",
+    )
+
+    parser.add_argument(
+        "--num-clients",
+        type=str,
+        default="1,4,16",
+        help="Comma separated numbers of concurrent clients to test.",
+    )
+
+    parser.add_argument(
+        "--num-utterances",
+        type=int,
+        default=1,
+        help="The number of utterances each client sends.",
+    )
+
+    parser.add_argument(
+        "--packet-ms",
+        type=float,
+        default=100,
+        help="The duration of audio in each message, in milliseconds.",
+    )
+
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="""How fast the audio is sent, relative to real time. If 0,
+        the audio is sent as fast as possible.""",
+    )
+
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=16000,
+        help="The sample rate of the input sound files",
+    )
+
+    parser.add_argument(
+        "sound_files",
+        type=str,
+        nargs="+",
+        help="The input sound file(s) to send. "
+        "Supported formats are those supported by torchaudio.load(). "
+        "For example, wav and flac are supported.",
+    )
+
+    return parser
+
+
+def read_sound_files(
+    filenames: List[str], expected_sample_rate: float
+) -> List[np.ndarray]:
+    """Read a list of sound files into a list 1-D float32 arrays.
+    Args:
+      filenames:
+        A list of sound filenames.
+      expected_sample_rate:
+        The expected sample rate of the sound files.
+    Returns:
+      Return a list of 1-D float32 arrays.
+    """
+    ans = []
+    for f in filenames:
+        wave, sample_rate = torchaudio.load(f)
+        assert (
+            sample_rate == expected_sample_rate
+        ), f"expected sample rate: {expected_sample_rate}. Given: {sample_rate}"
+        # We use only the first channel
+        ans.append(wave[0].numpy())
+    return ans
+
+
+async def transcribe(
+    host: str,
+    port: int,
+    samples: np.ndarray,
+    sample_rate: int,
+    packet_ms: float = 100,
+    speed: float = 1.0,
+) -> Dict:
+    """Send an utterance to the server and wait for its final result.
+
+    Args:
+      host:
+        Address of the server.
+      port:
+        Port of the server.
+      samples:
+        A 1-D float32 array with the audio samples.
+      sample_rate:
+        The sample rate of samples.
+      packet_ms:
+        The duration of audio in each message, in milliseconds.
+      speed:
+        How fast the audio is sent, relative to real time. If 0, the audio is
+        sent as fast as possible.
+    Returns:
+      Return a dict with the following keys:
+        - text: The final result.
+        - latencies: A list with the latency of each chunk in seconds.
+        - duration: The duration of the audio in seconds.
+        - elapsed: The time from sending the first message to receiving the
+                   final result, in seconds.
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    packet_size = max(int(sample_rate * packet_ms / 1000), 1)
+
+    # num_sent[i] is the number of samples sent by the i-th message,
+    # including previous messages, and send_times[i] is when it was sent.
+    num_sent = []
+    send_times = []
+
+    start = time.time()
+
+    async def send():
+        for i in range(0, samples.size, packet_size):
+            packet = samples[i : i + packet_size]
+            if speed > 0:
+                # A microphone produces the packet at the end of its duration
+                delay = start + (i + packet.size) / sample_rate / speed - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            write_message(writer, packet.astype("<f4").tobytes())
+            num_sent.append(i + packet.size)
+            send_times.append(time.time())
+            await writer.drain()
+
+        write_message(writer, b"")
+        num_sent.append(samples.size)
+        send_times.append(time.time())
+        await writer.drain()
+
+    sender = asyncio.create_task(send())
+
+    latencies = []
+    while True:
+        message = await read_message(reader)
+        if message is None:
+            raise ConnectionError("The server closed the connection")
+        now = time.time()
+        result = json.loads(message.decode("utf-8"))
+        if result["final"]:
+            # The final chunk is ready only after the end of the utterance
+            # has been received.
+            i = len(send_times) - 1
+        else:
+            i = bisect.bisect_left(num_sent, result["num_samples"])
+        latencies.append(now - send_times[i])
+        if result["final"]:
+            break
+
+    elapsed = time.time() - start
+    await sender
+    writer.close()
+    await writer.wait_closed()
+
+    return {
+        "text": result["text"],
+        "latencies": latencies,
+        "duration": samples.size / sample_rate,
+        "elapsed": elapsed,
+    }
+
+
+async def run_clients(
+    host: str,
+    port: int,
+    waves: List[np.ndarray],
+    sample_rate: int,
+    num_clients: int,
+    num_utterances: int,
+    packet_ms: float,
+    speed: float,
+) -> Dict[str, float]:
+    """Run num_clients clients at the same time. Each of them transcribes
+    num_utterances utterances from waves, one after another.
+
+    Returns:
+      Return a dict with the latency percentiles in milliseconds and the
+      real-time factors.
+    """
+
+    async def client(k: int) -> List[Dict]:
+        results = []
+        for i in range(num_utterances):
+            samples = waves[(k * num_utterances + i) % len(waves)]
+            results.append(
+                await transcribe(host, port, samples, sample_rate, packet_ms, speed)
+            )
+        return results
+
+    start = time.time()
+    results = await asyncio.gather(*[client(k) for k in range(num_clients)])
+    elapsed = time.time() - start
+    results = sum(results, [])
+
+    latencies = np.array(sum([r["latencies"] for r in results], [])) * 1000
+    duration = sum(r["duration"] for r in results)
+    return {
+        "num_utterances": len(results),
+        "num_chunks": latencies.size,
+        "p50": np.percentile(latencies, 50),
+        "p95": np.percentile(latencies, 95),
+        "p99": np.percentile(latencies, 99),
+        # The time from the first message of an utterance to its final
+        # result, divided by the duration of the utterance
+        "rtf": sum(r["elapsed"] for r in results) / duration,
+        # How many seconds of audio the server transcribes per second
+        "throughput": duration / elapsed,
+    }
+
+
+async def run(args) -> None:
+    waves = read_sound_files(args.sound_files, args.sample_rate)
+    for num_clients in map(int, args.num_clients.split(",")):
+        stats = await run_clients(
+            host=args.server_addr,
+            port=args.server_port,
+            waves=waves,
+            sample_rate=args.sample_rate,
+            num_clients=num_clients,
+            num_utterances=args.num_utterances,
+            packet_ms=args.packet_ms,
+            speed=args.speed,
+        )
+        logging.info(
+            f"num_clients: {num_clients}, "
+            f"num_utterances: {stats['num_utterances']}, "
+            f"num_chunks: {stats['num_chunks']}, "
+            f"chunk latency (ms) p50: {stats['p50']:.1f}, "
+            f"p95: {stats['p95']:.1f}, p99: {stats['p99']:.1f}, "
+            f"RTF: {stats['rtf']:.3f}, "
+            f"throughput: {stats['throughput']:.1f}x real time"
+        )
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.info(vars(args))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -33,8 +33,11 @@ Usage:
 import argparse
 import logging
 import math
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
 
 import k2
 import numpy as np
@@ -45,6 +48,7 @@ from asr_datamodule import AsrDataModule
 from decode_stream import DecodeStream
 from kaldifeat import Fbank, FbankOptions
 from lhotse import CutSet
+from lhotse.cut import Cut
 from streaming_beam_search import (
     fast_beam_search_one_best,
     greedy_search,
@@ -54,6 +58,7 @@ from torch import Tensor, nn
 from torch.nn.utils.rnn import pad_sequence
 from train import add_model_arguments, get_params, get_model
 
+from icefall import StatePool
 from icefall.checkpoint import (
     average_checkpoints,
     average_checkpoints_with_averaged_model,
@@ -197,6 +202,32 @@ def get_parser():
         help="The number of streams that can be decoded parallel.",
     )
 
+    parser.add_argument(
+        "--decoder-cache-size",
+        type=int,
+        default=0,
+        help="""If positive, each stream caches its decoder outputs by the
+        last context_size tokens in a LRU cache with this many entries.
+        Used only when --decoding-method is modified_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--num-prefetch-workers",
+        type=int,
+        default=2,
+        help="""The number of threads that load audio and compute features
+        in the background while the model is decoding. If 0, they are
+        computed in the decoding loop.""",
+    )
+
+    parser.add_argument(
+        "--max-prefetch-cuts",
+        type=int,
+        default=200,
+        help="""The maximum number of cuts whose features are computed
+        ahead of time. Used only when --num-prefetch-workers is positive.""",
+    )
+
     add_model_arguments(parser)
 
     return parser
@@ -226,6 +257,22 @@ def get_init_states(
     return states
 
 
+def get_state_batch_dims(num_layers: int) -> List[int]:
+    """Return the batch dimension of each tensor in the states returned by
+    :func:`get_init_states`, which is needed by `StatePool`.
+
+    Args:
+      num_layers:
+        The total number of encoder layers, i.e., (len(states) - 2) // 6.
+    """
+    # cached_key, cached_nonlin_attn, cached_val1, cached_val2,
+    # cached_conv1, cached_conv2
+    batch_dims = [1, 1, 1, 1, 0, 0] * num_layers
+    # cached_embed_left_pad, processed_lens
+    batch_dims += [0, 0]
+    return batch_dims
+
+
 def stack_states(state_list: List[List[torch.Tensor]]) -> List[torch.Tensor]:
     """Stack list of zipformer states that correspond to separate utterances
     into a single emformer state, so that it can be used as an input for
@@ -442,6 +489,7 @@ def decode_one_chunk(
     params: AttributeDict,
     model: nn.Module,
     decode_streams: List[DecodeStream],
+    state_pool: StatePool,
 ) -> List[int]:
     """Decode one chunk frames of features for each decode_streams and
     return the indexes of finished streams in a List.
@@ -453,6 +501,9 @@ def decode_one_chunk(
         The neural model.
       decode_streams:
         A List of DecodeStream, each belonging to a utterance.
+      state_pool:
+        The pool holding the encoder states of decode_streams, indexed by
+        `DecodeStream.state_slot`.
     Returns:
       Return a List containing which DecodeStreams are finished.
     """
@@ -462,14 +513,14 @@ def decode_one_chunk(
 
     features = []
     feature_lens = []
-    states = []
+    slots = []
     processed_lens = []  # Used in fast-beam-search
 
     for stream in decode_streams:
         feat, feat_len = stream.get_feature_frames(chunk_size * 2)
         features.append(feat)
         feature_lens.append(feat_len)
-        states.append(stream.states)
+        slots.append(stream.state_slot)
         processed_lens.append(stream.done_frames)
 
     feature_lens = torch.tensor(feature_lens, device=device)
@@ -489,7 +540,9 @@ def decode_one_chunk(
             value=LOG_EPS,
         )
 
-    states = stack_states(states)
+    # Unless the set of streams changed since the last chunk, this returns
+    # the states from the last chunk without any copy.
+    states = state_pool.get_batch_states(slots)
 
     encoder_out, encoder_out_lens, new_states = streaming_forward(
         features=features,
@@ -530,11 +583,10 @@ def decode_one_chunk(
             f"Unsupported decoding method: {params.decoding_method}"
         )
 
-    states = unstack_states(new_states)
+    state_pool.set_batch_states(slots, new_states)
 
     finished_streams = []
     for i in range(len(decode_streams)):
-        decode_streams[i].states = states[i]
         decode_streams[i].done_frames += encoder_out_lens[i]
         if decode_streams[i].done:
             finished_streams.append(i)
@@ -542,6 +594,110 @@ def decode_one_chunk(
     return finished_streams
 
 
+def compute_features(cut: Cut, opts: FbankOptions) -> torch.Tensor:
+    """Load the audio of a cut and compute its fbank features.
+
+    Returns:
+      Return a 2-D tensor of shape (num_frames, num_bins) on opts.device.
+    """
+    audio: np.ndarray = cut.load_audio()
+    # audio.shape: (1, num_samples)
+    assert len(audio.shape) == 2
+    assert audio.shape[0] == 1, "Should be single channel"
+    assert audio.dtype == np.float32, audio.dtype
+
+    # The trained model is using normalized samples
+    assert audio.max() <= 1, "Should be normalized to [-1, 1])"
+
+    samples = torch.from_numpy(audio).squeeze(0)
+
+    fbank = Fbank(opts)
+    return fbank(samples.to(opts.device))
+
+
+class FeaturePrefetcher(object):
+    """Iterate over (cut, features) pairs, while the features of the
+    following cuts are computed by a thread pool in the background.
+
+    The cuts are returned in their original order, so the decoding results
+    do not depend on the number of workers.
+    """
+
+    def __init__(
+        self,
+        cuts: CutSet,
+        opts: FbankOptions,
+        num_workers: int,
+        max_prefetch: int,
+    ):
+        """
+        Args:
+          cuts:
+            The cuts to compute features for.
+          opts:
+            The options of the fbank.
+          num_workers:
+            The number of threads. If 0, the features are computed when
+            they are requested.
+          max_prefetch:
+            The maximum number of cuts whose features are computed but not
+            yet consumed, including the ones being computed.
+        """
+        assert max_prefetch > 0, max_prefetch
+        self.cuts = cuts
+        self.opts = opts
+        self.num_workers = num_workers
+        self.max_prefetch = max_prefetch
+
+        # The number of cuts whose features were not ready when they were
+        # requested, and the total time spent on waiting for them
+        self.num_starved = 0
+        self.wait_time = 0.0
+        self.num_cuts = 0
+
+    def __iter__(self) -> Iterator[Tuple[Cut, torch.Tensor]]:
+        if self.num_workers <= 0:
+            for cut in self.cuts:
+                start = time.time()
+                feature = compute_features(cut, self.opts)
+                self.num_starved += 1
+                self.wait_time += time.time() - start
+                self.num_cuts += 1
+                yield cut, feature
+            return
+
+        cut_iter = iter(self.cuts)
+        pending: Deque[Tuple[Cut, Future]] = deque()
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            while True:
+                while len(pending) < self.max_prefetch:
+                    cut = next(cut_iter, None)
+                    if cut is None:
+                        break
+                    pending.append(
+                        (cut, executor.submit(compute_features, cut, self.opts))
+                    )
+
+                if len(pending) == 0:
+                    break
+
+                cut, future = pending.popleft()
+                if not future.done():
+                    start = time.time()
+                    future.result()
+                    self.num_starved += 1
+                    self.wait_time += time.time() - start
+                self.num_cuts += 1
+                yield cut, future.result()
+
+    def __str__(self) -> str:
+        return (
+            f"num_cuts: {self.num_cuts}, "
+            f"num_starved: {self.num_starved}, "
+            f"wait_time: {self.wait_time:.2f}s"
+        )
+
+
 def decode_dataset(
     cuts: CutSet,
     params: AttributeDict,
@@ -583,35 +739,39 @@ def decode_dataset(
 
     log_interval = 100
 
+    initial_states = get_init_states(model=model, batch_size=1, device=device)
+    state_pool = StatePool(
+        init_states=initial_states,
+        batch_dims=get_state_batch_dims((len(initial_states) - 2) // 6),
+        max_streams=params.num_decode_streams,
+    )
+
+    # Hits and misses of the decoder output caches of finished streams
+    decoder_cache_hits = 0
+    decoder_cache_misses = 0
+
     decode_results = []
+    # Audio loading and feature extraction run in background threads, so
+    # that they overlap with the decoding of the model.
+    prefetcher = FeaturePrefetcher(
+        cuts=cuts,
+        opts=opts,
+        num_workers=params.num_prefetch_workers,
+        max_prefetch=params.max_prefetch_cuts,
+    )
+
     # Contain decode streams currently running.
     decode_streams = []
-    for num, cut in enumerate(cuts):
+    for num, (cut, feature) in enumerate(prefetcher):
         # each utterance has a DecodeStream.
-        initial_states = get_init_states(
-            model=model, batch_size=1, device=device
-        )
         decode_stream = DecodeStream(
             params=params,
             cut_id=cut.id,
-            initial_states=initial_states,
             decoding_graph=decoding_graph,
             device=device,
         )
+        decode_stream.state_slot = state_pool.allocate()
 
-        audio: np.ndarray = cut.load_audio()
-        # audio.shape: (1, num_samples)
-        assert len(audio.shape) == 2
-        assert audio.shape[0] == 1, "Should be single channel"
-        assert audio.dtype == np.float32, audio.dtype
-
-        # The trained model is using normalized samples
-        assert audio.max() <= 1, "Should be normalized to [-1, 1])"
-
-        samples = torch.from_numpy(audio).squeeze(0)
-
-        fbank = Fbank(opts)
-        feature = fbank(samples.to(device))
         decode_stream.set_features(feature, tail_pad_len=30)
         decode_stream.ground_truth = cut.supervisions[0].text
 
@@ -619,7 +779,10 @@ def decode_dataset(
 
         while len(decode_streams) >= params.num_decode_streams:
             finished_streams = decode_one_chunk(
-                params=params, model=model, decode_streams=decode_streams
+                params=params,
+                model=model,
+                decode_streams=decode_streams,
+                state_pool=state_pool,
             )
             for i in sorted(finished_streams, reverse=True):
                 decode_results.append(
@@ -629,6 +792,10 @@ def decode_dataset(
                         sp.decode(decode_streams[i].decoding_result()).split(),
                     )
                 )
+                if decode_streams[i].decoder_cache is not None:
+                    decoder_cache_hits += decode_streams[i].decoder_cache.num_hits
+                    decoder_cache_misses += decode_streams[i].decoder_cache.num_misses
+                state_pool.free(decode_streams[i].state_slot)
                 del decode_streams[i]
 
         if num % log_interval == 0:
@@ -637,7 +804,10 @@ def decode_dataset(
     # decode final chunks of last sequences
     while len(decode_streams):
         finished_streams = decode_one_chunk(
-            params=params, model=model, decode_streams=decode_streams
+            params=params,
+            model=model,
+            decode_streams=decode_streams,
+            state_pool=state_pool,
         )
         for i in sorted(finished_streams, reverse=True):
             decode_results.append(
@@ -647,8 +817,23 @@ def decode_dataset(
                     sp.decode(decode_streams[i].decoding_result()).split(),
                 )
             )
+            if decode_streams[i].decoder_cache is not None:
+                decoder_cache_hits += decode_streams[i].decoder_cache.num_hits
+                decoder_cache_misses += decode_streams[i].decoder_cache.num_misses
+            state_pool.free(decode_streams[i].state_slot)
             del decode_streams[i]
 
+    # If num_starved is close to num_cuts, the decoding waited for the
+    # features most of the time and --num-prefetch-workers should be increased.
+    logging.info(f"Feature prefetcher: {prefetcher}")
+
+    if decoder_cache_hits + decoder_cache_misses > 0:
+        hit_rate = decoder_cache_hits / (decoder_cache_hits + decoder_cache_misses)
+        logging.info(
+            f"Decoder output cache: num_hits: {decoder_cache_hits}, "
+            f"num_misses: {decoder_cache_misses}, hit_rate: {hit_rate:.2%}"
+        )
+
     if params.decoding_method == "greedy_search":
         key = "greedy_search"
     elif params.decoding_method == "fast_beam_search":
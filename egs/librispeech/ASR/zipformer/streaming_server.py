@@ -0,0 +1,616 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A real-time streaming ASR server for causal zipformer models.
+
+Many clients can send audio at the same time. Whenever a client has sent
+enough audio for the next chunk of its stream, the chunk becomes ready.
+A scheduler collects the ready chunks of all streams into a batch and runs
+:func:`streaming_decode.decode_one_chunk` on it. A batch is decoded when it
+has --max-batch-size chunks, or when the first ready chunk has waited for
+--max-wait-ms. The server sends a partial result to the client after each
+decoded chunk, and the final result after the last one.
+
+Usage:
+
+./zipformer/export.py \
+  --exp-dir ./zipformer/exp \
+  --causal 1 \
+  --tokens data/lang_bpe_500/tokens.txt \
+  --epoch 30 \
+  --avg 9
+
+./zipformer/streaming_server.py \
+  --checkpoint ./zipformer/exp/pretrained.pt \
+  --tokens data/lang_bpe_500/tokens.txt \
+  --causal 1 \
+  --chunk-size 16 \
+  --left-context-frames 128 \
+  --decoding-method greedy_search \
+  --port 6006
+
+You can use ./zipformer/streaming_client.py to send sound files to it and to
+measure the latency under different numbers of concurrent clients.
+
+The protocol is plain TCP. Every message is a 4-byte big-endian length,
+followed by the payload. Each connection transcribes one utterance:
+
+  - The client sends float32 little-endian samples in the range [-1, 1] at
+    --sample-rate Hz, in as many messages as it likes. An empty message
+    means the end of the utterance.
+  - The server replies with UTF-8 encoded JSON messages
+    {"text": str, "final": bool, "num_samples": int}, where num_samples is
+    the number of samples the server had received when the decoded chunk
+    became ready. After the message with "final": true, the server closes
+    the connection.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import k2
+import numpy as np
+import torch
+from decode_stream import DecodeStream
+from kaldifeat import FbankOptions, OnlineFbank
+from streaming_decode import decode_one_chunk, get_init_states, get_state_batch_dims
+from torch import nn
+from train import add_model_arguments, get_model, get_params
+
+from icefall import StatePool
+from icefall.utils import AttributeDict, num_tokens
+
+LOG_EPS = math.log(1e-10)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        type=str,
+        required=True,
+        help="Path to the checkpoint. "
+        "The checkpoint is assumed to be saved by "
+        "icefall.checkpoint.save_checkpoint(), e.g., by ./zipformer/export.py",
+    )
+
+    parser.add_argument(
+        "--tokens",
+        type=str,
+        required=True,
+        help="""Path to tokens.txt.""",
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="The host to listen on.",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=6006,
+        help="The port to listen on.",
+    )
+
+    parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=16000,
+        help="The sample rate of the audio sent by the clients.",
+    )
+
+    parser.add_argument(
+        "--max-streams",
+        type=int,
+        default=500,
+        help="""The maximum number of concurrent streams. Further clients
+        wait until a stream finishes.""",
+    )
+
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=50,
+        help="The maximum number of chunks decoded in a batch.",
+    )
+
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=10,
+        help="""The maximum time a ready chunk waits for other chunks to
+        form a batch, in milliseconds.""",
+    )
+
+    parser.add_argument(
+        "--decoding-method",
+        type=str,
+        default="greedy_search",
+        help="""Supported decoding methods are:
+        greedy_search
+        modified_beam_search
+        fast_beam_search
+        """,
+    )
+
+    parser.add_argument(
+        "--num_active_paths",
+        type=int,
+        default=4,
+        help="""An interger indicating how many candidates we will keep for each
+        frame. Used only when --decoding-method is modified_beam_search.""",
+    )
+
+    parser.add_argument(
+        "--beam",
+        type=float,
+        default=4,
+        help="""A floating point value to calculate the cutoff score during beam
+        search (i.e., `cutoff = max-score - beam`), which is the same as the
+        `beam` in Kaldi.
+        Used only when --decoding-method is fast_beam_search""",
+    )
+
+    parser.add_argument(
+        "--max-contexts",
+        type=int,
+        default=4,
+        help="""Used only when --decoding-method is
+        fast_beam_search""",
+    )
+
+    parser.add_argument(
+        "--max-states",
+        type=int,
+        default=32,
+        help="""Used only when --decoding-method is
+        fast_beam_search""",
+    )
+
+    parser.add_argument(
+        "--context-size",
+        type=int,
+        default=2,
+        help="The context size in the decoder. 1 means bigram; 2 means tri-gram",
+    )
+
+    add_model_arguments(parser)
+
+    return parser
+
+
+async def read_message(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """Read a length-prefixed message. Return None if the connection is
+    closed before a complete message is received."""
+    try:
+        header = await reader.readexactly(4)
+        (length,) = struct.unpack(">I", header)
+        return await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def write_message(writer: asyncio.StreamWriter, payload: bytes) -> None:
+    """Write a length-prefixed message."""
+    writer.write(struct.pack(">I", len(payload)) + payload)
+
+
+class ServerStream(DecodeStream):
+    """A DecodeStream whose features are computed from the audio received
+    from a client, while the client is still sending it."""
+
+    def __init__(
+        self,
+        params: AttributeDict,
+        stream_id: str,
+        opts: FbankOptions,
+        writer: asyncio.StreamWriter,
+        decoding_graph: Optional[k2.Fsa] = None,
+        device: torch.device = torch.device("cpu"),
+    ) -> None:
+        super().__init__(
+            params=params,
+            cut_id=stream_id,
+            decoding_graph=decoding_graph,
+            device=device,
+        )
+        self.sample_rate = opts.frame_opts.samp_freq
+        self.online_fbank = OnlineFbank(opts)
+        self.writer = writer
+        self.device = device
+
+        self.features = torch.empty(0, opts.mel_opts.num_bins, device=device)
+        self.num_fetched_frames = 0
+        self.num_samples = 0
+        self.input_finished = False
+        self.tail_padded = False
+
+        # The time when the next chunk became ready and the number of samples
+        # received at that time. None if the next chunk is not ready yet.
+        self.ready_time: Optional[float] = None
+        self.ready_num_samples = 0
+
+        # It is set after the final result is sent.
+        self.finished = asyncio.Event()
+
+    def accept_waveform(self, samples: torch.Tensor) -> None:
+        self.online_fbank.accept_waveform(
+            sampling_rate=self.sample_rate, waveform=samples
+        )
+        self.num_samples += samples.numel()
+
+    def finish_input(self) -> None:
+        if not self.input_finished:
+            self.online_fbank.input_finished()
+            self.input_finished = True
+
+    def fetch_features(self) -> None:
+        """Move the new frames of the online fbank to self.features. After the
+        input is finished, the features are padded as in :meth:`set_features`.
+
+        It must not be called while the stream is being decoded.
+        """
+        num_frames_ready = self.online_fbank.num_frames_ready
+        if num_frames_ready > self.num_fetched_frames:
+            frames = [
+                self.online_fbank.get_frame(i)
+                for i in range(self.num_fetched_frames, num_frames_ready)
+            ]
+            frames = torch.cat(frames, dim=0).to(self.device)
+            self.features = torch.cat([self.features, frames], dim=0)
+            self.num_fetched_frames = num_frames_ready
+
+        if self.input_finished and not self.tail_padded:
+            # The same tail padding as in streaming_decode.py
+            self.features = torch.nn.functional.pad(
+                self.features,
+                (0, 0, 0, self.pad_length + 30),
+                mode="constant",
+                value=LOG_EPS,
+            )
+            self.tail_padded = True
+
+        self.num_frames = self.features.size(0)
+
+    def is_ready(self, chunk_length: int) -> bool:
+        """Return True if there are enough features to decode the next chunk.
+
+        Args:
+          chunk_length:
+            The number of feature frames of a chunk, without the right
+            padding needed by the encoder_embed.
+        """
+        if self.done:
+            return False
+        if self.tail_padded:
+            return True
+        num_frames = self.num_frames - self.num_processed_frames
+        return num_frames >= chunk_length + self.pad_length
+
+
+class StreamingServer(object):
+    def __init__(
+        self,
+        params: AttributeDict,
+        model: nn.Module,
+        token_ids_to_words: Callable[[List[int]], str],
+        decoding_graph: Optional[k2.Fsa] = None,
+        max_streams: int = 500,
+        max_batch_size: int = 50,
+        max_wait_ms: float = 10,
+    ):
+        """
+        Args:
+          params:
+            It's the return value of :func:`get_params`, updated with the
+            command line arguments.
+          model:
+            The neural model. It has to have an attribute `device`.
+          token_ids_to_words:
+            A function converting the decoded token IDs to text.
+          decoding_graph:
+            The decoding graph, used only when --decoding-method is
+            fast_beam_search.
+          max_streams:
+            The maximum number of concurrent streams.
+          max_batch_size:
+            The maximum number of chunks decoded in a batch.
+          max_wait_ms:
+            The maximum time a ready chunk waits for other chunks to form a
+            batch, in milliseconds.
+        """
+        self.params = params
+        self.model = model
+        self.token_ids_to_words = token_ids_to_words
+        self.decoding_graph = decoding_graph
+        self.max_streams = max_streams
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.device = model.device
+
+        self.opts = FbankOptions()
+        self.opts.device = "cpu"
+        self.opts.frame_opts.dither = 0
+        self.opts.frame_opts.snip_edges = False
+        self.opts.frame_opts.samp_freq = params.sample_rate
+        self.opts.mel_opts.num_bins = params.feature_dim
+        self.opts.mel_opts.high_freq = -400
+
+        initial_states = get_init_states(model=model, batch_size=1, device=self.device)
+        self.state_pool = StatePool(
+            init_states=initial_states,
+            batch_dims=get_state_batch_dims((len(initial_states) - 2) // 6),
+            max_streams=max_streams,
+        )
+
+        # The number of feature frames of a chunk
+        self.chunk_length = int(params.chunk_size) * 2
+
+        self.streams: List[ServerStream] = []
+        self.num_connections = 0
+
+        # The model runs in a separate thread, so that the event loop can
+        # receive audio while a batch is being decoded.
+        self.executor = ThreadPoolExecutor(1)
+
+        # Statistics
+        self.num_batches = 0
+        self.num_chunks = 0
+        self.num_finished_samples = 0
+        self.compute_time = 0.0
+
+    async def start(self, host: str, port: int) -> asyncio.AbstractServer:
+        """Start listening on host:port and return the asyncio server."""
+        # They have to be created inside the running event loop
+        self.slots = asyncio.Semaphore(self.max_streams)
+        self.new_data = asyncio.Event()
+        self.scheduler = asyncio.create_task(self.run_scheduler())
+
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logging.info(f"Listening on {server.sockets[0].getsockname()}")
+        return server
+
+    async def stop(self, server: asyncio.AbstractServer) -> None:
+        server.close()
+        await server.wait_closed()
+        self.scheduler.cancel()
+        try:
+            await self.scheduler
+        except asyncio.CancelledError:
+            pass
+        self.executor.shutdown()
+
+    async def handle_connection(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        async with self.slots:
+            stream = ServerStream(
+                params=self.params,
+                stream_id=str(self.num_connections),
+                opts=self.opts,
+                writer=writer,
+                decoding_graph=self.decoding_graph,
+                device=self.device,
+            )
+            self.num_connections += 1
+            self.streams.append(stream)
+
+            while True:
+                message = await read_message(reader)
+                if not message:
+                    # An empty message, or the client has closed the connection
+                    stream.finish_input()
+                    self.new_data.set()
+                    break
+
+                samples = np.frombuffer(message, dtype="<f4")
+                stream.accept_waveform(torch.from_numpy(samples.copy()))
+                self.new_data.set()
+
+            await stream.finished.wait()
+
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    def _collect_ready_streams(self) -> List[ServerStream]:
+        """Return the streams whose next chunk is ready, the one that has
+        waited longest first."""
+        now = time.time()
+        ready = []
+        for stream in self.streams:
+            if stream.state_slot is None:
+                stream.state_slot = self.state_pool.allocate()
+            stream.fetch_features()
+            if stream.is_ready(self.chunk_length):
+                if stream.ready_time is None:
+                    stream.ready_time = now
+                    stream.ready_num_samples = stream.num_samples
+                ready.append(stream)
+        ready.sort(key=lambda s: s.ready_time)
+        return ready
+
+    @torch.no_grad()
+    def _decode_batch(self, streams: List[ServerStream]) -> List[int]:
+        return decode_one_chunk(
+            params=self.params,
+            model=self.model,
+            decode_streams=streams,
+            state_pool=self.state_pool,
+        )
+
+    def _send_results(self, streams: List[ServerStream]) -> None:
+        for stream in streams:
+            result = {
+                "text": self.token_ids_to_words(stream.decoding_result()),
+                "final": stream.done,
+                "num_samples": stream.ready_num_samples,
+            }
+            stream.ready_time = None
+            if not stream.writer.is_closing():
+                write_message(stream.writer, json.dumps(result).encode("utf-8"))
+
+            if stream.done:
+                self.num_finished_samples += stream.num_samples
+                self.state_pool.free(stream.state_slot)
+                self.streams.remove(stream)
+                stream.finished.set()
+
+    async def run_scheduler(self) -> None:
+        """Form batches of ready chunks and decode them, until cancelled."""
+        loop = asyncio.get_running_loop()
+        log_interval = 1000
+        while True:
+            await self.new_data.wait()
+            self.new_data.clear()
+
+            ready = self._collect_ready_streams()
+            if len(ready) == 0:
+                continue
+
+            # Wait for more chunks until the batch is full or the chunk that
+            # became ready first reaches its deadline
+            deadline = ready[0].ready_time + self.max_wait
+            while len(ready) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.new_data.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self.new_data.clear()
+                ready = self._collect_ready_streams()
+
+            batch = ready[: self.max_batch_size]
+            start = time.time()
+            await loop.run_in_executor(self.executor, self._decode_batch, batch)
+            self.compute_time += time.time() - start
+            self.num_batches += 1
+            self.num_chunks += len(batch)
+
+            self._send_results(batch)
+
+            # There may be ready chunks left
+            self.new_data.set()
+
+            if self.num_batches % log_interval == 0:
+                logging.info(self.get_stats())
+
+    def get_stats(self) -> str:
+        duration = self.num_finished_samples / self.params.sample_rate
+        rtf = self.compute_time / duration if duration > 0 else 0.0
+        return (
+            f"num_connections: {self.num_connections}, "
+            f"num_active_streams: {len(self.streams)}, "
+            f"num_batches: {self.num_batches}, "
+            f"average batch size: {self.num_chunks / max(self.num_batches, 1):.2f}, "
+            f"compute RTF of finished streams: {rtf:.4f}"
+        )
+
+
+async def run_server(server: StreamingServer, host: str, port: int) -> None:
+    asyncio_server = await server.start(host, port)
+    try:
+        await asyncio_server.serve_forever()
+    finally:
+        await server.stop(asyncio_server)
+        logging.info(server.get_stats())
+
+
+@torch.no_grad()
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+
+    params = get_params()
+    params.update(vars(args))
+
+    token_table = k2.SymbolTable.from_file(params.tokens)
+
+    params.blank_id = token_table["<blk>"]
+    params.unk_id = token_table["<unk>"]
+    params.vocab_size = num_tokens(token_table) + 1
+
+    assert params.causal, params.causal
+    assert "," not in params.chunk_size, "chunk_size should be one value in decoding."
+    assert (
+        "," not in params.left_context_frames
+    ), "left_context_frames should be one value in decoding."
+
+    logging.info(f"{params}")
+
+    device = torch.device("cpu")
+    if torch.cuda.is_available():
+        device = torch.device("cuda", 0)
+
+    logging.info(f"device: {device}")
+
+    logging.info("Creating model")
+    model = get_model(params)
+
+    checkpoint = torch.load(args.checkpoint, map_location="cpu")
+    model.load_state_dict(checkpoint["model"], strict=False)
+    model.to(device)
+    model.eval()
+    model.device = device
+
+    decoding_graph = None
+    if params.decoding_method == "fast_beam_search":
+        decoding_graph = k2.trivial_graph(params.vocab_size - 1, device=device)
+
+    def token_ids_to_words(token_ids: List[int]) -> str:
+        text = ""
+        for i in token_ids:
+            text += token_table[i]
+        return text.replace("▁", " ").strip()
+
+    server = StreamingServer(
+        params=params,
+        model=model,
+        token_ids_to_words=token_ids_to_words,
+        decoding_graph=decoding_graph,
+        max_streams=params.max_streams,
+        max_batch_size=params.max_batch_size,
+        max_wait_ms=params.max_wait_ms,
+    )
+    asyncio.run(run_server(server, params.host, params.port))
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./zipformer/test_blank_skip.py
+"""
+
+import torch
+from blank_skip import BlankSkipStats, skip_blank_frames
+
+
+def test_skip_blank_frames():
+    N, T, C, V = 3, 6, 4, 5
+    encoder_out = torch.rand(N, T, C)
+    encoder_out_lens = torch.tensor([6, 4, 3])
+
+    blank_prob = torch.tensor(
+        [
+            [0.1, 0.99, 0.2, 0.99, 0.99, 0.5],
+            [0.99, 0.99, 0.99, 0.99, 0.0, 0.0],
+            [0.3, 0.99, 0.99, 0.0, 0.0, 0.0],
+        ]
+    )
+    ctc_output = torch.full((N, T, V), -1.0)
+    ctc_output[:, :, 0] = blank_prob.log()
+
+    out, out_lens, frame_indexes = skip_blank_frames(
+        encoder_out, encoder_out_lens, ctc_output, threshold=0.9
+    )
+    assert out_lens.tolist() == [3, 1, 1]
+    assert out.shape == (N, 3, C)
+    # Padding frames are not kept, and the last frame is kept if all
+    # frames of an utterance are blank.
+    assert frame_indexes.tolist() == [[0, 2, 5], [3, 0, 0], [0, 0, 0]]
+    for i in range(N):
+        for t in range(out_lens[i]):
+            assert torch.equal(out[i, t], encoder_out[i, frame_indexes[i, t]])
+
+    stats = BlankSkipStats()
+    stats.update(encoder_out_lens, out_lens)
+    assert stats.num_frames == 13
+    assert stats.num_kept_frames == 5
+
+    # Nothing is skipped with threshold 1
+    out, out_lens, frame_indexes = skip_blank_frames(
+        encoder_out, encoder_out_lens, ctc_output, threshold=1.0
+    )
+    assert torch.equal(out_lens, encoder_out_lens)
+    for i in range(N):
+        assert torch.equal(out[i, : out_lens[i]], encoder_out[i, : out_lens[i]])
+
+
+def main():
+    test_skip_blank_frames()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./zipformer/test_blockwise_attention.py
+"""
+
+import torch
+from zipformer import ChunkAttentionMask, Zipformer2
+
+
+def _get_model(causal: bool) -> Zipformer2:
+    torch.manual_seed(20240108)
+    model = Zipformer2(
+        downsampling_factor=(1, 2),
+        encoder_dim=(64, 96),
+        num_encoder_layers=(1, 1),
+        encoder_unmasked_dim=(48, 48),
+        query_head_dim=16,
+        pos_head_dim=4,
+        value_head_dim=8,
+        num_heads=4,
+        feedforward_dim=128,
+        cnn_module_kernel=15,
+        causal=causal,
+        chunk_size=(16,) if causal else (-1,),
+        left_context_frames=(32,) if causal else (-1,),
+    )
+    model.eval()
+    return model
+
+
+@torch.no_grad()
+def test_blockwise_attention():
+    x = torch.randn(150, 2, 64)
+    x_lens = torch.tensor([150, 99])
+    src_key_padding_mask = torch.arange(150).unsqueeze(0) >= x_lens.unsqueeze(1)
+
+    for causal in (False, True):
+        model = _get_model(causal)
+        expected, expected_lens = model(x, x_lens, src_key_padding_mask)
+
+        # Block sizes that divide the frames of a stack or not, and a block
+        # larger than the input
+        for block_size in (1, 24, 50, 1000):
+            model.set_attention_block_size(block_size)
+            out, out_lens = model(x, x_lens, src_key_padding_mask)
+            assert torch.equal(out_lens, expected_lens)
+            assert torch.allclose(out, expected, atol=1e-5), (
+                (out - expected).abs().max()
+            )
+
+        model.set_attention_block_size(0)
+        out, _ = model(x, x_lens, src_key_padding_mask)
+        assert torch.equal(out, expected)
+
+
+def test_chunk_attention_mask():
+    model = _get_model(causal=True)
+    x = torch.randn(150, 2, 64)
+    for left_context_chunks in (2, -1):
+        expected = model._get_attn_mask(x, 16, left_context_chunks)
+        mask = model._get_attn_mask(x, 16, left_context_chunks, blockwise=True)
+        assert isinstance(mask, ChunkAttentionMask)
+
+        for ds in (1, 2, 4):
+            if ds > 1:
+                expected_ds = expected[::ds, ::ds]
+                mask_ds = mask[::ds, ::ds]
+            else:
+                expected_ds, mask_ds = expected, mask
+            seq_len = expected_ds.shape[0]
+            assert mask_ds.shape == expected_ds.shape
+
+            assert torch.equal(mask_ds[..., 0:seq_len, 0:seq_len], expected_ds)
+            for q_start in range(0, seq_len, 7):
+                q_end = min(q_start + 7, seq_len)
+                assert torch.equal(
+                    mask_ds[..., q_start:q_end, 3:seq_len],
+                    expected_ds[..., q_start:q_end, 3:seq_len],
+                )
+
+                # The keys outside key_range() are all masked
+                k_start, k_end = mask_ds.key_range(q_start, q_end)
+                block = expected_ds[q_start:q_end]
+                assert block[:, :k_start].all() and block[:, k_end:].all()
+                assert not block[:, k_start].all()
+                assert not block[:, k_end - 1].all()
+
+
+def main():
+    test_blockwise_attention()
+    test_chunk_attention_mask()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/ASR
+    python ./zipformer/test_streaming_server.py
+"""
+
+import asyncio
+from typing import List
+
+import numpy as np
+import torch
+from decode_stream import DecodeStream
+from kaldifeat import OnlineFbank
+from streaming_client import run_clients, transcribe
+from streaming_decode import decode_one_chunk, get_init_states, get_state_batch_dims
+from streaming_server import StreamingServer, get_parser
+from train import get_model, get_params
+
+from icefall import StatePool
+
+
+def _get_model_and_params():
+    parser = get_parser()
+    args = parser.parse_args(
+        [
+            "--checkpoint",
+            "",
+            "--tokens",
+            "",
+            "--causal",
+            "1",
+            "--chunk-size",
+            "16",
+            "--left-context-frames",
+            "64",
+            "--num-encoder-layers",
+            "1,1,1,1,1,1",
+            "--feedforward-dim",
+            "64,64,64,64,64,64",
+            "--encoder-dim",
+            "32,32,32,32,32,32",
+            "--encoder-unmasked-dim",
+            "32,32,32,32,32,32",
+            "--num-heads",
+            "2,2,2,2,2,2",
+            "--decoder-dim",
+            "32",
+            "--joiner-dim",
+            "32",
+        ]
+    )
+    params = get_params()
+    params.update(vars(args))
+    params.blank_id = 0
+    params.vocab_size = 20
+
+    torch.manual_seed(20240105)
+    model = get_model(params)
+    model.eval()
+    model.device = torch.device("cpu")
+    return model, params
+
+
+def _token_ids_to_words(token_ids: List[int]) -> str:
+    return " ".join(map(str, token_ids))
+
+
+@torch.no_grad()
+def _decode_offline(server: StreamingServer, samples: np.ndarray) -> str:
+    """Decode an utterance alone, with all features computed in advance."""
+    online_fbank = OnlineFbank(server.opts)
+    online_fbank.accept_waveform(
+        sampling_rate=server.params.sample_rate, waveform=torch.from_numpy(samples)
+    )
+    online_fbank.input_finished()
+    features = torch.cat(
+        [online_fbank.get_frame(i) for i in range(online_fbank.num_frames_ready)]
+    )
+
+    initial_states = get_init_states(model=server.model, batch_size=1)
+    state_pool = StatePool(
+        init_states=initial_states,
+        batch_dims=get_state_batch_dims((len(initial_states) - 2) // 6),
+        max_streams=1,
+    )
+    stream = DecodeStream(params=server.params, cut_id="0")
+    stream.state_slot = state_pool.allocate()
+    stream.set_features(features, tail_pad_len=30)
+    while not stream.done:
+        decode_one_chunk(server.params, server.model, [stream], state_pool)
+    return _token_ids_to_words(stream.decoding_result())
+
+
+def test_streaming_server():
+    model, params = _get_model_and_params()
+    server = StreamingServer(
+        params=params,
+        model=model,
+        token_ids_to_words=_token_ids_to_words,
+        max_streams=3,
+        max_batch_size=2,
+        max_wait_ms=5,
+    )
+
+    rng = np.random.default_rng(20240105)
+    waves = [
+        rng.uniform(-0.5, 0.5, size=n).astype(np.float32)
+        for n in [100, 5000, 16000, 24000, 40000]
+    ]
+
+    async def run():
+        asyncio_server = await server.start("127.0.0.1", 0)
+        port = asyncio_server.sockets[0].getsockname()[1]
+        try:
+            results = await asyncio.gather(
+                *[
+                    transcribe(
+                        "127.0.0.1",
+                        port,
+                        samples,
+                        params.sample_rate,
+                        packet_ms=30 * (i + 1),
+                        speed=0,
+                    )
+                    for i, samples in enumerate(waves)
+                ]
+            )
+            stats = await run_clients(
+                "127.0.0.1",
+                port,
+                waves,
+                params.sample_rate,
+                num_clients=4,
+                num_utterances=2,
+                packet_ms=100,
+                speed=0,
+            )
+        finally:
+            await server.stop(asyncio_server)
+        return results, stats
+
+    results, stats = asyncio.run(run())
+
+    for samples, result in zip(waves, results):
+        assert result["text"] == _decode_offline(server, samples), result
+        assert len(result["latencies"]) > 0
+
+    assert stats["num_utterances"] == 8, stats
+    assert stats["p50"] <= stats["p95"] <= stats["p99"], stats
+    assert len(server.streams) == 0
+    assert server.state_pool.num_free_slots == 3
+
+
+def main():
+    test_streaming_server()
+
+
+if __name__ == "__main__":
+    main()
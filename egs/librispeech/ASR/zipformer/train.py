@@ -87,7 +87,11 @@ from torch.utils.tensorboard import SummaryWriter
 from zipformer import Zipformer2
 
 from icefall import diagnostics
-from icefall.checkpoint import load_checkpoint, remove_checkpoints
+from icefall.checkpoint import (
+    AsyncCheckpointWriter,
+    load_checkpoint,
+    remove_checkpoints,
+)
 from icefall.checkpoint import save_checkpoint as save_checkpoint_impl
 from icefall.checkpoint import (
     save_checkpoint_with_global_batch_idx,
@@ -97,6 +101,7 @@ from icefall.dist import cleanup_dist, setup_dist
 from icefall.env import get_env_info
 from icefall.err import raise_grad_scale_is_too_small_error
 from icefall.hooks import register_inf_check_hooks
+from icefall.prefetcher import DevicePrefetcher
 from icefall.utils import (
     AttributeDict,
     MetricsTracker,
@@ -519,6 +524,17 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--async-checkpoint",
+        type=str2bool,
+        default=False,
+        help="""If True, the checkpoints saved every --save-every-n batches
+        are copied to CPU memory and written to disk in a background thread,
+        so that the training does not wait for the disk. It takes an extra
+        copy of the checkpoint in CPU memory.
+        """,
+    )
+
     parser.add_argument(
         "--average-period",
         type=int,
@@ -888,8 +904,12 @@ def compute_loss(
     batch_idx_train = params.batch_idx_train
     warm_step = params.warm_step
 
-    texts = batch["supervisions"]["text"]
-    y = sp.encode(texts, out_type=int)
+    if "token_ids" in supervisions:
+        # Encoded in the dataloader workers, see TokenizedDataset
+        y = supervisions["token_ids"]
+    else:
+        texts = batch["supervisions"]["text"]
+        y = sp.encode(texts, out_type=int)
     y = k2.RaggedTensor(y)
 
     with torch.set_grad_enabled(is_training):
@@ -928,20 +948,22 @@ def compute_loss(
 
     assert loss.requires_grad == is_training
 
-    info = MetricsTracker()
+    # The values are kept on the device until they are logged, so that
+    # we don't wait for the GPU on every batch.
+    info = MetricsTracker(device=loss.device)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        info["frames"] = (feature_lens // params.subsampling_factor).sum().item()
+        info["frames"] = (feature_lens // params.subsampling_factor).sum()
 
     # Note: We use reduction=sum while computing the loss.
-    info["loss"] = loss.detach().cpu().item()
+    info["loss"] = loss.detach()
     if params.use_transducer:
-        info["simple_loss"] = simple_loss.detach().cpu().item()
-        info["pruned_loss"] = pruned_loss.detach().cpu().item()
+        info["simple_loss"] = simple_loss.detach()
+        info["pruned_loss"] = pruned_loss.detach()
     if params.use_ctc:
-        info["ctc_loss"] = ctc_loss.detach().cpu().item()
+        info["ctc_loss"] = ctc_loss.detach()
     if params.use_attention_decoder:
-        info["attn_decoder_loss"] = attention_decoder_loss.detach().cpu().item()
+        info["attn_decoder_loss"] = attention_decoder_loss.detach()
 
     return loss, info
 
@@ -993,6 +1015,7 @@ def train_one_epoch(
     tb_writer: Optional[SummaryWriter] = None,
     world_size: int = 1,
     rank: int = 0,
+    checkpoint_writer: Optional[AsyncCheckpointWriter] = None,
 ) -> None:
     """Train the model for one epoch.
 
@@ -1024,11 +1047,11 @@ def train_one_epoch(
       rank:
         The rank of the node in DDP training. If no DDP is used, it should
         be set to 0.
+      checkpoint_writer:
+        If not None, the checkpoints are written in the background by it.
     """
     model.train()
 
-    tot_loss = MetricsTracker()
-
     saved_bad_model = False
 
     def save_bad_model(suffix: str = ""):
@@ -1044,7 +1067,11 @@ def train_one_epoch(
             rank=0,
         )
 
-    for batch_idx, batch in enumerate(train_dl):
+    # Copy the next batch to the GPU while the current one is being processed
+    device = model.device if isinstance(model, DDP) else next(model.parameters()).device
+    tot_loss = MetricsTracker(device=device)
+
+    for batch_idx, batch in enumerate(DevicePrefetcher(train_dl, device)):
         if batch_idx % 10 == 0:
             set_batch_count(model, get_adjusted_batch_count(params))
 
@@ -1108,11 +1135,13 @@ def train_one_epoch(
                 sampler=train_dl.sampler,
                 scaler=scaler,
                 rank=rank,
+                writer=checkpoint_writer,
             )
             remove_checkpoints(
                 out_dir=params.exp_dir,
                 topk=params.keep_last_k,
                 rank=rank,
+                writer=checkpoint_writer,
             )
 
         if batch_idx % 100 == 0 and params.use_autocast:
@@ -1141,7 +1170,7 @@ def train_one_epoch(
                 f"batch {batch_idx}, loss[{loss_info}], "
                 f"tot_loss[{tot_loss}], batch size: {batch_size}, "
                 f"lr: {cur_lr:.2e}, "
-                + (f"grad_scale: {scaler._scale.item()}" if params.use_autocast else "")
+                + (f"grad_scale: {cur_grad_scale}" if params.use_autocast else "")
             )
 
             if tb_writer is not None:
@@ -1369,7 +1398,7 @@ def run(rank, world_size, args):
         sampler_state_dict = None
 
     train_dl = dataset.train_dataloaders(
-        train_cuts, sampler_state_dict=sampler_state_dict
+        train_cuts, sampler_state_dict=sampler_state_dict, sp=sp
     )
 
     # valid_cuts = librispeech.dev_clean_cuts()
@@ -1393,6 +1422,10 @@ def run(rank, world_size, args):
         logging.info("Loading grad scaler state dict")
         scaler.load_state_dict(checkpoints["grad_scaler"])
 
+    checkpoint_writer = None
+    if params.async_checkpoint and rank == 0:
+        checkpoint_writer = AsyncCheckpointWriter()
+
     for epoch in range(params.start_epoch, params.num_epochs + 1):
         scheduler.step_epoch(epoch - 1)
         fix_random_seed(params.seed + epoch - 1)
@@ -1416,6 +1449,7 @@ def run(rank, world_size, args):
             tb_writer=tb_writer,
             world_size=world_size,
             rank=rank,
+            checkpoint_writer=checkpoint_writer,
         )
 
         if params.print_diagnostics:
@@ -1433,6 +1467,9 @@ def run(rank, world_size, args):
             rank=rank,
         )
 
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+
     logging.info("Done!")
 
     if world_size > 1:
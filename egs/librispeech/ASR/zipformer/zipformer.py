@@ -151,6 +151,8 @@ class Zipformer2(EncoderInterface):
         self.causal = causal
         self.chunk_size = chunk_size
         self.left_context_frames = left_context_frames
+        # see set_attention_block_size()
+        self.attention_block_size = 0
 
         for u, d in zip(encoder_unmasked_dim, encoder_dim):
             assert u <= d
@@ -263,6 +265,22 @@ class Zipformer2(EncoderInterface):
 
         return feature_masks
 
+    def set_attention_block_size(self, block_size: int) -> None:
+        """
+        If block_size > 0, the self-attention of all encoder layers is computed
+        block by block in inference, with blocks of block_size query frames and
+        block_size key frames, so that the memory used is linear in the number
+        of frames instead of quadratic.  This is intended for decoding long
+        recordings without splitting them.  If block_size <= 0, the attention
+        weights are computed at once, which is the default.
+
+        It has no effect in training mode, and in scripted or traced models.
+        """
+        self.attention_block_size = max(block_size, 0)
+        for m in self.modules():
+            if isinstance(m, RelPositionMultiheadAttentionWeights):
+                m.block_size = max(block_size, 0)
+
     def get_chunk_info(self) -> Tuple[int, int]:
         """
         Returns chunk_size and left_context_chunks.
@@ -325,7 +343,12 @@ class Zipformer2(EncoderInterface):
             # Not support exporting a model for simulating streaming decoding
             attn_mask = None
         else:
-            attn_mask = self._get_attn_mask(x, chunk_size, left_context_chunks)
+            attn_mask = self._get_attn_mask(
+                x,
+                chunk_size,
+                left_context_chunks,
+                blockwise=not self.training and self.attention_block_size > 0,
+            )
 
         for i, module in enumerate(self.encoders):
             ds = self.downsampling_factor[i]
@@ -362,8 +385,12 @@ class Zipformer2(EncoderInterface):
         return x, lengths
 
     def _get_attn_mask(
-        self, x: Tensor, chunk_size: int, left_context_chunks: int
-    ) -> Optional[Tensor]:
+        self,
+        x: Tensor,
+        chunk_size: int,
+        left_context_chunks: int,
+        blockwise: bool = False,
+    ) -> Union[Tensor, "ChunkAttentionMask", None]:
         """
         Return None if chunk_size == -1, else return attention mask of shape
           (seq_len, seq_len), interpreted as (tgt_seq_len, src_seq_len).  True
@@ -371,6 +398,9 @@ class Zipformer2(EncoderInterface):
         Args:
            x: embeddings after self.encoder_embed(), of shape (seq_len, batch_size, embed_dim).
           chunk_size: chunk size, must divide
+          blockwise: if True, return a ChunkAttentionMask instead, which
+             builds only the blocks of the mask used by blockwise attention,
+             so that the memory used stays linear in seq_len.
         """
         if chunk_size <= 0:
             return None
@@ -387,6 +417,11 @@ class Zipformer2(EncoderInterface):
 
         seq_len = x.shape[0]
 
+        if blockwise:
+            return ChunkAttentionMask(
+                seq_len, chunk_size, left_context_chunks, device=x.device
+            )
+
         # t is frame index, shape (seq_len,)
         t = torch.arange(seq_len, dtype=torch.int32, device=x.device)
         # c is chunk index for each frame, shape (seq_len,)
@@ -761,6 +796,19 @@ class Zipformer2EncoderLayer(nn.Module):
             Returns:
                A tensor which has the same shape as src
         """
+        if (
+            not (torch.jit.is_scripting() or torch.jit.is_tracing())
+            and not self.training
+            and self.self_attn_weights.block_size > 0
+        ):
+            return self.blockwise_forward(
+                src,
+                pos_emb=pos_emb,
+                chunk_size=chunk_size,
+                attn_mask=attn_mask,
+                src_key_padding_mask=src_key_padding_mask,
+            )
+
         src_orig = src
 
         # dropout rate for non-feedforward submodules
@@ -874,6 +922,66 @@ class Zipformer2EncoderLayer(nn.Module):
 
         return src
 
+    @torch.jit.unused
+    def blockwise_forward(
+        self,
+        src: Tensor,
+        pos_emb: Tensor,
+        chunk_size: int = -1,
+        attn_mask: Union[Tensor, "ChunkAttentionMask", None] = None,
+        src_key_padding_mask: Optional[Tensor] = None,
+    ) -> Tensor:
+        """
+        Same as forward() in inference mode, but the attention weights are
+        never materialized, so that the memory used is linear in seq_len.
+        See RelPositionMultiheadAttentionWeights.blockwise_forward().  The
+        arguments and return value are the same as forward().
+        """
+        assert not self.training
+        src_orig = src
+
+        attn_weights = self.self_attn_weights.blockwise_forward(
+            src,
+            pos_emb=pos_emb,
+            attn_mask=attn_mask,
+            key_padding_mask=src_key_padding_mask,
+        )
+
+        src = src + self.feed_forward1(src)
+
+        src = src + self.balancer_na(
+            self.nonlin_attention.blockwise_forward(src, attn_weights.select_heads(1))
+        )
+
+        src = src + self.self_attn1.blockwise_forward(src, attn_weights)
+
+        src = src + self.conv_module1(
+            src, chunk_size=chunk_size, src_key_padding_mask=src_key_padding_mask
+        )
+
+        src = src + self.balancer_ff2(self.feed_forward2(src))
+
+        # bypass in the middle of the layer.
+        src = self.bypass_mid(src_orig, src)
+
+        src = src + self.self_attn2.blockwise_forward(src, attn_weights)
+
+        src = src + self.conv_module2(
+            src, chunk_size=chunk_size, src_key_padding_mask=src_key_padding_mask
+        )
+
+        src = src + self.balancer_ff3(self.feed_forward3(src))
+
+        src = self.balancer1(src)
+        src = self.norm(src)
+
+        src = self.bypass(src_orig, src)
+
+        src = self.balancer2(src)
+        src = self.whiten(src)
+
+        return src
+
     def streaming_forward(
         self,
         src: Tensor,
@@ -1575,6 +1683,11 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
         self.copy_pos_query = Identity()
         self.copy_query = Identity()
 
+        # If positive, the attention weights are computed block by block in
+        # inference, see blockwise_forward().  It is set by
+        # Zipformer2.set_attention_block_size().
+        self.block_size = 0
+
     def forward(
         self,
         x: Tensor,
@@ -1609,7 +1722,11 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
         k = x[..., query_dim : 2 * query_dim]
         # p is the position-encoding query
         p = x[..., 2 * query_dim :]
-        assert p.shape[-1] == num_heads * pos_head_dim, (p.shape[-1], num_heads, pos_head_dim)
+        assert p.shape[-1] == num_heads * pos_head_dim, (
+            p.shape[-1],
+            num_heads,
+            pos_head_dim,
+        )
 
         q = self.copy_query(q)  # for diagnostics only, does nothing.
         k = self.whiten_keys(self.balance_keys(k))  # does nothing in the forward pass.
@@ -1843,6 +1960,70 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
 
         return attn_weights, cached_key
 
+    def blockwise_forward(
+        self,
+        x: Tensor,
+        pos_emb: Tensor,
+        key_padding_mask: Optional[Tensor] = None,
+        attn_mask: Union[Tensor, "ChunkAttentionMask", None] = None,
+    ) -> "BlockwiseAttentionWeights":
+        r"""
+        Like forward(), but for inference only.  Instead of the attention weights,
+        it returns the queries, keys and projected positional embeddings, from
+        which the weights are computed block by block when they are used.
+
+        Args:
+            x: input of shape (seq_len, batch_size, embed_dim)
+            pos_emb: Positional embedding tensor, of shape (1, 2*seq_len - 1, pos_dim)
+            key_padding_mask: a bool tensor of shape (batch_size, seq_len).  Positions that
+               are True in this mask will be ignored as sources in the attention weighting.
+            attn_mask: mask of shape (seq_len, seq_len) or (batch_size, seq_len, seq_len),
+               interpreted as ([batch_size,] tgt_seq_len, src_seq_len)
+               saying which positions are allowed to attend to which other positions.
+               May also be a ChunkAttentionMask.
+        Returns:
+           a BlockwiseAttentionWeights, which stands for attention weights of shape
+           (num_heads, batch_size, seq_len, seq_len).
+        """
+        assert self.block_size > 0, self.block_size
+        x = self.in_proj(x)
+        query_head_dim = self.query_head_dim
+        pos_head_dim = self.pos_head_dim
+        num_heads = self.num_heads
+
+        seq_len, batch_size, _ = x.shape
+
+        query_dim = query_head_dim * num_heads
+
+        q = x[..., 0:query_dim]
+        k = x[..., query_dim : 2 * query_dim]
+        p = x[..., 2 * query_dim :]
+
+        q = q.reshape(seq_len, batch_size, num_heads, query_head_dim)
+        p = p.reshape(seq_len, batch_size, num_heads, pos_head_dim)
+        k = k.reshape(seq_len, batch_size, num_heads, query_head_dim)
+
+        q = q.permute(2, 1, 0, 3)  # (head, batch, time1, query_head_dim)
+        p = p.permute(2, 1, 0, 3)  # (head, batch, time1, pos_head_dim)
+        k = k.permute(2, 1, 3, 0)  # (head, batch, d_k, time2)
+
+        pos_emb = self.linear_pos(pos_emb)
+        seq_len2 = 2 * seq_len - 1
+        pos_emb = pos_emb.reshape(-1, seq_len2, num_heads, pos_head_dim).permute(
+            2, 0, 3, 1
+        )
+        # pos shape now: (head, {1 or batch_size}, pos_dim, seq_len2)
+
+        return BlockwiseAttentionWeights(
+            q=q,
+            k=k,
+            p=p,
+            pos_emb=pos_emb,
+            block_size=self.block_size,
+            key_padding_mask=key_padding_mask,
+            attn_mask=attn_mask,
+        )
+
     def _print_attn_entropy(self, attn_weights: Tensor):
         # attn_weights: (num_heads, batch_size, seq_len, seq_len)
         (num_heads, batch_size, seq_len, seq_len) = attn_weights.shape
@@ -1860,6 +2041,235 @@ class RelPositionMultiheadAttentionWeights(nn.Module):
                 )
 
 
+class ChunkAttentionMask(object):
+    """
+    The chunk attention mask of shape (seq_len, seq_len) returned by
+    Zipformer2._get_attn_mask(), without materializing it.  It is used with
+    blockwise attention (see BlockwiseAttentionWeights), and supports the two
+    ways the mask is indexed there: mask[::ds, ::ds] in
+    DownsampledZipformer2Encoder, which returns the ChunkAttentionMask of the
+    downsampled frames, and mask[..., q_start:q_end, k_start:k_end] in
+    BlockwiseAttentionWeights, which builds the mask of that block only, as a
+    bool tensor of shape (q_end - q_start, k_end - k_start).
+
+    Args:
+      seq_len: the number of frames.
+      chunk_size: the number of frames per chunk.
+      left_context_chunks: the number of left-context chunks each chunk
+        attends to.
+      device: the device of the masks returned.
+    """
+
+    def __init__(
+        self,
+        seq_len: int,
+        chunk_size: int,
+        left_context_chunks: int,
+        device: torch.device = torch.device("cpu"),
+    ) -> None:
+        self.seq_len = seq_len
+        self.chunk_size = chunk_size
+        self.left_context_chunks = left_context_chunks
+        self.device = device
+        self.shape = (seq_len, seq_len)
+
+    def __getitem__(
+        self, index: Tuple[slice, ...]
+    ) -> Union[Tensor, "ChunkAttentionMask"]:
+        if index[0] is Ellipsis:
+            index = index[1:]
+        rows, cols = index
+
+        if rows.step is not None and rows.step != 1:
+            ds = rows.step
+            assert rows == cols == slice(None, None, ds), index
+            assert self.chunk_size % ds == 0, (self.chunk_size, ds)
+            return ChunkAttentionMask(
+                (self.seq_len + ds - 1) // ds,
+                self.chunk_size // ds,
+                self.left_context_chunks,
+                device=self.device,
+            )
+
+        q_start, q_end, _ = rows.indices(self.seq_len)
+        k_start, k_end, _ = cols.indices(self.seq_len)
+        tgt_c = torch.div(
+            torch.arange(q_start, q_end, device=self.device),
+            self.chunk_size,
+            rounding_mode="floor",
+        ).unsqueeze(-1)
+        src_c = torch.div(
+            torch.arange(k_start, k_end, device=self.device),
+            self.chunk_size,
+            rounding_mode="floor",
+        )
+        return torch.logical_or(src_c > tgt_c, src_c < tgt_c - self.left_context_chunks)
+
+    def key_range(self, q_start: int, q_end: int) -> Tuple[int, int]:
+        """
+        Return (k_start, k_end) such that the keys outside k_start:k_end are
+        masked for all the queries in q_start:q_end.
+        """
+        chunk_size = self.chunk_size
+        first_chunk = q_start // chunk_size - self.left_context_chunks
+        last_chunk = (q_end - 1) // chunk_size
+        return (
+            max(first_chunk * chunk_size, 0),
+            min((last_chunk + 1) * chunk_size, self.seq_len),
+        )
+
+
+class BlockwiseAttentionWeights(object):
+    """
+    Attention weights of RelPositionMultiheadAttentionWeights that are never
+    materialized as a (num_heads, batch_size, seq_len, seq_len) tensor.  Instead,
+    matmul() computes the scores of one (block_size, block_size) block at a time,
+    including the relative-position term, and accumulates the weighted values
+    with an online softmax.  So the memory used is linear in seq_len, at the
+    cost of recomputing the scores for each call of matmul().  For inference only.
+
+    Args:
+      q: queries, of shape (num_heads, batch_size, seq_len, query_head_dim)
+      k: keys, of shape (num_heads, batch_size, query_head_dim, seq_len)
+      p: position-encoding queries, of shape
+         (num_heads, batch_size, seq_len, pos_head_dim)
+      pos_emb: projected positional embeddings, of shape
+         (num_heads, 1 or batch_size, pos_head_dim, 2*seq_len-1)
+      block_size: the number of query and key frames per block.
+      key_padding_mask: see RelPositionMultiheadAttentionWeights.forward()
+      attn_mask: see RelPositionMultiheadAttentionWeights.forward(); may
+         also be a ChunkAttentionMask, in which case the key blocks that are
+         masked entirely are skipped.
+    """
+
+    def __init__(
+        self,
+        q: Tensor,
+        k: Tensor,
+        p: Tensor,
+        pos_emb: Tensor,
+        block_size: int,
+        key_padding_mask: Optional[Tensor] = None,
+        attn_mask: Union[Tensor, ChunkAttentionMask, None] = None,
+    ) -> None:
+        self.q = q
+        self.k = k
+        self.p = p
+        self.pos_emb = pos_emb
+        self.block_size = block_size
+        self.key_padding_mask = key_padding_mask
+        self.attn_mask = attn_mask
+
+        (num_heads, batch_size, seq_len, _) = q.shape
+        self.shape = (num_heads, batch_size, seq_len, seq_len)
+
+    def select_heads(self, num_heads: int) -> "BlockwiseAttentionWeights":
+        """Return the weights of the first num_heads heads, like attn_weights[0:num_heads]."""
+        return BlockwiseAttentionWeights(
+            q=self.q[:num_heads],
+            k=self.k[:num_heads],
+            p=self.p[:num_heads],
+            pos_emb=self.pos_emb[:num_heads],
+            block_size=self.block_size,
+            key_padding_mask=self.key_padding_mask,
+            attn_mask=self.attn_mask,
+        )
+
+    def _get_scores(self, q_start: int, q_end: int, k_start: int, k_end: int) -> Tensor:
+        """Return attn_scores[:, :, q_start:q_end, k_start:k_end] of
+        RelPositionMultiheadAttentionWeights.forward(), with masks applied."""
+        seq_len = self.shape[-1]
+        q_len = q_end - q_start
+        k_len = k_end - k_start
+
+        scores = torch.matmul(self.q[:, :, q_start:q_end], self.k[..., k_start:k_end])
+
+        # Relative positions needed by this block.  Query i and key j use
+        # pos_emb[..., seq_len - 1 - i + j], see the .as_strided() in
+        # RelPositionMultiheadAttentionWeights.forward().
+        pos_start = seq_len - q_end + k_start
+        pos_end = seq_len - q_start + k_end - 1
+        pos_emb = self.pos_emb[..., pos_start:pos_end]
+        pos_scores = torch.matmul(self.p[:, :, q_start:q_end], pos_emb)
+        pos_scores = pos_scores.as_strided(
+            scores.shape,
+            (
+                pos_scores.stride(0),
+                pos_scores.stride(1),
+                pos_scores.stride(2) - pos_scores.stride(3),
+                pos_scores.stride(3),
+            ),
+            storage_offset=pos_scores.stride(3) * (q_len - 1),
+        )
+        scores = scores + pos_scores
+
+        if self.attn_mask is not None:
+            scores = scores.masked_fill(
+                self.attn_mask[..., q_start:q_end, k_start:k_end], -1000
+            )
+        if self.key_padding_mask is not None:
+            scores = scores.masked_fill(
+                self.key_padding_mask[:, k_start:k_end].reshape(-1, 1, k_len), -1000
+            )
+        return scores
+
+    def matmul(self, v: Tensor) -> Tensor:
+        """
+        Return torch.matmul(attn_weights, v).
+
+        Args:
+          v: a tensor of shape (num_heads, batch_size, seq_len, value_head_dim)
+        Returns:
+          a tensor with the same shape as v.
+        """
+        (num_heads, batch_size, seq_len, _) = self.shape
+        assert v.shape[:3] == (num_heads, batch_size, seq_len), (v.shape, self.shape)
+        block_size = self.block_size
+
+        out = torch.empty_like(v)
+        v_mean = None
+        for q_start in range(0, seq_len, block_size):
+            q_end = min(q_start + block_size, seq_len)
+
+            # the running max of the scores, sum of exp(scores) and weighted sum of values
+            max_scores = None
+            denom = None
+            acc = None
+            (key_start, key_end) = (0, seq_len)
+            if isinstance(self.attn_mask, ChunkAttentionMask):
+                (key_start, key_end) = self.attn_mask.key_range(q_start, q_end)
+            for k_start in range(key_start, key_end, block_size):
+                k_end = min(k_start + block_size, key_end)
+                scores = self._get_scores(q_start, q_end, k_start, k_end)
+
+                block_max = scores.amax(dim=-1, keepdim=True)
+                if max_scores is None:
+                    max_scores = block_max
+                    exp_scores = (scores - max_scores).exp()
+                    denom = exp_scores.sum(dim=-1, keepdim=True)
+                    acc = torch.matmul(exp_scores.to(v.dtype), v[:, :, k_start:k_end])
+                else:
+                    new_max_scores = torch.maximum(max_scores, block_max)
+                    correction = (max_scores - new_max_scores).exp()
+                    exp_scores = (scores - new_max_scores).exp()
+                    denom = denom * correction + exp_scores.sum(dim=-1, keepdim=True)
+                    acc = acc * correction.to(v.dtype) + torch.matmul(
+                        exp_scores.to(v.dtype), v[:, :, k_start:k_end]
+                    )
+                    max_scores = new_max_scores
+
+            acc = acc / denom.to(v.dtype)
+            if (key_start, key_end) != (0, seq_len):
+                # Queries whose keys in key_start:key_end are all masked, e.g.
+                # padding frames, attend to all the frames uniformly, as they
+                # do when no block is skipped.
+                if v_mean is None:
+                    v_mean = v.mean(dim=2, keepdim=True)
+                acc = torch.where(max_scores == -1000, v_mean, acc)
+            out[:, :, q_start:q_end] = acc
+        return out
+
+
 class SelfAttention(nn.Module):
     """
     The simplest possible attention module.  This one works with already-computed attention
@@ -1930,6 +2340,43 @@ class SelfAttention(nn.Module):
 
         return x
 
+    def blockwise_forward(
+        self,
+        x: Tensor,
+        attn_weights: BlockwiseAttentionWeights,
+    ) -> Tensor:
+        """
+        Like forward(), but with attention weights returned by
+        RelPositionMultiheadAttentionWeights.blockwise_forward().
+
+        Args:
+          x: input tensor, of shape (seq_len, batch_size, embed_dim)
+         attn_weights: attention weights, of shape (num_heads, batch_size, seq_len, seq_len)
+        Returns:
+           a tensor with the same shape as x.
+        """
+        (seq_len, batch_size, embed_dim) = x.shape
+        num_heads = attn_weights.shape[0]
+        assert attn_weights.shape == (num_heads, batch_size, seq_len, seq_len)
+
+        x = self.in_proj(x)  # (seq_len, batch_size, num_heads * value_head_dim)
+        x = x.reshape(seq_len, batch_size, num_heads, -1).permute(2, 1, 0, 3)
+        # now x: (num_heads, batch_size, seq_len, value_head_dim)
+        value_head_dim = x.shape[-1]
+
+        x = attn_weights.matmul(x)
+
+        x = (
+            x.permute(2, 1, 0, 3)
+            .contiguous()
+            .view(seq_len, batch_size, num_heads * value_head_dim)
+        )
+
+        x = self.out_proj(x)
+        x = self.whiten(x)
+
+        return x
+
     def streaming_forward(
         self,
         x: Tensor,
@@ -2133,6 +2580,52 @@ class NonlinAttention(nn.Module):
         x = self.whiten2(x)
         return x
 
+    def blockwise_forward(
+        self,
+        x: Tensor,
+        attn_weights: BlockwiseAttentionWeights,
+    ) -> Tensor:
+        """
+        Like forward(), but with attention weights returned by
+        RelPositionMultiheadAttentionWeights.blockwise_forward().
+
+        Args:
+           x: a Tensor of shape (seq_len, batch_size, num_channels)
+        attn_weights: attention weights, of shape (num_heads, batch_size, seq_len, seq_len)
+        Returns:
+           a Tensor with the same shape as x
+        """
+        x = self.in_proj(x)
+
+        (seq_len, batch_size, _) = x.shape
+        hidden_channels = self.hidden_channels
+
+        s, x, y = x.chunk(3, dim=2)
+
+        s = self.balancer(s)
+        s = self.tanh(s)
+
+        s = s.unsqueeze(-1).reshape(seq_len, batch_size, hidden_channels)
+        x = self.whiten1(x)
+        x = x * s
+        x = self.identity1(x)
+
+        num_heads = attn_weights.shape[0]
+        assert attn_weights.shape == (num_heads, batch_size, seq_len, seq_len)
+
+        x = x.reshape(seq_len, batch_size, num_heads, -1).permute(2, 1, 0, 3)
+        # now x: (num_heads, batch_size, seq_len, head_dim)
+        x = attn_weights.matmul(x)
+        x = x.permute(2, 1, 0, 3).reshape(seq_len, batch_size, -1)
+
+        y = self.identity2(y)
+        x = x * y
+        x = self.identity3(x)
+
+        x = self.out_proj(x)
+        x = self.whiten2(x)
+        return x
+
     def streaming_forward(
         self,
         x: Tensor,
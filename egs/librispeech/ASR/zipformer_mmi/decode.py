@@ -221,6 +221,17 @@ def get_parser():
 
     add_model_arguments(parser)
 
+    parser.add_argument(
+        "--max-arcs",
+        type=int,
+        default=1000000,
+        help="""Maximum total number of arcs of the lattices rescored with
+        the n-gram LM at a time. A lattice with more arcs is pruned on its
+        own before rescoring. Reduce it if you get CUDA OOM errors during
+        rescoring. 0 means no limit.
+        """,
+    )
+
     return parser
 
 
@@ -373,6 +384,7 @@ def decode_one_batch(
         num_paths=params.num_paths,
         lm_scale_list=lm_scale_list,
         nbest_scale=params.nbest_scale,
+        max_arcs=params.max_arcs or None,
     )
 
     ans = dict()
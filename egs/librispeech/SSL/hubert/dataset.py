@@ -16,6 +16,7 @@
 # limitations under the License.
 
 import sys
+from pathlib import Path
 from typing import Any, Dict, Optional
 
 import numpy as np
@@ -26,6 +27,8 @@ from lhotse.cut import CutSet
 from lhotse.dataset.collation import read_audio_from_cuts
 from torch.utils.data.dataloader import default_collate
 
+from icefall.ali import AlignmentStore, gather_alignments
+
 
 class HubertDataset(torch.utils.data.Dataset):
     """
@@ -49,7 +52,16 @@ class HubertDataset(torch.utils.data.Dataset):
         pad_audio: bool = False,
         num_classes: list = [504],
         do_normalize: bool = True,
+        kmeans_dir: Optional[Path] = None,
     ) -> None:
+        """
+        Args:
+          kmeans_dir:
+            If not None, the k-means labels are read from this directory,
+            written by prepare_kmeans_labels.py as an
+            :class:`icefall.ali.AlignmentStore`, instead of being parsed from
+            cut.custom["kmeans"].
+        """
         super().__init__()
         self.sample_rate = sample_rate
         self.label_rate = label_rate
@@ -60,6 +72,7 @@ class HubertDataset(torch.utils.data.Dataset):
         self.max_sample_size = (
             max_sample_size if max_sample_size is not None else sys.maxsize
         )
+        self.kmeans_labels = AlignmentStore(kmeans_dir) if kmeans_dir else None
 
     def __getitem__(self, cuts: CutSet) -> Dict[str, Any]:
         self._validate(cuts)
@@ -77,12 +90,20 @@ class HubertDataset(torch.utils.data.Dataset):
             audio, audio_lens, audio_size
         )
 
-        kmeans = [cut.custom["kmeans"] for cut in cuts]
-        kmeans = [
-            torch.tensor([int(item) for item in label.split()], dtype=torch.int64)
-            for label in kmeans
-        ]
-        kmeans, _ = self.collater_frm_label(kmeans, audio_size, audio_starts)
+        if self.kmeans_labels is not None:
+            offsets, lengths = self.kmeans_labels.lookup([cut.id for cut in cuts])
+            kmeans, _ = self._collate_labels(
+                self.kmeans_labels.alignments,
+                offsets,
+                lengths,
+                audio_size,
+                audio_starts,
+            )
+        else:
+            kmeans = [
+                np.array(cut.custom["kmeans"].split(), dtype=np.int64) for cut in cuts
+            ]
+            kmeans, _ = self.collater_frm_label(kmeans, audio_size, audio_starts)
 
         return {
             "cuts": cuts,
@@ -134,7 +155,7 @@ class HubertDataset(torch.utils.data.Dataset):
                 collated_audios[i] = audio
             elif diff < 0:
                 assert self.pad_audio
-                collated_audios[i] = torch.cat([audio, audio.new_full((-diff,), 0.0)])
+                collated_audios[i, :audio_len] = audio
                 padding_mask[i, diff:] = True
             else:
                 collated_audios[i], audio_starts[i] = self.crop_to_max_size(
@@ -179,20 +200,28 @@ class HubertDataset(torch.utils.data.Dataset):
         return res
 
     def collater_frm_label(self, targets, audio_size, audio_starts):
+        lengths = np.array([len(t) for t in targets], dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        labels = np.concatenate([np.asarray(t, dtype=np.int64) for t in targets])
+        return self._collate_labels(labels, offsets, lengths, audio_size, audio_starts)
+
+    def _collate_labels(self, labels, offsets, lengths, audio_size, audio_starts):
+        """The labels of the i-th cut are
+        labels[offsets[i] : offsets[i] + lengths[i]]. They are cropped like the
+        audio and padded in one go."""
         label_rate = self.label_rate
         pad = self.num_classes[0] - 1
         assert label_rate > 0
         s2f = label_rate / self.sample_rate
-        frm_starts = [int(round(s * s2f)) for s in audio_starts]
+        frm_starts = np.array([int(round(s * s2f)) for s in audio_starts])
         frm_size = int(round(audio_size * s2f))
         if not self.pad_audio:
-            rem_size = [len(t) - s for t, s in zip(targets, frm_starts)]
-            frm_size = min(frm_size, *rem_size)
-        targets = [t[s : s + frm_size] for t, s in zip(targets, frm_starts)]
+            frm_size = min(frm_size, *(lengths - frm_starts))
+        # The number of labels in t[s : s + frm_size]
+        lengths = np.clip(np.minimum(lengths - frm_starts, frm_size), 0, None)
 
-        lengths = torch.LongTensor([len(t) for t in targets])
-        targets = self.collate_tokens(targets, pad_idx=pad, left_pad=False)
-        return targets, lengths
+        targets = gather_alignments(labels, offsets + frm_starts, lengths, pad)
+        return targets, torch.from_numpy(lengths.astype(np.int64))
 
 
 class HubertAsrDataset(torch.utils.data.Dataset):
@@ -298,7 +327,7 @@ class HubertAsrDataset(torch.utils.data.Dataset):
                 collated_audios[i] = audio
             elif diff < 0:
                 assert self.pad_audio
-                collated_audios[i] = torch.cat([audio, audio.new_full((-diff,), 0.0)])
+                collated_audios[i, :audio_len] = audio
                 padding_mask[i, diff:] = True
             else:
                 collated_audios[i], audio_starts[i] = self.crop_to_max_size(
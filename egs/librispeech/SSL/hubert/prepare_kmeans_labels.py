@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Save the k-means labels in cut.custom["kmeans"] of the given cuts once, in
+memory-mapped files that are read by HubertDataset with --kmeans-dir, so that
+the labels are not parsed from strings for every batch.
+
+Usage:
+
+    cd icefall/egs/librispeech/SSL
+    ./hubert/prepare_kmeans_labels.py \
+      --kmeans-dir data/kmeans/labels \
+      data/kmeans/librispeech_cuts_train-clean-100.jsonl.gz \
+      data/kmeans/librispeech_cuts_train-clean-360.jsonl.gz \
+      data/kmeans/librispeech_cuts_train-other-500.jsonl.gz \
+      data/kmeans/librispeech_cuts_dev-clean.jsonl.gz
+
+    ./hubert/pretrain.py --kmeans-dir data/kmeans/labels ...
+"""
+
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+from lhotse import CutSet, combine, load_manifest_lazy
+
+from icefall.ali import AlignmentWriter
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--kmeans-dir",
+        type=Path,
+        required=True,
+        help="The directory to save the labels.",
+    )
+
+    parser.add_argument(
+        "manifests",
+        type=Path,
+        nargs="+",
+        help="Cut manifests with k-means labels. All the cuts used in the "
+        "training and validation should be given at once.",
+    )
+
+    return parser
+
+
+def write_kmeans_labels(cuts: CutSet, kmeans_dir: Path) -> None:
+    """Save the labels in cut.custom["kmeans"] of all cuts to kmeans_dir,
+    which can be read with icefall.ali.AlignmentStore."""
+    # The labels are at --label-rate of the dataset and are not subsampled
+    with AlignmentWriter(kmeans_dir, subsampling_factor=1) as writer:
+        for cut in cuts:
+            writer.write(cut.id, np.array(cut.custom["kmeans"].split(), dtype=np.int64))
+
+
+def main():
+    args = get_parser().parse_args()
+    logging.info(vars(args))
+
+    cuts = combine(load_manifest_lazy(p) for p in args.manifests)
+    write_kmeans_labels(cuts, args.kmeans_dir)
+    logging.info(f"Saved the k-means labels to {args.kmeans_dir}")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+    main()
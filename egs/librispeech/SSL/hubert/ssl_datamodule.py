@@ -132,6 +132,14 @@ class LibriSpeechDataModule:
             default=True,
             help="always crop from the beginning if false",
         )
+        group.add_argument(
+            "--kmeans-dir",
+            type=Path,
+            default=None,
+            help="If given, read the k-means labels from this directory, "
+            "written by prepare_kmeans_labels.py, instead of parsing them "
+            "from the cuts.",
+        )
 
     def train_dataloaders(
         self,
@@ -161,6 +169,7 @@ class LibriSpeechDataModule:
             pad_audio=pad_audio,
             num_classes=num_classes,
             do_normalize=do_normalize,
+            kmeans_dir=self.args.kmeans_dir,
         )
 
         if self.args.bucketing_sampler:
@@ -221,6 +230,7 @@ class LibriSpeechDataModule:
             pad_audio=pad_audio,
             num_classes=num_classes,
             do_normalize=do_normalize,
+            kmeans_dir=self.args.kmeans_dir,
         )
         valid_sampler = DynamicBucketingSampler(
             cuts_valid,
@@ -256,6 +266,7 @@ class LibriSpeechDataModule:
             pad_audio=pad_audio,
             num_classes=num_classes,
             do_normalize=do_normalize,
+            kmeans_dir=self.args.kmeans_dir,
         )
         sampler = DynamicBucketingSampler(
             cuts,
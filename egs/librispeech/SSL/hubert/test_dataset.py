@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+To run this file, do:
+
+    cd icefall/egs/librispeech/SSL
+    python ./hubert/test_dataset.py
+"""
+
+import tempfile
+
+import numpy as np
+import torch
+from dataset import HubertDataset
+from lhotse import CutSet
+from lhotse.cut import MonoCut
+from prepare_kmeans_labels import write_kmeans_labels
+
+
+def collate_per_cut(dataset, targets, audio_size, audio_starts):
+    """The collation of the k-means labels before they were memory-mapped,
+    which processes one cut at a time."""
+    pad = dataset.num_classes[0] - 1
+    s2f = dataset.label_rate / dataset.sample_rate
+    frm_starts = [int(round(s * s2f)) for s in audio_starts]
+    frm_size = int(round(audio_size * s2f))
+    if not dataset.pad_audio:
+        rem_size = [len(t) - s for t, s in zip(targets, frm_starts)]
+        frm_size = min(frm_size, *rem_size)
+    targets = [t[s : s + frm_size] for t, s in zip(targets, frm_starts)]
+
+    lengths = torch.LongTensor([len(t) for t in targets])
+    targets = dataset.collate_tokens(targets, pad_idx=pad, left_pad=False)
+    return targets, lengths
+
+
+def test_kmeans_labels():
+    rng = np.random.default_rng(20240101)
+    num_classes = 504
+    cuts = []
+    for i in range(20):
+        # 50 labels per second
+        num_labels = int(rng.integers(50, 200))
+        labels = rng.integers(0, num_classes - 1, num_labels)
+        cuts.append(
+            MonoCut(
+                id=f"cut-{i}",
+                start=0,
+                duration=num_labels / 50,
+                channel=0,
+                custom={"kmeans": " ".join(map(str, labels))},
+            )
+        )
+    cuts = CutSet.from_cuts(cuts)
+
+    with tempfile.TemporaryDirectory() as kmeans_dir:
+        write_kmeans_labels(cuts, kmeans_dir)
+
+        for pad_audio in [True, False]:
+            dataset = HubertDataset(
+                pad_audio=pad_audio, num_classes=[num_classes], kmeans_dir=kmeans_dir
+            )
+            # A batch in another order than the one in which they were written
+            batch = [cuts[f"cut-{i}"] for i in [7, 3, 15, 0, 11]]
+            audio_lens = [int(c.duration * 16000) for c in batch]
+            if pad_audio:
+                audio_size = max(audio_lens)
+                audio_starts = [0] * len(batch)
+            else:
+                audio_size = min(audio_lens)
+                audio_starts = [
+                    int(rng.integers(0, n - audio_size + 1)) for n in audio_lens
+                ]
+
+            offsets, lengths = dataset.kmeans_labels.lookup([c.id for c in batch])
+            kmeans, kmeans_lens = dataset._collate_labels(
+                dataset.kmeans_labels.alignments,
+                offsets,
+                lengths,
+                audio_size,
+                audio_starts,
+            )
+
+            targets = [
+                torch.tensor([int(t) for t in c.custom["kmeans"].split()])
+                for c in batch
+            ]
+            expected, expected_lens = collate_per_cut(
+                dataset, targets, audio_size, audio_starts
+            )
+            assert torch.equal(kmeans, expected), pad_audio
+            assert torch.equal(kmeans_lens, expected_lens), pad_audio
+
+        try:
+            dataset.kmeans_labels.lookup(["cut-0", "missing"])
+            assert False, "Expected a KeyError"
+        except KeyError:
+            pass
+
+
+def main():
+    test_kmeans_labels()
+
+
+if __name__ == "__main__":
+    main()
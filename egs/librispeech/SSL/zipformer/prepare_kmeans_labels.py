@@ -0,0 +1 @@
+../hubert/prepare_kmeans_labels.py
\ No newline at end of file
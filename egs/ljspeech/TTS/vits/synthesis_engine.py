@@ -0,0 +1,393 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A batched inference engine of VITS for generating a large amount of speech
+from text, e.g., for data augmentation of ASR.
+
+The input is split into chunks of utterances. For each chunk:
+
+  - The texts are normalized and converted to phonemes in a process pool.
+    The token IDs of each text are kept in an LRU cache, so that repeated
+    texts, e.g., the same sentence spoken by different speakers, are
+    converted only once. The texts of the next chunk are processed while
+    the current chunk is being synthesized.
+  - The utterances are sorted by the number of tokens and grouped into
+    batches of at most --max-tokens padded tokens, which are synthesized
+    with VITS.inference_batch().
+  - The generated audio is written to wav files in a thread pool.
+"""
+
+import argparse
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torchaudio
+from tokenizer import Tokenizer, text_to_tokens
+
+
+def add_synthesis_engine_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=20000,
+        help="Maximum number of tokens in a batch, including padding.",
+    )
+
+    parser.add_argument(
+        "--num-text-workers",
+        type=int,
+        default=4,
+        help="""Number of processes for text normalization and phonemization.
+        If 0, it is done in the main process.
+        """,
+    )
+
+    parser.add_argument(
+        "--num-write-workers",
+        type=int,
+        default=2,
+        help="Number of threads for writing wav files.",
+    )
+
+    parser.add_argument(
+        "--text-cache-size",
+        type=int,
+        default=100000,
+        help="Maximum number of texts in the cache of token IDs.",
+    )
+
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=2000,
+        help="Number of utterances that are sorted by length together.",
+    )
+
+
+def _texts_to_tokens(texts: List[str], lang: str) -> List[List[str]]:
+    return [text_to_tokens(text, lang) for text in texts]
+
+
+def _save_wavs(
+    filenames: List[str],
+    audio: torch.Tensor,
+    audio_lens: List[int],
+    sampling_rate: int,
+) -> None:
+    for i, filename in enumerate(filenames):
+        torchaudio.save(
+            filename,
+            audio[i : i + 1, : audio_lens[i]],
+            sample_rate=sampling_rate,
+        )
+
+
+class SynthesisEngine(object):
+    def __init__(
+        self,
+        model: nn.Module,
+        tokenizer: Tokenizer,
+        sampling_rate: int,
+        frame_shift: int,
+        max_tokens: int = 20000,
+        num_text_workers: int = 4,
+        num_write_workers: int = 2,
+        cache_size: int = 100000,
+        chunk_size: int = 2000,
+        lang: str = "en-us",
+    ):
+        """
+        Args:
+          model:
+            The VITS model. It should be in eval mode.
+          tokenizer:
+            Used to convert phonemes to token IDs.
+          sampling_rate:
+            Sampling rate of the generated audio.
+          frame_shift:
+            Number of samples generated for each frame of the durations.
+          max_tokens:
+            Maximum number of tokens in a batch, including padding.
+          num_text_workers:
+            Number of processes for text normalization and phonemization.
+            If 0, the texts are processed in the current process.
+          num_write_workers:
+            Number of threads for writing wav files.
+          cache_size:
+            Maximum number of texts in the cache of token IDs.
+          chunk_size:
+            Number of utterances that are sorted by length together.
+            A larger chunk gives less padding but uses more memory.
+          lang:
+            Language argument passed to phonemize_espeak().
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.sampling_rate = sampling_rate
+        self.frame_shift = frame_shift
+        self.max_tokens = max_tokens
+        self.chunk_size = chunk_size
+        self.cache_size = cache_size
+        self.lang = lang
+        self.device = next(model.parameters()).device
+
+        self.text_pool = None
+        if num_text_workers > 0:
+            # Use spawn, since CUDA may have been initialized in this process
+            self.text_pool = ProcessPoolExecutor(
+                num_text_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        self.write_pool = ThreadPoolExecutor(num_write_workers)
+        # Limit the number of batches waiting to be written
+        self.max_pending_writes = 2 * num_write_workers
+
+        # text -> token IDs
+        self.cache: OrderedDict = OrderedDict()
+        # text -> (future, index of the text in the result of the future)
+        self.pending_texts: Dict[str, Tuple[Future, int]] = {}
+        self.pending_writes: deque = deque()
+
+        self.num_utterances = 0
+        self.num_chars = 0
+        self.num_samples = 0
+        self.num_cache_hits = 0
+        self.num_cache_misses = 0
+        self.elapsed = 0.0
+
+    def synthesize(
+        self,
+        utterances: Iterable[Tuple[str, str, Optional[int]]],
+        output_dir: Path,
+    ) -> None:
+        """Synthesize the given utterances and save them to
+        output_dir/{utt_id}.wav.
+
+        Args:
+          utterances:
+            An iterable of (utt_id, text, speaker_id). speaker_id is None for
+            single-speaker models.
+          output_dir:
+            The directory to save the wav files.
+        """
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        start = time.time()
+        # Process the texts of the next chunk while synthesizing the
+        # current one
+        current = None
+        for chunk in self._get_chunks(utterances):
+            self._start_text_processing([text for _, text, _ in chunk])
+            if current is not None:
+                self._synthesize_chunk(current, output_dir)
+            current = chunk
+        if current is not None:
+            self._synthesize_chunk(current, output_dir)
+
+        while self.pending_writes:
+            self.pending_writes.popleft().result()
+        self.elapsed += time.time() - start
+
+    def close(self) -> None:
+        if self.text_pool is not None:
+            self.text_pool.shutdown()
+        self.write_pool.shutdown()
+
+    def __enter__(self) -> "SynthesisEngine":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _get_chunks(
+        self, utterances: Iterable[Tuple[str, str, Optional[int]]]
+    ) -> Iterable[List[Tuple[str, str, Optional[int]]]]:
+        chunk = []
+        for utt in utterances:
+            chunk.append(utt)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _start_text_processing(self, texts: List[str]) -> None:
+        """Submit the texts that are neither cached nor being processed to
+        the process pool."""
+        if self.text_pool is None:
+            return
+
+        texts = [
+            text
+            for text in dict.fromkeys(texts)
+            if text not in self.cache and text not in self.pending_texts
+        ]
+        # Send the texts in groups to reduce the overhead of the pool
+        group_size = 64
+        for i in range(0, len(texts), group_size):
+            group = texts[i : i + group_size]
+            future = self.text_pool.submit(_texts_to_tokens, group, self.lang)
+            for k, text in enumerate(group):
+                self.pending_texts[text] = (future, k)
+
+    def _get_token_ids(self, texts: List[str]) -> List[List[int]]:
+        token_ids = {}
+        for text in texts:
+            if text in token_ids:
+                continue
+
+            if text in self.cache:
+                self.cache.move_to_end(text)
+                self.num_cache_hits += 1
+                token_ids[text] = self.cache[text]
+                continue
+
+            self.num_cache_misses += 1
+            if text in self.pending_texts:
+                future, k = self.pending_texts.pop(text)
+                tokens = future.result()[k]
+            else:
+                tokens = text_to_tokens(text, self.lang)
+
+            ids = self.tokenizer.tokens_to_token_ids(
+                [tokens], intersperse_blank=True, add_sos=True, add_eos=True
+            )[0]
+            token_ids[text] = ids
+
+            self.cache[text] = ids
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return [token_ids[text] for text in texts]
+
+    def _get_batches(self, token_ids: List[List[int]]) -> List[List[int]]:
+        """Group the utterances into batches of similar lengths.
+
+        Returns:
+          A list of batches, each containing the indexes of its utterances.
+        """
+        indexes = sorted(
+            range(len(token_ids)), key=lambda i: len(token_ids[i]), reverse=True
+        )
+        batches = []
+        batch = []
+        for i in indexes:
+            # The utterances are sorted in descending order of length, so the
+            # first one of a batch determines its padded length.
+            if batch and (len(batch) + 1) * len(token_ids[batch[0]]) > self.max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _synthesize_chunk(
+        self,
+        chunk: List[Tuple[str, str, Optional[int]]],
+        output_dir: Path,
+    ) -> None:
+        token_ids = self._get_token_ids([text for _, text, _ in chunk])
+
+        for batch in self._get_batches(token_ids):
+            tokens = [token_ids[i] for i in batch]
+            speakers = [chunk[i][2] for i in batch]
+            audio, audio_lens = self._synthesize_batch(tokens, speakers)
+
+            filenames = [str(output_dir / f"{chunk[i][0]}.wav") for i in batch]
+            if len(self.pending_writes) >= self.max_pending_writes:
+                self.pending_writes.popleft().result()
+            self.pending_writes.append(
+                self.write_pool.submit(
+                    _save_wavs, filenames, audio, audio_lens, self.sampling_rate
+                )
+            )
+
+            self.num_utterances += len(batch)
+            self.num_chars += sum(len(chunk[i][1]) for i in batch)
+            self.num_samples += sum(audio_lens)
+
+        logging.info(f"Utterances processed until now: {self.num_utterances}")
+
+    @torch.no_grad()
+    def _synthesize_batch(
+        self, tokens: List[List[int]], speakers: List[Optional[int]]
+    ) -> Tuple[torch.Tensor, List[int]]:
+        """
+        Returns:
+          Return a tuple containing:
+            - The generated audio, of shape (B, T), on CPU.
+            - The number of samples of each utterance.
+        """
+        tokens_lens = torch.tensor([len(t) for t in tokens], dtype=torch.int64)
+        padded = torch.full(
+            (len(tokens), max(len(t) for t in tokens)),
+            self.tokenizer.pad_id,
+            dtype=torch.int64,
+        )
+        for i, t in enumerate(tokens):
+            padded[i, : len(t)] = torch.tensor(t, dtype=torch.int64)
+
+        sids = None
+        if speakers[0] is not None:
+            assert all(s is not None for s in speakers), speakers
+            sids = torch.tensor(speakers, dtype=torch.int64, device=self.device)
+
+        audio, _, durations = self.model.inference_batch(
+            text=padded.to(self.device),
+            text_lengths=tokens_lens.to(self.device),
+            sids=sids,
+        )
+        audio = audio.cpu()
+        # convert to samples
+        audio_lens = (
+            (durations.sum(1) * self.frame_shift)
+            .to(dtype=torch.int64)
+            .clamp(max=audio.size(1))
+            .tolist()
+        )
+        return audio, audio_lens
+
+    @property
+    def chars_per_second(self) -> float:
+        return self.num_chars / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def rtf(self) -> float:
+        """Real-time factor, i.e., the processing time divided by the
+        duration of the generated audio."""
+        audio_seconds = self.num_samples / self.sampling_rate
+        return self.elapsed / audio_seconds if audio_seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        num_lookups = self.num_cache_hits + self.num_cache_misses
+        hit_rate = self.num_cache_hits / num_lookups if num_lookups > 0 else 0.0
+        return (
+            f"utterances: {self.num_utterances}, characters: {self.num_chars}, "
+            f"audio: {self.num_samples / self.sampling_rate:.1f} s, "
+            f"elapsed: {self.elapsed:.1f} s, "
+            f"characters per second: {self.chars_per_second:.1f}, "
+            f"RTF: {self.rtf:.4f}, "
+            f"text cache hit rate: {hit_rate:.2%}"
+        )
@@ -30,6 +30,28 @@ except Exception as ex:
 from utils import intersperse
 
 
+def text_to_tokens(text: str, lang: str = "en-us") -> List[str]:
+    """Normalize a transcript and convert it to a list of phonemes.
+
+    It does not depend on the token table, so it can be run in worker
+    processes, see ./synthesis_engine.py.
+
+    Args:
+      text:
+        A transcript.
+      lang:
+        Language argument passed to phonemize_espeak().
+    """
+    # Text normalization
+    text = tacotron_cleaner.cleaners.custom_english_cleaners(text)
+    # Convert to phonemes
+    tokens_list = phonemize_espeak(text, lang)
+    tokens = []
+    for t in tokens_list:
+        tokens.extend(t)
+    return tokens
+
+
 class Tokenizer(object):
     def __init__(self, tokens: str):
         """
@@ -82,34 +104,14 @@ class Tokenizer(object):
         Returns:
           Return a list of token id list [utterance][token_id]
         """
-        token_ids_list = []
-
-        for text in texts:
-            # Text normalization
-            text = tacotron_cleaner.cleaners.custom_english_cleaners(text)
-            # Convert to phonemes
-            tokens_list = phonemize_espeak(text, lang)
-            tokens = []
-            for t in tokens_list:
-                tokens.extend(t)
-
-            token_ids = []
-            for t in tokens:
-                if t not in self.token2id:
-                    logging.warning(f"Skip OOV {t}")
-                    continue
-                token_ids.append(self.token2id[t])
-
-            if intersperse_blank:
-                token_ids = intersperse(token_ids, self.pad_id)
-            if add_sos:
-                token_ids = [self.sos_id] + token_ids
-            if add_eos:
-                token_ids = token_ids + [self.eos_id]
-
-            token_ids_list.append(token_ids)
-
-        return token_ids_list
+        tokens_list = [text_to_tokens(text, lang) for text in texts]
+
+        return self.tokens_to_token_ids(
+            tokens_list,
+            intersperse_blank=intersperse_blank,
+            add_sos=add_sos,
+            add_eos=add_eos,
+        )
 
     def tokens_to_token_ids(
         self,
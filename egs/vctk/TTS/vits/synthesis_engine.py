@@ -0,0 +1 @@
+../../../ljspeech/TTS/vits/synthesis_engine.py
\ No newline at end of file
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../../../../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+This script generates speech for a large number of texts with the batched
+inference engine in ./vits/synthesis_engine.py.
+
+Each line of the input file contains an utterance ID, a speaker in
+data/speakers.txt and the text, separated by whitespace, e.g.,
+
+    utt-0001 p225 Please call Stella.
+
+Usage:
+./vits/synthesize.py \
+    --epoch 1000 \
+    --exp-dir ./vits/exp \
+    --input-text texts.txt \
+    --output-dir ./vits/exp/synthesize \
+    --max-tokens 20000 \
+    --num-text-workers 4
+"""
+
+
+import argparse
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, Tuple
+
+import torch
+from synthesis_engine import SynthesisEngine, add_synthesis_engine_arguments
+from tokenizer import Tokenizer
+from train import get_model, get_params
+
+from icefall.checkpoint import load_checkpoint
+from icefall.utils import setup_logger
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "--epoch",
+        type=int,
+        default=1000,
+        help="""It specifies the checkpoint to use for synthesis.
+        Note: Epoch counts from 1.
+        """,
+    )
+
+    parser.add_argument(
+        "--exp-dir",
+        type=str,
+        default="vits/exp",
+        help="The experiment dir",
+    )
+
+    parser.add_argument(
+        "--tokens",
+        type=str,
+        default="data/tokens.txt",
+        help="""Path to vocabulary.""",
+    )
+
+    parser.add_argument(
+        "--speakers",
+        type=Path,
+        default=Path("data/speakers.txt"),
+        help="Path to speakers.txt file.",
+    )
+
+    parser.add_argument(
+        "--input-text",
+        type=str,
+        required=True,
+        help="Each line contains an utterance ID, a speaker and the text.",
+    )
+
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        required=True,
+        help="The generated wav files are saved to this directory.",
+    )
+
+    add_synthesis_engine_arguments(parser)
+
+    return parser
+
+
+def read_texts(
+    filename: str, speaker_map: Dict[str, int]
+) -> Iterator[Tuple[str, str, int]]:
+    with open(filename, "r", encoding="utf-8") as f:
+        for line in f:
+            utt_id, speaker, text = line.strip().split(maxsplit=2)
+            yield utt_id, text, speaker_map[speaker]
+
+
+@torch.no_grad()
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    args.exp_dir = Path(args.exp_dir)
+
+    params = get_params()
+    params.update(vars(args))
+
+    output_dir = Path(params.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    setup_logger(f"{output_dir}/log-synthesize-epoch-{params.epoch}")
+    logging.info("Synthesis started")
+
+    device = torch.device("cpu")
+    if torch.cuda.is_available():
+        device = torch.device("cuda", 0)
+
+    tokenizer = Tokenizer(params.tokens)
+    params.blank_id = tokenizer.pad_id
+    params.vocab_size = tokenizer.vocab_size
+
+    with open(params.speakers) as f:
+        speaker_map = {line.strip(): i for i, line in enumerate(f)}
+    params.num_spks = len(speaker_map)
+
+    logging.info(f"Device: {device}")
+    logging.info(params)
+
+    logging.info("About to create model")
+    model = get_model(params)
+
+    load_checkpoint(f"{params.exp_dir}/epoch-{params.epoch}.pt", model)
+
+    model.to(device)
+    model.eval()
+
+    with SynthesisEngine(
+        model=model,
+        tokenizer=tokenizer,
+        sampling_rate=params.sampling_rate,
+        frame_shift=params.frame_shift,
+        max_tokens=params.max_tokens,
+        num_text_workers=params.num_text_workers,
+        num_write_workers=params.num_write_workers,
+        cache_size=params.text_cache_size,
+        chunk_size=params.chunk_size,
+    ) as engine:
+        engine.synthesize(read_texts(params.input_text, speaker_map), output_dir)
+
+    logging.info(engine)
+    logging.info(f"Wav files are saved to {output_dir}")
+    logging.info("Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -17,7 +17,7 @@ from .checkpoint import (
     save_checkpoint_with_global_batch_idx,
 )
 
-from .context_graph import ContextGraph, ContextState
+from .context_graph import CompiledContextGraph, ContextGraph, ContextState
 
 from .decode import (
     get_lattice,
@@ -46,6 +46,7 @@ from .utils import (
     MetricsTracker,
     add_eos,
     add_sos,
+    atomic_save,
     concat,
     encode_supervisions,
     get_alignments,
@@ -71,6 +72,15 @@ from .utils import (
     write_error_stats,
 )
 
-from .ngram_lm import NgramLm, NgramLmStateCost
+from .ngram_lm import (
+    CompiledNgramLm,
+    CompiledNgramLmStateCost,
+    NgramLm,
+    NgramLmStateCost,
+)
+
+from .state_pool import StatePool
+
+from .prefetcher import DevicePrefetcher, TokenizedDataset
 
 from .lm_wrapper import LmScorer
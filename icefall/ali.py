@@ -14,12 +14,210 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict, List, Tuple
+import json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
+import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
 
 
+class AlignmentWriter(object):
+    """Write framewise alignments to a directory that is read by
+    :class:`AlignmentStore`.
+
+    The alignments are appended to a flat binary file as they are written,
+    so the memory usage does not grow with the number of frames. Only the
+    cut IDs and the lengths are kept in memory until :meth:`close`.
+
+    Usage::
+
+        with AlignmentWriter("data/ali_500/train-960", subsampling_factor=4) as w:
+            for cut_id, ali in ...:
+                w.write(cut_id, ali)
+    """
+
+    def __init__(
+        self,
+        ali_dir: Union[str, Path],
+        subsampling_factor: int,
+        dtype: str = "uint16",
+    ):
+        """
+        Args:
+          ali_dir:
+            The directory to save the alignments.
+          subsampling_factor:
+            The subsampling factor of the model.
+          dtype:
+            The dtype of the saved alignments, either uint16 or int32.
+            Use int32 if there are more than 65536 classes.
+        """
+        assert dtype in ("uint16", "int32"), dtype
+        self.ali_dir = Path(ali_dir)
+        self.ali_dir.mkdir(parents=True, exist_ok=True)
+        self.subsampling_factor = subsampling_factor
+        self.dtype = np.dtype(dtype)
+        self.info = np.iinfo(self.dtype)
+
+        self.cut_ids: List[str] = []
+        self.lengths: List[int] = []
+        self.f = open(self.ali_dir / "alignments.bin", "wb")
+
+    def write(self, cut_id: str, alignment: Sequence[int]) -> None:
+        ali = np.asarray(alignment, dtype=np.int64)
+        if ali.size > 0 and (ali.min() < self.info.min or ali.max() > self.info.max):
+            raise ValueError(
+                f"The alignment of {cut_id} does not fit in {self.dtype}: "
+                f"[{ali.min()}, {ali.max()}]"
+            )
+        self.f.write(ali.astype(self.dtype).tobytes())
+        self.cut_ids.append(cut_id)
+        self.lengths.append(ali.size)
+
+    def close(self) -> None:
+        if self.f is None:
+            return
+        self.f.close()
+        self.f = None
+
+        cut_ids = np.array([c.encode("utf-8") for c in self.cut_ids])
+        lengths = np.array(self.lengths, dtype=np.int64)
+        offsets = np.cumsum(lengths) - lengths
+        order = np.argsort(cut_ids, kind="stable")
+        cut_ids = cut_ids[order]
+        assert (cut_ids[1:] != cut_ids[:-1]).all(), "Duplicate cut IDs"
+
+        np.save(self.ali_dir / "cut_ids.npy", cut_ids)
+        np.save(self.ali_dir / "offsets.npy", offsets[order])
+        np.save(self.ali_dir / "lengths.npy", lengths[order])
+        # Written last, so a directory without it is incomplete
+        with open(self.ali_dir / "meta.json", "w") as f:
+            json.dump(
+                {
+                    "subsampling_factor": self.subsampling_factor,
+                    "dtype": self.dtype.name,
+                },
+                f,
+            )
+
+    def __enter__(self) -> "AlignmentWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class AlignmentStore(object):
+    """Framewise alignments saved by :class:`AlignmentWriter` in a directory
+    containing:
+
+        - alignments.bin: the alignments of all cuts, concatenated, as
+          uint16 or int32
+        - cut_ids.npy: the sorted cut IDs
+        - offsets.npy: the offset in alignments.bin of each cut
+        - lengths.npy: the number of frames of each cut
+        - meta.json: the subsampling factor and the dtype
+
+    The files are memory-mapped, so the alignments are neither loaded into
+    each process nor converted to Python objects. The alignments of a batch
+    are gathered directly into a padded tensor by :meth:`get_padded`.
+
+    It can also be used as a read-only dict from cut IDs to 1-D
+    torch.int64 tensors, like the one returned by
+    :func:`convert_alignments_to_tensor`.
+    """
+
+    def __init__(self, ali_dir: Union[str, Path]):
+        self.ali_dir = Path(ali_dir)
+        with open(self.ali_dir / "meta.json") as f:
+            meta = json.load(f)
+        self.subsampling_factor = meta["subsampling_factor"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.alignments = None
+
+    def __getstate__(self):
+        # Each process memory-maps the files on its own
+        state = self.__dict__.copy()
+        state["alignments"] = None
+        return state
+
+    def _load(self) -> None:
+        d = self.ali_dir
+        self.alignments = np.memmap(d / "alignments.bin", dtype=self.dtype, mode="r")
+        self.cut_ids = np.load(d / "cut_ids.npy", mmap_mode="r")
+        self.offsets = np.load(d / "offsets.npy", mmap_mode="r")
+        self.lengths = np.load(d / "lengths.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        if self.alignments is None:
+            self._load()
+        return len(self.cut_ids)
+
+    def __contains__(self, cut_id: str) -> bool:
+        return self._find([cut_id])[1].all()
+
+    def __getitem__(self, cut_id: str) -> torch.Tensor:
+        return self.get_padded([cut_id])[0]
+
+    def keys(self) -> Iterator[str]:
+        if self.alignments is None:
+            self._load()
+        for cut_id in self.cut_ids:
+            yield cut_id.decode("utf-8")
+
+    def _find(self, cut_ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        if self.alignments is None:
+            self._load()
+        keys = np.array([c.encode("utf-8") for c in cut_ids])
+        idx = np.searchsorted(self.cut_ids, keys)
+        idx = np.minimum(idx, len(self.cut_ids) - 1)
+        return idx, self.cut_ids[idx] == keys
+
+    def lookup(self, cut_ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the offsets in `self.alignments` and the numbers of frames
+        of the alignments of the given cuts, as two 1-D int64 arrays.
+
+        Raises KeyError if a cut has no alignment.
+        """
+        idx, found = self._find(cut_ids)
+        if not found.all():
+            missing = [c for c, f in zip(cut_ids, found) if not f]
+            raise KeyError(f"No alignments in {self.ali_dir} for {missing}")
+        return self.offsets[idx], self.lengths[idx]
+
+    def get_padded(self, cut_ids: List[str], padding_value: int = 0) -> torch.Tensor:
+        """Return the alignments of the given cuts as a 2-D torch.int64
+        tensor of shape (N, T), where T is the number of frames of the longest
+        alignment. Shorter alignments are padded with `padding_value`."""
+        offsets, lengths = self.lookup(cut_ids)
+        return gather_alignments(self.alignments, offsets, lengths, padding_value)
+
+
+def gather_alignments(
+    alignments: np.ndarray,
+    offsets: np.ndarray,
+    lengths: np.ndarray,
+    padding_value: int = 0,
+) -> torch.Tensor:
+    """Return a padded torch.int64 tensor of shape (len(offsets), lengths.max()),
+    whose i-th row is alignments[offsets[i] : offsets[i] + lengths[i]].
+
+    `alignments` can be, e.g., the memory-mapped alignments of an
+    :class:`AlignmentStore`. Only the selected frames are read from it.
+    """
+    size = int(lengths.max()) if len(lengths) > 0 else 0
+    frames = np.arange(size)
+    if (lengths == size).all():
+        return torch.from_numpy(alignments[offsets[:, None] + frames].astype(np.int64))
+
+    mask = frames < lengths[:, None]
+    ans = np.full((len(offsets), size), padding_value, dtype=np.int64)
+    ans[mask] = alignments[(offsets[:, None] + frames)[mask]]
+    return torch.from_numpy(ans)
+
+
 def save_alignments(
     alignments: Dict[str, List[int]],
     subsampling_factor: int,
@@ -45,20 +243,28 @@ def save_alignments(
     torch.save(ali_dict, filename)
 
 
-def load_alignments(filename: str) -> Tuple[int, Dict[str, List[int]]]:
+def load_alignments(
+    filename: str,
+) -> Tuple[int, Union[Dict[str, List[int]], AlignmentStore]]:
     """Load alignments from a file.
 
     Args:
       filename:
         Path to the file containing alignment information.
-        The file should be saved by :func:`save_alignments`.
+        The file should be saved by :func:`save_alignments`. It can also
+        be a directory saved by :class:`AlignmentWriter`.
     Returns:
       Return a tuple containing:
         - subsampling_factor: The subsampling_factor used to compute
           the alignments.
         - alignments: A dict containing utterances and their corresponding
-          framewise alignment, after subsampling.
+          framewise alignment, after subsampling. If `filename` is a
+          directory, it is an :class:`AlignmentStore` instead.
     """
+    if Path(filename).is_dir():
+        store = AlignmentStore(filename)
+        return store.subsampling_factor, store
+
     ali_dict = torch.load(filename)
     subsampling_factor = ali_dict["subsampling_factor"]
     alignments = ali_dict["alignments"]
@@ -66,8 +272,8 @@ def load_alignments(filename: str) -> Tuple[int, Dict[str, List[int]]]:
 
 
 def convert_alignments_to_tensor(
-    alignments: Dict[str, List[int]], device: torch.device
-) -> Dict[str, torch.Tensor]:
+    alignments: Union[Dict[str, List[int]], AlignmentStore], device: torch.device
+) -> Union[Dict[str, torch.Tensor], AlignmentStore]:
     """Convert alignments from list of int to a 1-D torch.Tensor.
 
     Args:
@@ -80,7 +286,14 @@ def convert_alignments_to_tensor(
       Return a dict using 1-D torch.Tensor to store the alignments.
       The dtype of the tensor are `torch.int64`. We choose `torch.int64`
       because `torch.nn.functional.one_hot` requires that.
+
+      An :class:`AlignmentStore` is returned as it is, since it is kept
+      memory-mapped on CPU; :func:`lookup_alignments` moves the alignments
+      of each batch to the device.
     """
+    if isinstance(alignments, AlignmentStore):
+        return alignments
+
     ans = {}
     for utt_id, ali in alignments.items():
         ali = torch.tensor(ali, dtype=torch.int64, device=device)
@@ -90,9 +303,10 @@ def convert_alignments_to_tensor(
 
 def lookup_alignments(
     cut_ids: List[str],
-    alignments: Dict[str, torch.Tensor],
+    alignments: Union[Dict[str, torch.Tensor], AlignmentStore],
     num_classes: int,
     log_score: float = -10,
+    device: Optional[torch.device] = None,
 ) -> torch.Tensor:
     """Return a mask constructed from alignments by a list of cut IDs.
 
@@ -122,18 +336,27 @@ def lookup_alignments(
         A list of utterance IDs.
       alignments:
         A dict containing alignments. The keys are utterance IDs and the values
-        are framewise alignments.
+        are framewise alignments. It can also be an :class:`AlignmentStore`.
       num_classes:
         The max token ID + 1 that appears in the alignments.
       log_score:
         Positions in the returned tensor not corresponding to the alignments
         are filled with this value.
+      device:
+        If not None, the device of the returned mask when `alignments` is an
+        :class:`AlignmentStore`. Otherwise, the mask is on the device of
+        the alignments.
     Returns:
       Return a 3-D torch.float32 tensor of shape (N, T, C).
     """
     # We assume all utterances have their alignments.
-    ali = [alignments[cut_id] for cut_id in cut_ids]
-    padded_ali = pad_sequence(ali, batch_first=True, padding_value=0)
+    if isinstance(alignments, AlignmentStore):
+        padded_ali = alignments.get_padded(cut_ids, padding_value=0)
+        if device is not None:
+            padded_ali = padded_ali.to(device)
+    else:
+        ali = [alignments[cut_id] for cut_id in cut_ids]
+        padded_ali = pad_sequence(ali, batch_first=True, padding_value=0)
     padded_one_hot = torch.nn.functional.one_hot(
         padded_ali,
         num_classes=num_classes,
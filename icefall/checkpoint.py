@@ -16,12 +16,15 @@
 # limitations under the License.
 
 
+import copy
 import glob
 import logging
 import os
 import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 import torch
 import torch.nn as nn
@@ -46,6 +49,7 @@ def save_checkpoint(
     scaler: Optional[GradScaler] = None,
     sampler: Optional[CutSampler] = None,
     rank: int = 0,
+    writer: Optional["AsyncCheckpointWriter"] = None,
 ) -> None:
     """Save training information to a file.
 
@@ -66,6 +70,9 @@ def save_checkpoint(
         The GradScaler to be saved. We only save its `state_dict()`.
       rank:
         Used in DDP. We save checkpoint only for the node whose rank is 0.
+      writer:
+        If not None, the checkpoint is copied to CPU memory and is written
+        to the file in the background by this writer.
     Returns:
       Return None.
     """
@@ -93,9 +100,133 @@ def save_checkpoint(
             assert k not in checkpoint
             checkpoint[k] = v
 
+    if writer is not None:
+        writer.save(checkpoint, filename)
+        return
+
     torch.save(checkpoint, filename)
 
 
+class AsyncCheckpointWriter(object):
+    """Write checkpoints to disk in a background thread, so that the training
+    is blocked only while the checkpoint is copied to CPU memory.
+
+    At most one checkpoint is being written at any time: saving a checkpoint
+    waits until the previous one has been written. Each checkpoint is first
+    written to a temporary file, which is then renamed, so that an
+    interrupted write never leaves a partial checkpoint-xxx.pt behind.
+
+    The files are written by torch.save(), so they can be loaded by
+    :func:`load_checkpoint` as usual.
+
+    Usage::
+
+        writer = AsyncCheckpointWriter()
+        save_checkpoint(filename, model, ..., writer=writer)
+        remove_checkpoints(out_dir, topk, writer=writer)
+        ...
+        writer.close()
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(1)
+        self.futures: List[Future] = []
+        # Pinned CPU tensors that receive the CUDA tensors of the last
+        # checkpoint. They are reused if the next checkpoint has tensors of
+        # the same shapes, which is the case for a given model and optimizer.
+        self.buffers: List[Tensor] = []
+
+    def save(self, checkpoint: Dict[str, Any], filename: Path) -> None:
+        """Copy the tensors in `checkpoint` to CPU memory, and then write
+        `checkpoint` to `filename` in the background."""
+        # The buffers can be overwritten only after the previous checkpoint
+        # has been written
+        self.wait()
+
+        checkpoint = self._snapshot(checkpoint)
+        self.futures.append(self.executor.submit(self._write, checkpoint, filename))
+
+    def remove_checkpoints(self, out_dir: Path, topk: int) -> None:
+        """Run :func:`remove_checkpoints` in the background, after the
+        checkpoints being written."""
+        self.futures.append(
+            self.executor.submit(remove_checkpoints, out_dir=out_dir, topk=topk)
+        )
+
+    def wait(self) -> None:
+        """Wait until all submitted tasks are done. An exception raised
+        by a task is raised again here."""
+        futures, self.futures = self.futures, []
+        for f in futures:
+            f.result()
+
+    def close(self) -> None:
+        self.wait()
+        self.executor.shutdown()
+
+    def _snapshot(self, checkpoint: Dict[str, Any]) -> Dict[str, Any]:
+        """Return a copy of `checkpoint`, in which the tensors are copied
+        to CPU memory. Tensors sharing the same memory are still shared."""
+        copied: Dict[Tuple, Tensor] = dict()
+        num_buffers = 0
+        has_cuda = False
+
+        def copy_tensor(t: Tensor) -> Tensor:
+            nonlocal num_buffers, has_cuda
+            key = (t.device, t.data_ptr(), t.dtype, t.shape, t.stride())
+            if key in copied:
+                return copied[key]
+
+            if t.is_cuda:
+                has_cuda = True
+                i = num_buffers
+                num_buffers += 1
+                if (
+                    i == len(self.buffers)
+                    or self.buffers[i].shape != t.shape
+                    or self.buffers[i].dtype != t.dtype
+                ):
+                    buffer = torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+                    if i == len(self.buffers):
+                        self.buffers.append(buffer)
+                    else:
+                        self.buffers[i] = buffer
+                ans = self.buffers[i]
+                ans.copy_(t, non_blocking=True)
+            else:
+                ans = t.detach().clone()
+
+            copied[key] = ans
+            return ans
+
+        def copy_obj(obj):
+            if isinstance(obj, Tensor):
+                return copy_tensor(obj)
+            if isinstance(obj, (dict, list)):
+                # A shallow copy keeps the type, e.g., of an AttributeDict
+                ans = copy.copy(obj)
+                for k in ans.keys() if isinstance(ans, dict) else range(len(ans)):
+                    ans[k] = copy_obj(ans[k])
+                return ans
+            if isinstance(obj, tuple) and not hasattr(obj, "_fields"):
+                return tuple(copy_obj(v) for v in obj)
+            return obj
+
+        ans = copy_obj(checkpoint)
+        if has_cuda:
+            torch.cuda.synchronize()
+        return ans
+
+    @staticmethod
+    def _write(checkpoint: Dict[str, Any], filename: Path) -> None:
+        # Imported here to avoid a circular import, as icefall.utils
+        # imports this module
+        from icefall.utils import atomic_save
+
+        atomic_save(checkpoint, filename)
+        logging.info(f"Saved checkpoint to {filename}")
+
+
 def load_checkpoint(
     filename: Path,
     model: nn.Module,
@@ -146,41 +277,160 @@ def load_checkpoint(
     return checkpoint
 
 
+def _load_checkpoint_mmap(filename: Union[str, Path]) -> Dict[str, Any]:
+    """Load a checkpoint with memory mapping if possible. The tensors are
+    read from disk only when they are accessed, so the entries that are
+    not used, e.g., the optimizer state, cost neither time nor memory.
+    """
+    try:
+        return torch.load(str(filename), map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # mmap requires torch >= 2.1 and checkpoints in the zipfile format
+        return torch.load(filename, map_location="cpu")
+
+
+def _copy_state_dict(
+    state_dict: Dict[str, Tensor], device: torch.device
+) -> Dict[str, Tensor]:
+    """Copy the tensors of a state_dict to the given device. Shared tensors,
+    i.e., tensors with the same data_ptr, are still shared after copying.
+    """
+    copied: Dict[int, Tensor] = dict()
+    ans = dict()
+    for k, v in state_dict.items():
+        v_data_ptr = v.data_ptr()
+        if v_data_ptr not in copied:
+            copied[v_data_ptr] = v.to(device=device, copy=True)
+        ans[k] = copied[v_data_ptr]
+    return ans
+
+
+def _iter_model_state_dicts(
+    filenames: List[Path], device: torch.device, num_threads: int
+) -> Iterator[Dict[str, Tensor]]:
+    """Yield checkpoint["model"] of the given checkpoints in order.
+
+    If num_threads is 0, the state dicts are memory-mapped and are read
+    by the caller when it accesses them. Otherwise, num_threads threads
+    read the state dicts into memory ahead of the caller, so at most
+    num_threads + 1 state dicts are in memory at the same time.
+    """
+    if num_threads <= 0:
+        for f in filenames:
+            yield _load_checkpoint_mmap(f)["model"]
+        return
+
+    def read(f):
+        return _copy_state_dict(_load_checkpoint_mmap(f)["model"], device)
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        futures = deque()
+        for f in filenames:
+            futures.append(executor.submit(read, f))
+            if len(futures) > num_threads:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def _checkpoint_signature(filenames: List[Path]) -> List[Tuple[str, int, int]]:
+    """Identify the content of the given checkpoints by their size and
+    modification time."""
+    ans = []
+    for f in filenames:
+        stat = os.stat(f)
+        ans.append((str(Path(f).resolve()), stat.st_size, stat.st_mtime_ns))
+    return ans
+
+
+def _load_cached_average(
+    cache_filename: Path, filenames: List[Path], device: torch.device
+) -> Optional[Dict[str, Tensor]]:
+    """Return the averaged state_dict saved by :func:`_save_cached_average`,
+    or None if it does not exist or the checkpoints have changed since."""
+    if not Path(cache_filename).is_file():
+        return None
+
+    cached = torch.load(cache_filename, map_location=device)
+    if cached.get("checkpoints") != _checkpoint_signature(filenames):
+        logging.info(f"Ignoring {cache_filename} since the checkpoints changed")
+        return None
+
+    logging.info(f"Loading averaged model from {cache_filename}")
+    return cached["model"]
+
+
+def _save_cached_average(
+    cache_filename: Path, filenames: List[Path], state_dict: Dict[str, Tensor]
+) -> None:
+    cache_filename = Path(cache_filename)
+    cache_filename.parent.mkdir(parents=True, exist_ok=True)
+    # See AsyncCheckpointWriter._write() for why it is imported here
+    from icefall.utils import atomic_save
+
+    atomic_save(
+        {"model": state_dict, "checkpoints": _checkpoint_signature(filenames)},
+        cache_filename,
+    )
+    logging.info(f"Saved averaged model to {cache_filename}")
+
+
 def average_checkpoints(
-    filenames: List[Path], device: torch.device = torch.device("cpu")
+    filenames: List[Path],
+    device: torch.device = torch.device("cpu"),
+    num_threads: int = 0,
+    cache_filename: Optional[Path] = None,
 ) -> dict:
     """Average a list of checkpoints.
 
+    Only the model state dicts are read from the checkpoints, tensor by
+    tensor, and are accumulated in place, so only the averaged model is kept
+    in memory.
+
     Args:
       filenames:
         Filenames of the checkpoints to be averaged. We assume all
         checkpoints are saved by :func:`save_checkpoint`.
       device:
         Move checkpoints to this device before averaging.
+      num_threads:
+        If positive, use that many threads to read the checkpoints ahead of
+        the averaging. It takes up to num_threads more copies of the model
+        in memory.
+      cache_filename:
+        If not None, the averaged model is saved to this file, and is loaded
+        from it if it exists and the checkpoints have not changed since.
     Returns:
       Return a dict (i.e., state_dict) which is the average of all
       model state dicts contained in the checkpoints.
     """
+    if cache_filename is not None:
+        avg = _load_cached_average(cache_filename, filenames, device)
+        if avg is not None:
+            return avg
+
     n = len(filenames)
 
-    avg = torch.load(filenames[0], map_location=device)["model"]
+    avg = None
+    for state_dict in _iter_model_state_dicts(filenames, device, num_threads):
+        if avg is None:
+            avg = _copy_state_dict(state_dict, device)
 
-    # Identify shared parameters. Two parameters are said to be shared
-    # if they have the same data_ptr
-    uniqued: Dict[int, str] = dict()
+            # Identify shared parameters. Two parameters are said to be shared
+            # if they have the same data_ptr
+            uniqued: Dict[int, str] = dict()
 
-    for k, v in avg.items():
-        v_data_ptr = v.data_ptr()
-        if v_data_ptr in uniqued:
-            continue
-        uniqued[v_data_ptr] = k
+            for k, v in avg.items():
+                v_data_ptr = v.data_ptr()
+                if v_data_ptr in uniqued:
+                    continue
+                uniqued[v_data_ptr] = k
 
-    uniqued_names = list(uniqued.values())
+            uniqued_names = list(uniqued.values())
+            continue
 
-    for i in range(1, n):
-        state_dict = torch.load(filenames[i], map_location=device)["model"]
         for k in uniqued_names:
-            avg[k] += state_dict[k]
+            avg[k] += state_dict[k].to(device)
 
     for k in uniqued_names:
         if avg[k].is_floating_point():
@@ -188,6 +438,9 @@ def average_checkpoints(
         else:
             avg[k] //= n
 
+    if cache_filename is not None:
+        _save_cached_average(cache_filename, filenames, avg)
+
     return avg
 
 
@@ -202,6 +455,7 @@ def save_checkpoint_with_global_batch_idx(
     scaler: Optional[GradScaler] = None,
     sampler: Optional[CutSampler] = None,
     rank: int = 0,
+    writer: Optional[AsyncCheckpointWriter] = None,
 ):
     """Save training info after processing given number of batches.
 
@@ -233,6 +487,9 @@ def save_checkpoint_with_global_batch_idx(
       rank:
         The rank ID used in DDP training of the current node. Set it to 0
         if DDP is not used.
+      writer:
+        If not None, the checkpoint is written in the background by this
+        writer. See :class:`AsyncCheckpointWriter`.
     """
     out_dir = Path(out_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -247,6 +504,7 @@ def save_checkpoint_with_global_batch_idx(
         scaler=scaler,
         sampler=sampler,
         rank=rank,
+        writer=writer,
     )
 
 
@@ -317,6 +575,7 @@ def remove_checkpoints(
     out_dir: Path,
     topk: int,
     rank: int = 0,
+    writer: Optional[AsyncCheckpointWriter] = None,
 ):
     """Remove checkpoints from the given directory.
 
@@ -333,10 +592,18 @@ def remove_checkpoints(
       rank:
         If using DDP for training, it is the rank of the current node.
         Use 0 if no DDP is used for training.
+      writer:
+        If not None, the checkpoints are removed in the background by this
+        writer, after the checkpoints it is writing.
     """
     assert topk >= 1, topk
     if rank != 0:
         return
+
+    if writer is not None:
+        writer.remove_checkpoints(out_dir, topk)
+        return
+
     checkpoints = find_checkpoints(out_dir)
 
     if len(checkpoints) == 0:
@@ -389,6 +656,7 @@ def average_checkpoints_with_averaged_model(
     filename_start: str,
     filename_end: str,
     device: torch.device = torch.device("cpu"),
+    cache_filename: Optional[Path] = None,
 ) -> Dict[str, Tensor]:
     """Average model parameters over the range with given
     start model (excluded) and end model.
@@ -420,9 +688,19 @@ def average_checkpoints_with_averaged_model(
         is saved by :func:`save_checkpoint`.
       device:
         Move checkpoints to this device before averaging.
+      cache_filename:
+        If not None, the averaged model is saved to this file, and is loaded
+        from it if it exists and the checkpoints have not changed since.
     """
-    state_dict_start = torch.load(filename_start, map_location=device)
-    state_dict_end = torch.load(filename_end, map_location=device)
+    if cache_filename is not None:
+        avg = _load_cached_average(
+            cache_filename, [filename_start, filename_end], device
+        )
+        if avg is not None:
+            return avg
+
+    state_dict_start = _load_checkpoint_mmap(filename_start)
+    state_dict_end = _load_checkpoint_mmap(filename_end)
 
     batch_idx_train_start = state_dict_start["batch_idx_train"]
     batch_idx_train_end = state_dict_end["batch_idx_train"]
@@ -433,7 +711,7 @@ def average_checkpoints_with_averaged_model(
 
     model_end = state_dict_end["model_avg"]
     model_start = state_dict_start["model_avg"]
-    avg = model_end
+    avg = _copy_state_dict(model_end, device)
 
     # scale the weight to avoid overflow
     average_state_dict(
@@ -444,6 +722,9 @@ def average_checkpoints_with_averaged_model(
         scaling_factor=weight_end,
     )
 
+    if cache_filename is not None:
+        _save_cached_average(cache_filename, [filename_start, filename_end], avg)
+
     return avg
 
 
@@ -14,11 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import json
+import logging
 import os
 import shutil
 from collections import deque
+from pathlib import Path
 from typing import Dict, List, Optional, Tuple, Union
 
+import torch
+
+from icefall.utils import Pathlike, atomic_save
+
 
 class ContextState:
     """The state in ContextGraph"""
@@ -480,6 +488,316 @@ class ContextGraph:
         return dot
 
 
+class CompiledContextGraph:
+    """A flattened ContextGraph whose nodes are stored in tensors, so that
+    many (state, token) pairs, e.g., all hypotheses of a batch, can be
+    advanced at once with :meth:`forward_one_step`.
+
+    A state is represented by the id of the corresponding ContextState
+    (i.e., `ContextState.id`), so the root is always 0.
+
+    The trie arcs are stored as sorted keys `src * vocab_size + token`, which
+    are looked up with a single `torch.searchsorted` call. Fail arcs skip the
+    nodes without outgoing arcs, since the search would go through them
+    anyway, so that fewer fail arcs are followed.
+
+    Use :meth:`from_context_graph` to construct it from a ContextGraph,
+    and :meth:`save` / :meth:`load` to serialize it, or
+    :meth:`load_or_build` to do both with an on-disk cache.
+    """
+
+    def __init__(self, tensors: Dict[str, torch.Tensor], phrases: List[str]):
+        """
+        Args:
+          tensors:
+            A dict of tensors, see :meth:`from_context_graph` for their
+            meanings.
+          phrases:
+            phrases[i] is the phrase of the i-th node, valid only for end nodes.
+        """
+        self.arc_keys = tensors["arc_keys"]
+        self.arc_dests = tensors["arc_dests"]
+        self.fail = tensors["fail"]
+        self.token_score = tensors["token_score"]
+        self.node_score = tensors["node_score"]
+        self.output_score = tensors["output_score"]
+        self.is_end = tensors["is_end"]
+        self.output = tensors["output"]
+        self.level = tensors["level"]
+        self.ac_threshold = tensors["ac_threshold"]
+        self.vocab_size = int(tensors["vocab_size"])
+        self.phrases = phrases
+
+    @property
+    def num_nodes(self) -> int:
+        return self.fail.numel()
+
+    @property
+    def device(self) -> torch.device:
+        return self.fail.device
+
+    def _tensors(self) -> Dict[str, torch.Tensor]:
+        return {
+            "arc_keys": self.arc_keys,
+            "arc_dests": self.arc_dests,
+            "fail": self.fail,
+            "token_score": self.token_score,
+            "node_score": self.node_score,
+            "output_score": self.output_score,
+            "is_end": self.is_end,
+            "output": self.output,
+            "level": self.level,
+            "ac_threshold": self.ac_threshold,
+            "vocab_size": torch.tensor(self.vocab_size),
+        }
+
+    @staticmethod
+    def from_context_graph(graph: ContextGraph) -> "CompiledContextGraph":
+        """Flatten a ContextGraph that has been built.
+
+        The returned object contains the following 1-D tensors, indexed by
+        node id unless stated otherwise:
+
+          - arc_keys: int64, `src * vocab_size + token` of each trie arc, sorted.
+          - arc_dests: int64, the destination node of each trie arc.
+          - fail: int64, the fail arc, skipping nodes without outgoing arcs.
+          - token_score, node_score, output_score, ac_threshold: float32,
+            the same as the attributes of ContextState.
+          - is_end: bool.
+          - output: int64, the output node or -1 if there is none.
+          - level: int64.
+        """
+        nodes = [graph.root]
+        queue = deque([graph.root])
+        while queue:
+            current_node = queue.popleft()
+            for token in sorted(current_node.next.keys()):
+                node = current_node.next[token]
+                nodes.append(node)
+                queue.append(node)
+        nodes.sort(key=lambda node: node.id)
+        num_nodes = len(nodes)
+        assert [node.id for node in nodes] == list(range(num_nodes))
+
+        vocab_size = 1 + max(
+            [token for node in nodes for token in node.next.keys()], default=0
+        )
+
+        arc_keys = []
+        arc_dests = []
+        for node in nodes:
+            for token in sorted(node.next.keys()):
+                arc_keys.append(node.id * vocab_size + token)
+                arc_dests.append(node.next[token].id)
+
+        fail = []
+        for node in nodes:
+            f = node.fail
+            while f.token != -1 and len(f.next) == 0:
+                f = f.fail
+            fail.append(f.id)
+
+        tensors = {
+            "arc_keys": torch.tensor(arc_keys, dtype=torch.int64),
+            "arc_dests": torch.tensor(arc_dests, dtype=torch.int64),
+            "fail": torch.tensor(fail, dtype=torch.int64),
+            "token_score": torch.tensor(
+                [node.token_score for node in nodes], dtype=torch.float32
+            ),
+            "node_score": torch.tensor(
+                [node.node_score for node in nodes], dtype=torch.float32
+            ),
+            "output_score": torch.tensor(
+                [node.output_score for node in nodes], dtype=torch.float32
+            ),
+            "is_end": torch.tensor([node.is_end for node in nodes], dtype=torch.bool),
+            "output": torch.tensor(
+                [-1 if node.output is None else node.output.id for node in nodes],
+                dtype=torch.int64,
+            ),
+            "level": torch.tensor([node.level for node in nodes], dtype=torch.int64),
+            "ac_threshold": torch.tensor(
+                [node.ac_threshold for node in nodes], dtype=torch.float32
+            ),
+            "vocab_size": torch.tensor(vocab_size),
+        }
+        phrases = [node.phrase for node in nodes]
+        return CompiledContextGraph(tensors, phrases)
+
+    def to(self, device: torch.device) -> "CompiledContextGraph":
+        tensors = {k: v.to(device) for k, v in self._tensors().items()}
+        return CompiledContextGraph(tensors, self.phrases)
+
+    def save(self, filename: str) -> None:
+        tensors = {k: v.cpu() for k, v in self._tensors().items()}
+        atomic_save({"tensors": tensors, "phrases": self.phrases}, filename)
+
+    @staticmethod
+    def load(
+        filename: str, device: torch.device = torch.device("cpu")
+    ) -> "CompiledContextGraph":
+        d = torch.load(filename, map_location=device)
+        return CompiledContextGraph(d["tensors"], d["phrases"])
+
+    @staticmethod
+    def load_or_build(
+        cache_dir: Pathlike,
+        token_ids: List[List[int]],
+        context_score: float,
+        ac_threshold: float = 1.0,
+        phrases: Optional[List[str]] = None,
+        scores: Optional[List[float]] = None,
+        ac_thresholds: Optional[List[float]] = None,
+        device: torch.device = torch.device("cpu"),
+    ) -> "CompiledContextGraph":
+        """Load the compiled graph of the given contexts from `cache_dir`.
+        If it is not there, build a ContextGraph with
+        `ContextGraph(context_score, ac_threshold).build(...)`, compile it and
+        save it to `cache_dir`.
+
+        The file name contains a hash of all the arguments, so a graph is
+        never loaded after the contexts, e.g., the contexts file or the BPE
+        model used to encode it, or the options are changed.
+
+        Args:
+          cache_dir:
+            The directory of the cached graphs. It is created if it does
+            not exist.
+          device:
+            The device of the returned graph.
+          Others:
+            See :class:`ContextGraph` and :meth:`ContextGraph.build`.
+        """
+        key = hashlib.sha1(
+            json.dumps(
+                [
+                    token_ids,
+                    context_score,
+                    ac_threshold,
+                    phrases,
+                    scores,
+                    ac_thresholds,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()
+        filename = Path(cache_dir) / f"context-graph-{key}.pt"
+        if filename.is_file():
+            logging.info(f"Loading compiled context graph from {filename}")
+            return CompiledContextGraph.load(str(filename), device=device)
+
+        graph = ContextGraph(context_score, ac_threshold=ac_threshold)
+        graph.build(
+            token_ids,
+            phrases=phrases,
+            scores=scores,
+            ac_thresholds=ac_thresholds,
+        )
+        compiled = CompiledContextGraph.from_context_graph(graph)
+
+        logging.info(f"Saving compiled context graph to {filename}")
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        compiled.save(str(filename))
+        return compiled.to(device)
+
+    def _goto(
+        self, states: torch.Tensor, tokens: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Look up the trie arcs leaving `states` with `tokens`.
+
+        Returns:
+          Return a tuple of two tensors:
+            - The destination states. Valid only where `found` is True.
+            - found, a bool tensor.
+        """
+        if self.arc_keys.numel() == 0:
+            return states, torch.zeros_like(states, dtype=torch.bool)
+
+        valid = (tokens >= 0) & (tokens < self.vocab_size)
+        keys = states * self.vocab_size + tokens
+        indexes = torch.searchsorted(self.arc_keys, keys)
+        indexes = indexes.clamp_(max=self.arc_keys.numel() - 1)
+        found = valid & (self.arc_keys[indexes] == keys)
+        return self.arc_dests[indexes], found
+
+    def forward_one_step(
+        self,
+        states: torch.Tensor,
+        tokens: torch.Tensor,
+        strict_mode: bool = True,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """The batched version of :meth:`ContextGraph.forward_one_step`.
+
+        Args:
+          states:
+            A 1-D int64 tensor of node ids.
+          tokens:
+            A 1-D int64 tensor with the same shape as `states`.
+          strict_mode:
+            See :meth:`ContextGraph.forward_one_step`.
+        Returns:
+          Return a tuple of three tensors with the same shape as `states`:
+            - scores, the boosting scores.
+            - next_states.
+            - matched, the matched node with the longest phrase,
+              or -1 if no phrase is matched.
+        """
+        assert states.shape == tokens.shape, (states.shape, tokens.shape)
+        states = states.to(torch.int64)
+        tokens = tokens.to(torch.int64)
+
+        nodes, found = self._goto(states, tokens)
+
+        # For tokens not matched, trace along the fail arcs until the token
+        # is matched or the root is reached
+        pending = ~found
+        cur = self.fail[states]
+        while pending.any():
+            dests, dest_found = self._goto(cur, tokens)
+            nodes = torch.where(pending & dest_found, dests, nodes)
+            nodes = torch.where(pending & ~dest_found & (cur == 0), cur, nodes)
+            pending = pending & ~dest_found & (cur != 0)
+            cur = torch.where(pending, self.fail[cur], cur)
+
+        scores = torch.where(
+            found,
+            self.token_score[nodes],
+            self.node_score[nodes] - self.node_score[states],
+        )
+
+        output = self.output[nodes]
+        is_end = self.is_end[nodes]
+        matched = torch.where(is_end, nodes, output)
+        output_score = self.output_score[nodes]
+
+        if strict_mode:
+            return scores + output_score, nodes, matched
+
+        # Fall back to the root once a phrase is matched
+        has_output = output_score != 0
+        node_score = self.node_score[nodes]
+        longest_score = torch.where(
+            is_end | (output < 0), node_score, self.node_score[output.clamp(min=0)]
+        )
+        scores = torch.where(
+            has_output, scores + longest_score - node_score, scores + output_score
+        )
+        nodes = torch.where(has_output, torch.zeros_like(nodes), nodes)
+        return scores, nodes, matched
+
+    def is_matched(self, states: torch.Tensor) -> torch.Tensor:
+        """Return the matched node of each state, or -1 if the state matches
+        no phrase. See :meth:`ContextGraph.is_matched`."""
+        return torch.where(self.is_end[states], states, self.output[states])
+
+    def finalize(self, states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """The batched version of :meth:`ContextGraph.finalize`.
+
+        Returns:
+          Return a tuple of scores and next states, which are all root.
+        """
+        return -self.node_score[states], torch.zeros_like(states)
+
+
 def _test(queries, score, strict_mode):
     contexts_str = [
         "S",
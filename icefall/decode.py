@@ -15,7 +15,7 @@
 # limitations under the License.
 
 import logging
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import k2
 import torch
@@ -50,44 +50,129 @@ DEFAULT_LM_SCALE = [
 ]
 
 
+def _get_num_arcs(fsas: k2.Fsa) -> torch.Tensor:
+    """Return a 1-D CPU tensor containing the number of arcs of each FSA
+    in the given FsaVec."""
+    shape = fsas.arcs.shape()
+    arc_splits = shape.row_splits(2)[shape.row_splits(1).long()]
+    return (arc_splits[1:] - arc_splits[:-1]).cpu().long()
+
+
+def _get_splits(
+    num_fsas: int,
+    batch_size: Optional[int] = None,
+    num_arcs: Optional[List[int]] = None,
+    max_arcs: Optional[int] = None,
+    a_indexes: Optional[List[int]] = None,
+    a_num_arcs: Optional[List[int]] = None,
+) -> List[Tuple[int, int]]:
+    """Split the range [0, num_fsas) into consecutive batches, each of which
+    contains at most `batch_size` FSAs and, if `num_arcs` is given, at most
+    `max_arcs` arcs. An FSA with more than `max_arcs` arcs is put into a
+    batch of its own.
+
+    If `a_indexes` is given, the i-th FSA is intersected with the
+    a_indexes[i]-th FSA of another FsaVec, which has a_num_arcs[a_indexes[i]]
+    arcs. The arcs of each FSA of the other FsaVec are counted once per
+    batch, however many FSAs of the batch are intersected with it.
+
+    Returns:
+      Return a list of (start, end) pairs.
+    """
+    splits = []
+    start = 0
+    total = 0
+    # indexes into a_num_arcs of the FSAs counted in the current batch
+    seen = set()
+    for i in range(num_fsas):
+        n = num_arcs[i] if num_arcs is not None else 0
+        a = a_indexes[i] if a_indexes is not None else None
+        a_n = a_num_arcs[a] if a is not None and a not in seen else 0
+        full = batch_size is not None and i - start >= batch_size
+        if num_arcs is not None and max_arcs is not None:
+            full = full or total + n + a_n > max_arcs
+        if i > start and full:
+            splits.append((start, i))
+            start = i
+            total = 0
+            seen = set()
+            a_n = a_num_arcs[a] if a is not None else 0
+        total += n + a_n
+        if a is not None:
+            seen.add(a)
+    if num_fsas > start:
+        splits.append((start, num_fsas))
+    return splits
+
+
+def _index_fsa_range(fsas: k2.Fsa, start: int, end: int) -> k2.Fsa:
+    """Return the FSAs in the range [start, end) of the given FsaVec."""
+    if start == 0 and end == fsas.shape[0]:
+        return fsas
+    indexes = torch.arange(start, end, dtype=torch.int32, device=fsas.device)
+    return k2.index_fsa(fsas, indexes)
+
+
 def _intersect_device(
     a_fsas: k2.Fsa,
     b_fsas: k2.Fsa,
     b_to_a_map: torch.Tensor,
     sorted_match_a: bool,
     batch_size: int = 50,
+    max_arcs: Optional[int] = None,
 ) -> k2.Fsa:
     """This is a wrapper of k2.intersect_device and its purpose is to split
     b_fsas into several batches and process each batch separately to avoid
     CUDA OOM error.
 
-    The arguments and return value of this function are the same as
-    :func:`k2.intersect_device`.
+    Each batch contains at most `batch_size` FSAs of b_fsas. If `max_arcs`
+    is not None, the total number of arcs of the FSAs in a batch, plus
+    that of the distinct FSAs of a_fsas they are intersected with if a_fsas
+    has more than one FSA, is also at most `max_arcs`. A batch with more
+    than one FSA that still runs out of memory is split into two halves.
+
+    The other arguments and the return value of this function are the same
+    as :func:`k2.intersect_device`.
     """
     num_fsas = b_fsas.shape[0]
-    if num_fsas <= batch_size:
-        return k2.intersect_device(
-            a_fsas, b_fsas, b_to_a_map=b_to_a_map, sorted_match_a=sorted_match_a
-        )
-
-    num_batches = (num_fsas + batch_size - 1) // batch_size
-    splits = []
-    for i in range(num_batches):
-        start = i * batch_size
-        end = min(start + batch_size, num_fsas)
-        splits.append((start, end))
+    num_arcs = None
+    a_indexes = None
+    a_num_arcs = None
+    if max_arcs is not None:
+        num_arcs = _get_num_arcs(b_fsas).tolist()
+        if a_fsas.shape[0] > 1:
+            a_indexes = b_to_a_map.tolist()
+            a_num_arcs = _get_num_arcs(a_fsas).tolist()
+
+    splits = _get_splits(
+        num_fsas, batch_size, num_arcs, max_arcs, a_indexes, a_num_arcs
+    )
 
     ans = []
-    for start, end in splits:
-        indexes = torch.arange(start, end).to(b_to_a_map)
-
-        fsas = k2.index_fsa(b_fsas, indexes)
-        b_to_a = k2.index_select(b_to_a_map, indexes)
-        path_lattice = k2.intersect_device(
-            a_fsas, fsas, b_to_a_map=b_to_a, sorted_match_a=sorted_match_a
-        )
+    # Batches to process, in reverse order
+    pending = splits[::-1]
+    while pending:
+        start, end = pending.pop()
+        try:
+            path_lattice = k2.intersect_device(
+                a_fsas,
+                _index_fsa_range(b_fsas, start, end),
+                b_to_a_map=b_to_a_map[start:end],
+                sorted_match_a=sorted_match_a,
+            )
+        except RuntimeError as e:
+            if end - start == 1:
+                raise
+            logging.info(f"Caught exception:\n{e}\n")
+            logging.info(f"Splitting a batch of {end - start} FSAs into two")
+            mid = (start + end) // 2
+            pending.append((mid, end))
+            pending.append((start, mid))
+            continue
         ans.append(path_lattice)
 
+    if len(ans) == 1:
+        return ans[0]
     return k2.cat(ans)
 
 
@@ -300,7 +385,12 @@ class Nbest(object):
         # `fsa` has only one extra attribute: aux_labels.
         return Nbest(fsa=fsa, shape=utt_to_path_shape)
 
-    def intersect(self, lattice: k2.Fsa, use_double_scores=True) -> "Nbest":
+    def intersect(
+        self,
+        lattice: k2.Fsa,
+        use_double_scores=True,
+        max_arcs: Optional[int] = None,
+    ) -> "Nbest":
         """Intersect this Nbest object with a lattice, get 1-best
         path from the resulting FsaVec, and return a new Nbest object.
 
@@ -314,6 +404,10 @@ class Nbest(object):
           use_double_scores:
             True to use double precision when computing shortest path.
             False to use single precision.
+          max_arcs:
+            Optional. If not None, the paths are intersected with the lattice
+            in batches with at most this number of arcs. See
+            :func:`_intersect_device`.
         Returns:
           Return a new Nbest. This new Nbest shares the same shape with `self`,
           while its `fsa` is the 1-best path from intersecting `self.fsa` and
@@ -354,6 +448,7 @@ class Nbest(object):
                 word_fsa_with_epsilon_loops,
                 b_to_a_map=torch.zeros_like(path_to_utt_map),
                 sorted_match_a=True,
+                max_arcs=max_arcs,
             )
         else:
             path_lattice = _intersect_device(
@@ -361,6 +456,7 @@ class Nbest(object):
                 word_fsa_with_epsilon_loops,
                 b_to_a_map=path_to_utt_map,
                 sorted_match_a=True,
+                max_arcs=max_arcs,
             )
 
         # path_lattice has word IDs as labels and token IDs as aux_labels
@@ -722,6 +818,7 @@ def nbest_rescore_with_LM(
     lm_scale_list: List[float],
     nbest_scale: float = 1.0,
     use_double_scores: bool = True,
+    max_arcs: Optional[int] = None,
 ) -> Dict[str, k2.Fsa]:
     """Rescore an n-best list with an n-gram LM.
     The path with the maximum score is used as the decoding output.
@@ -745,6 +842,10 @@ def nbest_rescore_with_LM(
       use_double_scores:
         True to use double precision during computation. False to use
         single precision.
+      max_arcs:
+        Optional. If not None, the paths are intersected with the lattice
+        and with the LM in batches with at most this number of arcs, to
+        avoid CUDA OOM errors. See :func:`_intersect_device`.
     Returns:
       A dict of FsaVec, whose key is an lm_scale and the value is the
       best decoding path for each utterance in the lattice.
@@ -766,7 +867,7 @@ def nbest_rescore_with_LM(
     )
     # nbest.fsa.scores contains 0s
 
-    nbest = nbest.intersect(lattice)
+    nbest = nbest.intersect(lattice, max_arcs=max_arcs)
 
     # Now nbest.fsa has its scores set
     assert hasattr(nbest.fsa, "lm_scores")
@@ -785,11 +886,12 @@ def nbest_rescore_with_LM(
     path_to_utt_map = nbest.shape.row_ids(1)
 
     LM = k2.arc_sort(LM)
-    path_lattice = k2.intersect_device(
+    path_lattice = _intersect_device(
         LM,
         inv_fsa_with_epsilon_loops,
         b_to_a_map=torch.zeros_like(path_to_utt_map),
         sorted_match_a=True,
+        max_arcs=max_arcs,
     )
 
     # Its labels are token IDs.
@@ -816,11 +918,122 @@ def nbest_rescore_with_LM(
     return ans
 
 
+def _intersect_with_G(
+    G_with_epsilon_loops: k2.Fsa,
+    inv_lattice: k2.Fsa,
+    max_arcs: Optional[int] = None,
+    prune_th_list: Optional[List[float]] = None,
+) -> Optional[Tuple[k2.Fsa, List[float]]]:
+    """Intersect each lattice with G in batches, pruning only the lattices
+    that do not fit in memory.
+
+    The lattices are split into batches with at most `max_arcs` arcs. A
+    batch with more than one lattice that runs out of memory is split into
+    two halves. A single lattice with more than `max_arcs` arcs, or that
+    runs out of memory, is pruned with `k2.prune_on_arc_post` using the
+    thresholds in `prune_th_list` in turn, until it can be intersected.
+
+    Args:
+      G_with_epsilon_loops:
+        An FsaVec containing only a single FSA. See
+        :func:`rescore_with_whole_lattice`.
+      inv_lattice:
+        An FsaVec with axes [utt][state][arc], whose labels are word IDs.
+      max_arcs:
+        Optional. The maximum number of arcs of the lattices in a batch.
+        If None, all lattices are put in a single batch at first.
+      prune_th_list:
+        Optional. The pruning thresholds, in increasing order.
+    Returns:
+      Return None if a lattice is still too large after pruning it with the
+      last threshold. Otherwise, return a tuple containing:
+        - The top-sorted and connected intersection of the lattices and G.
+        - A list containing the pruning threshold used for each lattice,
+          which is 0 for lattices that are not pruned.
+    """
+    if prune_th_list is None:
+        # NOTE: The choice of the threshold list is arbitrary here to avoid
+        # OOM. You may need to fine tune it.
+        prune_th_list = [1e-10, 1e-9, 1e-8, 1e-7, 1e-6]
+        prune_th_list += [1e-5, 1e-4, 1e-3, 1e-2, 1e-1]
+
+    device = inv_lattice.device
+    num_seqs = inv_lattice.shape[0]
+
+    num_arcs = None
+    if max_arcs is not None:
+        num_arcs = _get_num_arcs(inv_lattice).tolist()
+    splits = _get_splits(num_seqs, num_arcs=num_arcs, max_arcs=max_arcs)
+
+    def intersect(fsas: k2.Fsa) -> k2.Fsa:
+        b_to_a_map = torch.zeros(fsas.shape[0], device=device, dtype=torch.int32)
+        lattice = k2.intersect_device(
+            G_with_epsilon_loops,
+            fsas,
+            b_to_a_map,
+            sorted_match_a=True,
+        )
+        return k2.top_sort(k2.connect(lattice))
+
+    prune_th = [0.0] * num_seqs
+    ans = []
+    # Batches to process, in reverse order
+    pending = splits[::-1]
+    while pending:
+        start, end = pending.pop()
+        fsas = _index_fsa_range(inv_lattice, start, end)
+        if end - start > 1:
+            try:
+                ans.append(intersect(fsas))
+            except RuntimeError as e:
+                logging.info(f"Caught exception:\n{e}\n")
+                logging.info(f"Splitting a batch of {end - start} lattices into two")
+                mid = (start + end) // 2
+                pending.append((mid, end))
+                pending.append((start, mid))
+            continue
+
+        loop_count = 0
+        while True:
+            if max_arcs is None or fsas.arcs.num_elements() <= max_arcs:
+                try:
+                    ans.append(intersect(fsas))
+                    break
+                except RuntimeError as e:
+                    logging.info(f"Caught exception:\n{e}\n")
+                    logging.info(
+                        "This OOM is not an error. You can ignore it. "
+                        "If your model does not converge well, or --max-duration "
+                        "is too large, or the input sound file is difficult to "
+                        "decode, you will meet this exception."
+                    )
+            if loop_count >= len(prune_th_list):
+                logging.info("Return None as the resulting lattice is too large.")
+                return None
+            logging.info(
+                f"Lattice {start}: num_arcs before pruning: "
+                f"{fsas.arcs.num_elements()}"
+            )
+            fsas = k2.prune_on_arc_post(fsas, prune_th_list[loop_count], True)
+            prune_th[start] = prune_th_list[loop_count]
+            logging.info(
+                f"Lattice {start}: num_arcs after pruning: "
+                f"{fsas.arcs.num_elements()}"
+            )
+            loop_count += 1
+
+    if len(ans) == 1:
+        return ans[0], prune_th
+    return k2.cat(ans), prune_th
+
+
 def rescore_with_whole_lattice(
     lattice: k2.Fsa,
     G_with_epsilon_loops: k2.Fsa,
     lm_scale_list: Optional[List[float]] = None,
     use_double_scores: bool = True,
+    max_arcs: Optional[int] = None,
+    prune_th_list: Optional[List[float]] = None,
 ) -> Union[k2.Fsa, Dict[str, k2.Fsa]]:
     """Intersect the lattice with an n-gram LM and use shortest path
     to decode.
@@ -847,17 +1060,27 @@ def rescore_with_whole_lattice(
       use_double_scores:
         True to use double precision in the computation.
         False to use single precision.
+      max_arcs:
+        Optional. If not None, the lattices are intersected with
+        `G_with_epsilon_loops` in batches with at most this number of arcs,
+        and only the lattices with more arcs are pruned. Otherwise, all
+        lattices are intersected at once at first. In both cases, a batch
+        running out of memory is split, and a single lattice running out
+        of memory is pruned; the other lattices are not affected.
+      prune_th_list:
+        Optional. The thresholds of `k2.prune_on_arc_post` to try in turn
+        for a lattice that is too large. See :func:`_intersect_with_G`.
     Returns:
       If `lm_scale_list` is None, return a new lattice which is the intersection
       result of `lattice` and `G_with_epsilon_loops`.
       Otherwise, return a dict whose key is an entry in `lm_scale_list` and the
       value is the decoding result (i.e., an FsaVec containing linear FSAs).
+      Return None if a lattice is too large even after pruning.
     """
     # Nbest is not used in this function
     assert hasattr(lattice, "lm_scores")
     assert G_with_epsilon_loops.shape == (1, None, None)
 
-    device = lattice.device
     lattice.scores = lattice.scores - lattice.lm_scores
     # We will use lm_scores from G, so remove lats.lm_scores here
     del lattice.lm_scores
@@ -869,45 +1092,23 @@ def rescore_with_whole_lattice(
     # inv_lattice has word IDs as labels.
     # Its `aux_labels` is token IDs
     inv_lattice = k2.invert(lattice)
-    num_seqs = lattice.shape[0]
 
-    b_to_a_map = torch.zeros(num_seqs, device=device, dtype=torch.int32)
+    ans = _intersect_with_G(
+        G_with_epsilon_loops,
+        inv_lattice,
+        max_arcs=max_arcs,
+        prune_th_list=prune_th_list,
+    )
+    if ans is None:
+        return None
+    rescoring_lattice, prune_th = ans
 
-    # NOTE: The choice of the threshold list is arbitrary here to avoid OOM.
-    # You may need to fine tune it.
-    prune_th_list = [1e-10, 1e-9, 1e-8, 1e-7, 1e-6]
-    prune_th_list += [1e-5, 1e-4, 1e-3, 1e-2, 1e-1]
-    max_loop_count = 10
-    loop_count = 0
-    while loop_count <= max_loop_count:
-        try:
-            rescoring_lattice = k2.intersect_device(
-                G_with_epsilon_loops,
-                inv_lattice,
-                b_to_a_map,
-                sorted_match_a=True,
-            )
-            rescoring_lattice = k2.top_sort(k2.connect(rescoring_lattice))
-            break
-        except RuntimeError as e:
-            logging.info(f"Caught exception:\n{e}\n")
-            if loop_count >= max_loop_count:
-                logging.info("Return None as the resulting lattice is too large.")
-                return None
-            logging.info(f"num_arcs before pruning: {inv_lattice.arcs.num_elements()}")
-            logging.info(
-                "This OOM is not an error. You can ignore it. "
-                "If your model does not converge well, or --max-duration "
-                "is too large, or the input sound file is difficult to "
-                "decode, you will meet this exception."
-            )
-            inv_lattice = k2.prune_on_arc_post(
-                inv_lattice,
-                prune_th_list[loop_count],
-                True,
-            )
-            logging.info(f"num_arcs after pruning: {inv_lattice.arcs.num_elements()}")
-        loop_count += 1
+    num_pruned = sum(th > 0 for th in prune_th)
+    if num_pruned > 0:
+        logging.info(
+            f"Pruned {num_pruned} out of {len(prune_th)} lattices before "
+            f"rescoring. Pruning thresholds of each lattice: {prune_th}"
+        )
 
     # lat has token IDs as labels
     # and word IDs as aux_labels.
@@ -940,6 +1141,7 @@ def rescore_with_attention_decoder(
     ngram_lm_scale: Optional[float] = None,
     attention_scale: Optional[float] = None,
     use_double_scores: bool = True,
+    max_arcs: Optional[int] = None,
 ) -> Dict[str, k2.Fsa]:
     """This function extracts `num_paths` paths from the given lattice and uses
     an attention decoder to rescore them. The path with the highest score is
@@ -970,6 +1172,11 @@ def rescore_with_attention_decoder(
         Optional. It specifies the scale for n-gram LM scores.
       attention_scale:
         Optional. It specifies the scale for attention decoder scores.
+      max_arcs:
+        Optional. If not None, the paths are intersected with the lattice
+        in batches with at most this number of arcs. Batches running out of
+        memory are split further, and `num_paths` is only decreased if a
+        single path still runs out of memory. See :func:`_intersect_device`.
     Returns:
       A dict of FsaVec, whose key contains a string
       ngram_lm_scale_attention_scale and the value is the
@@ -986,7 +1193,7 @@ def rescore_with_attention_decoder(
                 nbest_scale=nbest_scale,
             )
             # nbest.fsa.scores are all 0s at this point
-            nbest = nbest.intersect(lattice)
+            nbest = nbest.intersect(lattice, max_arcs=max_arcs)
             break
         except RuntimeError as e:
             logging.info(f"Caught exception:\n{e}\n")
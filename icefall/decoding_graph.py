@@ -0,0 +1,448 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Build the decoding graphs, i.e., LG, HLG and the G used for LM rescoring,
+with an on-disk cache of all intermediate results.
+
+Each graph in the cache is saved to a file whose name contains a hash of
+everything it is built from, i.e., the contents of the lexicon, the tokens,
+the words and the LM files, and the compile options. So:
+
+  - a graph is only rebuilt if one of its inputs changes, e.g., changing
+    only the LM reuses the arc-sorted L;
+  - a graph is never loaded from the cache after its inputs are changed;
+  - different recipes and LMs, and concurrent jobs, can share the same
+    cache directory.
+
+The graphs are arc-sorted and saved on CPU with torch.save(fsa.as_dict()).
+They are memory-mapped when they are loaded, if it is supported by torch.
+
+Usage::
+
+    cache = GraphCache("data/graph_cache")
+    HLG = compile_HLG("data/lang_bpe_500", "data/lm/G_3_gram.fst.txt", cache)
+
+    G = get_rescoring_G(
+        "data/lm",
+        "G_4_gram",
+        first_word_disambig_id=lexicon.word_table["#0"],
+        device=device,
+        cache=cache,
+    )
+"""
+
+import hashlib
+import json
+import logging
+from functools import partial
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import k2
+import torch
+
+from icefall.lexicon import Lexicon
+from icefall.utils import Pathlike, atomic_save
+
+DEFAULT_GRAPH_CACHE_DIR = "data/graph_cache"
+
+
+def load_fsa(filename: Pathlike, device: Union[str, torch.device] = "cpu") -> k2.Fsa:
+    """Load an FSA saved with torch.save(fsa.as_dict())."""
+    try:
+        d = torch.load(str(filename), map_location="cpu", mmap=True)
+    except (TypeError, RuntimeError):
+        # mmap requires torch >= 2.1 and the new zipfile format
+        d = torch.load(filename, map_location="cpu")
+    return k2.Fsa.from_dict(d).to(device)
+
+
+def save_fsa(fsa: k2.Fsa, filename: Pathlike) -> None:
+    """Save an FSA so that it can be loaded by :func:`load_fsa`."""
+    atomic_save(fsa.to("cpu").as_dict(), filename)
+
+
+class GraphCache(object):
+    """A content-addressed on-disk cache of FSAs."""
+
+    def __init__(self, cache_dir: Pathlike = DEFAULT_GRAPH_CACHE_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def file_hash(self, filename: Pathlike) -> str:
+        """Return the SHA1 of the content of the given file.
+
+        Hashing a large LM takes a while, so the hash is saved in the
+        file_hashes directory of the cache and is reused while the size and
+        the modification time of the file do not change. Each file has its
+        own entry, named by a hash of its path, so jobs sharing the cache
+        never overwrite the entries of other files.
+        """
+        filename = Path(filename).resolve()
+        stat = filename.stat()
+        path_hash = hashlib.sha1(str(filename).encode("utf-8")).hexdigest()
+        entry_filename = self.cache_dir / "file_hashes" / f"{path_hash}.json"
+
+        if entry_filename.is_file():
+            with open(entry_filename) as f:
+                entry = json.load(f)
+            if (
+                entry["path"] == str(filename)
+                and entry["size"] == stat.st_size
+                and entry["mtime_ns"] == stat.st_mtime_ns
+            ):
+                return entry["sha1"]
+
+        logging.info(f"Computing the hash of {filename}")
+        h = hashlib.sha1()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                h.update(chunk)
+
+        entry = {
+            "path": str(filename),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha1": h.hexdigest(),
+        }
+        entry_filename.parent.mkdir(exist_ok=True)
+        atomic_save(entry, entry_filename, save=partial(json.dump, indent=2), mode="w")
+
+        return h.hexdigest()
+
+    def get(self, name: str, key: str, compute: Callable[[], k2.Fsa]) -> k2.Fsa:
+        """Return the FSA of the given name and key from the cache, or
+        compute it with `compute()` and save it to the cache.
+
+        Args:
+          name:
+            Name of the FSA, e.g., "LG". It is only used in the file name.
+          key:
+            A hash of everything the FSA depends on. See :func:`get_key`.
+          compute:
+            A function returning the FSA.
+        """
+        filename = self.cache_dir / f"{name}-{key}.pt"
+        if filename.is_file():
+            logging.info(f"Loading {name} from {filename}")
+            return load_fsa(filename)
+
+        fsa = compute()
+        logging.info(f"Saving {name} to {filename}")
+        save_fsa(fsa, filename)
+        return fsa
+
+
+def get_key(*parts) -> str:
+    """Return a hash of the given parts, e.g., hashes of files and options."""
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(str(p).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:20]
+
+
+def _get(
+    cache: Optional[GraphCache],
+    name: str,
+    key: Callable[[], str],
+    compute: Callable[[], k2.Fsa],
+) -> k2.Fsa:
+    if cache is None:
+        return compute()
+    return cache.get(name, key(), compute)
+
+
+def _file_key(cache: Optional[GraphCache], filename: Pathlike) -> str:
+    return cache.file_hash(filename) if cache is not None else ""
+
+
+def _read_G(lm_file: Pathlike) -> k2.Fsa:
+    """Read G from either an OpenFst text file or a .pt file."""
+    lm_file = Path(lm_file)
+    if lm_file.suffix == ".pt":
+        logging.info(f"Loading pre-compiled {lm_file}")
+        return load_fsa(lm_file)
+
+    logging.info(f"Loading {lm_file}")
+    with open(lm_file) as f:
+        return k2.Fsa.from_openfst(f.read(), acceptor=False)
+
+
+def get_L(lang_dir: Pathlike, cache: Optional[GraphCache] = None) -> k2.Fsa:
+    """Return the arc-sorted lang_dir/L_disambig.pt."""
+    filename = Path(lang_dir) / "L_disambig.pt"
+    return _get(
+        cache,
+        "L",
+        lambda: get_key("L", _file_key(cache, filename)),
+        lambda: k2.arc_sort(load_fsa(filename)),
+    )
+
+
+def get_G(lm_file: Pathlike, cache: Optional[GraphCache] = None) -> k2.Fsa:
+    """Return the arc-sorted G read from an OpenFst text file, e.g.,
+    data/lm/G_3_gram.fst.txt, or a .pt file."""
+    return _get(
+        cache,
+        "G",
+        lambda: get_key("G", _file_key(cache, lm_file)),
+        lambda: k2.arc_sort(_read_G(lm_file)),
+    )
+
+
+def compile_LG(
+    lang_dir: Pathlike,
+    lm_file: Pathlike,
+    cache: Optional[GraphCache] = None,
+    weight_pushing: k2.DeterminizeWeightPushingType = (
+        k2.DeterminizeWeightPushingType.kNoWeightPushing
+    ),
+) -> k2.Fsa:
+    """Build LG from lang_dir/L_disambig.pt and the given LM.
+
+    It composes L and G, determinizes LG, removes the disambiguation
+    symbols and the epsilons, and returns the arc-sorted LG.
+
+    Args:
+      lang_dir:
+        The language directory, e.g., data/lang_phone or data/lang_bpe_500.
+      lm_file:
+        The LM, e.g., data/lm/G_3_gram.fst.txt.
+      cache:
+        If not None, the intermediate results, i.e., L, G, LG and det-LG,
+        are saved to and loaded from it.
+      weight_pushing:
+        The weight pushing type of k2.determinize().
+    Returns:
+      An FSA representing LG.
+    """
+    lang_dir = Path(lang_dir)
+
+    def lexicon_key() -> str:
+        return get_key(
+            _file_key(cache, lang_dir / "L_disambig.pt"),
+            _file_key(cache, lang_dir / "tokens.txt"),
+            _file_key(cache, lang_dir / "words.txt"),
+            _file_key(cache, lm_file),
+        )
+
+    def compose() -> k2.Fsa:
+        L = get_L(lang_dir, cache)
+        G = get_G(lm_file, cache)
+
+        logging.info("Intersecting L and G")
+        LG = k2.compose(L, G)
+        logging.info(f"LG shape: {LG.shape}")
+
+        logging.info("Connecting LG")
+        LG = k2.connect(LG)
+        logging.info(f"LG shape after k2.connect: {LG.shape}")
+        return LG
+
+    def determinize() -> k2.Fsa:
+        LG = _get(cache, "LG", lambda: get_key("LG", lexicon_key()), compose)
+
+        lexicon = Lexicon(lang_dir)
+        first_token_disambig_id = lexicon.token_table["#0"]
+        first_word_disambig_id = lexicon.word_table["#0"]
+
+        logging.info("Determinizing LG")
+        LG = k2.determinize(LG, weight_pushing)
+
+        logging.info("Connecting LG after k2.determinize")
+        LG = k2.connect(LG)
+
+        logging.info("Removing disambiguation symbols on LG")
+        # LG.labels[LG.labels >= first_token_disambig_id] = 0
+        # see https://github.com/k2-fsa/k2/pull/1140
+        labels = LG.labels
+        labels[labels >= first_token_disambig_id] = 0
+        LG.labels = labels
+
+        assert isinstance(LG.aux_labels, k2.RaggedTensor)
+        LG.aux_labels.values[LG.aux_labels.values >= first_word_disambig_id] = 0
+
+        LG = k2.remove_epsilon(LG)
+        logging.info(f"LG shape after k2.remove_epsilon: {LG.shape}")
+
+        LG = k2.connect(LG)
+        LG.aux_labels = LG.aux_labels.remove_values_eq(0)
+
+        logging.info("Arc sorting LG")
+        return k2.arc_sort(LG)
+
+    return _get(
+        cache,
+        "det-LG",
+        lambda: get_key("det-LG", lexicon_key(), weight_pushing),
+        determinize,
+    )
+
+
+def compile_HLG(
+    lang_dir: Pathlike,
+    lm_file: Pathlike,
+    cache: Optional[GraphCache] = None,
+    weight_pushing: k2.DeterminizeWeightPushingType = (
+        k2.DeterminizeWeightPushingType.kNoWeightPushing
+    ),
+) -> k2.Fsa:
+    """Build HLG, where H is the CTC topology of the tokens in lang_dir and
+    LG is returned by :func:`compile_LG`.
+
+    Args:
+      lang_dir:
+        The language directory, e.g., data/lang_phone or data/lang_bpe_500.
+      lm_file:
+        The LM, e.g., data/lm/G_3_gram.fst.txt.
+      cache:
+        If not None, HLG and the intermediate results are saved to and
+        loaded from it.
+      weight_pushing:
+        The weight pushing type of k2.determinize().
+    Returns:
+      An FSA representing HLG.
+    """
+    lang_dir = Path(lang_dir)
+
+    def compose() -> k2.Fsa:
+        LG = compile_LG(lang_dir, lm_file, cache, weight_pushing)
+
+        lexicon = Lexicon(lang_dir)
+        max_token_id = max(lexicon.tokens)
+        logging.info(f"Building ctc_topo. max_token_id: {max_token_id}")
+        H = k2.ctc_topo(max_token_id)
+
+        logging.info("Composing H and LG")
+        # CAUTION: The name of the inner_labels is fixed
+        # to `tokens`. If you want to change it, please
+        # also change other places in icefall that are using
+        # it.
+        HLG = k2.compose(H, LG, inner_labels="tokens")
+
+        logging.info("Connecting HLG")
+        HLG = k2.connect(HLG)
+
+        logging.info("Arc sorting HLG")
+        HLG = k2.arc_sort(HLG)
+        logging.info(f"HLG.shape: {HLG.shape}")
+        return HLG
+
+    return _get(
+        cache,
+        "HLG",
+        lambda: get_key(
+            "HLG",
+            _file_key(cache, lang_dir / "L_disambig.pt"),
+            _file_key(cache, lang_dir / "tokens.txt"),
+            _file_key(cache, lang_dir / "words.txt"),
+            _file_key(cache, lm_file),
+            weight_pushing,
+        ),
+        compose,
+    )
+
+
+def get_rescoring_G(
+    lm_dir: Pathlike,
+    lm: str,
+    first_word_disambig_id: int,
+    device: Union[str, torch.device],
+    cache: Optional[GraphCache] = None,
+    add_epsilon_self_loops: bool = False,
+) -> k2.Fsa:
+    """Return the G used for LM rescoring, e.g., of n-best lists or lattices.
+
+    Args:
+      lm_dir:
+        The directory containing {lm}.fst.txt, or the {lm}.pt saved by
+        older versions of the decoding scripts.
+      lm:
+        The stem name of the LM, e.g., G_4_gram.
+      first_word_disambig_id:
+        The ID of #0 in words.txt. The labels of the arcs entering the
+        back-off states, which are #0, are set to 0.
+      device:
+        The device of the returned G.
+      cache:
+        If not None, G is saved to and loaded from it.
+      add_epsilon_self_loops:
+        True to add epsilon self-loops to G, as needed to compose it with
+        whole lattices.
+    Returns:
+      Return an arc-sorted FsaVec containing G, with `G.lm_scores` set
+      to `G.scores`.
+    """
+    lm_dir = Path(lm_dir)
+    lm_file = lm_dir / f"{lm}.fst.txt"
+
+    def read() -> k2.Fsa:
+        if not lm_file.is_file():
+            # G saved by older versions of the decoding scripts, which
+            # has already been processed as below
+            logging.info(f"Loading pre-compiled {lm}.pt")
+            return load_fsa(lm_dir / f"{lm}.pt")
+
+        logging.info(f"Loading {lm_file}")
+        logging.warning("It may take several minutes for a large LM.")
+        with open(lm_file) as f:
+            G = k2.Fsa.from_openfst(f.read(), acceptor=False)
+        # G.aux_labels is not needed in later computations, so
+        # remove it here.
+        del G.aux_labels
+        # CAUTION: The following line is crucial.
+        # Arcs entering the back-off state have label equal to #0.
+        # We have to change it to 0 here.
+        G.labels[G.labels >= first_word_disambig_id] = 0
+        # See https://github.com/k2-fsa/k2/issues/874
+        # for why we need to set G.properties to None
+        G.__dict__["_properties"] = None
+        G = k2.Fsa.from_fsas([G])
+        G = k2.arc_sort(G)
+        # Save a dummy value so that it can be loaded in C++.
+        # See https://github.com/pytorch/pytorch/issues/67902
+        # for why we need to do this.
+        G.dummy = 1
+        return G
+
+    def with_epsilon_self_loops() -> k2.Fsa:
+        G = _get(cache, "rescoring-G", key, read)
+        # Add epsilon self-loops to G as we will compose
+        # it with the whole lattice later
+        G = k2.add_epsilon_self_loops(G)
+        return k2.arc_sort(G)
+
+    def key() -> str:
+        source = lm_file if lm_file.is_file() else lm_dir / f"{lm}.pt"
+        return get_key("rescoring-G", _file_key(cache, source), first_word_disambig_id)
+
+    if add_epsilon_self_loops:
+        G = _get(
+            cache,
+            "rescoring-G-eps",
+            lambda: get_key("eps", key()),
+            with_epsilon_self_loops,
+        )
+    else:
+        G = _get(cache, "rescoring-G", key, read)
+
+    G = G.to(device)
+    # G.lm_scores is used to replace HLG.lm_scores during
+    # LM rescoring.
+    G.lm_scores = G.scores.clone()
+    return G
@@ -16,6 +16,7 @@
 
 import argparse
 import logging
+from typing import List
 
 import torch
 
@@ -218,11 +219,42 @@ class LmScorer(torch.nn.Module):
         Args:
             x (torch.Tensor): Input tokens
             x_lens (torch.Tensor): Length of the input tokens
-            state (optional): LM states
-
+            state (optional): LM states. For the RNN LM, it is a tuple (h, c)
+              with batch dimension 1. For the transformer LM, it contains
+              the cached keys and values of all previous tokens, see
+              `TransformerLM.score_token()`. If it is given, x contains only
+              the new tokens.
+
+        Returns:
+            The log-probabilities of the next token and the new LM states
         """
         return self.lm.score_token(x, x_lens, state)
 
+    def stack_states(self, states: List):
+        """Stack the LM states of several sequences into a batch,
+        so that they can be passed to :meth:`score_token` together.
+
+        Args:
+            states: A list of LM states, each of them with batch size 1,
+                or more generally, returned by :meth:`score_token` or
+                :meth:`get_state`.
+        """
+        if self.lm_type == "rnn":
+            h = torch.cat([s[0] for s in states], dim=1)
+            c = torch.cat([s[1] for s in states], dim=1)
+            return (h, c)
+        else:
+            return self.lm.stack_states(states)
+
+    def get_state(self, state, i: int):
+        """Return the LM states of the i-th sequence of a batch, with batch
+        size 1. It is the inverse of :meth:`stack_states`.
+        """
+        if self.lm_type == "rnn":
+            return (state[0][:, i : i + 1], state[1][:, i : i + 1])
+        else:
+            return self.lm.get_state(state, i)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
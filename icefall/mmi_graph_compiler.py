@@ -1,6 +1,6 @@
 import logging
 from pathlib import Path
-from typing import Iterable, List, Tuple, Union
+from typing import Iterable, List, Optional, Tuple, Union
 
 import k2
 import torch
@@ -102,7 +102,10 @@ class MmiTrainingGraphCompiler(object):
         logging.info(f"ctc_topo_P num_arcs: {self.ctc_topo_P.num_arcs}")
 
     def compile(
-        self, texts: Iterable[str], replicate_den: bool = True
+        self,
+        texts: Iterable[str],
+        replicate_den: bool = True,
+        num_graphs: Optional[k2.Fsa] = None,
     ) -> Tuple[k2.Fsa, k2.Fsa]:
         """Create numerator and denominator graphs from transcripts
         and the bigram phone LM.
@@ -118,6 +121,10 @@ class MmiTrainingGraphCompiler(object):
             If True, the returned den_graph is replicated to match the number
             of FSAs in the returned num_graph; if False, the returned den_graph
             contains only a single FSA
+          num_graphs:
+            If not None, it contains the numerator graphs of `texts` compiled
+            beforehand by :meth:`compile_num_graphs`, e.g., in the dataloader
+            workers, and it is returned as `num_graph`.
         Returns:
           A tuple (num_graph, den_graph), where
 
@@ -128,6 +135,30 @@ class MmiTrainingGraphCompiler(object):
               with the same shape of the `num_graph` if replicate_den is
               True; otherwise, it is an FsaVec containing only a single FSA.
         """
+        if num_graphs is None:
+            num = self.compile_num_graphs(texts)
+        else:
+            num = num_graphs
+
+        ctc_topo_P_vec = k2.create_fsa_vec([self.ctc_topo_P])
+        if replicate_den:
+            indexes = torch.zeros(len(texts), dtype=torch.int32, device=self.device)
+            den = k2.index_fsa(ctc_topo_P_vec, indexes)
+        else:
+            den = ctc_topo_P_vec
+
+        return num, den
+
+    def compile_num_graphs(self, texts: Iterable[str]) -> k2.Fsa:
+        """Create numerator graphs from transcripts and the bigram phone LM.
+
+        Args:
+          texts:
+            A list of transcripts. See :meth:`compile`.
+        Returns:
+          Return the numerator graph, which is an FsaVec with shape
+          `(len(texts), None, None)`.
+        """
         transcript_fsa = self.build_transcript_fsa(texts)
 
         # remove word IDs from transcript_fsa since it is not needed
@@ -153,14 +184,7 @@ class MmiTrainingGraphCompiler(object):
 
         num = k2.arc_sort(num)
 
-        ctc_topo_P_vec = k2.create_fsa_vec([self.ctc_topo_P])
-        if replicate_den:
-            indexes = torch.zeros(len(texts), dtype=torch.int32, device=self.device)
-            den = k2.index_fsa(ctc_topo_P_vec, indexes)
-        else:
-            den = ctc_topo_P_vec
-
-        return num, den
+        return num
 
     def build_transcript_fsa(self, texts: List[str]) -> k2.Fsa:
         """Convert transcripts to an FsaVec with the help of a lexicon
@@ -14,10 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+import os
+import struct
+import zipfile
 from collections import defaultdict
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 
-from icefall.utils import is_module_available
+import numpy as np
+
+from icefall.utils import atomic_save, is_module_available
 
 
 class NgramLm:
@@ -53,6 +59,10 @@ class NgramLm:
         self.lm = lm
         self.backoff_id = backoff_id
 
+    @property
+    def num_states(self) -> int:
+        return self.lm.num_states
+
     def _process_backoff_arcs(
         self,
         state: int,
@@ -139,6 +149,357 @@ class NgramLm:
         return next_states, next_costs
 
 
+def _load_npz_with_mmap(filename: str) -> Dict[str, np.ndarray]:
+    """Memory-map the arrays of an uncompressed .npz file, e.g., one
+    written by `np.savez`. Note that `np.load(filename, mmap_mode="r")`
+    ignores `mmap_mode` for .npz files.
+
+    Args:
+      filename:
+        Path to the .npz file.
+    Returns:
+      Return a dict mapping array names to read-only memory-mapped arrays.
+    """
+    ans = {}
+    with zipfile.ZipFile(filename) as zf, open(filename, "rb") as f:
+        for info in zf.infolist():
+            assert info.compress_type == zipfile.ZIP_STORED, (
+                f"{info.filename} in {filename} is compressed. "
+                "Please use np.savez instead of np.savez_compressed"
+            )
+            # The local file header has 30 bytes, followed by the file name
+            # and the extra field, whose lengths are at offset 26 and 28
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            name = info.filename[: -len(".npy")]
+            if int(np.prod(shape)) == 0:
+                # mmap does not support empty arrays
+                ans[name] = np.empty(shape, dtype=dtype)
+                continue
+
+            ans[name] = np.memmap(
+                filename,
+                dtype=dtype,
+                mode="r",
+                shape=shape,
+                order="F" if fortran_order else "C",
+                offset=f.tell(),
+            )
+    return ans
+
+
+class CompiledNgramLm:
+    def __init__(self, arrays: Dict[str, np.ndarray], backoff_id: int):
+        """
+        An n-gram LM flattened into CSR-style arrays. Use
+        :meth:`from_ngram_lm` or :meth:`load_or_compile` to construct it.
+
+        Args:
+          arrays:
+            A dict containing the following arrays:
+
+              - arc_offsets: A 1-D int64 array of shape (num_states + 1,).
+                Arcs leaving state s are in the range
+                [arc_offsets[s], arc_offsets[s + 1]).
+              - ilabels: A 1-D int32 array of shape (num_arcs,). Arcs of
+                each state are sorted by ilabel.
+              - next_states: A 1-D int32 array of shape (num_arcs,).
+              - weights: A 1-D float32 array of shape (num_arcs,).
+              - backoff_states: A 1-D int32 array of shape (num_states,).
+                It is the destination state of the backoff arc of each state,
+                or -1 if the state has no backoff arc.
+              - backoff_weights: A 1-D float32 array of shape (num_states,).
+                The weight of the backoff arc of each state.
+          backoff_id:
+            ID of the backoff symbol.
+        """
+        self.arc_offsets = arrays["arc_offsets"]
+        self.ilabels = arrays["ilabels"]
+        self.next_states = arrays["next_states"]
+        self.weights = arrays["weights"]
+        self.backoff_states = arrays["backoff_states"]
+        self.backoff_weights = arrays["backoff_weights"]
+        self.backoff_id = backoff_id
+
+        assert self.arc_offsets.shape[0] == self.backoff_states.shape[0] + 1
+
+    @property
+    def num_states(self) -> int:
+        return self.backoff_states.shape[0]
+
+    @property
+    def num_arcs(self) -> int:
+        return self.ilabels.shape[0]
+
+    @staticmethod
+    def from_ngram_lm(ngram_lm: NgramLm) -> "CompiledNgramLm":
+        """Flatten the FST of the given NgramLm into arrays."""
+        import kaldifst
+
+        lm = ngram_lm.lm
+        assert lm.start == 0, lm.start
+        num_states = lm.num_states
+
+        arc_offsets = np.zeros(num_states + 1, dtype=np.int64)
+        ilabels = []
+        next_states = []
+        weights = []
+        backoff_states = np.full(num_states, -1, dtype=np.int32)
+        backoff_weights = np.zeros(num_states, dtype=np.float32)
+
+        for state in range(num_states):
+            arc_offsets[state + 1] = arc_offsets[state] + lm.num_arcs(state)
+            for arc in kaldifst.ArcIterator(lm, state):
+                ilabels.append(arc.ilabel)
+                next_states.append(arc.nextstate)
+                weights.append(arc.weight.value)
+                if arc.ilabel == ngram_lm.backoff_id:
+                    backoff_states[state] = arc.nextstate
+                    backoff_weights[state] = arc.weight.value
+
+        arrays = {
+            "arc_offsets": arc_offsets,
+            "ilabels": np.array(ilabels, dtype=np.int32),
+            "next_states": np.array(next_states, dtype=np.int32),
+            "weights": np.array(weights, dtype=np.float32),
+            "backoff_states": backoff_states,
+            "backoff_weights": backoff_weights,
+        }
+        return CompiledNgramLm(arrays, backoff_id=ngram_lm.backoff_id)
+
+    def save(self, filename: str) -> None:
+        """Save the arrays to an uncompressed .npz file, which can be
+        memory-mapped by :meth:`load`."""
+        arrays = dict(
+            arc_offsets=self.arc_offsets,
+            ilabels=self.ilabels,
+            next_states=self.next_states,
+            weights=self.weights,
+            backoff_states=self.backoff_states,
+            backoff_weights=self.backoff_weights,
+            backoff_id=np.array(self.backoff_id, dtype=np.int64),
+        )
+        atomic_save(arrays, filename, save=lambda obj, f: np.savez(f, **obj))
+
+    @staticmethod
+    def load(filename: str, mmap: bool = True) -> "CompiledNgramLm":
+        """Load a .npz file written by :meth:`save`.
+
+        Args:
+          filename:
+            Path to the .npz file.
+          mmap:
+            True to memory-map the arrays, so that several processes
+            loading the same file share one copy of it in memory.
+        """
+        if mmap:
+            arrays = _load_npz_with_mmap(filename)
+        else:
+            with np.load(filename) as f:
+                arrays = dict(f)
+        backoff_id = int(arrays.pop("backoff_id"))
+        return CompiledNgramLm(arrays, backoff_id=backoff_id)
+
+    @staticmethod
+    def load_or_compile(
+        fst_filename: str,
+        backoff_id: int,
+        is_binary: bool = False,
+        cache_filename: Optional[str] = None,
+    ) -> "CompiledNgramLm":
+        """Load the compiled LM from `cache_filename` if it exists and is
+        newer than `fst_filename`. Otherwise, load the FST with
+        :class:`NgramLm`, compile it and save the result to `cache_filename`.
+
+        Args:
+          fst_filename:
+            Path to the FST.
+          backoff_id:
+            ID of the backoff symbol.
+          is_binary:
+            True if the given file is a binary FST.
+          cache_filename:
+            If not None, path to the .npz file to cache the compiled LM.
+        """
+        if (
+            cache_filename is not None
+            and os.path.isfile(cache_filename)
+            and os.path.getmtime(cache_filename) >= os.path.getmtime(fst_filename)
+        ):
+            logging.info(f"Loading compiled n-gram LM from {cache_filename}")
+            ans = CompiledNgramLm.load(cache_filename)
+            assert ans.backoff_id == backoff_id, (ans.backoff_id, backoff_id)
+            return ans
+
+        ngram_lm = NgramLm(fst_filename, backoff_id=backoff_id, is_binary=is_binary)
+        ans = CompiledNgramLm.from_ngram_lm(ngram_lm)
+        if cache_filename is not None:
+            logging.info(f"Saving compiled n-gram LM to {cache_filename}")
+            ans.save(cache_filename)
+        return ans
+
+    def _find_arcs(
+        self, states: np.ndarray, labels: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Vectorized binary search for the arcs with the given ilabels
+        leaving the given states.
+
+        Args:
+          states:
+            A 1-D int64 array of states.
+          labels:
+            A 1-D int64 array of the same shape as `states`.
+        Returns:
+          Return a tuple of two 1-D arrays:
+            - arc indexes. Valid only where `found` is True.
+            - found, a bool array.
+        """
+        begin = self.arc_offsets[states]
+        end = self.arc_offsets[states + 1]
+        if self.num_arcs == 0:
+            return begin, np.zeros(states.shape, dtype=bool)
+
+        # Find the first arc whose ilabel is not less than the label
+        # within [begin, end) for all states at once
+        left = begin.copy()
+        right = end.copy()
+        while True:
+            active = left < right
+            if not active.any():
+                break
+            mid = (left + right) // 2
+            go_right = self.ilabels[np.minimum(mid, self.num_arcs - 1)] < labels
+            left = np.where(active & go_right, mid + 1, left)
+            right = np.where(active & ~go_right, mid, right)
+
+        found = left < end
+        found &= self.ilabels[np.minimum(left, self.num_arcs - 1)] == labels
+        return left, found
+
+    def batch_next_state(
+        self,
+        states: Union[List[int], np.ndarray],
+        labels: Union[List[int], np.ndarray],
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Advance many states at once, following backoff arcs until an arc
+        with the given label is found, i.e., the usual deterministic
+        semantics of a backoff n-gram LM.
+
+        Args:
+          states:
+            A 1-D array of states, e.g., one per hypothesis.
+          labels:
+            A 1-D array of the same shape as `states`.
+        Returns:
+          Return a tuple of two 1-D arrays with the same shape as `states`:
+            - next_states, a int64 array. It is -1 if the label cannot be
+              accepted even after following all backoff arcs.
+            - costs, a float32 array containing the cost of the arc plus
+              the costs of the backoff arcs followed. It is inf where
+              next_states is -1.
+        """
+        states = np.asarray(states, dtype=np.int64)
+        labels = np.asarray(labels, dtype=np.int64)
+        assert states.shape == labels.shape, (states.shape, labels.shape)
+        assert states.ndim == 1, states.shape
+
+        next_states = np.full(states.shape, -1, dtype=np.int64)
+        costs = np.zeros(states.shape, dtype=np.float32)
+
+        # indexes of entries that have not found their arcs yet
+        pending = np.arange(states.shape[0])
+        cur_states = states.copy()
+        while pending.size > 0:
+            arcs, found = self._find_arcs(cur_states[pending], labels[pending])
+
+            done = pending[found]
+            next_states[done] = self.next_states[arcs[found]]
+            costs[done] += self.weights[arcs[found]]
+
+            pending = pending[~found]
+            backoff_states = self.backoff_states[cur_states[pending]]
+            has_backoff = backoff_states >= 0
+
+            costs[pending[~has_backoff]] = float("inf")
+
+            costs[pending[has_backoff]] += self.backoff_weights[
+                cur_states[pending[has_backoff]]
+            ]
+            pending = pending[has_backoff]
+            cur_states[pending] = backoff_states[has_backoff]
+
+        return next_states, costs
+
+    def forward_state_costs(
+        self,
+        row_ids: np.ndarray,
+        states: np.ndarray,
+        costs: np.ndarray,
+        labels: np.ndarray,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Advance the sets of (state, cost) pairs of many rows, e.g., one
+        row per hypothesis, by one label each. It has the same semantics as
+        :meth:`NgramLmStateCost.forward_one_step`, i.e., the label is looked
+        up from every state reachable via backoff arcs and the minimum cost
+        of each next state is kept.
+
+        Args:
+          row_ids:
+            A 1-D int64 array. row_ids[i] is the row of the i-th pair.
+          states:
+            A 1-D int64 array of the same shape as `row_ids`.
+          costs:
+            A 1-D float64 array of the same shape as `row_ids`.
+          labels:
+            A 1-D int64 array. labels[r] is the label of row r.
+        Returns:
+          Return a tuple (row_ids, states, costs) of the next pairs, sorted
+          by row and then by state, with one pair per distinct next state
+          of a row. Rows that cannot accept their labels have no pairs.
+        """
+        ans_row_ids = []
+        ans_states = []
+        ans_costs = []
+        while row_ids.size > 0:
+            arcs, found = self._find_arcs(states, labels[row_ids])
+            arcs = arcs[found]
+            next_states = self.next_states[arcs].astype(np.int64)
+            # Like NgramLm.get_next_state_and_cost, arcs entering the start
+            # state are ignored
+            keep = next_states != 0
+            ans_row_ids.append(row_ids[found][keep])
+            ans_states.append(next_states[keep])
+            ans_costs.append((costs[found] + self.weights[arcs])[keep])
+
+            backoff_states = self.backoff_states[states]
+            has_backoff = backoff_states >= 0
+            row_ids = row_ids[has_backoff]
+            costs = costs[has_backoff] + self.backoff_weights[states[has_backoff]]
+            states = backoff_states[has_backoff].astype(np.int64)
+
+        row_ids = np.concatenate(ans_row_ids) if ans_row_ids else row_ids
+        states = np.concatenate(ans_states) if ans_states else states
+        costs = np.concatenate(ans_costs) if ans_costs else costs
+        if row_ids.size == 0:
+            return row_ids, states, costs
+
+        order = np.lexsort((states, row_ids))
+        row_ids, states, costs = row_ids[order], states[order], costs[order]
+        is_first = np.ones(row_ids.shape, dtype=bool)
+        is_first[1:] = (row_ids[1:] != row_ids[:-1]) | (states[1:] != states[:-1])
+        first = np.flatnonzero(is_first)
+        return row_ids[first], states[first], np.minimum.reduceat(costs, first)
+
+
 class NgramLmStateCost:
     def __init__(self, ngram_lm: NgramLm, state_cost: Optional[dict] = None):
         assert ngram_lm.lm.start == 0, ngram_lm.lm.start
@@ -163,9 +524,94 @@ class NgramLmStateCost:
 
         return NgramLmStateCost(ngram_lm=self.ngram_lm, state_cost=state_cost)
 
+    @staticmethod
+    def forward_one_step_batch(
+        state_costs: List["NgramLmStateCost"], labels: List[int]
+    ) -> List["NgramLmStateCost"]:
+        """Call :meth:`forward_one_step` of each of the given objects."""
+        return [s.forward_one_step(label) for s, label in zip(state_costs, labels)]
+
     @property
     def lm_score(self) -> float:
         if len(self.state_cost) == 0:
             return float("-inf")
 
         return -1 * min(self.state_cost.values())
+
+
+class CompiledNgramLmStateCost:
+    def __init__(
+        self,
+        ngram_lm: CompiledNgramLm,
+        states: Optional[np.ndarray] = None,
+        costs: Optional[np.ndarray] = None,
+    ):
+        """
+        The same as :class:`NgramLmStateCost`, but for a
+        :class:`CompiledNgramLm`. Use :meth:`forward_one_step_batch` to
+        advance many hypotheses with a single vectorized lookup.
+
+        Args:
+          ngram_lm:
+            The compiled n-gram LM.
+          states:
+            A 1-D int64 array of the reachable states.
+          costs:
+            A 1-D float64 array of the costs of `states`.
+        """
+        self.ngram_lm = ngram_lm
+        if states is not None:
+            self.states = states
+            self.costs = costs
+        else:
+            # At the very beginning, we are at the start state with cost 0
+            self.states = np.zeros(1, dtype=np.int64)
+            self.costs = np.zeros(1, dtype=np.float64)
+
+    @property
+    def state_cost(self) -> Dict[int, float]:
+        return dict(zip(self.states.tolist(), self.costs.tolist()))
+
+    def forward_one_step(self, label: int) -> "CompiledNgramLmStateCost":
+        return CompiledNgramLmStateCost.forward_one_step_batch([self], [label])[0]
+
+    @staticmethod
+    def forward_one_step_batch(
+        state_costs: List["CompiledNgramLmStateCost"], labels: List[int]
+    ) -> List["CompiledNgramLmStateCost"]:
+        """Advance each of the given objects by the corresponding label with
+        a single call of :meth:`CompiledNgramLm.forward_state_costs`.
+
+        Args:
+          state_costs:
+            A list of objects sharing the same LM.
+          labels:
+            A list of labels, one per object.
+        Returns:
+          Return a list of new objects, one per object in `state_costs`.
+        """
+        assert len(state_costs) == len(labels), (len(state_costs), len(labels))
+        if len(state_costs) == 0:
+            return []
+
+        ngram_lm = state_costs[0].ngram_lm
+        sizes = [s.states.shape[0] for s in state_costs]
+        row_ids, states, costs = ngram_lm.forward_state_costs(
+            row_ids=np.repeat(np.arange(len(state_costs)), sizes),
+            states=np.concatenate([s.states for s in state_costs]),
+            costs=np.concatenate([s.costs for s in state_costs]),
+            labels=np.asarray(labels, dtype=np.int64),
+        )
+
+        splits = np.searchsorted(row_ids, np.arange(1, len(state_costs)))
+        return [
+            CompiledNgramLmStateCost(ngram_lm, states=s, costs=c)
+            for s, c in zip(np.split(states, splits), np.split(costs, splits))
+        ]
+
+    @property
+    def lm_score(self) -> float:
+        if self.costs.shape[0] == 0:
+            return float("-inf")
+
+        return -1 * float(self.costs.min())
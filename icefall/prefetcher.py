@@ -0,0 +1,142 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import Any, Iterable, Iterator, Union
+
+import torch
+
+
+def _to_device(batch: Any, device: torch.device, pin_memory: bool) -> Any:
+    """Move all tensors in a (nested) batch to the given device. Other
+    objects, e.g., texts and cuts, are returned as they are."""
+    if isinstance(batch, torch.Tensor):
+        if pin_memory and batch.device.type == "cpu":
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=pin_memory)
+    elif isinstance(batch, dict):
+        return {k: _to_device(v, device, pin_memory) for k, v in batch.items()}
+    elif isinstance(batch, (list, tuple)) and not isinstance(batch, str):
+        return type(batch)(_to_device(v, device, pin_memory) for v in batch)
+    else:
+        return batch
+
+
+def _record_stream(batch: Any, stream: "torch.cuda.Stream") -> None:
+    """Tell the caching allocator that the tensors of a batch, which are
+    allocated on a side stream, are used on the given stream."""
+    if isinstance(batch, torch.Tensor):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)) and not isinstance(batch, str):
+        for v in batch:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher(object):
+    """Wrap a dataloader so that the tensors of its batches are moved to
+    the given device one batch ahead.
+
+    On CUDA, the tensors of the next batch are copied to pinned memory and
+    then to the GPU with non-blocking copies on a side stream, while the
+    model is processing the current batch on the current stream. On other
+    devices, e.g., CPU, it moves the tensors in the main thread when a batch
+    is requested, i.e., it is a plain passthrough for CPU.
+
+    Usage::
+
+        for batch_idx, batch in enumerate(DevicePrefetcher(train_dl, device)):
+            ...
+    """
+
+    def __init__(self, dataloader: Iterable, device: Union[str, torch.device]):
+        """
+        Args:
+          dataloader:
+            An iterable of batches, e.g., a `torch.utils.data.DataLoader`.
+            A batch can be a tensor, or a dict, list or tuple of them, which
+            may also contain other objects.
+          device:
+            The device to move the tensors to.
+        """
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(device=self.device)
+        else:
+            self.stream = None
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    def __iter__(self) -> Iterator[Any]:
+        if self.stream is None:
+            for batch in self.dataloader:
+                yield _to_device(batch, self.device, pin_memory=False)
+            return
+
+        iterator = iter(self.dataloader)
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            _record_stream(batch, current_stream)
+
+            # Start copying the next batch before the current one is used
+            next_batch = self._preload(iterator)
+            yield batch
+
+    def _preload(self, iterator: Iterator[Any]) -> Any:
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            return _to_device(batch, self.device, pin_memory=True)
+
+
+class TokenizedDataset(torch.utils.data.Dataset):
+    """Wrap a dataset returning batches of `K2SpeechRecognitionDataset`
+    to encode `batch["supervisions"]["text"]` with a sentencepiece model.
+    The token IDs are saved in `batch["supervisions"]["token_ids"]`.
+
+    Since the dataset is called in the dataloader workers, the main process
+    does not need to encode the texts of each batch.
+    """
+
+    def __init__(self, dataset: torch.utils.data.Dataset, sp):
+        """
+        Args:
+          dataset:
+            The dataset to wrap.
+          sp:
+            A `sentencepiece.SentencePieceProcessor`, or any object with an
+            `encode(texts, out_type=int)` method. It is copied to the workers.
+        """
+        self.dataset = dataset
+        self.sp = sp
+
+    def __getitem__(self, index: Any) -> dict:
+        batch = self.dataset[index]
+        supervisions = batch["supervisions"]
+        supervisions["token_ids"] = self.sp.encode(supervisions["text"], out_type=int)
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.dataset)
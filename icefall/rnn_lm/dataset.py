@@ -14,14 +14,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Tuple
+import json
+import logging
+import resource
+import time
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
 
 import k2
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 
-from icefall.utils import AttributeDict, add_eos, add_sos
+from icefall.utils import AttributeDict, add_eos, add_sos, atomic_save
 
 
 class LmDataset(torch.utils.data.Dataset):
@@ -115,6 +122,168 @@ class LmDataset(torch.utils.data.Dataset):
         return sentence_tokens
 
 
+class LmShards(object):
+    """An LM corpus saved in shards by :meth:`write_shard` and
+    :meth:`write_index`, in a directory containing:
+
+        - shard-XXXXX.tokens.npy: the BPE tokens of all sentences of the
+          shard, concatenated, as int32
+        - shard-XXXXX.offsets.npy: an int64 array of num_sentences + 1
+          entries; the tokens of the i-th sentence of the shard are
+          tokens[offsets[i]:offsets[i+1]]
+        - index.json: the names and sizes of the shards. It is written
+          after all shards, so a directory without it is incomplete.
+
+    The sentences of each shard are sorted by length in descending order.
+    The files are memory-mapped, so the corpus is neither loaded into nor
+    copied to each process; only the tokens of the batches being used are
+    read from the page cache.
+    """
+
+    def __init__(self, lm_dir: Union[str, Path]):
+        self.lm_dir = Path(lm_dir)
+        with open(self.lm_dir / "index.json") as f:
+            self.shards = json.load(f)["shards"]
+        self.tokens = None
+
+    def __getstate__(self):
+        # Each dataloader worker memory-maps the files on its own
+        state = self.__dict__.copy()
+        state["tokens"] = None
+        state["offsets"] = None
+        return state
+
+    def _load(self) -> None:
+        self.tokens = []
+        self.offsets = []
+        for shard in self.shards:
+            name = shard["name"]
+            d = self.lm_dir
+            self.tokens.append(np.load(d / f"{name}.tokens.npy", mmap_mode="r"))
+            self.offsets.append(np.load(d / f"{name}.offsets.npy", mmap_mode="r"))
+
+    def __len__(self) -> int:
+        """Return the number of shards."""
+        return len(self.shards)
+
+    def get_offsets(self, shard: int) -> np.ndarray:
+        if self.tokens is None:
+            self._load()
+        return self.offsets[shard]
+
+    def get_sentences(self, shard: int, start: int, end: int) -> k2.RaggedTensor:
+        """Return a ragged tensor with 2 axes [sentence][token] containing the
+        sentences start, start + 1, ..., end - 1 of the given shard."""
+        offsets = self.get_offsets(shard)[start : end + 1]
+        tokens = self.tokens[shard][offsets[0] : offsets[-1]]
+        row_splits = torch.from_numpy((offsets - offsets[0]).astype(np.int32))
+        shape = k2.ragged.create_ragged_shape2(
+            row_splits=row_splits, cached_tot_size=tokens.size
+        )
+        # Copy the tokens out of the memory-mapped file
+        return k2.RaggedTensor(shape, torch.from_numpy(np.array(tokens)))
+
+    @staticmethod
+    def write_shard(
+        lm_dir: Union[str, Path], index: int, sentences: List[List[int]]
+    ) -> Dict[str, Union[str, int]]:
+        """Save the given sentences, each a list of BPE tokens, as the index-th
+        shard in lm_dir. Return the entry of the shard in index.json."""
+        lm_dir = Path(lm_dir)
+        name = f"shard-{index:05d}"
+
+        lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+        order = np.argsort(-lengths, kind="stable")
+        offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+        np.cumsum(lengths[order], out=offsets[1:])
+        tokens = np.fromiter(
+            (t for i in order for t in sentences[i]),
+            dtype=np.int32,
+            count=int(offsets[-1]),
+        )
+
+        np.save(lm_dir / f"{name}.tokens.npy", tokens)
+        np.save(lm_dir / f"{name}.offsets.npy", offsets)
+        return {
+            "name": name,
+            "num_sentences": len(sentences),
+            "num_tokens": int(offsets[-1]),
+        }
+
+    @staticmethod
+    def write_index(
+        lm_dir: Union[str, Path], shards: List[Dict[str, Union[str, int]]]
+    ) -> None:
+        """Save index.json of the shards returned by :meth:`write_shard`."""
+        atomic_save(
+            {"shards": shards},
+            Path(lm_dir) / "index.json",
+            save=partial(json.dump, indent=2),
+            mode="w",
+        )
+
+
+class ShardedLmDataset(torch.utils.data.Dataset):
+    def __init__(
+        self,
+        lm_dir: Union[str, Path],
+        max_sent_len: int,
+        batch_size: int,
+    ):
+        """
+        The same as :class:`LmDataset`, but the sentences are read from
+        the memory-mapped shards of :class:`LmShards`.
+
+        Args:
+          lm_dir:
+            The directory containing the shards, e.g., generated by
+            `../local/prepare_lm_shards.py`.
+          max_sent_len:
+            Maximum sentence length. It is used to change the batch size
+            dynamically. See :class:`LmDataset`.
+          batch_size:
+            The expected batch size. It is changed dynamically according
+            to the "max_sent_len".
+
+        The batches are formed within each shard from the offsets only, in
+        the same way as :class:`LmDataset`. Since the sentences of a shard
+        are sorted by length, each batch is a range of sentences of a shard,
+        so the batches are kept in an array of (shard, start, end).
+        """
+        super().__init__()
+        assert batch_size > 0, batch_size
+        assert max_sent_len > 1, max_sent_len
+
+        self.shards = LmShards(lm_dir)
+
+        batches = []
+        for shard in range(len(self.shards)):
+            offsets = self.shards.get_offsets(shard)
+            num_sentences = len(offsets) - 1
+            cur = 0
+            while cur < num_sentences:
+                sentence_length = int(offsets[cur + 1] - offsets[cur])
+                sz = sentence_length // max_sent_len + 1
+                actual_batch_size = min(batch_size // sz + 1, batch_size)
+                end = min(cur + actual_batch_size, num_sentences)
+                batches.append((shard, cur, end))
+                cur = end
+
+        self.batches = np.array(batches, dtype=np.int64).reshape(-1, 3)
+
+    def __len__(self) -> int:
+        """Return number of batches in this dataset"""
+        return len(self.batches)
+
+    def __getitem__(self, i: int) -> k2.RaggedTensor:
+        """Get the i'th batch in this dataset
+        Return a ragged tensor with 2 axes [sentence][token].
+        """
+        assert 0 <= i < len(self), i
+        shard, start, end = self.batches[i].tolist()
+        return self.shards.get_sentences(shard, start, end)
+
+
 class LmDatasetCollate:
     def __init__(self, sos_id: int, eos_id: int, blank_id: int):
         """
@@ -172,7 +341,10 @@ def get_dataloader(
     Args:
       filename:
         Path to the file containing LM data. The file is assumed to
-        be generated by `../local/sort_lm_training_data.py`.
+        be generated by `../local/sort_lm_training_data.py`. If it is a
+        directory, it should contain the shards generated by
+        `../local/prepare_lm_shards.py`, which are memory-mapped
+        instead of being loaded into memory.
       is_distributed:
         True if using DDP training. False otherwise.
       params:
@@ -180,19 +352,34 @@ def get_dataloader(
     Returns:
       Return a dataloader containing the LM data.
     """
-    lm_data = torch.load(filename)
-
-    words = lm_data["words"]
-    sentences = lm_data["sentences"]
-    sentence_lengths = lm_data["sentence_lengths"]
-
-    dataset = LmDataset(
-        sentences=sentences,
-        words=words,
-        sentence_lengths=sentence_lengths,
-        max_sent_len=params.max_sent_len,
-        batch_size=params.batch_size,
+    start = time.time()
+    if Path(filename).is_dir():
+        dataset = ShardedLmDataset(
+            lm_dir=filename,
+            max_sent_len=params.max_sent_len,
+            batch_size=params.batch_size,
+        )
+    else:
+        lm_data = torch.load(filename)
+
+        words = lm_data["words"]
+        sentences = lm_data["sentences"]
+        sentence_lengths = lm_data["sentence_lengths"]
+
+        dataset = LmDataset(
+            sentences=sentences,
+            words=words,
+            sentence_lengths=sentence_lengths,
+            max_sent_len=params.max_sent_len,
+            batch_size=params.batch_size,
+        )
+    # ru_maxrss is in KB on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    logging.info(
+        f"Loaded {len(dataset)} batches from {filename} in "
+        f"{time.time() - start:.1f} s. Peak resident memory: {max_rss:.0f} MB"
     )
+
     if is_distributed:
         sampler = DistributedSampler(dataset, shuffle=True, drop_last=True)
     else:
@@ -15,12 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import tempfile
+
 import k2
 import torch
-from rnn_lm.dataset import LmDataset, LmDatasetCollate
+from rnn_lm.dataset import LmDataset, LmDatasetCollate, LmShards, ShardedLmDataset
 
 
-def main():
+def test_lm_dataset():
     sentences = k2.RaggedTensor(
         [[0, 1, 2], [1, 0, 1], [0, 1], [1, 3, 0, 2, 0], [3], [0, 2, 1]]
     )
@@ -67,5 +69,51 @@ def main():
     # I've checked the output manually; the output is as expected.
 
 
+def test_sharded_lm_dataset():
+    sentences = [[3, 6, 2], [2, 8, 9, 3, 5], [5], [5, 6, 7, 8, 9, 3, 6], [9, 2]]
+
+    with tempfile.TemporaryDirectory() as lm_dir:
+        shards = [LmShards.write_shard(lm_dir, 0, sentences)]
+        LmShards.write_index(lm_dir, shards)
+        dataset = ShardedLmDataset(lm_dir, max_sent_len=3, batch_size=4)
+
+        # The sentences are sorted by length in the shard, so the batches are
+        # the same as LmDataset with sorted sentences
+        sorted_sentences = sorted(sentences, key=len, reverse=True)
+        expected = LmDataset(
+            sentences=k2.RaggedTensor([[i] for i in range(len(sentences))]),
+            words=k2.RaggedTensor(sorted_sentences),
+            sentence_lengths=torch.tensor([len(s) for s in sorted_sentences]),
+            max_sent_len=3,
+            batch_size=4,
+        )
+        assert len(dataset) == len(expected), (len(dataset), len(expected))
+        for i in range(len(dataset)):
+            assert dataset[i].tolist() == expected[i].tolist(), i
+
+        # Two shards
+        shards = [
+            LmShards.write_shard(lm_dir, 0, sentences[:2]),
+            LmShards.write_shard(lm_dir, 1, sentences[2:]),
+        ]
+        LmShards.write_index(lm_dir, shards)
+        dataset = ShardedLmDataset(lm_dir, max_sent_len=3, batch_size=4)
+        batches = [s for i in range(len(dataset)) for s in dataset[i].tolist()]
+        assert sorted(batches) == sorted(sentences), batches
+
+        collate_fn = LmDatasetCollate(sos_id=1, eos_id=-1, blank_id=0)
+        dataloader = torch.utils.data.DataLoader(
+            dataset, batch_size=1, collate_fn=collate_fn, num_workers=2
+        )
+        for x, y, lengths in dataloader:
+            assert x.shape == y.shape, (x.shape, y.shape)
+            assert x.size(0) == lengths.numel(), (x.shape, lengths)
+
+
+def main():
+    test_lm_dataset()
+    test_sharded_lm_dataset()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,176 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Optional
+
+import torch
+
+
+class StatePool(object):
+    """A pool of model states for streaming decoding.
+
+    Instead of keeping a list of tensors per stream and stacking them into
+    a batch for every chunk (see `stack_states()` and `unstack_states()` in
+    the streaming recipes), the states of all streams are kept in
+    preallocated tensors with `max_streams` entries along the batch
+    dimension. Each stream owns a slot, i.e., an index into that dimension.
+
+    The batched states of the last decoded chunk are kept as they are. As
+    long as the same streams are decoded in the same order, which is the
+    common case, they are passed to the model again without any copy. Only
+    when the set of active streams changes, the batched states are written
+    back to their slots and the states of the new set are gathered by index.
+
+    Usage::
+
+        pool = StatePool(get_init_states(model, batch_size=1), batch_dims, 100)
+        slot = pool.allocate()  # when a stream starts
+        ...
+        states = pool.get_batch_states(slots)
+        encoder_out, encoder_out_lens, new_states = streaming_forward(states, ...)
+        pool.set_batch_states(slots, new_states)
+        ...
+        pool.free(slot)  # when a stream finishes
+    """
+
+    def __init__(
+        self,
+        init_states: List[torch.Tensor],
+        batch_dims: List[int],
+        max_streams: int,
+    ):
+        """
+        Args:
+          init_states:
+            The initial states of a single stream, i.e., with batch size 1.
+            A new stream starts from these states.
+          batch_dims:
+            batch_dims[i] is the batch dimension of init_states[i].
+          max_streams:
+            The maximum number of streams that can be active at the same
+            time.
+        """
+        assert len(init_states) == len(batch_dims), (
+            len(init_states),
+            len(batch_dims),
+        )
+        assert max_streams > 0, max_streams
+        for s, d in zip(init_states, batch_dims):
+            assert s.size(d) == 1, (s.shape, d)
+
+        self.init_states = init_states
+        self.batch_dims = batch_dims
+        self.max_streams = max_streams
+        self.device = init_states[0].device
+
+        self.pool = [
+            s.repeat_interleave(max_streams, dim=d)
+            for s, d in zip(init_states, batch_dims)
+        ]
+
+        # Reverse the order so that slots are allocated from 0
+        self._free_slots = list(range(max_streams - 1, -1, -1))
+
+        # Slots of the batched states of the last chunk. An entry is
+        # set to None when its slot is freed, so that it is not written back.
+        self._active_slots: Optional[List[Optional[int]]] = None
+        self._active_states: Optional[List[torch.Tensor]] = None
+
+    @property
+    def num_free_slots(self) -> int:
+        return len(self._free_slots)
+
+    def allocate(self) -> int:
+        """Allocate a slot for a new stream and reset it to the initial states.
+
+        Returns:
+          Return the index of the slot.
+        """
+        assert len(self._free_slots) > 0, "No free slots, increase max_streams"
+        slot = self._free_slots.pop()
+        for p, s, d in zip(self.pool, self.init_states, self.batch_dims):
+            p.narrow(d, slot, 1).copy_(s)
+        return slot
+
+    def free(self, slot: int) -> None:
+        """Release the slot of a finished stream."""
+        assert 0 <= slot < self.max_streams, slot
+        assert slot not in self._free_slots, f"Slot {slot} is not allocated"
+        if self._active_slots is not None:
+            self._active_slots = [None if s == slot else s for s in self._active_slots]
+        self._free_slots.append(slot)
+
+    def get_batch_states(self, slots: List[int]) -> List[torch.Tensor]:
+        """Return the batched states of the given slots.
+
+        Args:
+          slots:
+            The slots of the streams to decode. The i-th entry of the
+            batch dimension of the returned states belongs to slots[i].
+        Returns:
+          Return a list of tensors, with the same layout as the `init_states`
+          passed to the constructor, except that the batch dimension has
+          size len(slots).
+        """
+        if self._active_slots == slots:
+            return self._active_states
+
+        self._flush()
+
+        index = torch.tensor(slots, dtype=torch.int64, device=self.device)
+        return [p.index_select(d, index) for p, d in zip(self.pool, self.batch_dims)]
+
+    def set_batch_states(self, slots: List[int], states: List[torch.Tensor]) -> None:
+        """Set the batched states of the given slots, usually the states
+        returned by the model for the states from :meth:`get_batch_states`.
+
+        The states are not copied into the pool until the set of active
+        streams changes.
+        """
+        assert len(states) == len(self.pool), (len(states), len(self.pool))
+        self._active_slots = list(slots)
+        self._active_states = states
+
+    def get_states(self, slot: int) -> List[torch.Tensor]:
+        """Return the states of a single stream, with batch size 1."""
+        self._flush()
+        return [p.narrow(d, slot, 1) for p, d in zip(self.pool, self.batch_dims)]
+
+    def _flush(self) -> None:
+        """Write the batched states of the last chunk back to their slots."""
+        if self._active_slots is None:
+            return
+
+        active_slots = self._active_slots
+        active_states = self._active_states
+        self._active_slots = None
+        self._active_states = None
+
+        keep = [i for i, s in enumerate(active_slots) if s is not None]
+        if len(keep) == 0:
+            return
+
+        dst_index = torch.tensor(
+            [active_slots[i] for i in keep], dtype=torch.int64, device=self.device
+        )
+        src_index = torch.tensor(keep, dtype=torch.int64, device=self.device)
+
+        for p, s, d in zip(self.pool, active_states, self.batch_dims):
+            if len(keep) < s.size(d):
+                s = s.index_select(d, src_index)
+            # The model may promote the dtype, e.g., processed_lens of
+            # zipformer is int32 initially, but int64 after the first chunk.
+            p.index_copy_(d, dst_index, s.to(p.dtype))
@@ -161,6 +161,85 @@ class RelPositionMultiheadAttention(nn.Module):
             left_context=left_context,
         )
 
+    def streaming_forward(
+        self,
+        x: Tensor,
+        pos_emb: Tensor,
+        cached_key: Tensor,
+        cached_val: Tensor,
+        mask: Optional[Tensor] = None,
+    ) -> Tuple[Tensor, Tensor, Tensor]:
+        """Self-attention of new frames over the projected keys and values
+        of the previous frames, which are cached, and of the new frames.
+
+        Args:
+          x:
+            The new frames, of shape (T, N, E).
+          pos_emb:
+            Positional embedding of shape (1, S+2*T-1, E), i.e., the output of
+            `RelPositionalEncoding` with `left_context` being S.
+          cached_key:
+            Keys of the previous frames, of shape (S, N, E).
+          cached_val:
+            Values of the previous frames, of shape (S, N, E).
+          mask:
+            A bool tensor of shape (N, T, S+T). True means the corresponding
+            key is not allowed to be attended to by the corresponding query.
+        Returns:
+          Return a tuple of 3 tensors:
+            - The attention output, of shape (T, N, E).
+            - The keys of the previous and new frames, of shape (S+T, N, E).
+            - The values of the previous and new frames, of shape (S+T, N, E).
+        """
+        tgt_len, bsz, embed_dim = x.shape
+        left_context = cached_key.size(0)
+        num_heads = self.num_heads
+        head_dim = embed_dim // num_heads
+        scaling = float(head_dim) ** -0.5
+
+        q, k, v = nn.functional.linear(
+            x, self.in_proj.get_weight(), self.in_proj.get_bias()
+        ).chunk(3, dim=-1)
+        k = torch.cat([cached_key, k], dim=0)
+        v = torch.cat([cached_val, v], dim=0)
+        src_len = k.size(0)
+
+        q = (q * scaling).contiguous().view(tgt_len, bsz, num_heads, head_dim)
+        q = q.transpose(0, 1)  # (batch, time1, head, d_k)
+        k_ = k.contiguous().view(src_len, bsz, num_heads, head_dim)
+        k_ = k_.permute(1, 2, 3, 0)  # (batch, head, d_k, time2)
+        v_ = v.contiguous().view(src_len, bsz * num_heads, head_dim).transpose(0, 1)
+
+        p = self.linear_pos(pos_emb).view(pos_emb.size(0), -1, num_heads, head_dim)
+        p = p.permute(0, 2, 3, 1)
+
+        q_with_bias_u = (q + self._pos_bias_u()).transpose(1, 2)
+        q_with_bias_v = (q + self._pos_bias_v()).transpose(1, 2)
+
+        matrix_ac = torch.matmul(q_with_bias_u, k_)
+        matrix_bd = torch.matmul(q_with_bias_v, p)
+        matrix_bd = self.rel_shift(matrix_bd, left_context)
+
+        attn_output_weights = matrix_ac + matrix_bd  # (batch, head, time1, time2)
+        if mask is not None:
+            attn_output_weights = attn_output_weights.masked_fill(
+                mask.unsqueeze(1), float("-inf")
+            )
+        attn_output_weights = nn.functional.softmax(attn_output_weights, dim=-1)
+        attn_output_weights = attn_output_weights.view(
+            bsz * num_heads, tgt_len, src_len
+        )
+
+        attn_output = torch.bmm(attn_output_weights, v_)
+        attn_output = (
+            attn_output.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        )
+        attn_output = nn.functional.linear(
+            attn_output, self.out_proj.get_weight(), self.out_proj.get_bias()
+        )
+
+        return attn_output, k, v
+
     def rel_shift(self, x: Tensor, left_context: int = 0) -> Tensor:
         """Compute relative positional encoding.
 
@@ -115,6 +115,69 @@ class Transformer(torch.nn.Module):
         x = x.permute(1, 0, 2)  # (T, N, C) ->(N, T, C)
         return x, x_lens
 
+    def streaming_forward(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        cached_key: torch.Tensor,
+        cached_val: torch.Tensor,
+        cached_lens: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Process new frames given the cached keys and values of all previous
+        frames, so that the cost of a new frame is linear in the number of
+        previous frames, instead of re-encoding the whole sequence.
+
+        Sequences of different lengths are right aligned, i.e., padding
+        frames are on the left. In this way, the relative position between
+        the last frame and a previous frame is the same for all sequences.
+
+        Args:
+          x:
+            The new frames, of shape (N, T, input_dim). If cached_key is not
+            empty, x must not contain padding frames.
+          x_lens:
+            The number of valid frames in x, of shape (N,). Padding frames
+            are on the left.
+          cached_key:
+            Cached keys of shape (num_layers, S, N, d_model).
+          cached_val:
+            Cached values of shape (num_layers, S, N, d_model).
+          cached_lens:
+            The number of valid frames in the cache, of shape (N,).
+        Returns:
+          Return a tuple of 4 tensors:
+            - The output of shape (N, T, d_model).
+            - The updated cached_key, of shape (num_layers, S+T, N, d_model).
+            - The updated cached_val, of shape (num_layers, S+T, N, d_model).
+            - The updated cached_lens, of shape (N,).
+        """
+        batch_size, num_frames, _ = x.shape
+        left_context = cached_key.size(1)
+
+        new_lens = cached_lens + x_lens
+        total = left_context + num_frames
+        positions = torch.arange(total, device=x.device)
+        # (N, S+T), True for padding frames
+        key_padding_mask = positions.unsqueeze(0) < (total - new_lens).unsqueeze(1)
+        # (T, S+T), True for future frames
+        causal_mask = positions.unsqueeze(0) > positions[left_context:].unsqueeze(1)
+        mask = key_padding_mask.unsqueeze(1) | causal_mask.unsqueeze(0)
+        # A padding frame attends to itself only, so that its output is
+        # not NaN. It is never attended to by valid frames.
+        mask[:, range(num_frames), range(left_context, total)] = False
+
+        x = self.norm_before(self.embed(x))
+
+        x, pos_emb = self.encoder_pos(x, left_context=left_context)
+        x = x.permute(1, 0, 2)
+
+        x, cached_key, cached_val = self.encoder.streaming_forward(
+            x, pos_emb, cached_key, cached_val, mask
+        )
+
+        x = x.permute(1, 0, 2)  # (T, N, C) ->(N, T, C)
+        return x, cached_key, cached_val, new_lens
+
 
 class TransformerEncoder(torch.nn.Module):
     def __init__(self, encoder_layer: torch.nn.Module, num_layers: int) -> None:
@@ -160,6 +223,43 @@ class TransformerEncoder(torch.nn.Module):
 
         return output
 
+    def streaming_forward(
+        self,
+        src: torch.Tensor,
+        pos_emb: torch.Tensor,
+        cached_key: torch.Tensor,
+        cached_val: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            src: the new frames, of shape (T, N, C).
+            pos_emb: Positional embedding tensor (required).
+            cached_key: cached keys of all layers, (num_layers, S, N, C).
+            cached_val: cached values of all layers, (num_layers, S, N, C).
+            mask: the mask of shape (N, T, S+T), True for masked keys.
+
+        Returns:
+            output, and the updated cached_key and cached_val,
+            of shape (num_layers, S+T, N, C)
+        """
+        output = src
+
+        new_cached_key = []
+        new_cached_val = []
+        for layer_index, mod in enumerate(self.layers):
+            output, key, val = mod.streaming_forward(
+                output,
+                pos_emb,
+                cached_key=cached_key[layer_index],
+                cached_val=cached_val[layer_index],
+                mask=mask,
+            )
+            new_cached_key.append(key)
+            new_cached_val.append(val)
+
+        return output, torch.stack(new_cached_key), torch.stack(new_cached_val)
+
 
 class TransformerEncoderLayer(torch.nn.Module):
     def __init__(
@@ -235,6 +335,45 @@ class TransformerEncoderLayer(torch.nn.Module):
 
         return src
 
+    def streaming_forward(
+        self,
+        src: torch.Tensor,
+        pos_emb: torch.Tensor,
+        cached_key: torch.Tensor,
+        cached_val: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Pass the new frames through the encoder layer, attending to the
+        cached keys and values of the previous frames.
+
+        Args:
+            src: the new frames, of shape (T, N, C).
+            pos_emb: Positional embedding tensor (required).
+            cached_key: keys of the previous frames, of shape (S, N, C).
+            cached_val: values of the previous frames, of shape (S, N, C).
+            mask: the mask of shape (N, T, S+T), True for masked keys.
+
+        Returns:
+            output, and the keys and values of the previous and new frames
+        """
+        src_att, key, val = self.self_attn.streaming_forward(
+            src,
+            pos_emb=pos_emb,
+            cached_key=cached_key,
+            cached_val=cached_val,
+            mask=mask,
+        )
+
+        src = src + self.dropout(src_att)
+
+        # feed forward module
+        src = src + self.dropout(self.feed_forward(src))
+
+        src = self.norm_final(self.balancer(src))
+
+        return src, key, val
+
 
 class RelPositionalEncoding(torch.nn.Module):
     """Relative positional encoding module.
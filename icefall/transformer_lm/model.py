@@ -15,7 +15,7 @@
 # limitations under the License.
 
 import logging
-from typing import Optional, Tuple
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn.functional as F
@@ -102,13 +102,137 @@ class TransformerLM(torch.nn.Module):
 
         return nll_loss
 
-    def score_token(self, x: torch.Tensor, x_lens: torch.Tensor, state=None):
-        bs = x.size(0)
+    def score_token(
+        self,
+        x: torch.Tensor,
+        x_lens: torch.Tensor,
+        state: Optional[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+        """Score the next token of the input sequences.
+
+        The returned state contains the keys and values of all tokens seen so
+        far, so that the next call only has to process the new tokens, like
+        the (h, c) of the RNN LM. This makes the cost of scoring a token linear
+        in the length of the history, instead of re-encoding the whole
+        sequence.
+
+        Args:
+          x:
+            If state is None, the whole input sequences, of shape (N, L),
+            padded on the right. Otherwise, the new tokens, of shape (N, T),
+            which are appended to the sequences of the state.
+          x_lens:
+            The number of valid tokens in x, of shape (N,). It is used only
+            when state is None.
+          state:
+            None, or the state returned by a previous call, i.e., a tuple
+            (cached_key, cached_val, cached_lens) with shapes
+            (num_layers, S, N, d_model), (num_layers, S, N, d_model) and (N,).
+            The batch dimension is 2, 2 and 0, respectively. See
+            :meth:`stack_states` and :meth:`get_state`.
+        Returns:
+          Return a tuple containing:
+            - The log-probabilities of the next token, of shape (N, vocab_size).
+            - The updated state.
+        """
+        bs, num_tokens = x.shape
+        if state is None:
+            # Move the padding to the left, so that all sequences end
+            # at the last position. See `Transformer.streaming_forward()`.
+            x_lens = x_lens.to(x.device)
+            index = torch.arange(num_tokens, device=x.device).unsqueeze(0)
+            index = index - (num_tokens - x_lens).unsqueeze(1)
+            x = x.gather(1, index.clamp(min=0))
+
+            num_layers = len(self.encoder.encoder.layers)
+            d_model = self.encoder.d_model
+            cached_key = torch.zeros(
+                num_layers,
+                0,
+                bs,
+                d_model,
+                device=x.device,
+                dtype=self.input_embedding.weight.dtype,
+            )
+            cached_val = torch.zeros_like(cached_key)
+            cached_lens = torch.zeros(bs, dtype=torch.int64, device=x.device)
+        else:
+            x_lens = torch.full((bs,), num_tokens, device=x.device)
+            cached_key, cached_val, cached_lens = state
+
+        x = self.input_embedding(x)
+        x, cached_key, cached_val, cached_lens = self.encoder.streaming_forward(
+            x,
+            x_lens,
+            cached_key=cached_key,
+            cached_val=cached_val,
+            cached_lens=cached_lens,
+        )
+        last_logits = self.output_linear(x[:, -1])
 
-        state = None
-        logits = self.forward(x, x, x_lens, return_logits=True)
-        index = torch.arange(bs)
+        return last_logits.log_softmax(-1), (cached_key, cached_val, cached_lens)
 
-        last_logits = logits[index, x_lens - 1, :]
+    @staticmethod
+    def stack_states(
+        states: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Stack the states of sequences into a batch. The caches are
+        padded on the left to the longest one.
 
-        return last_logits.log_softmax(-1), state
+        Args:
+          states:
+            A list of states returned by :meth:`score_token` or
+            :meth:`get_state`.
+        Returns:
+          Return the state of the batch.
+        """
+        max_len = max(s[0].size(1) for s in states)
+        cached_key = torch.cat(
+            [F.pad(s[0], (0, 0, 0, 0, max_len - s[0].size(1), 0)) for s in states],
+            dim=2,
+        )
+        cached_val = torch.cat(
+            [F.pad(s[1], (0, 0, 0, 0, max_len - s[1].size(1), 0)) for s in states],
+            dim=2,
+        )
+        cached_lens = torch.cat([s[2] for s in states])
+        return cached_key, cached_val, cached_lens
+
+    @staticmethod
+    def get_state(
+        state: Tuple[torch.Tensor, torch.Tensor, torch.Tensor], i: int
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Return the state of the i-th sequence of a batch, with batch size 1.
+        The padding of the cache is removed. No data is copied.
+        """
+        cached_key, cached_val, cached_lens = state
+        length = int(cached_lens[i])
+        start = cached_key.size(1) - length
+        return (
+            cached_key[:, start:, i : i + 1],
+            cached_val[:, start:, i : i + 1],
+            cached_lens[i : i + 1],
+        )
+
+    @staticmethod
+    def select_states(
+        state: Tuple[torch.Tensor, torch.Tensor, torch.Tensor],
+        indexes: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Reorder the sequences of a batch, e.g., by the back-pointers of
+        the surviving hypotheses after pruning a beam.
+
+        Args:
+          state:
+            The state of a batch.
+          indexes:
+            A 1-D tensor. The i-th sequence of the returned state is
+            the indexes[i]-th sequence of the given state.
+        """
+        cached_key, cached_val, cached_lens = state
+        indexes = indexes.to(cached_lens.device)
+        return (
+            cached_key.index_select(2, indexes),
+            cached_val.index_select(2, indexes),
+            cached_lens.index_select(0, indexes),
+        )
@@ -123,14 +123,17 @@ def get_parser():
         "--lm-data",
         type=str,
         default="data/lm_training_bpe_500/sorted_lm_data.pt",
-        help="LM training data",
+        help="""LM training data. It can also be a directory of
+        memory-mapped shards generated by local/prepare_lm_shards.py,
+        e.g., data/lm_training_bpe_500/lm_shards""",
     )
 
     parser.add_argument(
         "--lm-data-valid",
         type=str,
         default="data/lm_training_bpe_500/sorted_lm_data-valid.pt",
-        help="LM validation data",
+        help="""LM validation data. It can also be a directory of
+        memory-mapped shards, e.g., data/lm_training_bpe_500/lm_shards-valid""",
     )
 
     parser.add_argument(
@@ -29,7 +29,18 @@ from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
 from shutil import copyfile
-from typing import Dict, Iterable, List, Optional, TextIO, Tuple, Union
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 import k2
 import k2.version
@@ -1147,14 +1158,143 @@ def write_surt_error_stats(
 
 
 class MetricsTracker(collections.defaultdict):
-    def __init__(self):
+    def __init__(self, device: Optional[torch.device] = None):
+        """
+        Args:
+          device:
+            If not None, the tracker is in the device-resident mode. The
+            values, which can be tensors on the device with a single element,
+            are accumulated in a preallocated tensor on the device, so that
+            setting and adding them does not wait for the device. They are
+            copied to Python numbers, at the cost of one synchronization, only
+            when they are read, e.g., for logging or :meth:`reduce`.
+        """
         # Passing the type 'int' to the base-class constructor
         # makes undefined items default to int() which is zero.
         # This class will play a role as metrics tracker.
         # It can record many metrics, including but not limited to loss.
         super(MetricsTracker, self).__init__(int)
+        self.device = None if device is None else torch.device(device)
+        # The following are used only in the device-resident mode.
+        # key -> index in self.buffer
+        self.key_to_index: Dict[str, int] = {}
+        # keys whose values are integers, e.g., "frames"
+        self.int_keys = set()
+        self.buffer = None
+        # True if the values in the dict are older than the ones in self.buffer
+        self.stale = False
+
+    def __setitem__(self, key: str, value) -> None:
+        if self.device is None:
+            super(MetricsTracker, self).__setitem__(key, value)
+            return
+
+        if key not in self.key_to_index:
+            if self.buffer is None:
+                self.buffer = torch.zeros(16, dtype=torch.float64, device=self.device)
+            elif len(self.key_to_index) == self.buffer.numel():
+                self.buffer = torch.cat([self.buffer, torch.zeros_like(self.buffer)])
+            self.key_to_index[key] = len(self.key_to_index)
+            # The value in the dict is set by _materialize()
+            super(MetricsTracker, self).__setitem__(key, None)
+
+        if isinstance(value, torch.Tensor):
+            is_int = not value.is_floating_point()
+            value = value.detach().reshape(())
+        else:
+            is_int = isinstance(value, int)
+
+        if is_int:
+            self.int_keys.add(key)
+        else:
+            self.int_keys.discard(key)
+
+        # It does not wait for the device, even if value is a Python number
+        self.buffer[self.key_to_index[key]] = value
+        self.stale = True
+
+    def __getitem__(self, key: str):
+        self._materialize()
+        return super(MetricsTracker, self).__getitem__(key)
+
+    def items(self):
+        self._materialize()
+        return super(MetricsTracker, self).items()
+
+    def values(self):
+        self._materialize()
+        return super(MetricsTracker, self).values()
+
+    def get(self, key: str, default=None):
+        self._materialize()
+        return super(MetricsTracker, self).get(key, default)
+
+    def _materialize(self) -> None:
+        """Copy the values in the device-resident mode to the dict."""
+        if not self.stale:
+            return
+        self.stale = False
+        values = self.buffer[: len(self.key_to_index)].tolist()
+        for k, i in self.key_to_index.items():
+            v = int(values[i]) if k in self.int_keys else values[i]
+            super(MetricsTracker, self).__setitem__(k, v)
+
+    def _copy_to(self, ans: "MetricsTracker") -> None:
+        """Copy the values of self to an empty tracker in the device-resident mode."""
+        if self.device is None:
+            for k, v in self.items():
+                ans[k] = v
+            return
+        for k in self.key_to_index:
+            super(MetricsTracker, ans).__setitem__(k, None)
+        ans.key_to_index = dict(self.key_to_index)
+        ans.int_keys = set(self.int_keys)
+        if self.buffer is not None:
+            ans.buffer = self.buffer.clone()
+        ans.stale = True
+
+    def _add_on_device(self, other: "MetricsTracker") -> "MetricsTracker":
+        ans = MetricsTracker(self.device or other.device)
+        self._copy_to(ans)
+
+        if other.device is None:
+            items = [(k, v) for k, v in other.items() if v - v == 0]
+            for k, v in items:
+                if k not in ans.key_to_index:
+                    ans[k] = 0
+                ans.buffer[ans.key_to_index[k]] += v
+                if not isinstance(v, int):
+                    ans.int_keys.discard(k)
+            ans.stale = True
+            return ans
+
+        n = len(other.key_to_index)
+        if n == 0:
+            return ans
+        values = other.buffer[:n]
+        # Values that are inf or nan are not added, like in __add__()
+        values = torch.where(torch.isfinite(values), values, torch.zeros_like(values))
+
+        keys = list(other.key_to_index)
+        if keys == list(ans.key_to_index)[:n]:
+            # The keys are usually set in the same order for each batch, so
+            # the values can be added at once.
+            ans.buffer[:n] += values
+        else:
+            for k, i in other.key_to_index.items():
+                if k not in ans.key_to_index:
+                    ans[k] = 0
+                ans.buffer[ans.key_to_index[k]] += values[i]
+        for k in keys:
+            if k not in other.int_keys:
+                ans.int_keys.discard(k)
+        ans.stale = True
+        return ans
 
     def __add__(self, other: "MetricsTracker") -> "MetricsTracker":
+        if self.device is not None or other.device is not None:
+            return self._add_on_device(other)
+
         ans = MetricsTracker()
         for k, v in self.items():
             ans[k] = v
@@ -1164,6 +1304,15 @@ class MetricsTracker(collections.defaultdict):
         return ans
 
     def __mul__(self, alpha: float) -> "MetricsTracker":
+        if self.device is not None:
+            ans = MetricsTracker(self.device)
+            self._copy_to(ans)
+            if ans.buffer is not None:
+                ans.buffer *= alpha
+            if not isinstance(alpha, int):
+                ans.int_keys = set()
+            return ans
+
         ans = MetricsTracker()
         for k, v in self.items():
             ans[k] = v * alpha
@@ -1215,6 +1364,18 @@ class MetricsTracker(collections.defaultdict):
         all processes get the total.
         """
         keys = sorted(self.keys())
+        if self.device is not None:
+            if not keys:
+                return
+            # Read the values only once, after all_reduce()
+            s = torch.stack([self.buffer[self.key_to_index[k]] for k in keys])
+            dist.all_reduce(s, op=dist.ReduceOp.SUM)
+            for k, v in zip(keys, s):
+                self.buffer[self.key_to_index[k]] = v
+            self.int_keys = set()
+            self.stale = True
+            return
+
         s = torch.tensor([float(self[k]) for k in keys], device=device)
         dist.all_reduce(s, op=dist.ReduceOp.SUM)
         for k, v in zip(keys, s.cpu().tolist()):
@@ -2253,6 +2414,31 @@ def symlink_or_copy(exp_dir: Path, src: str, dst: str):
     os.close(dir_fd)
 
 
+def atomic_save(
+    obj: Any,
+    filename: Pathlike,
+    save: Callable[[Any, IO], None] = torch.save,
+    mode: str = "wb",
+) -> None:
+    """Save `obj` to `filename` with `save(obj, f)`, e.g., torch.save or
+    json.dump, where `f` is a file opened with `mode`.
+
+    The object is written to a temporary file in the same directory, which
+    is then renamed to `filename`, so that other processes reading
+    `filename` never see a partially written file.
+    """
+    filename = Path(filename)
+    tmp = filename.with_name(f"{filename.name}.tmp-{os.getpid()}")
+    try:
+        with open(tmp, mode) as f:
+            save(obj, f)
+        os.replace(tmp, filename)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+
+
 def num_tokens(
     token_table: k2.SymbolTable, disambig_pattern: str = re.compile(r"^#\d+$")
 ) -> int:
@@ -0,0 +1,261 @@
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compile the training graphs of CTC and MMI in the dataloader workers.
+
+The graph compilers, e.g., :class:`CtcTrainingGraphCompiler`, build the
+graphs of each batch from its transcripts. With a phone lexicon, this
+involves k2.intersect with L_inv and k2.compose with the CTC topology,
+which can take a noticeable part of each training step, and it is repeated
+for the same transcripts in every epoch.
+
+:class:`GraphCompilingDataset` moves this work to the dataloader workers.
+The compiled graphs of a batch are returned in `batch["graphs"]`, which
+:func:`get_compiled_graphs` converts back to an FsaVec in the main process.
+Optionally, the graph of each transcript is also saved to a directory and
+reused in later epochs and by later runs.
+
+Usage::
+
+    graph_compiler = CtcTrainingGraphCompiler(lexicon, device=device)
+    # The graphs are compiled on CPU in the workers
+    train = GraphCompilingDataset(
+        train,
+        CtcTrainingGraphCompiler(lexicon, device=torch.device("cpu")),
+        cache_dir="data/graph_cache",
+    )
+    ...
+    supervision_segments, texts = encode_supervisions(...)
+    decoding_graph = get_compiled_graphs(batch, texts, device)
+    if decoding_graph is None:
+        decoding_graph = graph_compiler.compile(texts)
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Any, List, Optional, Union
+
+import k2
+import torch
+
+from icefall.bpe_graph_compiler import BpeCtcTrainingGraphCompiler
+from icefall.graph_compiler import CtcTrainingGraphCompiler
+from icefall.mmi_graph_compiler import MmiTrainingGraphCompiler
+from icefall.utils import atomic_save
+
+
+def _update_hash_with_fsa(h: "hashlib._Hash", fsa: k2.Fsa) -> None:
+    h.update(fsa.arcs.values().cpu().numpy().tobytes())
+    if hasattr(fsa, "aux_labels"):
+        if isinstance(fsa.aux_labels, torch.Tensor):
+            h.update(fsa.aux_labels.cpu().numpy().tobytes())
+        else:
+            h.update(str(fsa.aux_labels).encode("utf-8"))
+
+
+def get_graph_compiler_hash(graph_compiler: Any) -> str:
+    """Return a hash of everything that the compiled graphs depend on, apart
+    from the transcripts, i.e., the type of the graph compiler, its FSAs,
+    e.g., L_inv and the CTC topology, and its mapping from words to IDs.
+    """
+    h = hashlib.sha1(type(graph_compiler).__name__.encode("utf-8"))
+
+    for name in ["L_inv", "ctc_topo", "ctc_topo_P"]:
+        fsa = getattr(graph_compiler, name, None)
+        if fsa is not None:
+            h.update(name.encode("utf-8"))
+            _update_hash_with_fsa(h, fsa)
+
+    if isinstance(graph_compiler, BpeCtcTrainingGraphCompiler):
+        h.update(graph_compiler.sp.serialized_model_proto())
+    elif isinstance(graph_compiler, MmiTrainingGraphCompiler):
+        h.update(str(graph_compiler.lexicon.word_table).encode("utf-8"))
+        h.update(str(graph_compiler.oov_id).encode("utf-8"))
+    else:
+        h.update(str(graph_compiler.word_table).encode("utf-8"))
+        h.update(str(graph_compiler.oov_id).encode("utf-8"))
+
+    return h.hexdigest()
+
+
+class TrainingGraphCache(object):
+    """An on-disk cache of the training graphs of transcripts.
+
+    Each graph is saved to its own file, whose name is a hash of the
+    transcript and of the graph compiler (see :func:`get_graph_compiler_hash`),
+    so that a changed lexicon or topology never reuses stale graphs. The files
+    can be shared by all dataloader workers and all ranks.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], graph_compiler_hash: str):
+        """
+        Args:
+          cache_dir:
+            The directory to save the graphs.
+          graph_compiler_hash:
+            It is returned by :func:`get_graph_compiler_hash`.
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.graph_compiler_hash = graph_compiler_hash
+
+    def get(self, text: str) -> Optional[k2.Fsa]:
+        """Return the graph of the given transcript, or None if it is not
+        cached."""
+        filename = self._filename(text)
+        if not filename.is_file():
+            return None
+        return k2.Fsa.from_dict(torch.load(filename, map_location="cpu"))
+
+    def put(self, text: str, graph: k2.Fsa) -> None:
+        filename = self._filename(text)
+        filename.parent.mkdir(exist_ok=True)
+        atomic_save(graph.as_dict(), filename)
+
+    def _filename(self, text: str) -> Path:
+        h = hashlib.sha1(self.graph_compiler_hash.encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        key = h.hexdigest()
+        return self.cache_dir / key[:2] / f"{key}.pt"
+
+
+class GraphCompilingDataset(torch.utils.data.Dataset):
+    """Wrap a dataset returning batches of `K2SpeechRecognitionDataset`
+    to compile the training graphs of `batch["supervisions"]["text"]`.
+
+    The graphs are saved in `batch["graphs"]` as the dict returned by
+    `k2.Fsa.as_dict()` of an FsaVec, whose i-th FSA is the graph of the
+    i-th supervision. Use :func:`get_compiled_graphs` to get them in the
+    order of the transcripts returned by `encode_supervisions()`.
+
+    The supported graph compilers are :class:`CtcTrainingGraphCompiler`,
+    :class:`BpeCtcTrainingGraphCompiler` and :class:`MmiTrainingGraphCompiler`.
+    For the latter, only the numerator graphs are compiled, since the
+    denominator graph is the same for all utterances.
+    """
+
+    def __init__(
+        self,
+        dataset: torch.utils.data.Dataset,
+        graph_compiler: Any,
+        cache_dir: Optional[Union[str, Path]] = None,
+    ):
+        """
+        Args:
+          dataset:
+            The dataset to wrap.
+          graph_compiler:
+            The graph compiler to use in the workers. It must be on CPU.
+          cache_dir:
+            If not None, the graph of each transcript is saved to this
+            directory and reused, see :class:`TrainingGraphCache`.
+        """
+        assert torch.device(graph_compiler.device).type == "cpu", (
+            "The graphs are compiled on CPU in the dataloader workers. "
+            f"Given: {graph_compiler.device}"
+        )
+        assert isinstance(
+            graph_compiler,
+            (
+                CtcTrainingGraphCompiler,
+                BpeCtcTrainingGraphCompiler,
+                MmiTrainingGraphCompiler,
+            ),
+        ), f"Unsupported type of graph compiler: {type(graph_compiler)}"
+
+        self.dataset = dataset
+        self.graph_compiler = graph_compiler
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = TrainingGraphCache(
+                cache_dir, get_graph_compiler_hash(graph_compiler)
+            )
+
+    def __getitem__(self, index: Any) -> dict:
+        batch = self.dataset[index]
+        batch["graphs"] = self.compile(batch["supervisions"]["text"]).as_dict()
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def compile(self, texts: List[str]) -> k2.Fsa:
+        """Return an FsaVec containing the graphs of the given transcripts."""
+        if self.cache is None:
+            return self._compile(texts)
+
+        graphs = {}
+        for text in texts:
+            if text not in graphs:
+                graph = self.cache.get(text)
+                if graph is not None:
+                    graphs[text] = graph
+
+        missing = [text for text in dict.fromkeys(texts) if text not in graphs]
+        if missing:
+            compiled = self._compile(missing)
+            for i, text in enumerate(missing):
+                graphs[text] = compiled[i]
+                self.cache.put(text, graphs[text])
+
+        return k2.create_fsa_vec([graphs[text] for text in texts])
+
+    def _compile(self, texts: List[str]) -> k2.Fsa:
+        graph_compiler = self.graph_compiler
+        if isinstance(graph_compiler, MmiTrainingGraphCompiler):
+            return graph_compiler.compile_num_graphs(texts)
+        elif isinstance(graph_compiler, BpeCtcTrainingGraphCompiler):
+            return graph_compiler.compile(graph_compiler.texts_to_ids(texts))
+        else:
+            return graph_compiler.compile(texts)
+
+
+def get_compiled_graphs(
+    batch: dict,
+    texts: List[str],
+    device: Union[str, torch.device],
+) -> Optional[k2.Fsa]:
+    """Return the graphs compiled by :class:`GraphCompilingDataset` for the
+    given transcripts, or None if the batch contains no compiled graphs.
+
+    Args:
+      batch:
+        A batch returned by :class:`GraphCompilingDataset`.
+      texts:
+        The transcripts of the batch in the order of the returned graphs,
+        e.g., the ones returned by `encode_supervisions()`, which sorts the
+        supervisions by duration.
+      device:
+        The device of the returned graphs.
+    Returns:
+      Return an FsaVec on the given device, whose i-th FSA is the graph of
+      `texts[i]`.
+    """
+    if "graphs" not in batch:
+        return None
+
+    graphs = k2.Fsa.from_dict(batch["graphs"])
+
+    # The graph of a supervision depends only on its transcript
+    text_to_index = {text: i for i, text in enumerate(batch["supervisions"]["text"])}
+    indexes = [text_to_index[text] for text in texts]
+    if indexes != list(range(graphs.shape[0])):
+        graphs = k2.index_fsa(graphs, torch.tensor(indexes, dtype=torch.int32))
+
+    return graphs.to(device)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pickle
+
+import pytest
+import torch
+
+from icefall.ali import (
+    AlignmentStore,
+    AlignmentWriter,
+    convert_alignments_to_tensor,
+    load_alignments,
+    lookup_alignments,
+)
+
+
+@pytest.fixture
+def alignments():
+    return {
+        "cut-2": [1, 3, 2],
+        "cut-1": [1, 0, 4, 2],
+        "cut-3": [],
+        "cut-0": [4, 4, 4, 4, 4, 1],
+    }
+
+
+def test_alignment_store(alignments, tmp_path):
+    ali_dir = tmp_path / "ali"
+    with AlignmentWriter(ali_dir, subsampling_factor=4) as writer:
+        for cut_id, ali in alignments.items():
+            writer.write(cut_id, ali)
+
+    subsampling_factor, store = load_alignments(ali_dir)
+    assert isinstance(store, AlignmentStore)
+    assert subsampling_factor == 4
+    assert len(store) == len(alignments)
+    assert "cut-1" in store
+    assert "cut-4" not in store
+    assert sorted(store.keys()) == sorted(alignments.keys())
+
+    for cut_id, ali in alignments.items():
+        assert store[cut_id].tolist() == ali
+
+    ali_tensor = convert_alignments_to_tensor(alignments, device="cpu")
+    cut_ids = ["cut-1", "cut-0", "cut-2", "cut-3"]
+    expected = lookup_alignments(cut_ids, ali_tensor, num_classes=5)
+    mask = lookup_alignments(cut_ids, store, num_classes=5)
+    assert torch.equal(mask, expected)
+
+    padded = store.get_padded(["cut-2", "cut-3"], padding_value=-1)
+    assert padded.tolist() == [[1, 3, 2], [-1, -1, -1]]
+
+    with pytest.raises(KeyError):
+        store.get_padded(["cut-1", "cut-4"])
+
+    # The memory-mapped files are opened again after pickling,
+    # e.g., in dataloader workers
+    store = pickle.loads(pickle.dumps(store))
+    assert store["cut-0"].tolist() == alignments["cut-0"]
+
+
+def test_alignment_writer_dtype(tmp_path):
+    with AlignmentWriter(tmp_path / "uint16", subsampling_factor=4) as writer:
+        with pytest.raises(ValueError):
+            writer.write("cut-0", [1, 2**16])
+
+    with AlignmentWriter(tmp_path / "int32", 4, dtype="int32") as writer:
+        writer.write("cut-0", [1, 2**16])
+    assert AlignmentStore(tmp_path / "int32")["cut-0"].tolist() == [1, 2**16]
@@ -20,7 +20,16 @@ import pytest
 import torch
 import torch.nn as nn
 
-from icefall.checkpoint import average_checkpoints, load_checkpoint, save_checkpoint
+from icefall.checkpoint import (
+    AsyncCheckpointWriter,
+    average_checkpoints,
+    average_checkpoints_with_averaged_model,
+    find_checkpoints,
+    load_checkpoint,
+    remove_checkpoints,
+    save_checkpoint,
+    save_checkpoint_with_global_batch_idx,
+)
 
 
 @pytest.fixture
@@ -61,3 +70,122 @@ def test_average_checkpoints(checkpoints1, checkpoints2):
     state_dict = average_checkpoints([checkpoints1, checkpoints2])
     assert torch.allclose(state_dict["p1"], torch.Tensor([30, 25.0]))
     assert torch.allclose(state_dict["p2"], torch.tensor([5, 51]))
+
+
+def test_average_checkpoints_num_threads(checkpoints1, checkpoints2):
+    filenames = [checkpoints1, checkpoints2, checkpoints1]
+    expected = average_checkpoints(filenames)
+    for num_threads in [1, 2, 4]:
+        state_dict = average_checkpoints(filenames, num_threads=num_threads)
+        assert torch.equal(state_dict["p1"], expected["p1"])
+        assert torch.equal(state_dict["p2"], expected["p2"])
+
+
+def test_average_checkpoints_shared_parameters(tmp_path):
+    filenames = []
+    for i in range(3):
+        m = nn.Module()
+        m.p1 = nn.Parameter(torch.tensor([1.0, 2.0]) * (i + 1))
+        m.p2 = m.p1
+        filenames.append(tmp_path / f"epoch-{i}.pt")
+        save_checkpoint(filenames[-1], m)
+
+    state_dict = average_checkpoints(filenames, num_threads=2)
+    assert torch.allclose(state_dict["p1"], torch.tensor([2.0, 4.0]))
+    assert state_dict["p1"].data_ptr() == state_dict["p2"].data_ptr()
+
+
+def test_average_checkpoints_cache(tmp_path, checkpoints1, checkpoints2):
+    cache_filename = tmp_path / "cache" / "averaged.pt"
+    filenames = [checkpoints1, checkpoints2]
+    expected = average_checkpoints(filenames, cache_filename=cache_filename)
+    assert cache_filename.is_file()
+
+    state_dict = average_checkpoints(filenames, cache_filename=cache_filename)
+    assert torch.equal(state_dict["p1"], expected["p1"])
+
+    # The cache is not used after a checkpoint is changed
+    m = nn.Module()
+    m.p1 = nn.Parameter(torch.tensor([0.0, 0.0]))
+    m.register_buffer("p2", torch.tensor([0, 0]))
+    save_checkpoint(checkpoints2, m)
+    state_dict = average_checkpoints(filenames, cache_filename=cache_filename)
+    assert torch.allclose(state_dict["p1"], torch.Tensor([5, 10.0]))
+
+
+def test_average_checkpoints_with_averaged_model(tmp_path):
+    filenames = []
+    for batch_idx_train, value in [(100, 1.0), (300, 3.0)]:
+        m = nn.Module()
+        m.p1 = nn.Parameter(torch.tensor([value]))
+        filenames.append(tmp_path / f"checkpoint-{batch_idx_train}.pt")
+        save_checkpoint(
+            filenames[-1], m, model_avg=m, params={"batch_idx_train": batch_idx_train}
+        )
+
+    for cache_filename in [None, tmp_path / "averaged.pt", tmp_path / "averaged.pt"]:
+        state_dict = average_checkpoints_with_averaged_model(
+            filename_start=filenames[0],
+            filename_end=filenames[1],
+            cache_filename=cache_filename,
+        )
+        # (3 * 300 - 1 * 100) / 200
+        assert torch.allclose(state_dict["p1"], torch.tensor([4.0]))
+
+
+def test_async_checkpoint_writer(tmp_path):
+    m = nn.Module()
+    m.p1 = nn.Parameter(torch.tensor([1.0, 2.0]))
+    m.p2 = m.p1
+    m_avg = nn.Module()
+    m_avg.p1 = nn.Parameter(torch.tensor([3.0, 4.0]))
+    optimizer = torch.optim.SGD(m.parameters(), lr=0.1, momentum=0.9)
+    m.p1.grad = torch.ones(2)
+    optimizer.step()
+
+    writer = AsyncCheckpointWriter()
+    for batch_idx in range(1, 5):
+        save_checkpoint_with_global_batch_idx(
+            out_dir=tmp_path,
+            global_batch_idx=batch_idx,
+            model=m,
+            model_avg=m_avg,
+            params={"batch_idx_train": batch_idx},
+            optimizer=optimizer,
+            writer=writer,
+        )
+        remove_checkpoints(out_dir=tmp_path, topk=2, writer=writer)
+        # The checkpoints contain the values at the time they are saved
+        with torch.no_grad():
+            m.p1 += 1
+            m_avg.p1 += 1
+    writer.close()
+
+    filenames = find_checkpoints(tmp_path)
+    assert [f.split("/")[-1] for f in filenames] == [
+        "checkpoint-4.pt",
+        "checkpoint-3.pt",
+    ]
+    assert sorted(f.name for f in tmp_path.iterdir()) == [
+        "checkpoint-3.pt",
+        "checkpoint-4.pt",
+    ]
+
+    new_m = nn.Module()
+    new_m.p1 = nn.Parameter(torch.zeros(2))
+    new_m.p2 = new_m.p1
+    new_m_avg = nn.Module()
+    new_m_avg.p1 = nn.Parameter(torch.zeros(2))
+    new_optimizer = torch.optim.SGD(new_m.parameters(), lr=0.1, momentum=0.9)
+    params = load_checkpoint(
+        filenames[0], new_m, model_avg=new_m_avg, optimizer=new_optimizer
+    )
+    assert params["batch_idx_train"] == 4
+    assert torch.allclose(new_m.p1, torch.tensor([3.9, 4.9]))
+    assert torch.allclose(new_m_avg.p1, torch.tensor([6.0, 7.0]))
+    assert torch.equal(
+        new_optimizer.state_dict()["state"][0]["momentum_buffer"], torch.ones(2)
+    )
+
+    checkpoint = torch.load(filenames[0])
+    assert checkpoint["model"]["p1"].data_ptr() == checkpoint["model"]["p2"].data_ptr()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Copyright      2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+
+import torch
+
+from icefall import CompiledContextGraph, ContextGraph
+
+
+def _build_graph() -> ContextGraph:
+    contexts_str = ["S", "HE", "SHE", "SHELL", "HIS", "HERS", "HELLO", "THIS", "THEM"]
+    context_graph = ContextGraph(context_score=1)
+    context_graph.build(
+        token_ids=[[ord(x) for x in s] for s in contexts_str],
+        phrases=contexts_str,
+        scores=[round(5 / len(s), 2) for s in contexts_str],
+    )
+    return context_graph
+
+
+def test_compiled_context_graph(tmp_path):
+    random.seed(20240101)
+    graph = _build_graph()
+    compiled = CompiledContextGraph.from_context_graph(graph)
+    assert compiled.num_nodes == graph.num_nodes + 1
+
+    compiled.save(str(tmp_path / "context_graph.pt"))
+    compiled = CompiledContextGraph.load(str(tmp_path / "context_graph.pt"))
+
+    queries = ["HEHERSHE", "HERSHE", "HISHE", "SHED", "SHELF", "HELLO", "DHRHISQ"]
+    queries += ["".join(random.choices("DEHILMORSTQ", k=20)) for _ in range(50)]
+
+    for strict_mode in [True, False]:
+        # Decode all queries in a batch
+        states = torch.zeros(len(queries), dtype=torch.int64)
+        expected_states = [graph.root] * len(queries)
+        for i in range(max(len(q) for q in queries)):
+            tokens = torch.tensor([ord(q[i % len(q)]) for q in queries])
+            scores, states, matched = compiled.forward_one_step(
+                states, tokens, strict_mode
+            )
+            for k, q in enumerate(queries):
+                score, state, matched_state = graph.forward_one_step(
+                    expected_states[k], ord(q[i % len(q)]), strict_mode
+                )
+                expected_states[k] = state
+                assert abs(scores[k].item() - score) < 1e-5, (scores[k], score)
+                assert states[k].item() == state.id
+                if matched_state is None:
+                    assert matched[k].item() == -1
+                else:
+                    assert matched[k].item() == matched_state.id
+
+            for k in range(len(queries)):
+                is_matched, matched_state = graph.is_matched(expected_states[k])
+                expected = matched_state.id if is_matched else -1
+                assert compiled.is_matched(states)[k].item() == expected
+
+        scores, states = compiled.finalize(states)
+        for k in range(len(queries)):
+            score, _ = graph.finalize(expected_states[k])
+            assert abs(scores[k].item() - score) < 1e-5
+        assert torch.all(states == 0)
+
+    # Tokens that are not in the graph
+    scores, states, matched = compiled.forward_one_step(
+        torch.tensor([0, 1]), torch.tensor([100000, -1])
+    )
+    assert torch.all(states == 0), states
+    assert torch.all(matched == -1), matched
+
+
+def test_load_or_build(tmp_path):
+    contexts_str = ["S", "HE", "SHE", "SHELL", "HIS", "HERS", "HELLO", "THIS", "THEM"]
+    token_ids = [[ord(x) for x in s] for s in contexts_str]
+    scores = [round(5 / len(s), 2) for s in contexts_str]
+    kwargs = dict(token_ids=token_ids, context_score=1, phrases=contexts_str)
+
+    expected = CompiledContextGraph.from_context_graph(_build_graph())
+    compiled = CompiledContextGraph.load_or_build(tmp_path, scores=scores, **kwargs)
+    assert len(list(tmp_path.glob("context-graph-*.pt"))) == 1
+
+    # Loaded from the cache
+    loaded = CompiledContextGraph.load_or_build(tmp_path, scores=scores, **kwargs)
+    for graph in [compiled, loaded]:
+        assert graph.phrases == expected.phrases
+        for k, v in expected._tensors().items():
+            assert torch.equal(graph._tensors()[k], v), k
+
+    # A new graph is built after the options are changed
+    CompiledContextGraph.load_or_build(tmp_path, **kwargs)
+    assert len(list(tmp_path.glob("context-graph-*.pt"))) == 2
@@ -24,7 +24,7 @@ You can run this file in one of the two ways:
 
 import k2
 
-from icefall.decode import Nbest
+from icefall.decode import Nbest, _get_splits, _intersect_with_G
 
 
 def test_nbest_from_lattice():
@@ -61,3 +61,91 @@ def test_nbest_from_lattice():
     argmax = tot_scores.argmax()
     best_path = k2.index_fsa(nbest2.fsa, argmax)
     print(best_path[0])
+
+    # The same result when the paths are intersected in batches
+    nbest3 = nbest.intersect(lattice, max_arcs=10)
+    assert k2.to_str_simple(nbest3.fsa) == k2.to_str_simple(nbest2.fsa)
+
+
+def test_intersect_with_G():
+    G = k2.Fsa.from_str(
+        """
+        0 0 1 -0.1
+        0 0 2 -0.2
+        0 1 -1 0
+        1
+    """
+    )
+    G = k2.add_epsilon_self_loops(k2.Fsa.from_fsas([G]))
+    G = k2.arc_sort(G)
+
+    # 3 arcs
+    small = k2.Fsa.from_str("0 1 1 -1.0\n1 2 2 -1.0\n2 3 -1 0\n3")
+    # 22 arcs, with many unlikely arcs
+    arcs = ["0 1 1 -0.1"]
+    arcs += [f"0 1 2 -{10 + i}" for i in range(20)]
+    arcs += ["1 2 -1 0", "2"]
+    large = k2.Fsa.from_str("\n".join(arcs))
+    inv_lattice = k2.arc_sort(k2.Fsa.from_fsas([small, large, small]))
+
+    expected, prune_th = _intersect_with_G(G, inv_lattice)
+    assert prune_th == [0, 0, 0]
+
+    lattice, prune_th = _intersect_with_G(G, inv_lattice, max_arcs=10)
+    # Only the lattice over the budget is pruned
+    assert prune_th[0] == 0 and prune_th[2] == 0
+    assert prune_th[1] > 0
+    assert lattice.shape[0] == 3
+
+    for i in [0, 2]:
+        assert k2.to_str_simple(lattice[i]) == k2.to_str_simple(expected[i])
+
+    # Pruning keeps the best path
+    best_path = k2.shortest_path(lattice, use_double_scores=True)
+    expected_best_path = k2.shortest_path(expected, use_double_scores=True)
+    assert k2.to_str_simple(best_path[1]) == k2.to_str_simple(expected_best_path[1])
+
+
+def test_get_splits():
+    assert _get_splits(5) == [(0, 5)]
+    assert _get_splits(5, batch_size=2) == [(0, 2), (2, 4), (4, 5)]
+
+    num_arcs = [3, 4, 10, 1, 2, 2]
+    assert _get_splits(6, num_arcs=num_arcs, max_arcs=7) == [
+        (0, 2),
+        (2, 3),
+        (3, 6),
+    ]
+    assert _get_splits(6, batch_size=2, num_arcs=num_arcs, max_arcs=7) == [
+        (0, 2),
+        (2, 3),
+        (3, 5),
+        (5, 6),
+    ]
+
+    # Paths of two lattices with 10 and 8 arcs. The arcs of a lattice are
+    # counted once per batch.
+    num_arcs = [1, 1, 1, 1, 1, 1]
+    a_indexes = [0, 0, 0, 1, 1, 1]
+    a_num_arcs = [10, 8]
+    assert _get_splits(
+        6,
+        num_arcs=num_arcs,
+        max_arcs=13,
+        a_indexes=a_indexes,
+        a_num_arcs=a_num_arcs,
+    ) == [(0, 3), (3, 6)]
+    assert _get_splits(
+        6,
+        num_arcs=num_arcs,
+        max_arcs=12,
+        a_indexes=a_indexes,
+        a_num_arcs=a_num_arcs,
+    ) == [(0, 2), (2, 3), (3, 6)]
+    assert _get_splits(
+        6,
+        num_arcs=num_arcs,
+        max_arcs=30,
+        a_indexes=a_indexes,
+        a_num_arcs=a_num_arcs,
+    ) == [(0, 6)]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import k2
+import pytest
+import torch
+
+from icefall.decoding_graph import GraphCache, compile_HLG, compile_LG, get_rescoring_G
+
+
+@pytest.fixture
+def lang_dir(tmp_path):
+    """
+    A lexicon with two words, each of which has a single token:
+
+        A a
+        B b
+    """
+    lang_dir = tmp_path / "lang"
+    lang_dir.mkdir()
+    (lang_dir / "tokens.txt").write_text("<eps> 0\na 1\nb 2\n#0 3\n")
+    (lang_dir / "words.txt").write_text("<eps> 0\nA 1\nB 2\n#0 3\n")
+
+    arcs = "0 0 1 1 0\n0 0 2 2 0\n"
+    L = k2.Fsa.from_str(f"{arcs}0 1 -1 -1 0\n1", num_aux_labels=1)
+    L_disambig = k2.Fsa.from_str(f"{arcs}0 0 3 3 0\n0 1 -1 -1 0\n1", num_aux_labels=1)
+    torch.save(L.as_dict(), lang_dir / "L.pt")
+    torch.save(L_disambig.as_dict(), lang_dir / "L_disambig.pt")
+    return lang_dir
+
+
+def write_G(filename, weight: float = 0.5):
+    # A 1-gram LM with a back-off arc, in OpenFst text format
+    filename.write_text(f"0 1 3 3 0.1\n1 0 1 1 {weight}\n1 0 2 2 1.0\n0 0.0\n")
+
+
+def _assert_same_fsas(a: k2.Fsa, b: k2.Fsa):
+    assert k2.to_str_simple(a) == k2.to_str_simple(b)
+
+
+def test_compile_LG(lang_dir, tmp_path):
+    lm_file = tmp_path / "G_1_gram.fst.txt"
+    write_G(lm_file)
+
+    expected = compile_LG(lang_dir, lm_file)
+    cache = GraphCache(tmp_path / "cache")
+    _assert_same_fsas(compile_LG(lang_dir, lm_file, cache), expected)
+    for name in ["L", "G", "LG", "det-LG"]:
+        assert len(list(cache.cache_dir.glob(f"{name}-*.pt"))) == 1, name
+
+    # Loaded from the cache
+    _assert_same_fsas(compile_LG(lang_dir, lm_file, cache), expected)
+
+    # Only the graphs depending on G are rebuilt after G is changed
+    write_G(lm_file, weight=0.25)
+    compile_LG(lang_dir, lm_file, cache)
+    assert len(list(cache.cache_dir.glob("L-*.pt"))) == 1
+    assert len(list(cache.cache_dir.glob("det-LG-*.pt"))) == 2
+
+    HLG = compile_HLG(lang_dir, lm_file, cache)
+    _assert_same_fsas(compile_HLG(lang_dir, lm_file), HLG)
+    assert len(list(cache.cache_dir.glob("HLG-*.pt"))) == 1
+
+
+def test_get_rescoring_G(tmp_path):
+    write_G(tmp_path / "G_1_gram.fst.txt")
+    cache = GraphCache(tmp_path / "cache")
+
+    G = get_rescoring_G(
+        tmp_path, "G_1_gram", first_word_disambig_id=3, device="cpu", cache=cache
+    )
+    assert G.shape[0] == 1
+    # The labels of the back-off arcs are set to 0
+    assert 3 not in G.labels.tolist()
+    assert torch.equal(G.lm_scores, G.scores)
+
+    G_eps = get_rescoring_G(
+        tmp_path,
+        "G_1_gram",
+        first_word_disambig_id=3,
+        device="cpu",
+        cache=cache,
+        add_epsilon_self_loops=True,
+    )
+    assert G_eps.num_arcs == G.num_arcs + 2
+
+    # Loaded from the cache
+    _assert_same_fsas(
+        get_rescoring_G(tmp_path, "G_1_gram", 3, device="cpu", cache=cache), G
+    )
+    assert len(list(cache.cache_dir.glob("rescoring-G-*.pt"))) == 2
+
+
+def test_file_hash(tmp_path):
+    cache = GraphCache(tmp_path / "cache")
+    a = tmp_path / "a.txt"
+    b = tmp_path / "b.txt"
+    a.write_text("a")
+    b.write_text("b")
+
+    hash_a = cache.file_hash(a)
+    hash_b = cache.file_hash(b)
+    assert hash_a != hash_b
+    # One entry per file, so that concurrent jobs do not overwrite each other
+    assert len(list((cache.cache_dir / "file_hashes").glob("*.json"))) == 2
+    assert cache.file_hash(a) == hash_a
+
+    a.write_text("aa")
+    assert cache.file_hash(a) != hash_a
+    assert cache.file_hash(b) == hash_b
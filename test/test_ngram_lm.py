@@ -15,6 +15,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
+
 import graphviz
 
 from icefall import is_module_available
@@ -24,11 +26,14 @@ if not is_module_available("kaldifst"):
 
 import kaldifst
 
-from icefall import NgramLm, NgramLmStateCost
-
+from icefall import (
+    CompiledNgramLm,
+    CompiledNgramLmStateCost,
+    NgramLm,
+    NgramLmStateCost,
+)
 
-def generate_fst(filename: str):
-    s = """
+FST_STR = """
 3	5	1	1	3.00464
 3	0	3	0	5.75646
 0	1	1	1	12.0533
@@ -42,7 +47,10 @@ def generate_fst(filename: str):
 5	4	2	2	0.804938
 5	1	3	0	9.67086
 """
-    fst = kaldifst.compile(s=s, acceptor=False)
+
+
+def generate_fst(filename: str):
+    fst = kaldifst.compile(s=FST_STR, acceptor=False)
     fst.write(filename)
     fst_dot = kaldifst.draw(fst, acceptor=False, portrait=True)
     source = graphviz.Source(fst_dot)
@@ -70,5 +78,73 @@ def main():
     print(s2.state_cost)
 
 
+def test_compiled_ngram_lm(tmp_path):
+    filename = str(tmp_path / "test.fst")
+    kaldifst.compile(s=FST_STR, acceptor=False).write(filename)
+    ngram_lm = NgramLm(filename, backoff_id=3, is_binary=True)
+
+    compiled = CompiledNgramLm.from_ngram_lm(ngram_lm)
+    compiled.save(str(tmp_path / "test.npz"))
+
+    for mmap in [True, False]:
+        loaded = CompiledNgramLm.load(str(tmp_path / "test.npz"), mmap=mmap)
+        assert loaded.backoff_id == 3
+        assert loaded.num_states == ngram_lm.num_states
+
+        states = [s for s in range(ngram_lm.num_states) for _ in range(4)]
+        labels = [1, 2, 4, 5] * ngram_lm.num_states
+        next_states, costs = loaded.batch_next_state(states, labels)
+        for s, label, ns, c in zip(states, labels, next_states, costs):
+            # Follow backoff arcs one by one until the label is accepted
+            expected_ns, expected_c = -1, float("inf")
+            cost = 0.0
+            while s is not None:
+                arc_ns, arc_c = ngram_lm._get_next_state_and_cost_without_backoff(
+                    s, label
+                )
+                if arc_ns is not None:
+                    expected_ns, expected_c = arc_ns, cost + arc_c
+                    break
+                s, backoff_c = ngram_lm._get_next_state_and_cost_without_backoff(
+                    s, ngram_lm.backoff_id
+                )
+                if s is not None:
+                    cost += backoff_c
+            assert ns == expected_ns, (ns, expected_ns)
+            assert math.isclose(c, expected_c, rel_tol=1e-5), (c, expected_c)
+
+
+def test_compiled_ngram_lm_state_cost(tmp_path):
+    filename = str(tmp_path / "test.fst")
+    kaldifst.compile(s=FST_STR, acceptor=False).write(filename)
+    ngram_lm = NgramLm(filename, backoff_id=3, is_binary=True)
+    compiled = CompiledNgramLm.from_ngram_lm(ngram_lm)
+
+    # All label sequences of length 3, advanced one step at a time in a batch
+    seqs = [[a, b, c] for a in [1, 2, 4] for b in [1, 2, 4] for c in [1, 2, 4]]
+    expected = [NgramLmStateCost(ngram_lm) for _ in seqs]
+    state_costs = [CompiledNgramLmStateCost(compiled) for _ in seqs]
+    for t in range(3):
+        labels = [seq[t] for seq in seqs]
+        expected = NgramLmStateCost.forward_one_step_batch(expected, labels)
+        state_costs = CompiledNgramLmStateCost.forward_one_step_batch(
+            state_costs, labels
+        )
+        for e, s in zip(expected, state_costs):
+            assert e.state_cost.keys() == s.state_cost.keys()
+            for state, cost in e.state_cost.items():
+                assert math.isclose(s.state_cost[state], cost, rel_tol=1e-5)
+            if math.isinf(e.lm_score):
+                assert e.lm_score == s.lm_score
+            else:
+                assert math.isclose(s.lm_score, e.lm_score, rel_tol=1e-5)
+
+    # The same as advancing them one by one
+    s = CompiledNgramLmStateCost(compiled)
+    for label in [1, 2, 4]:
+        s = s.forward_one_step(label)
+    assert s.state_cost == state_costs[seqs.index([1, 2, 4])].state_cost
+
+
 if __name__ == "__main__":
     main()
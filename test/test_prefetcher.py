@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List
+
+import torch
+
+from icefall import DevicePrefetcher, TokenizedDataset
+
+
+class _Dataset(torch.utils.data.Dataset):
+    """Return batches like K2SpeechRecognitionDataset."""
+
+    def __getitem__(self, i: int) -> dict:
+        return {
+            "inputs": torch.full((2, 5, 3), float(i)),
+            "supervisions": {
+                "text": [f"a{i}", "b c"],
+                "num_frames": torch.tensor([5, 4]),
+                "cut": ["cut-a", "cut-b"],
+            },
+        }
+
+    def __len__(self) -> int:
+        return 4
+
+
+class _Tokenizer:
+    def encode(self, texts: List[str], out_type=int) -> List[List[int]]:
+        return [[ord(c) for c in t] for t in texts]
+
+
+def _check_batches(batches: List[dict], device: torch.device):
+    assert len(batches) == 4
+    for i, batch in enumerate(batches):
+        assert batch["inputs"].device == device
+        assert torch.all(batch["inputs"] == i)
+        supervisions = batch["supervisions"]
+        assert supervisions["num_frames"].device == device
+        assert supervisions["num_frames"].tolist() == [5, 4]
+        assert supervisions["text"] == [f"a{i}", "b c"]
+        assert supervisions["cut"] == ["cut-a", "cut-b"]
+        assert supervisions["token_ids"] == [[97, 48 + i], [98, 32, 99]]
+
+
+def test_device_prefetcher():
+    dataset = TokenizedDataset(_Dataset(), _Tokenizer())
+    dl = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=2)
+
+    devices = [torch.device("cpu")]
+    if torch.cuda.is_available():
+        devices.append(torch.device("cuda", 0))
+
+    for device in devices:
+        prefetcher = DevicePrefetcher(dl, device)
+        assert len(prefetcher) == 4
+        _check_batches(list(prefetcher), device)
+        # It can be iterated again, e.g., for the next epoch
+        _check_batches(list(prefetcher), device)
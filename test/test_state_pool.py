@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from typing import List
+
+import torch
+
+from icefall import StatePool
+
+
+def _step(states: List[torch.Tensor], x: torch.Tensor) -> List[torch.Tensor]:
+    """A fake model, x is of shape (batch,)."""
+    return [
+        states[0] * 0.5 + x.view(1, -1, 1),
+        states[1] + x.to(torch.int32),
+    ]
+
+
+def test_state_pool():
+    random.seed(20240104)
+    torch.manual_seed(20240104)
+
+    init_states = [torch.zeros(3, 1, 2), torch.zeros(1, dtype=torch.int32)]
+    pool = StatePool(init_states, batch_dims=[1, 0], max_streams=4)
+
+    # Each stream is a list of [slot, states, number of remaining chunks]
+    streams = []
+    num_started = 0
+    while num_started < 20 or len(streams) > 0:
+        while num_started < 20 and pool.num_free_slots > 0 and random.random() < 0.5:
+            streams.append([pool.allocate(), init_states, random.randint(1, 5)])
+            num_started += 1
+        if len(streams) == 0:
+            continue
+
+        x = torch.rand(len(streams))
+        slots = [s[0] for s in streams]
+        states = pool.get_batch_states(slots)
+        for i, s in enumerate(streams):
+            actual = [t.narrow(d, i, 1) for t, d in zip(states, [1, 0])]
+            for a, b in zip(actual, s[1]):
+                assert torch.equal(a, b), (a, b)
+        pool.set_batch_states(slots, _step(states, x))
+
+        for i, s in enumerate(streams):
+            s[1] = _step(s[1], x[i : i + 1])
+            s[2] -= 1
+
+        for i in range(len(streams) - 1, -1, -1):
+            if streams[i][2] == 0:
+                for a, b in zip(pool.get_states(streams[i][0]), streams[i][1]):
+                    assert torch.equal(a, b), (a, b)
+                pool.free(streams[i][0])
+                del streams[i]
+
+    assert pool.num_free_slots == 4
+
+
+def test_state_pool_no_copy():
+    init_states = [torch.zeros(1, 5)]
+    pool = StatePool(init_states, batch_dims=[0], max_streams=2)
+    slots = [pool.allocate(), pool.allocate()]
+    states = pool.get_batch_states(slots)
+    new_states = [states[0] + 1]
+    pool.set_batch_states(slots, new_states)
+    # The set of streams is unchanged, so the states are returned as they are
+    assert pool.get_batch_states(slots)[0] is new_states[0]
+    assert pool.get_batch_states(slots[::-1])[0].sum() == 10
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+
+from icefall.transformer_lm.model import TransformerLM
+
+
+def _get_lm() -> TransformerLM:
+    torch.manual_seed(20240106)
+    lm = TransformerLM(
+        vocab_size=30,
+        embedding_dim=32,
+        d_model=32,
+        dim_feedforward=64,
+        nhead=4,
+        num_layers=3,
+    )
+    lm.eval()
+    return lm
+
+
+def _score_full(lm: TransformerLM, tokens: torch.Tensor) -> torch.Tensor:
+    """Score the next token by re-encoding the whole sequence."""
+    x = tokens.unsqueeze(0)
+    x_lens = torch.tensor([tokens.numel()])
+    logits = lm(x, x, x_lens, return_logits=True)
+    return logits[0, -1].log_softmax(-1)
+
+
+@torch.no_grad()
+def test_score_token():
+    lm = _get_lm()
+    x = torch.randint(1, 30, (3, 9))
+    x_lens = torch.tensor([9, 5, 7])
+    for i in range(3):
+        x[i, x_lens[i] :] = 0
+
+    scores, state = lm.score_token(x, x_lens)
+    for i in range(3):
+        expected = _score_full(lm, x[i, : x_lens[i]])
+        assert torch.allclose(scores[i], expected, atol=1e-5)
+
+    # Append one token at a time to the sequences of different lengths
+    new_tokens = torch.randint(1, 30, (3, 4))
+    for t in range(new_tokens.size(1)):
+        scores, state = lm.score_token(new_tokens[:, t : t + 1], None, state)
+        for i in range(3):
+            tokens = torch.cat([x[i, : x_lens[i]], new_tokens[i, : t + 1]])
+            expected = _score_full(lm, tokens)
+            assert torch.allclose(scores[i], expected, atol=1e-5)
+
+        # Split and stack the states, as in beam search
+        states = [lm.get_state(state, i) for i in range(3)]
+        assert states[1][0].size(1) == x_lens[1] + t + 1
+        state = lm.stack_states(states)
+
+
+@torch.no_grad()
+def test_select_states():
+    lm = _get_lm()
+    x = torch.tensor([[1, 5, 6, 0], [1, 7, 8, 9]])
+    x_lens = torch.tensor([3, 4])
+    _, state = lm.score_token(x, x_lens)
+
+    # The first hyp is dropped and the second one is duplicated
+    state = lm.select_states(state, torch.tensor([1, 1]))
+    scores, _ = lm.score_token(torch.tensor([[3], [4]]), None, state)
+    assert torch.allclose(
+        scores[0], _score_full(lm, torch.tensor([1, 7, 8, 9, 3])), atol=1e-5
+    )
+    assert torch.allclose(
+        scores[1], _score_full(lm, torch.tensor([1, 7, 8, 9, 4])), atol=1e-5
+    )
@@ -16,6 +16,8 @@
 # limitations under the License.
 
 
+import json
+
 import k2
 import pytest
 import torch
@@ -23,8 +25,10 @@ import torch
 from icefall.env import get_env_info
 from icefall.utils import (
     AttributeDict,
+    MetricsTracker,
     add_eos,
     add_sos,
+    atomic_save,
     encode_supervisions,
     get_texts,
     make_pad_mask,
@@ -163,3 +167,67 @@ def test_add_eos():
         [[1, 2, eos_id], [3, eos_id], [eos_id], [5, 8, 9, eos_id]]
     )
     assert str(ragged_eos) == str(expected)
+
+
+def _make_metrics(device, loss, frames):
+    info = MetricsTracker(device=device)
+    if device is None:
+        info["frames"] = frames
+        info["loss"] = loss
+        info["ctc_loss"] = loss / 2
+    else:
+        info["frames"] = torch.tensor(frames)
+        info["loss"] = torch.tensor(loss, dtype=torch.float64)
+        info["ctc_loss"] = torch.tensor(loss / 2, dtype=torch.float64)
+    return info
+
+
+def test_metrics_tracker_device_mode():
+    losses = [(120.5, 40), (float("inf"), 30), (98.25, 35), (float("nan"), 10)]
+    for device in [torch.device("cpu")] + (
+        [torch.device("cuda", 0)] if torch.cuda.is_available() else []
+    ):
+        expected = MetricsTracker()
+        tot = MetricsTracker(device=device)
+        for loss, frames in losses:
+            expected = expected * 0.5 + _make_metrics(None, loss, frames)
+            info = _make_metrics(device, loss, frames)
+            tot = tot * 0.5 + info
+            assert info["frames"] == frames
+            assert isinstance(info["frames"], int)
+            assert str(info) == str(_make_metrics(None, loss, frames))
+
+        assert str(tot) == str(expected)
+        assert tot.norm_items() == expected.norm_items()
+        assert sorted(tot.items()) == sorted(expected.items())
+
+        # Keys set in a different order
+        other = MetricsTracker(device=device)
+        other["loss"] = torch.tensor(1.0)
+        other["frames"] = torch.tensor(2)
+        host = MetricsTracker()
+        host["loss"] = 1.0
+        host["frames"] = 2
+        assert str(tot + other) == str(expected + host)
+        assert str(tot + host) == str(expected + host)
+        assert (other + other)["frames"] == 4
+
+
+def test_atomic_save(tmp_path):
+    filename = tmp_path / "a.pt"
+    atomic_save({"a": torch.arange(3)}, filename)
+    assert torch.load(filename)["a"].tolist() == [0, 1, 2]
+
+    atomic_save({"b": 1}, tmp_path / "b.json", save=json.dump, mode="w")
+    with open(tmp_path / "b.json") as f:
+        assert json.load(f) == {"b": 1}
+
+    def save(obj, f):
+        f.write(b"partial")
+        raise RuntimeError("failed")
+
+    # The existing file is kept and no temporary file is left
+    with pytest.raises(RuntimeError):
+        atomic_save(None, filename, save=save)
+    assert torch.load(filename)["a"].tolist() == [0, 1, 2]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["a.pt", "b.json"]
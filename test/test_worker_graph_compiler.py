@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Copyright    2024  Xiaomi Corp.
+#
+# See ../LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import re
+
+import k2
+import pytest
+import torch
+
+from icefall.graph_compiler import CtcTrainingGraphCompiler
+from icefall.lexicon import Lexicon
+from icefall.worker_graph_compiler import (
+    GraphCompilingDataset,
+    get_compiled_graphs,
+    get_graph_compiler_hash,
+)
+
+
+@pytest.fixture
+def lexicon():
+    """
+    The same lexicon as the one in test_graph_compiler.py, i.e.,
+
+        foo f o o
+        bar b a r
+        baz b a z
+        <UNK> SPN
+    """
+    L = k2.Fsa.from_str(
+        """
+        0 0 7 4 0
+        0 7 -1 -1 0
+        0 1 3 1 0
+        0 3 2 2 0
+        0 5 2 3 0
+        1 2 4 0 0
+        2 0 4 0 0
+        3 4 1 0 0
+        4 0 5 0 0
+        5 6 1 0 0
+        6 0 6 0 0
+        7
+    """,
+        num_aux_labels=1,
+    )
+    L.labels_sym = k2.SymbolTable.from_str(
+        """
+        a 1
+        b 2
+        f 3
+        o 4
+        r 5
+        z 6
+        SPN 7
+    """
+    )
+    L.aux_labels_sym = k2.SymbolTable.from_str(
+        """
+        foo 1
+        bar 2
+        baz 3
+        <UNK> 4
+    """
+    )
+    ans = Lexicon.__new__(Lexicon)
+    ans.token_table = L.labels_sym
+    ans.word_table = L.aux_labels_sym
+    ans.L_inv = k2.arc_sort(L.invert_())
+    ans.disambig_pattern = re.compile(r"^#\d+$")
+
+    return ans
+
+
+@pytest.fixture
+def compiler(lexicon):
+    return CtcTrainingGraphCompiler(lexicon, device=torch.device("cpu"))
+
+
+def _assert_same_graphs(a: k2.Fsa, b: k2.Fsa):
+    assert a.shape[0] == b.shape[0]
+    for i in range(a.shape[0]):
+        assert k2.to_str_simple(a[i]) == k2.to_str_simple(b[i])
+
+
+def test_graph_compiling_dataset(compiler, tmp_path):
+    texts = ["bar foo", "baz ok", "bar foo", "foo"]
+    dataset = {0: {"supervisions": {"text": texts}}}
+    expected = compiler.compile(texts)
+
+    for cache_dir in [None, tmp_path]:
+        graph_dataset = GraphCompilingDataset(dataset, compiler, cache_dir=cache_dir)
+        batch = graph_dataset[0]
+        graphs = get_compiled_graphs(batch, texts, device="cpu")
+        _assert_same_graphs(graphs, expected)
+
+    # One file per distinct transcript
+    assert len(list(tmp_path.glob("*/*.pt"))) == 3
+
+    # The graphs are read from the cache
+    graph_dataset = GraphCompilingDataset(dataset, compiler, cache_dir=tmp_path)
+    graph_dataset._compile = None
+    graphs = get_compiled_graphs(graph_dataset[0], texts, device="cpu")
+    _assert_same_graphs(graphs, expected)
+
+    # The graphs are reordered to match the given texts,
+    # e.g., the ones sorted by encode_supervisions()
+    sorted_texts = [texts[i] for i in [3, 1, 0, 2]]
+    graphs = get_compiled_graphs(batch, sorted_texts, device="cpu")
+    _assert_same_graphs(graphs, compiler.compile(sorted_texts))
+
+    assert get_compiled_graphs({"supervisions": {"text": texts}}, texts, "cpu") is None
+
+
+def test_graph_compiler_hash(lexicon, compiler):
+    assert get_graph_compiler_hash(compiler) == get_graph_compiler_hash(
+        CtcTrainingGraphCompiler(lexicon, device=torch.device("cpu"))
+    )
+    assert get_graph_compiler_hash(compiler) != get_graph_compiler_hash(
+        CtcTrainingGraphCompiler(lexicon, device=torch.device("cpu"), oov="foo")
+    )